@@ -1 +1,3 @@
-from .main_controller import MainController
\ No newline at end of file
+from .main_controller import MainController
+from .daemon import Daemon
+from .daemon import DaemonClient
\ No newline at end of file
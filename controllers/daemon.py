@@ -0,0 +1,343 @@
+import errno
+import io
+import json
+import os
+import selectors
+import socket
+import threading
+import time
+from ..models import LibraryWatcher
+from ..models import RetryQueue
+from ..models import mirror_diff
+
+class RequestOutput(io.TextIOBase):
+    def __init__(self, on_output=None):
+        #  What a request prints, kept for its response or passed to 'on_output' as it is printed
+        #  Text is passed on at the end of each line, including progress lines, which end with '\r'
+        self.on_output = on_output
+        self.output = io.StringIO()
+        self.pending = ''
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if self.on_output is None:
+            return self.output.write(text)
+        self.pending += text
+        end = max(self.pending.rfind('\n'), self.pending.rfind('\r')) + 1
+        if end > 0:
+            self.on_output(self.pending[:end])
+            self.pending = self.pending[end:]
+        return len(text)
+
+    def flush(self):
+        if self.on_output is not None and self.pending:
+            self.on_output(self.pending)
+            self.pending = ''
+
+    def getvalue(self):
+        #  Everything printed, or '' if it was passed to 'on_output'
+        self.flush()
+        return self.output.getvalue()
+
+class Daemon(object):
+    def __init__(self, load_controller, socket_path, background_hashing=True):
+        #  Description
+        #    Keep the mirrors loaded between scans, and serve requests on a Unix socket (see 'DaemonClient')
+        #  Implementation Notes
+        #    'load_controller' is called without arguments, and returns a MainController with its mirrors loaded
+        #    Libraries on local storage are watched with inotify; each changed directory is listed again before the
+        #    next request, so no request waits for the mirrors to load
+        #    Without inotify, every library is loaded again before each request, from its directory index
+        #    Requests run one at a time; what a request prints is returned to the client as its 'output',
+        #    or sent to the client line by line as it is printed, if the request asks for it with 'stream'
+        #    A request prints to its own output stream ('MainController.output'); sys.stdout is left alone, so
+        #    whatever else the process prints, such as loading the mirrors, goes to the daemon's own log
+        #    Checksums are pre-computed, and prior versions pruned, while no request is running
+
+        self.load_controller = load_controller
+        self.socket_path = socket_path
+        self.background_hashing = background_hashing
+        self.controller = None
+        self.watcher = None
+        self.listener = None
+        self.selector = None
+        self.stopping = False
+        self.request_lock = threading.Lock()  # Held while a request runs
+        self.watcher_lock = threading.Lock()  # Held while the watcher is read or replaced
+        self.loaded_time = None
+        self.output = None  # What the running request prints to; 'None' prints to sys.stdout
+
+        #  Counts of the last scan, as shown by the main menu; 'None' until a scan counts them
+        self.counts = {
+            'local_checksum_discrepancies': None,
+            'mirror_checksum_discrepancies': None,
+            'orphan_backup_media': None,
+            'empty_directories': None,
+            'backup_failures': None
+        }
+
+        self.commands = {
+            'status': self.status,
+            'scan': self.scan,
+            'backup': self.backup,
+            'report': self.report,
+            'reload': self.reload,
+            'stop': self.stop
+        }
+
+    def start(self):
+        #  Description
+        #    Load the mirrors, and listen on 'self.socket_path'
+        #  Guarantees
+        #    OSError is raised if another daemon is listening on the socket
+        #    A socket file left behind by a daemon that did not stop cleanly is replaced
+
+        if os.path.exists(self.socket_path):
+            try:
+                DaemonClient(self.socket_path).request('status')
+                raise OSError(errno.EADDRINUSE, 'A daemon is already listening', self.socket_path)
+            except ConnectionError:
+                os.remove(self.socket_path)
+        self.selector = selectors.DefaultSelector()
+        self.load()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.listener.listen()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.start_idle_work()
+
+    def serve_forever(self):
+        #  Accept connections, and read filesystem events between them, until a 'stop' request
+        try:
+            while not self.stopping:
+                for key, _ in self.selector.select(timeout=1):
+                    if key.fileobj is self.listener:
+                        connection, _ = self.listener.accept()
+                        threading.Thread(target=self.handle_connection, args=(connection,), daemon=True).start()
+                    else:
+                        with self.watcher_lock:
+                            if self.watcher is not None:
+                                self.watcher.read_changes()
+        finally:
+            self.close()
+
+    def close(self):
+        self.stop_idle_work()
+        if self.watcher is not None:
+            self.watcher.close()
+        self.selector.close()
+        if self.listener is not None:
+            self.listener.close()
+            os.remove(self.socket_path)
+            self.listener = None
+
+    def load(self):
+        #  Load the mirrors, and watch every library that can be watched
+        with self.watcher_lock:
+            if self.watcher is not None:
+                self.selector.unregister(self.watcher)
+                self.watcher.close()
+                self.watcher = None
+            self.controller = self.load_controller()
+            self.controller.output = self.output
+            self.loaded_time = time.time()
+            try:
+                self.watcher = LibraryWatcher(self.controller.get_all_libraries())
+            except OSError as error:
+                print('Libraries are not watched ({}); each request loads them again'.format(error), file=self.output)
+            if self.watcher is not None:
+                self.selector.register(self.watcher, selectors.EVENT_READ)
+
+    def refresh(self):
+        #  Description
+        #    Bring the loaded libraries up to date with the changes made since the last request
+        #  Guarantees
+        #    Only the changed directories are listed again (see 'Library.reload_directory')
+        #    Without a watcher, each library is loaded again; unchanged directories are not listed (see 'Library.load_all_media')
+
+        if self.watcher is None:
+            for library in self.controller.get_all_libraries():
+                library.load_all_media(None)
+            return
+        with self.watcher_lock:
+            self.watcher.read_changes()
+            changes = self.watcher.pop_changes()
+        for (library, directory_in_library), changed_names in sorted(changes.items(), key=lambda item: item[0][1]):
+            library.reload_directory(directory_in_library, changed_names)
+
+    def start_idle_work(self):
+        if self.background_hashing:
+            self.controller.start_background_hasher()
+        self.controller.start_version_pruner()
+
+    def stop_idle_work(self):
+        if self.controller is not None:
+            self.controller.stop_background_hasher()
+            self.controller.stop_version_pruner()
+
+    def handle_connection(self, connection):
+        #  Each line read is a JSON request; each response is written as one JSON line
+        #  A streamed request's output is written first, as one {'output': str} line for each line printed
+        with connection, connection.makefile('rwb') as stream:
+
+            def send(message):
+                stream.write(json.dumps(message).encode('utf-8') + b'\n')
+                stream.flush()
+
+            def send_output(text):
+                try:
+                    send({'output': text})
+                except OSError:
+                    pass  # The client went away; the request still runs to its end
+
+            for line in stream:
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                    if not isinstance(request, dict):
+                        raise ValueError('A request must be a JSON object')
+                    response = self.handle_request(request, send_output if request.get('stream') else None)
+                except ValueError as error:
+                    response = {'ok': False, 'error': 'Malformed request: {}'.format(error), 'output': ''}
+                try:
+                    send(response)
+                except OSError:
+                    return
+                if self.stopping:
+                    return
+
+    def handle_request(self, request, on_output=None):
+        #  Description
+        #    Run one request, as {'command': str, 'arguments': dict}
+        #  Guarantees
+        #    A dict is returned, with 'ok', 'output' (what the request printed) and either 'result' or 'error'
+        #    With 'on_output', what the request prints is passed to it as it is printed, and 'output' is ''
+
+        command = self.commands.get(request.get('command'))
+        if command is None:
+            return {'ok': False, 'error': 'Unknown command: {}'.format(request.get('command')), 'output': ''}
+        with self.request_lock:
+            self.stop_idle_work()
+            output = RequestOutput(on_output)
+            self.output = self.controller.output = output
+            try:
+                self.refresh()
+                result = command(**request.get('arguments', dict()))
+                response = {'ok': True, 'result': result, 'output': output.getvalue()}
+            except Exception as error:
+                response = {'ok': False, 'error': repr(error), 'output': output.getvalue()}
+            finally:
+                self.output = self.controller.output = None
+            if not self.stopping:
+                self.start_idle_work()
+        return response
+
+    def status(self):
+        libraries = []
+        watched_libraries = self.watcher.libraries if self.watcher is not None else []
+        for mirror in [self.controller.source_mirror] + self.controller.backup_mirrors:
+            for library_name, library in mirror.libraries.items():
+                libraries.append({
+                    'mirror_path': mirror.path,
+                    'library_name': library_name,
+                    'media_count': len(library.media),
+                    'watched': library in watched_libraries
+                })
+        return {
+            'pid': os.getpid(),
+            'loaded_seconds_ago': time.time() - self.loaded_time,
+            'libraries': libraries,
+            'counts': self.counts
+        }
+
+    def scan(self, kind='quick'):
+        #  A quick scan backs up new media from the loaded mirrors, so nothing is walked
+        if kind == 'quick':
+            self.controller.backup_new_source_media()
+        elif kind == 'regular':
+            self.controller.regular_scan()
+        elif kind == 'full':
+            self.controller.full_scan()
+        else:
+            raise ValueError('Unknown scan: {}'.format(kind))
+        self.counts['backup_failures'] = self.controller.get_backup_failure_count()
+        if kind != 'quick':
+            self.counts['local_checksum_discrepancies'] = len(self.controller.get_media_with_local_checksum_discrepancy())
+        differences = self.controller.get_mirror_differences([mirror_diff.DIFF_MISMATCH, mirror_diff.DIFF_ORPHAN])
+        self.counts['mirror_checksum_discrepancies'] = len([item for item in differences if item['status'] == mirror_diff.DIFF_MISMATCH])
+        self.counts['orphan_backup_media'] = len([item for item in differences if item['status'] == mirror_diff.DIFF_ORPHAN])
+        self.counts['empty_directories'] = self.controller.get_empty_directory_count()
+        return self.counts
+
+    def backup(self):
+        self.controller.backup_new_source_media()
+        self.counts['backup_failures'] = self.controller.get_backup_failure_count()
+        return self.counts
+
+    def report(self, name):
+        #  'backup' prints the report of the last backup; the others return a list of dicts
+        if name == 'backup':
+            if self.controller.backup_start_time is None:
+                print('No backup has run since the daemon started', file=self.output)
+            else:
+                self.controller.print_backup_report()
+                self.controller.print_failure_report()
+            return None
+        if name == 'failures':
+            retry_queue = RetryQueue()
+            retry_queue.load(self.controller.failure_report_file)
+            return retry_queue.get_failure_report()
+        if name == 'differences':
+            return self.controller.get_mirror_differences([mirror_diff.DIFF_NEW, mirror_diff.DIFF_MISMATCH, mirror_diff.DIFF_ORPHAN])
+        if name == 'local_checksum_discrepancies':
+            return self.controller.get_media_with_local_checksum_discrepancy()
+        raise ValueError('Unknown report: {}'.format(name))
+
+    def reload(self):
+        #  Reload the config and the mirrors
+        self.load()
+        return self.status()
+
+    def stop(self):
+        self.stopping = True
+        return None
+
+class DaemonClient(object):
+    def __init__(self, socket_path):
+        #  Description
+        #    Send requests to a Daemon listening on 'socket_path'
+        #  Implementation Notes
+        #    A request waits for as long as it runs; a scan may take hours, so its output can be streamed
+
+        self.socket_path = socket_path
+
+    def request(self, command, on_output=None, **arguments):
+        #  Description
+        #    Run one request in the daemon
+        #  Guarantees
+        #    The daemon's response is returned: a dict with 'ok', 'output' and either 'result' or 'error'
+        #    With 'on_output', what the request prints is passed to it while the request runs, and 'output' is ''
+        #    ConnectionError is raised if no daemon is listening
+
+        request = {'command': command, 'arguments': arguments}
+        if on_output is not None:
+            request['stream'] = True
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.connect(self.socket_path)
+                with connection.makefile('rwb') as stream:
+                    stream.write(json.dumps(request).encode('utf-8') + b'\n')
+                    stream.flush()
+                    while True:
+                        line = stream.readline()
+                        if not line:
+                            raise ConnectionResetError(errno.ECONNRESET, 'The daemon closed the connection', self.socket_path)
+                        response = json.loads(line.decode('utf-8'))
+                        if 'ok' in response:
+                            return response
+                        if on_output is not None:
+                            on_output(response['output'])
+        except FileNotFoundError as error:
+            raise ConnectionRefusedError(errno.ECONNREFUSED, 'No daemon is listening', self.socket_path) from error
@@ -1,19 +1,93 @@
+import os
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
+from ..models import BackgroundHasher
 from ..models import MediaFile
+from ..models import format_size
 from ..models import SourceMirror
 from ..models import BackupMirror
+from ..models import BackupQueue
+from ..models import ChangeDebouncer
+from ..models import LibraryWatcher
+from ..models import PackStorage
+from ..models import ParityStore
+from ..models import PollingWatcher
+from ..models import RenameIndex
+from ..models import RestoreJournal
+from ..models import RetryQueue
+from ..models import VersionPruner
+from ..models import VersionStore
+from ..models import capacity
+from ..models import discrepancy_rules
+from ..models import disk_layout
+from ..models import mirror_diff
+from ..models.result import Result
 
 class MainController(object):
-    def __init__(self, source_path, backup_path, libraries, stale_cache_days):
+    def __init__(self, source_path, backup_paths, libraries, stale_cache_days, throttles=None, retry_queue=None,
+                 when_full=capacity.WHEN_FULL_SUBSET, reserve_bytes=0, backup_queue=None, keep_versions=True,
+                 version_retention=None, storages=None, parity=None):
         self.source_path = source_path
-        self.backup_path = backup_path
+        self.backup_paths = backup_paths
+        self.throttles = throttles or dict()  # {'mirror_path': ThrottleObject}
+        self.storages = storages or dict()  # {'mirror_path': storage backend}; other mirrors are local (see 'storage')
         self.source_mirror = None
-        self.backup_mirror = None
+        self.backup_mirrors = []
         self.libraries = libraries
         self.stale_cache_days = stale_cache_days
 
+        #  Pre-computes checksums while the UI is idle (see 'start_background_hasher')
+        self.background_hasher = None
+
+        #  Per-mirror backup progress, as {'mirror_path': {'copied': int, 'retried': int, 'copy_methods': {}}}
+        self.backup_report = dict()
+
+        #  Failed backups are retried with backoff; whatever still fails is saved for a later re-run
+        self.retry_queue = retry_queue if retry_queue is not None else RetryQueue()
+        self.failure_report_file = os.path.join(source_path, '.cache', 'backup_failures.json')
+
+        #  What to do when a backup mirror cannot hold every new media file (see 'plan_backup_capacity')
+        self.when_full = when_full
+        self.reserve_bytes = reserve_bytes  # Free space to leave on each backup mirror
+        self.backup_start_time = None
+
+        #  The order new media is backed up in, and an optional time budget (see 'BackupQueue')
+        self.backup_queue = backup_queue if backup_queue is not None else BackupQueue()
+
+        #  Overwritten backup media is kept as a prior version, pruned by 'version_retention' (see 'VersionStore')
+        #  'version_retention' is a dict of {'max_versions': int, 'max_age_days': float}
+        self.keep_versions = keep_versions
+        self.version_retention = version_retention or dict()
+        self.version_pruner = None
+
+        #  Backed up media gets parity to repair bit rot from, if 'parity' settings are given (see 'ParityStore')
+        #  'parity' is a dict of {'block_size': int, 'data_blocks': int, 'parity_blocks': int, 'workers': int}
+        self.parity_store = ParityStore(**parity) if parity is not None else None
+
+        #  Where progress and reports are printed; 'None' prints to sys.stdout (see 'Daemon.handle_request')
+        self.output = None
+
+    @property
+    def backup_mirror(self):
+        #  The first backup mirror is the primary mirror
+        #  It is used when restoring source files from backup
+        return self.backup_mirrors[0] if len(self.backup_mirrors) > 0 else None
+
+    def get_backup_mirror(self, mirror_path):
+        for backup_mirror in self.backup_mirrors:
+            if backup_mirror.path == mirror_path:
+                return backup_mirror
+        raise KeyError('Backup mirror is not loaded: {}'.format(mirror_path))
+
+    def get_all_libraries(self):
+        #  All loaded libraries, source first, then each backup mirror in order
+        all_libraries = list(self.source_mirror.libraries.values())
+        for backup_mirror in self.backup_mirrors:
+            all_libraries += list(backup_mirror.libraries.values())
+        return all_libraries
+
     def require_mirrors_are_loaded(function):
         #  Decorator to ensure mirrors are loaded
         #  Ignore pylint errors
@@ -34,99 +108,579 @@ class MainController(object):
         return function_wrapper
 
     def quick_scan(self):
-        self.backup_new_source_media()
+        self.stream_backup_new_source_media()
 
     def regular_scan(self):
         self.backup_new_source_media()
-        print('')
+        print('', file=self.output)
         self.refresh_stale_cache_files(self.stale_cache_days)
-        print('')
+        print('', file=self.output)
         self.delete_orphan_cache_files()
+        self.compact_backup_packs()
 
     def full_scan(self):
         self.backup_new_source_media()
-        print('')
+        print('', file=self.output)
         self.refresh_stale_cache_files(-1)
-        print('')
+        print('', file=self.output)
         self.delete_orphan_cache_files()
+        self.compact_backup_packs()
 
-    def load_mirrors(self):
-        self.load_mirror(is_source=True, mirror_path=self.source_path)
-        self.load_mirror(is_source=False, mirror_path=self.backup_path)
-        print('')
+    def load_mirrors(self, load_media=True, restore=False):
+        #  With 'load_media' False, only the mirror and library objects are loaded
+        #  Streaming methods walk the libraries themselves (see 'stream_backup_new_source_media')
+        #  With 'restore', missing source libraries are made, so they can be restored (see 'plan_restore')
+        self.backup_mirrors = []
+        self.load_mirror(is_source=True, mirror_path=self.source_path, load_media=load_media, restore=restore)
+        for backup_path in self.backup_paths:
+            self.load_mirror(is_source=False, mirror_path=backup_path, load_media=load_media)
+        print('', file=self.output)
 
-    def load_mirror(self, is_source, mirror_path):
+    def load_mirror(self, is_source, mirror_path, load_media=True, restore=False):
         if is_source:
-            self.source_mirror = SourceMirror(mirror_path)
+            self.source_mirror = SourceMirror(
+                mirror_path,
+                throttle=self.throttles.get(mirror_path),
+                storage=self.storages.get(mirror_path)
+            )
             mirror = self.source_mirror
         else:
-            self.backup_mirror = BackupMirror(mirror_path)
-            mirror = self.backup_mirror
+            version_store = None
+            if self.keep_versions:
+                version_store = VersionStore(mirror_path, storage=self.storages.get(mirror_path), **self.version_retention)
+            mirror = BackupMirror(
+                mirror_path,
+                throttle=self.throttles.get(mirror_path),
+                version_store=version_store,
+                storage=self.storages.get(mirror_path),
+                parity_store=self.parity_store
+            )
+            self.backup_mirrors.append(mirror)
 
         for library_name in self.libraries:
-            mirror.load_library(library_name)
+            mirror.load_library(library_name, restore=restore)
+            if not load_media:
+                continue
             self.on_load_library_progress(
                 mirror_is_source=is_source,
                 library_name=library_name,
                 current_media_count=0
             )
             mirror.libraries[library_name].load_all_media(self.on_load_library_progress)
-            print('')
+            print('', file=self.output)
 
     def on_load_library_progress(self, mirror_is_source, library_name, current_media_count):
         print('Loading {0} library "{1}":  {2}'.format(
             'source' if mirror_is_source else 'backup',
             library_name,
             current_media_count
-        ), end='\r')
+        ), end='\r', file=self.output)
+
+    def reset_backup_report(self):
+        self.backup_start_time = time.time()
+        self.backup_report = {
+            backup_mirror.path: {
+                'copied': 0,
+                'retried': 0,
+                'skipped': 0,  # Not copied for lack of space
+                'deferred': 0,  # Not copied within the time budget
+                'bytes': 0,
+                'seconds': 0.0,  # Spent copying to the mirror; planning, retry backoff and parity are not counted
+                'copy_methods': dict(),
+                'extents': []
+            }
+            for backup_mirror in self.backup_mirrors
+        }
+
+    @require_mirrors_are_loaded
+    def plan_backup_capacity(self):
+        #  Description
+        #    Check that each backup mirror has room for the new source media, before anything is copied
+        #  Requires
+        #    Media must be loaded in each mirror
+        #  Guarantees
+        #    A list of dicts is returned, one for each backup mirror, with:
+        #      'mirror_path', 'required_bytes', 'available_bytes' and 'fits'
+        #      'selected', a dict of {'backup library path': set(paths_in_library)} to copy to the mirror
+        #      'selected_count', 'selected_bytes', 'skipped_count' and 'skipped_bytes'
+        #      'projected_seconds', from the throughput of the last backup, or 'None' if it was not measured
+        #    If a mirror is too small, 'self.when_full' either selects nothing or as many files as fit, in queue order
+        #    Nothing is copied
+
+        plan = []
+        for backup_mirror in self.backup_mirrors:
+            media_by_library = []
+            for library_name in self.libraries:
+                source_library = self.source_mirror.libraries[library_name]
+                backup_library = backup_mirror.libraries[library_name]
+                media_by_library.append((library_name, {
+                    path_in_library: source_library.media[path_in_library]
+                    for path_in_library in source_library.get_media_to_backup([backup_library])
+                }))
+            items = []
+            for library_name, path_in_library in self.backup_queue.order(media_by_library):
+                backup_library = backup_mirror.libraries[library_name]
+                media = self.source_mirror.libraries[library_name].media[path_in_library]
+                items.append(((backup_library.path, path_in_library), media.real_size))
+            sizes = dict(items)
+            required_bytes = sum(capacity.get_required_bytes(size) for item, size in items)
+            available_bytes = capacity.get_available_bytes(backup_mirror.path, self.reserve_bytes, backup_mirror.storage)
+            fits = required_bytes <= available_bytes
+            if fits:
+                selected, skipped = [item for item, size in items], []
+            elif self.when_full == capacity.WHEN_FULL_ABORT:
+                selected, skipped = [], [item for item, size in items]
+            else:
+                selected, skipped = capacity.select_to_fit(items, available_bytes)
+            selected_bytes = sum(sizes[item] for item in selected)
+            bytes_per_second = capacity.load_throughput(backup_mirror.path, backup_mirror.storage)
+            selected_media = {backup_mirror.libraries[library_name].path: set() for library_name in self.libraries}
+            for library_path, path_in_library in selected:
+                selected_media[library_path].add(path_in_library)
+            plan.append({
+                'mirror_path': backup_mirror.path,
+                'required_bytes': required_bytes,
+                'available_bytes': available_bytes,
+                'fits': fits,
+                'selected': selected_media,
+                'selected_count': len(selected),
+                'selected_bytes': selected_bytes,
+                'skipped_count': len(skipped),
+                'skipped_bytes': sum(sizes[item] for item in skipped),
+                'projected_seconds': selected_bytes / bytes_per_second if bytes_per_second else None
+            })
+        return plan
+
+    def print_backup_capacity_plan(self, plan):
+        for item in plan:
+            print('Backup mirror "{0}": {1} needed, {2} available'.format(
+                item['mirror_path'],
+                format_size(item['required_bytes']),
+                format_size(item['available_bytes'])
+            ), file=self.output)
+            if not item['fits']:
+                if item['selected_count'] == 0:
+                    print(' > Not enough space; nothing will be copied to this mirror', file=self.output)
+                else:
+                    print(' > Not enough space; {0} files ({1}) will be copied, {2} files ({3}) skipped'.format(
+                        item['selected_count'],
+                        format_size(item['selected_bytes']),
+                        item['skipped_count'],
+                        format_size(item['skipped_bytes'])
+                    ), file=self.output)
+            if item['projected_seconds'] is not None and item['selected_count'] > 0:
+                print(' > Projected duration: {0}, at the throughput measured by the last backup'.format(
+                    capacity.format_duration(item['projected_seconds'])
+                ), file=self.output)
 
     @require_mirrors_are_loaded
     def backup_new_source_media(self):
+        self.reset_backup_report()
+
+        #  Check every backup mirror has room before copying anything
+        capacity_plan = self.plan_backup_capacity()
+        self.print_backup_capacity_plan(capacity_plan)
+        selected_media = None
+        if not all(item['fits'] for item in capacity_plan):
+            selected_media = dict()
+            for item in capacity_plan:
+                selected_media.update(item['selected'])
+                self.backup_report[item['mirror_path']]['skipped'] += item['skipped_count']
+        print('', file=self.output)
+
+        #  Queue the new media of every library, in 'self.backup_queue' order
+        #  Each new source file is read once and written to every backup mirror that is missing it
+        targets = dict()
+        media_by_library = []
         for library_name in self.libraries:
-            #  Have the backup mirror scan the source mirror for new media files
-            #  The backup mirror will copy over any new media files
-            self.backup_mirror.libraries[library_name].backup_new_media(
-                source_library=self.source_mirror.libraries[library_name],
-                callback_on_start=self.on_backup_start,
-                callback_on_progress=self.on_backup_progress,
-                callback_on_error=self.on_backup_error
-            )
+            source_library = self.source_mirror.libraries[library_name]
+            backup_libraries = [backup_mirror.libraries[library_name] for backup_mirror in self.backup_mirrors]
+            targets[library_name] = source_library.get_media_to_backup(backup_libraries, selected_media)
+            media_by_library.append((library_name, {
+                path_in_library: source_library.media[path_in_library] for path_in_library in targets[library_name]
+            }))
+            self.on_backup_start(len(targets[library_name]), library_name)
+        queue = self.backup_queue.order(media_by_library)
+
+        self.backup_queue.start()
+        for index, (library_name, path_in_library) in enumerate(queue):
+            source_library = self.source_mirror.libraries[library_name]
+            source_media = source_library.media[path_in_library]
+            target_libraries = targets[library_name][path_in_library]
+            if not self.backup_queue.has_time_for(source_media.real_size, self.get_backup_throughput(target_libraries)):
+                for backup_library in target_libraries:
+                    self.backup_report[os.path.dirname(backup_library.path)]['deferred'] += 1
+                continue
+            self.on_backup_progress(len(queue), index + 1, path_in_library, library_name)
+            copy_results = self.backup_media(source_library, source_media, target_libraries)
+            for backup_library, copy_result in zip(target_libraries, copy_results):
+                mirror_path = os.path.dirname(backup_library.path)
+                self.on_backup_result(path_in_library, library_name, mirror_path, copy_result)
+                if not copy_result.success:
+                    self.on_backup_error(path_in_library, library_name, copy_result.message, mirror_path)
+        self.finish_backup()
+
+    def backup_media(self, source_library, source_media, backup_libraries):
+        #  Copy a source media file to 'backup_libraries' (see 'Library.backup_media'), and add the time it took
+        #  to each mirror's copy seconds, which its throughput is measured by
+        start_time = time.monotonic()
+        copy_results = source_library.backup_media(source_media, backup_libraries)
+        seconds = time.monotonic() - start_time
+        for backup_library in backup_libraries:
+            self.backup_report[os.path.dirname(backup_library.path)]['seconds'] += seconds
+        return copy_results
+
+    def get_backup_throughput(self, backup_libraries):
+        #  Description
+        #    Estimate the throughput of a copy to 'backup_libraries', in bytes per second
+        #  Guarantees
+        #    The slowest mirror's throughput so far in this run is used, or else its throughput in the last run
+        #    'None' is returned if no mirror's throughput is known
+
+        estimates = []
+        for backup_library in backup_libraries:
+            mirror_path = os.path.dirname(backup_library.path)
+            counts = self.backup_report[mirror_path]
+            if counts['bytes'] > 0 and counts['seconds'] > 0:
+                estimates.append(counts['bytes'] / counts['seconds'])
+            else:
+                estimates.append(capacity.load_throughput(mirror_path, backup_library.storage))
+        if None in estimates or len(estimates) == 0:
+            return None
+        return min(estimates)
+
+    @require_mirrors_are_loaded
+    def stream_backup_new_source_media(self):
+        #  Back up new source media while the mirrors are being walked
+        #  The first copy starts as soon as the first new file is found, and 'Library.media' is not populated
+        #  The total size is not known in advance, so free space is checked before each copy instead
+        #  When full, a mirror in 'abort' mode gets no more copies; the rest of its new media is skipped
+        #  Media is copied in walk order, within the time budget of 'self.backup_queue'
+        self.reset_backup_report()
+        self.backup_queue.start()
+        full_mirror_paths = set()
+        for library_name in self.libraries:
+            source_library = self.source_mirror.libraries[library_name]
+            backup_libraries = [backup_mirror.libraries[library_name] for backup_mirror in self.backup_mirrors]
+            file_number = 0
+            for path_in_library, media in mirror_diff.merge_libraries([source_library] + backup_libraries):
+                source_media = media[0]
+                target_libraries = [
+                    backup_library for backup_library, backup_media in zip(backup_libraries, media[1:])
+                    if backup_media is None
+                ]
+                if source_media is None or len(target_libraries) == 0:
+                    continue
+                for backup_library in list(target_libraries):
+                    mirror_path = os.path.dirname(backup_library.path)
+                    if mirror_path not in full_mirror_paths:
+                        available_bytes = capacity.get_available_bytes(mirror_path, self.reserve_bytes, backup_library.storage)
+                        if capacity.get_required_bytes(source_media.real_size) <= available_bytes:
+                            continue
+                        if self.when_full == capacity.WHEN_FULL_ABORT:
+                            full_mirror_paths.add(mirror_path)
+                    target_libraries.remove(backup_library)
+                    self.backup_report[mirror_path]['skipped'] += 1
+                if len(target_libraries) == 0:
+                    continue
+                if not self.backup_queue.has_time_for(source_media.real_size, self.get_backup_throughput(target_libraries)):
+                    for backup_library in target_libraries:
+                        self.backup_report[os.path.dirname(backup_library.path)]['deferred'] += 1
+                    continue
+                file_number += 1
+                self.on_backup_progress(
+                    total_files_to_backup=None,
+                    file_number=file_number,
+                    file_name=path_in_library,
+                    library_name=library_name
+                )
+                copy_results = self.backup_media(source_library, source_media, target_libraries)
+                for backup_library, copy_result in zip(target_libraries, copy_results):
+                    mirror_path = os.path.dirname(backup_library.path)
+                    self.on_backup_result(path_in_library, library_name, mirror_path, copy_result)
+                    if not copy_result.success:
+                        self.on_backup_error(path_in_library, library_name, copy_result.message, mirror_path)
+            print('{0} new media files backed up in library "{1}"'.format(file_number, library_name), file=self.output)
+        self.finish_backup()
+
+    @require_mirrors_are_loaded
+    def watch_new_source_media(self, settle_seconds=5.0, poll_interval_seconds=10.0, polling=False, stop_event=None):
+        #  Description
+        #    Back up new source media as it arrives, until 'stop_event' is set
+        #  Guarantees
+        #    The source libraries are watched with inotify, or polled every 'poll_interval_seconds' where it is not available
+        #    A new file is backed up once it is closed and has not changed for 'settle_seconds' (see 'ChangeDebouncer')
+        #    Only the directories that changed are listed; the libraries are not walked again
+        #  Implementation Notes
+        #    Media does not need to be loaded; an unloaded source library is walked once, to find its directories
+        #    'polling' polls even where inotify is available, e.g. for a network share changed by other machines
+
+        source_libraries = [self.source_mirror.libraries[library_name] for library_name in self.libraries]
+        watcher = None
+        if not polling:
+            try:
+                watcher = LibraryWatcher(source_libraries)
+            except OSError as error:
+                print('inotify is not available ({}); polling instead'.format(error), file=self.output)
+        if watcher is None:
+            watcher = PollingWatcher(source_libraries, poll_interval_seconds)
+        debouncer = ChangeDebouncer(settle_seconds)
+        print('Watching the source libraries for new media', file=self.output)
+        try:
+            while stop_event is None or not stop_event.is_set():
+                watcher.read_changes(timeout=min(settle_seconds, 1.0))
+                changes = watcher.pop_changes()
+                for (library, directory_in_library), changed_names in sorted(changes.items(), key=lambda item: item[0][1]):
+                    for path_in_library in library.reload_directory(directory_in_library, changed_names):
+                        debouncer.add(library, path_in_library)
+                changed_media = dict()
+                for library, path_in_library in debouncer.pop_settled(watcher.is_open):
+                    changed_media.setdefault(library.name, []).append(path_in_library)
+                if changed_media:
+                    self.backup_changed_source_media(changed_media)
+                    print('', file=self.output)
+        finally:
+            watcher.close()
+
+    @require_mirrors_are_loaded
+    def backup_changed_source_media(self, changed_media):
+        #  Description
+        #    Back up the named source media to each backup mirror that is missing it
+        #  Requires
+        #    'changed_media' is a dict of {'library_name': [paths_in_library]}
+        #  Guarantees
+        #    Only the named media is checked; no library is walked, and libraries do not need to be loaded
+        #    A source file that was backed up gets a cache file, from the checksum computed while copying
+        #    Media already in a backup mirror is left alone; a changed file is a mirror checksum discrepancy
+        #    Failures are retried and reported as by any backup (see 'finish_backup')
+
+        self.reset_backup_report()
+        self.backup_queue.start()
+        for library_name in self.libraries:
+            if library_name not in changed_media:
+                continue
+            source_library = self.source_mirror.libraries[library_name]
+            backup_libraries = [backup_mirror.libraries[library_name] for backup_mirror in self.backup_mirrors]
+            targets = source_library.get_media_to_backup(backup_libraries, paths_in_library=changed_media[library_name])
+            for index, path_in_library in enumerate(sorted(targets, key=mirror_diff.get_sort_key)):
+                source_media = source_library.get_media(path_in_library)
+                target_libraries = targets[path_in_library]
+                self.on_backup_progress(len(targets), index + 1, path_in_library, library_name)
+                copy_results = self.backup_media(source_library, source_media, target_libraries)
+                for backup_library, copy_result in zip(target_libraries, copy_results):
+                    mirror_path = os.path.dirname(backup_library.path)
+                    self.on_backup_result(path_in_library, library_name, mirror_path, copy_result)
+                    if not copy_result.success:
+                        self.on_backup_error(path_in_library, library_name, copy_result.message, mirror_path)
+                if any(copy_result.success for copy_result in copy_results):
+                    source_media.save_cache_file(overwrite=False)
+        self.finish_backup()
+
+    def finish_backup(self):
+        #  Retry the failures of this run, then save and print whatever still fails
+        #  The throughput of the run's copies is saved for the next run's projected duration
+        self.retry_failed_backups()
+        self.retry_queue.save(self.failure_report_file)
+        if self.parity_store is not None:
+            self.parity_store.close()
+        for mirror_path, counts in self.backup_report.items():
+            capacity.save_throughput(mirror_path, counts['bytes'], counts['seconds'], self.get_backup_mirror(mirror_path).storage)
+        self.print_backup_report()
+        self.print_failure_report()
+
+    @require_mirrors_are_loaded
+    def retry_failed_backups(self):
+        #  Description
+        #    Retry failed backups until each succeeds or runs out of attempts
+        #  Guarantees
+        #    Each retry waits for its backoff; other due retries run in the meantime
+        #    Successful retries are removed from 'self.retry_queue'
+        #    Failures of a library or mirror that is no longer in the config are dropped, as they can not be retried
+        #    No wait or retry runs past the run's time budget (see 'BackupQueue'); what is left stays in 'self.retry_queue'
+        #  Implementation Notes
+        #    A source file is read from the disc if its library's media is not loaded (see 'Library.get_media')
+
+        while True:
+            next_attempt_time = self.retry_queue.get_next_attempt_time()
+            if next_attempt_time is None:
+                return
+            delay = next_attempt_time - time.time()
+            remaining_seconds = self.backup_queue.get_remaining_seconds()
+            if remaining_seconds is not None and delay >= remaining_seconds:
+                break
+            if delay > 0:
+                print('Retrying {0} failed backups in {1:.0f} seconds'.format(len(self.retry_queue.get_pending()), delay), file=self.output)
+                time.sleep(delay)
+            if not self.retry_due_backups():
+                break
+        print('Leaving {} failed backups for the next run; the time budget is spent'.format(len(self.retry_queue.get_pending())), file=self.output)
+
+    def retry_due_backups(self):
+        #  Retry each failure whose backoff has passed; False is returned if the time budget ran out first
+        for entry in self.retry_queue.get_due():
+            library_name = entry['library_name']
+            path_in_library = entry['path_in_library']
+            mirror_path = entry['mirror_path']
+            backup_mirror_paths = [backup_mirror.path for backup_mirror in self.backup_mirrors]
+            if library_name not in self.source_mirror.libraries or mirror_path not in backup_mirror_paths:
+                print('Dropping failed backup: [{0}: {1}] -> {2}; the library or mirror is no longer configured'.format(
+                    library_name,
+                    path_in_library,
+                    mirror_path
+                ), file=self.output)
+                self.retry_queue.remove(library_name, path_in_library, mirror_path)
+                continue
+            source_library = self.source_mirror.libraries[library_name]
+            source_media = source_library.get_media(path_in_library)
+            backup_library = self.get_backup_mirror(mirror_path).libraries[library_name]
+            try:
+                size = source_media.real_size
+            except OSError:
+                size = 0  # A missing source file fails its retry without copying anything
+            if not self.backup_queue.has_time_for(size, self.get_backup_throughput([backup_library])):
+                return False
+            print('Retrying backup (attempt {0}): [{1}: {2}] -> {3}'.format(
+                entry['attempts'] + 1,
+                library_name,
+                path_in_library,
+                mirror_path
+            ), file=self.output)
+            result = self.backup_media(source_library, source_media, [backup_library])[0]
+            if result.success:
+                self.retry_queue.remove(library_name, path_in_library, mirror_path)
+                self.on_backup_result(path_in_library, library_name, mirror_path, result)
+                self.backup_report[mirror_path]['retried'] += 1
+            else:
+                self.on_backup_error(path_in_library, library_name, result.message, mirror_path)
+        return True
+
+    @require_mirrors_are_loaded
+    def retry_backup_failures(self):
+        #  Re-run only the backups that failed in an earlier run (see 'failure_report_file')
+        self.reset_backup_report()
+        if self.retry_queue.load(self.failure_report_file) == 0:
+            print('No failed backups to retry', file=self.output)
+            return
+        self.backup_queue.start()
+        self.finish_backup()
+
+    def get_backup_failure_count(self):
+        #  The number of failures saved by the last backup run
+        retry_queue = RetryQueue()
+        return retry_queue.load(self.failure_report_file)
+
+    def print_backup_report(self):
+        failure_counts = dict()
+        for failure in self.retry_queue.get_failure_report():
+            failure_counts[failure['mirror_path']] = failure_counts.get(failure['mirror_path'], 0) + 1
+        for mirror_path, counts in self.backup_report.items():
+            if counts['copied'] == 0 and counts['skipped'] == 0 and counts['deferred'] == 0 and failure_counts.get(mirror_path, 0) == 0:
+                continue
+            print('Backup mirror "{0}": {1} copied ({2} after a retry), {3} failed, {4} skipped for lack of space ({5})'.format(
+                mirror_path,
+                counts['copied'],
+                counts['retried'],
+                failure_counts.get(mirror_path, 0),
+                counts['skipped'],
+                ', '.join('{}: {}'.format(method, count) for method, count in sorted(counts['copy_methods'].items()))
+            ), file=self.output)
+            if counts['deferred'] > 0:
+                print('    {0} files did not fit in the time budget; they are backed up by the next scan'.format(counts['deferred']), file=self.output)
+            if counts['bytes'] > 0 and counts['seconds'] > 0:
+                print('    Throughput: {0} in {1}, {2}/s'.format(
+                    format_size(counts['bytes']),
+                    capacity.format_duration(counts['seconds']),
+                    format_size(counts['bytes'] / counts['seconds'])
+                ), file=self.output)
+            if counts['extents']:
+                #  Extents per copied file; a well laid out file uses few extents
+                print('    Fragmentation: {0:.1f} extents per file on average, {1} at most'.format(
+                    sum(counts['extents']) / len(counts['extents']),
+                    max(counts['extents'])
+                ), file=self.output)
 
     def on_backup_start(self, total_files_to_backup, library_name):
-        print('{0} new media files in library "{1}"'.format(total_files_to_backup, library_name))
+        print('{0} new media files in library "{1}"'.format(total_files_to_backup, library_name), file=self.output)
 
     def on_backup_progress(self, total_files_to_backup, file_number, file_name, library_name):
-        print('Backing up {0}/{1}: [{2}: {3}]'.format(file_number, total_files_to_backup, library_name, file_name))
+        #  The total is not known while streaming
+        if total_files_to_backup is None:
+            print('Backing up {0}: [{1}: {2}]'.format(file_number, library_name, file_name), file=self.output)
+        else:
+            print('Backing up {0}/{1}: [{2}: {3}]'.format(file_number, total_files_to_backup, library_name, file_name), file=self.output)
+
+    def on_backup_result(self, file_name, library_name, mirror_path, result):
+        counts = self.backup_report[mirror_path]
+        if result.success:
+            counts['copied'] += 1
+            copy_method = result.metrics.get('copy_method')
+            if copy_method:
+                counts['copy_methods'][copy_method] = counts['copy_methods'].get(copy_method, 0) + 1
+            if result.metrics.get('extents') is not None:
+                counts['extents'].append(result.metrics['extents'])
+            counts['bytes'] += result.metrics.get('bytes', 0)
+            self.save_parity(self.get_backup_mirror(mirror_path), library_name, file_name)
+
+    def save_parity(self, backup_mirror, library_name, path_in_library):
+        #  Save the parity of newly backed up media, if the mirror keeps parity
+        #  Media without parity is still backed up; a failure is only reported
+        if backup_mirror.parity_store is None:
+            return
+        try:
+            if not backup_mirror.parity_store.save_parity(backup_mirror.libraries[library_name], path_in_library):
+                print('No parity was saved for [{0}: {1}]; it changed while it was read'.format(library_name, path_in_library), file=self.output)
+        except OSError as error:
+            print('No parity was saved for [{0}: {1}]: {2}'.format(library_name, path_in_library, error), file=self.output)
 
-    def on_backup_error(self, file_name, library_name, error_message):
-        print('An error occurred during backup: [{0}: {1}]'.format(library_name, file_name))
-        print(error_message)
-        exit()
+    def on_backup_error(self, file_name, library_name, error_message, mirror_path):
+        #  The failure is queued for a retry, and the backup carries on with the next file
+        print('An error occurred during backup: [{0}: {1}] -> {2}'.format(library_name, file_name, mirror_path), file=self.output)
+        print(error_message, file=self.output)
+        self.retry_queue.add_failure(library_name, file_name, mirror_path, error_message)
+
+    def print_failure_report(self):
+        failure_report = self.retry_queue.get_failure_report()
+        if len(failure_report) == 0:
+            return
+        print('{0} media files could not be backed up; they are retried by "Retry failed backups":'.format(len(failure_report)), file=self.output)
+        for failure in failure_report:
+            print(' > [{0}: {1}] -> {2} ({3} attempts)'.format(
+                failure['library_name'],
+                failure['path_in_library'],
+                failure['mirror_path'],
+                failure['attempts']
+            ), file=self.output)
+            print(' >   {}'.format(failure['error_message']), file=self.output)
 
     @require_mirrors_are_loaded
     def refresh_stale_cache_files(self, days_until_stale):
-        for library_name in self.libraries:
-            self.source_mirror.libraries[library_name].refresh_stale_cache_files(
-                stale_cache_days=days_until_stale,
-                callback_on_start=self.on_refresh_start,
-                callback_on_progress=self.on_refresh_progress
+        #  Libraries are grouped by the device they are stored on
+        #  Each device is refreshed by its own thread, so separate discs are read concurrently
+        device_groups = dict()
+        for library in self.get_all_libraries():
+            device_groups.setdefault(library.storage.stat(library.path).st_dev, []).append(library)
+
+        def refresh_device_group(libraries):
+            for library in libraries:
+                library.refresh_stale_cache_files(
+                    stale_cache_days=days_until_stale,
+                    callback_on_start=self.on_refresh_start,
+                    callback_on_progress=self.on_refresh_progress
                 )
-            if len(self.source_mirror.libraries[library_name].media) > 0:
-                print('')
-            self.backup_mirror.libraries[library_name].refresh_stale_cache_files(
-                stale_cache_days=days_until_stale,
-                callback_on_start=self.on_refresh_start,
-                callback_on_progress=self.on_refresh_progress
-            )
-            if len(self.backup_mirror.libraries[library_name].media) > 0:
-                print('')
+                if len(library.media) > 0:
+                    print('', file=self.output)
+
+        with ThreadPoolExecutor(max_workers=len(device_groups)) as executor:
+            futures = [executor.submit(refresh_device_group, libraries) for libraries in device_groups.values()]
+            for future in futures:
+                future.result()
      
     def on_refresh_start(self, mirror_is_source, total_files_to_refresh, library_name):
         print('{0} media files with stale cache files in {1} library "{2}"'.format(
             total_files_to_refresh,
             'source' if mirror_is_source else 'backup',
             library_name
-        ))
+        ), file=self.output)
 
     def on_refresh_progress(self, total_files_to_refresh, file_number, mirror_is_source, file_name, library_name):
         print(' > Refreshing cache file {0}/{1}: [{2}/{3}: {4}]'.format(
@@ -135,57 +689,259 @@ class MainController(object):
             'Source' if mirror_is_source else 'Backup',
             library_name,
             file_name
-        ), end='\r')
+        ), end='\r', file=self.output)
 
     @require_mirrors_are_loaded
     def delete_orphan_cache_files(self):
-        print('Deleting orphan cache files...')
-        for library in list(self.source_mirror.libraries.values()) + list(self.backup_mirror.libraries.values()):
+        print('Deleting orphan cache files...', file=self.output)
+        for library in self.get_all_libraries():
             library.delete_orphan_cache_files()
 
+    def compact_backup_packs(self):
+        #  Reclaim the space of deleted and replaced files in backup mirrors stored in pack files (see 'PackStorage')
+        for backup_mirror in self.backup_mirrors:
+            if isinstance(backup_mirror.storage, PackStorage):
+                print('Compacting pack files: {}'.format(backup_mirror.path), file=self.output)
+                reclaimed_bytes = backup_mirror.storage.compact()
+                print('  Reclaimed {}'.format(format_size(reclaimed_bytes)), file=self.output)
+
     @require_mirrors_are_loaded
-    def get_orphan_backup_media(self):
-        orphan_backup_media = []
+    def get_mirror_differences(self, statuses):
+        #  Description
+        #    Compare the source mirror with every backup mirror in one streaming pass
+        #  Guarantees
+        #    A list of dicts is returned for entries with a status in 'statuses' (see 'mirror_diff')
+        #    Each dict has 'status', 'mirror_path', 'library_name' and 'path_in_library'
+        #    Cache files are only read when 'DIFF_MATCH' or 'DIFF_MISMATCH' is requested
+
+        compare_checksums = mirror_diff.DIFF_MATCH in statuses or mirror_diff.DIFF_MISMATCH in statuses
+        differences = []
         for library_name in self.libraries:
-            for path_in_library in self.backup_mirror.libraries[library_name].media:
-                if path_in_library not in self.source_mirror.libraries[library_name].media:
-                    orphan_backup_media.append({
+            backup_libraries = [backup_mirror.libraries[library_name] for backup_mirror in self.backup_mirrors]
+            for status, path_in_library, _, _, backup_library in mirror_diff.diff_libraries(
+                source_library=self.source_mirror.libraries[library_name],
+                backup_libraries=backup_libraries,
+                compare_checksums=compare_checksums
+            ):
+                if status in statuses:
+                    differences.append({
+                        'status': status,
+                        'mirror_path': os.path.dirname(backup_library.path),
                         'library_name': library_name,
                         'path_in_library': path_in_library
                     })
-        return orphan_backup_media
+        return differences
+
+    @require_mirrors_are_loaded
+    def get_orphan_backup_media(self):
+        return self.get_mirror_differences([mirror_diff.DIFF_ORPHAN])
 
     @require_mirrors_are_loaded
     def delete_orphan_backup_media(self):
         for orphan_backup_media in self.get_orphan_backup_media():
+            backup_mirror = self.get_backup_mirror(orphan_backup_media['mirror_path'])
             library_name = orphan_backup_media['library_name']
             path_in_library = orphan_backup_media['path_in_library']
-            input('Enter to delete: {}/{}'.format(library_name, path_in_library))
-            self.backup_mirror.libraries[library_name].delete_media(path_in_library)
+            input('Enter to delete: {}/{}/{}'.format(backup_mirror.path, library_name, path_in_library))
+            backup_mirror.libraries[library_name].delete_media(path_in_library)
+
+    @require_mirrors_are_loaded
+    def get_rename_index(self):
+        #  Every source media file, in every library (see 'RenameIndex')
+        #  An orphan backup file with the content of a source file was renamed or moved in the source
+        return RenameIndex(media for library in self.source_mirror.libraries.values() for media in library.media.values())
+
+    @require_mirrors_are_loaded
+    def plan_orphan_deletion(self, policy):
+        #  Description
+        #    Select the orphan backup media that 'policy' allows to be deleted
+        #  Requires
+        #    Media must be loaded in each mirror
+        #  Guarantees
+        #    A list of dicts is returned, one for each orphan to delete
+        #    Each dict has 'mirror_path', 'library_name', 'path_in_library' and 'size' (bytes)
+        #    Nothing is deleted
+
+        rename_index = self.get_rename_index() if policy.missing_from_rename_index else None
+        plan = []
+        for orphan_backup_media in self.get_orphan_backup_media():
+            backup_library = self.get_backup_mirror(orphan_backup_media['mirror_path']).libraries[orphan_backup_media['library_name']]
+            media = backup_library.media[orphan_backup_media['path_in_library']]
+            if policy.matches(media, rename_index):
+                orphan_backup_media['size'] = media.storage.stat(media.path).st_size
+                plan.append(orphan_backup_media)
+        return plan
+
+    def print_orphan_deletion_plan(self, plan):
+        #  Summarize the plan for each library, then in total
+        summary = dict()
+        for item in plan:
+            key = (item['mirror_path'], item['library_name'])
+            count, size = summary.get(key, (0, 0))
+            summary[key] = (count + 1, size + item['size'])
+        for (mirror_path, library_name), (count, size) in sorted(summary.items()):
+            print(' > {0}/{1}: {2} files, {3}'.format(mirror_path, library_name, count, format_size(size)), file=self.output)
+        print('Total: {0} files, {1}'.format(len(plan), format_size(sum(item['size'] for item in plan))), file=self.output)
+
+    @require_mirrors_are_loaded
+    def execute_orphan_deletion(self, plan, batch_size=100):
+        #  Description
+        #    Delete the orphan backup media in 'plan' (see 'plan_orphan_deletion')
+        #  Guarantees
+        #    Each library is handled by its own thread; its media is deleted in batches of 'batch_size'
+        #    Media files and their cache files are deleted
+        #    A list of Results is returned, one for each item in 'plan'
+
+        paths_by_library = dict()
+        for item in plan:
+            key = (item['mirror_path'], item['library_name'])
+            paths_by_library.setdefault(key, []).append(item['path_in_library'])
+
+        def delete_from_library(key, paths_in_library):
+            library = self.get_backup_mirror(key[0]).libraries[key[1]]
+            results = []
+            for index in range(0, len(paths_in_library), batch_size):
+                results += library.delete_media_batch(paths_in_library[index:index + batch_size])
+                print('Deleted {0}/{1} orphan files from {2}/{3}'.format(
+                    min(index + batch_size, len(paths_in_library)),
+                    len(paths_in_library),
+                    key[0],
+                    key[1]
+                ), file=self.output)
+            return results
+
+        results = []
+        with ThreadPoolExecutor(max_workers=max(len(paths_by_library), 1)) as executor:
+            futures = [executor.submit(delete_from_library, key, paths) for key, paths in paths_by_library.items()]
+            for future in futures:
+                results += future.result()
+        return results
 
     @require_mirrors_are_loaded
     def get_empty_directory_count(self):
         count = 0
-        for library in self.source_mirror.libraries.values():
-            count += len(library.get_empty_directories())
-        for library in self.backup_mirror.libraries.values():
+        for library in self.get_all_libraries():
             count += len(library.get_empty_directories())
         return count
 
     @require_mirrors_are_loaded
     def delete_empty_directories(self):
-        for library in self.source_mirror.libraries.values():
-            library.delete_empty_directories()
-        for library in self.backup_mirror.libraries.values():
+        for library in self.get_all_libraries():
             library.delete_empty_directories()
 
+    @require_mirrors_are_loaded
+    def iterate_prehash_candidates(self):
+        #  Description
+        #    Yield media whose checksum the next scan or backup will need
+        #  Guarantees
+        #    New source media, missing from any backup mirror, is yielded
+        #    Media whose existing cache file is stale is yielded
+        #    The mirrors are walked as the candidates are consumed; media does not need to be loaded
+
+        for library_name in self.libraries:
+            source_library = self.source_mirror.libraries[library_name]
+            backup_libraries = [backup_mirror.libraries[library_name] for backup_mirror in self.backup_mirrors]
+            for _, media in mirror_diff.merge_libraries([source_library] + backup_libraries):
+                if media[0] is not None and None in media[1:]:
+                    yield media[0]
+                    continue
+                for item in media:
+                    try:
+                        if item is not None and item.storage.isfile(item.cache_file) and item.cache_is_stale(self.stale_cache_days):
+                            yield item
+                    except (AssertionError, ValueError):
+                        #  A malformed cache file is reported by the next scan
+                        continue
+
+    @require_mirrors_are_loaded
+    def start_background_hasher(self):
+        #  Pre-compute checksums at low priority, so the next scan or backup can reuse them
+        if self.background_hasher is None or not self.background_hasher.is_alive():
+            self.background_hasher = BackgroundHasher(self.iterate_prehash_candidates())
+            self.background_hasher.start()
+
+    def stop_background_hasher(self):
+        if self.background_hasher is not None:
+            self.background_hasher.stop()
+            self.background_hasher = None
+
+    def start_version_pruner(self):
+        #  Prune prior versions of backup media at low priority, so overwrites never wait on it
+        version_stores = [backup_mirror.version_store for backup_mirror in self.backup_mirrors if backup_mirror.version_store]
+        if len(version_stores) == 0:
+            return
+        if self.version_pruner is None or not self.version_pruner.is_alive():
+            self.version_pruner = VersionPruner(version_stores)
+            self.version_pruner.start()
+
+    def stop_version_pruner(self):
+        if self.version_pruner is not None:
+            self.version_pruner.stop()
+            self.version_pruner = None
+
+    def replace_media(self, library, path_in_library, source_filepath, source_checksum, source_storage=None):
+        #  Description
+        #    Overwrite a media file in 'library' with a copy of 'source_filepath'
+        #  Guarantees
+        #    In a backup library with a VersionStore, the old file is kept as a prior version instead of being deleted
+        #    If the copy fails, the kept version is moved back, so the backup is never left without the file
+        #    Otherwise, the old file is deleted before copying
+        #    The Result of 'Library.copy_media' is returned; an OSError from the copy is raised
+        #    In a backup mirror that keeps parity, the new file gets new parity (see 'ParityStore')
+        #  Implementation Notes
+        #    A file that changed in only a few blocks, e.g. re-tagged media, is updated in place (see 'Library.update_media')
+        #    Its Result then has a 'bytes_saved' metric
+        #    The version of a file updated in place is a clone (see 'VersionStore.clone_version'); where the storage
+        #    can not clone files, the version is moved aside and the file is copied in full
+
+        version_store = None
+        target_mirror = None
+        for backup_mirror in self.backup_mirrors:
+            if library is backup_mirror.libraries.get(library.name):
+                version_store = backup_mirror.version_store
+                target_mirror = backup_mirror
+        version_path = None
+        result = None
+        try:
+            if path_in_library in library.media:
+                if version_store is not None:
+                    version_path = version_store.clone_version(library, path_in_library)
+                if version_store is None or version_path is not None:
+                    result = library.update_media(
+                        source_filepath=source_filepath,
+                        path_in_library=path_in_library,
+                        source_checksum=source_checksum,
+                        source_storage=source_storage
+                    )
+                if result is None:
+                    if version_store is not None and version_path is None:
+                        version_path = version_store.keep_version(library, path_in_library)
+                    else:
+                        library.delete_media(path_in_library)
+            if result is None:
+                result = library.copy_media(
+                    source_filepath=source_filepath,
+                    path_in_library=path_in_library,
+                    source_checksum=source_checksum,
+                    source_storage=source_storage
+                )
+        except OSError:
+            if version_path is not None:
+                version_store.restore_version(library, path_in_library, version_path)
+            raise
+        if not result.success and version_path is not None:
+            version_store.restore_version(library, path_in_library, version_path)
+        if result.success and target_mirror is not None:
+            self.save_parity(target_mirror, library.name, path_in_library)
+        return result
+
     def print_message_while_thread_is_alive(self, message, thread):
         ellipsis_count = 3
         thread_started = False
         while thread.is_alive() or thread_started is False:
             ellipsis_string = '.' * ellipsis_count
             empty_space = ' ' * (3 - ellipsis_count)
-            print('{}{}{}'.format(message, ellipsis_string, empty_space), end='\r')
+            print('{}{}{}'.format(message, ellipsis_string, empty_space), end='\r', file=self.output)
             if not thread_started:
                 thread.start()
                 thread_started = True
@@ -194,107 +950,113 @@ class MainController(object):
                 ellipsis_count = 0
 
     @require_mirrors_are_loaded
-    def get_media_with_local_checksum_discrepancy(self):
+    def get_media_with_local_checksum_discrepancy(self, deep=True):
         #  Check all media with stale cache files for a local checksum discrepancy
         #  Media with fresh cache files are not checked
+        #  Unless 'deep', media whose fingerprint matches its cache file is not read in full (quick triage)
+        #  Counts after a scan are deep: the scan already read each stale file in full, so its checksum is reused
         media_with_local_checksum_discrepancy = []
         for library_name in self.libraries:
-            source_and_backup_media_in_library = (
-                list(self.source_mirror.libraries[library_name].media.values()) + 
-                list(self.backup_mirror.libraries[library_name].media.values())
-            )
-            for media in source_and_backup_media_in_library:
-                if media.cache_is_stale(self.stale_cache_days):
-                    if media.real_checksum != media.cached_checksum:
-                        media_with_local_checksum_discrepancy.append({
-                            'source': media.source,
-                            'library_name': library_name,
-                            'path_in_library': media.path_in_library
-                        })
+            for mirror in [self.source_mirror] + self.backup_mirrors:
+                for media in mirror.libraries[library_name].media.values():
+                    if media.cache_is_stale(self.stale_cache_days):
+                        if media.has_local_discrepancy(deep=deep):
+                            media_with_local_checksum_discrepancy.append({
+                                'source': media.source,
+                                'mirror_path': mirror.path,
+                                'library_name': library_name,
+                                'path_in_library': media.path_in_library
+                            })
         return media_with_local_checksum_discrepancy
 
     @require_mirrors_are_loaded
-    def resolve_local_checksum_discrepancy(self, is_source, library_name, path_in_library):
+    def resolve_local_checksum_discrepancy(self, is_source, library_name, path_in_library, mirror_path=None):
+        #  'mirror_path' selects the backup mirror when 'is_source' is False
+        #  A source file is restored from the first backup mirror that has a copy
+        #  A backup file with parity can be repaired in place, even when the source file is gone (see 'ParityStore')
+        parity_store = None
         if is_source:
             target_library = self.source_mirror.libraries[library_name]
             target_media = target_library.media[path_in_library]
-            if path_in_library in self.backup_mirror.libraries[library_name].media:
-                mirror_media = self.backup_mirror.libraries[library_name].media[path_in_library]
-            else:
-                mirror_media = None
+            mirror_media = None
+            for backup_mirror in self.backup_mirrors:
+                if path_in_library in backup_mirror.libraries[library_name].media:
+                    mirror_media = backup_mirror.libraries[library_name].media[path_in_library]
+                    break
         else:
-            target_library = self.backup_mirror.libraries[library_name]
+            backup_mirror = self.get_backup_mirror(mirror_path) if mirror_path else self.backup_mirror
+            target_library = backup_mirror.libraries[library_name]
             target_media = target_library.media[path_in_library]
             if path_in_library in self.source_mirror.libraries[library_name].media:
                 mirror_media = self.source_mirror.libraries[library_name].media[path_in_library]
             else:
                 mirror_media = None
+            parity_store = backup_mirror.parity_store
+        can_repair = parity_store is not None and parity_store.has_parity(target_library, path_in_library)
 
         while True:
-            print('> Local checksum discrepancy: {}'.format(target_media.path))
-            target_media.print_info()
+            print('> Local checksum discrepancy: {}'.format(target_media.path), file=self.output)
+            target_media.print_info(self.output)
             two_string = '2. View the mirror file\'s values' if mirror_media else '2'+'\u0336'+'. Mirror file does not exist'
             three_string = '3. File is not valid. Overwrite this file with file from mirror' if mirror_media else '3'+'\u0336'+'. Mirror file does not exist'
+            five_string = '5. File is not valid. Repair this file from its parity' if can_repair else '5'+'\u0336'+'. File has no parity'
             input_string = (
                 '1. Media file is valid. Update the local cache file with new values' +
                 '\n{0}' +
                 '\n{1}' +
                 '\n4. Skip' +
+                ('\n{2}' if parity_store is not None else '') +
                 '\nChoose an option: '
             ).format(
                 two_string,
-                three_string
+                three_string,
+                five_string
             )
             result = input(input_string)
             if result is '1':
                 #  Refresh the cache file
-                print('Updating cache file with new values...')
+                print('Updating cache file with new values...', file=self.output)
                 target_media.save_cache_file(overwrite=True)
                 break
             elif result is '2' and mirror_media:
                 #  Print the mirror media's info
-                mirror_media.print_info()
+                mirror_media.print_info(self.output)
             elif result is '3' and mirror_media:
                 #  Copy the mirror media to the current library
-                print('Overwriting file with file from mirror...')
-                target_library.delete_media(path_in_library)
-                target_library.copy_media(mirror_media.path, path_in_library, mirror_media.real_checksum)
+                print('Overwriting file with file from mirror...', file=self.output)
+                self.replace_media(target_library, path_in_library, mirror_media.path, mirror_media.real_checksum, mirror_media.storage)
                 break
             elif result is '4':
                 break
+            elif result == '5' and can_repair:
+                #  Rebuild the damaged blocks from the parity saved when the file was backed up
+                print('Repairing file from its parity...', file=self.output)
+                repair_result = parity_store.repair(target_library, path_in_library)
+                if repair_result.success:
+                    print('{} damaged blocks were repaired'.format(repair_result.metrics['repaired_blocks']), file=self.output)
+                    break
+                print(repair_result.message, file=self.output)
+                can_repair = False
 
     @require_mirrors_are_loaded
     def get_media_with_mirror_checksum_discrepancy(self):
         #  Check all source media for a mirror checksum discrepancy
-        media_with_mirror_checksum_discrepancy = []
-        for library_name in self.libraries:
-            for source_media in self.source_mirror.libraries[library_name].media.values():
-                path_in_library = source_media.path_in_library
-
-                #  Make sure the backup media actually exists
-                if path_in_library in self.backup_mirror.libraries[library_name].media:
-                    backup_media = self.backup_mirror.libraries[library_name].media[path_in_library]
-                    if backup_media:
-                        if source_media.cached_checksum != backup_media.cached_checksum:
-                            media_with_mirror_checksum_discrepancy.append({
-                                'library_name': library_name,
-                                'path_in_library': path_in_library
-                            })
-        return media_with_mirror_checksum_discrepancy
+        return self.get_mirror_differences([mirror_diff.DIFF_MISMATCH])
 
     @require_mirrors_are_loaded
     @require_no_local_checksum_discrepancies
-    def resolve_mirror_checksum_discrepancy(self, library_name, path_in_library):
+    def resolve_mirror_checksum_discrepancy(self, library_name, path_in_library, mirror_path=None):
+        backup_mirror = self.get_backup_mirror(mirror_path) if mirror_path else self.backup_mirror
         source_library = self.source_mirror.libraries[library_name]
         source_media = source_library.media[path_in_library]
-        backup_library = self.backup_mirror.libraries[library_name]
+        backup_library = backup_mirror.libraries[library_name]
         backup_media = backup_library.media[path_in_library]
 
         while True:
-            print('> Mirror checksum discrepancy: {}'.format(path_in_library))
-            source_media.print_info()
-            print('')
-            backup_media.print_info()
+            print('> Mirror checksum discrepancy: {}'.format(path_in_library), file=self.output)
+            source_media.print_info(self.output)
+            print('', file=self.output)
+            backup_media.print_info(self.output)
             input_string = (
                 '1. Source file is valid. Overwrite backup file' +
                 '\n2. Backup file is valid. Overwrite source file' +
@@ -303,13 +1065,19 @@ class MainController(object):
             )
             result = input(input_string)
             if result is '1':
-                #  Delete the backup file and copy the source file to the backup mirror
-                backup_library.delete_media(path_in_library)
-                backup_library.copy_media(
-                    source_filepath=source_media.path,
+                #  Keep the backup file as a prior version and copy the source file to the backup mirror
+                #  A backup file that differs in only a few blocks is updated in place
+                result = self.replace_media(
+                    library=backup_library,
                     path_in_library=path_in_library,
-                    source_checksum=source_media.real_checksum
+                    source_filepath=source_media.path,
+                    source_checksum=source_media.real_checksum,
+                    source_storage=source_media.storage
                 )
+                if not result.success:
+                    print(result.message, file=self.output)
+                elif result.metrics.get('bytes_saved'):
+                    print('Updated in place; {} was not rewritten'.format(format_size(result.metrics['bytes_saved'])), file=self.output)
                 break
             elif result is '2':
                 #  Delete the source file and copy the backup file to the source mirror
@@ -317,8 +1085,278 @@ class MainController(object):
                 source_library.copy_media(
                     source_filepath=backup_media.path,
                     path_in_library=path_in_library,
-                    source_checksum=backup_media.real_checksum
+                    source_checksum=backup_media.real_checksum,
+                    source_storage=backup_media.storage
                 )
                 break
             elif result is '3':
-                break
\ No newline at end of file
+                break
+
+    @require_mirrors_are_loaded
+    def get_checksum_discrepancies(self):
+        #  Description
+        #    Get every local and mirror checksum discrepancy as a Discrepancy object
+        #  Requires
+        #    Media must be loaded in each mirror
+        #  Guarantees
+        #    Local discrepancies are listed first
+        #    A path with a local discrepancy is not also listed as a mirror discrepancy
+
+        discrepancies = []
+        local_paths = set()
+        for item in self.get_media_with_local_checksum_discrepancy():
+            library_name = item['library_name']
+            path_in_library = item['path_in_library']
+            if item['source']:
+                #  Pair a source file with the first backup mirror that has a copy
+                backup_mirror = self.backup_mirror
+                for candidate_mirror in self.backup_mirrors:
+                    if path_in_library in candidate_mirror.libraries[library_name].media:
+                        backup_mirror = candidate_mirror
+                        break
+            else:
+                backup_mirror = self.get_backup_mirror(item['mirror_path'])
+            discrepancies.append(self.make_discrepancy(
+                discrepancy_rules.DISCREPANCY_LOCAL,
+                library_name,
+                path_in_library,
+                item['source'],
+                backup_mirror
+            ))
+            local_paths.add((library_name, path_in_library))
+        for item in self.get_media_with_mirror_checksum_discrepancy():
+            if (item['library_name'], item['path_in_library']) not in local_paths:
+                discrepancies.append(self.make_discrepancy(
+                    discrepancy_rules.DISCREPANCY_MIRROR,
+                    item['library_name'],
+                    item['path_in_library'],
+                    True,
+                    self.get_backup_mirror(item['mirror_path'])
+                ))
+        return discrepancies
+
+    def make_discrepancy(self, kind, library_name, path_in_library, is_source, backup_mirror):
+        source_library = self.source_mirror.libraries[library_name]
+        backup_library = backup_mirror.libraries[library_name]
+        return discrepancy_rules.Discrepancy(
+            kind=kind,
+            library_name=library_name,
+            path_in_library=path_in_library,
+            is_source=is_source,
+            source_library=source_library,
+            source_media=source_library.media.get(path_in_library),
+            backup_library=backup_library,
+            backup_media=backup_library.media.get(path_in_library)
+        )
+
+    @require_mirrors_are_loaded
+    def plan_discrepancy_resolution(self, rules):
+        #  Description
+        #    Choose an action for each checksum discrepancy by applying 'rules' in order
+        #  Guarantees
+        #    A tuple is returned: (plan, unresolved)
+        #    'plan' is a list of (Discrepancy, action) tuples
+        #    'unresolved' is a list of Discrepancy objects that no rule applied to
+        #    Nothing is changed on the filesystem
+
+        plan = []
+        unresolved = []
+        for discrepancy in self.get_checksum_discrepancies():
+            action = discrepancy_rules.choose_action(discrepancy, rules)
+            if action is None:
+                unresolved.append(discrepancy)
+            else:
+                plan.append((discrepancy, action))
+        return plan, unresolved
+
+    @require_mirrors_are_loaded
+    def execute_discrepancy_plan(self, plan, workers=4):
+        #  Description
+        #    Carry out a plan from 'plan_discrepancy_resolution' as one parallel job
+        #  Guarantees
+        #    Up to 'workers' actions run at once
+        #    Each copy is verified against the checksum of the file it was copied from (see 'Library.copy_media')
+        #    A report is returned, as {'results': [(Discrepancy, action, Result)], 'bytes_copied': int, 'bytes_saved': int,
+        #    'seconds': float}, where 'bytes_saved' were not written as their files were updated in place
+
+        def execute(discrepancy, action):
+            if action == discrepancy_rules.ACTION_UPDATE_CACHE:
+                discrepancy.changed_media.save_cache_file(overwrite=True)
+                return Result(subject=discrepancy.changed_media.path, success=True)
+            if action == discrepancy_rules.ACTION_COPY_SOURCE_TO_BACKUP:
+                from_media, to_library = discrepancy.source_media, discrepancy.backup_library
+            else:
+                from_media, to_library = discrepancy.backup_media, discrepancy.source_library
+            result = self.replace_media(
+                library=to_library,
+                path_in_library=discrepancy.path_in_library,
+                source_filepath=from_media.path,
+                source_checksum=from_media.real_checksum,
+                source_storage=from_media.storage
+            )
+            if result.success:
+                #  A file updated in place has already counted only the bytes it wrote
+                result.metrics.setdefault('bytes', from_media.storage.stat(from_media.path).st_size)
+            return result
+
+        start_time = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(execute, discrepancy, action) for discrepancy, action in plan]
+            results = []
+            for (discrepancy, action), future in zip(plan, futures):
+                try:
+                    result = future.result()
+                except (AssertionError, OSError) as error:
+                    result = Result(subject=discrepancy.path_in_library, success=False, message=repr(error))
+                results.append((discrepancy, action, result))
+        return {
+            'results': results,
+            'bytes_copied': sum(result.metrics.get('bytes', 0) for _, _, result in results),
+            'bytes_saved': sum(result.metrics.get('bytes_saved', 0) for _, _, result in results),
+            'seconds': time.monotonic() - start_time
+        }
+
+    def print_discrepancy_plan(self, plan, unresolved):
+        counts = dict()
+        for _, action in plan:
+            counts[action] = counts.get(action, 0) + 1
+        for action, count in sorted(counts.items()):
+            print(' > {0}: {1}'.format(action, count), file=self.output)
+        print(' > No rule applies (left for manual review): {}'.format(len(unresolved)), file=self.output)
+
+    def print_discrepancy_report(self, report):
+        counts = dict()
+        for discrepancy, action, result in report['results']:
+            succeeded, failed = counts.get(action, (0, 0))
+            counts[action] = (succeeded + 1, failed) if result.success else (succeeded, failed + 1)
+            if not result.success:
+                print('Failed to {0}: [{1}: {2}]'.format(action, discrepancy.library_name, discrepancy.path_in_library), file=self.output)
+                print(result.message, file=self.output)
+        for action, (succeeded, failed) in sorted(counts.items()):
+            print(' > {0}: {1} succeeded, {2} failed'.format(action, succeeded, failed), file=self.output)
+        print('Copied {0} in {1:.1f} seconds'.format(format_size(report['bytes_copied']), report['seconds']), file=self.output)
+        if report.get('bytes_saved'):
+            print('Updated in place; {} was not rewritten'.format(format_size(report['bytes_saved'])), file=self.output)
+
+    @require_mirrors_are_loaded
+    def plan_restore(self, library_names=None, mirror_path=None):
+        #  Description
+        #    Select the backup media to restore into the source libraries, e.g. after a source disc failed
+        #  Requires
+        #    Media must be loaded in each mirror
+        #  Guarantees
+        #    The copies of an interrupted restore are undone first, so they are restored again (see 'RestoreJournal')
+        #    A list of dicts is returned, one for each backup media file missing from the source
+        #    Each dict has 'mirror_path', 'library_name', 'path_in_library' and 'size' (bytes)
+        #    Media is ordered by its physical layout in the backup mirror, to reduce seeking
+        #    Nothing is copied
+
+        backup_mirror = self.get_backup_mirror(mirror_path) if mirror_path else self.backup_mirror
+        plan = []
+        for library_name in library_names or self.libraries:
+            source_library = self.source_mirror.libraries[library_name]
+            backup_library = backup_mirror.libraries[library_name]
+            RestoreJournal(source_library).recover()
+            missing_media = {
+                path_in_library: media.path for path_in_library, media in backup_library.media.items()
+                if path_in_library not in source_library.media
+            }
+            for path_in_library in disk_layout.sort_by_layout(missing_media, backup_library.storage):
+                plan.append({
+                    'mirror_path': backup_mirror.path,
+                    'library_name': library_name,
+                    'path_in_library': path_in_library,
+                    'size': backup_library.media[path_in_library].real_size
+                })
+        return plan
+
+    @require_mirrors_are_loaded
+    def execute_restore(self, plan, workers=4, callback_on_progress=None):
+        #  Description
+        #    Restore the backup media in 'plan' (see 'plan_restore') as one parallel job
+        #  Guarantees
+        #    Up to 'workers' files are copied at once
+        #    Each copy is verified against the backup file's cached checksum, so a damaged backup is not restored
+        #    Each restored file gets a cache file with the verified checksum
+        #    Each copy is recorded in its library's RestoreJournal until it is verified, so an interrupted restore can resume
+        #    A report is returned, as {'results': [(item, Result)], 'bytes_copied': int, 'seconds': float}
+
+        journals = dict()
+        for item in plan:
+            if item['library_name'] not in journals:
+                journals[item['library_name']] = RestoreJournal(self.source_mirror.libraries[item['library_name']])
+        progress = {'file_number': 0, 'bytes_copied': 0}
+        progress_lock = threading.Lock()
+        start_time = time.monotonic()
+
+        def restore(item):
+            source_library = self.source_mirror.libraries[item['library_name']]
+            backup_media = self.get_backup_mirror(item['mirror_path']).libraries[item['library_name']].media[item['path_in_library']]
+            journal = journals[item['library_name']]
+            journal.start(item['path_in_library'])
+            try:
+                result = source_library.copy_media(
+                    source_filepath=backup_media.path,
+                    path_in_library=item['path_in_library'],
+                    source_checksum=backup_media.cached_checksum,
+                    source_storage=backup_media.storage
+                )
+            finally:
+                journal.finish(item['path_in_library'])
+            with progress_lock:
+                progress['file_number'] += 1
+                progress['bytes_copied'] += result.metrics.get('bytes', 0)
+                if callback_on_progress:
+                    callback_on_progress(
+                        total_files_to_restore=len(plan),
+                        file_number=progress['file_number'],
+                        file_name=item['path_in_library'],
+                        library_name=item['library_name'],
+                        bytes_per_second=progress['bytes_copied'] / max(time.monotonic() - start_time, 0.001)
+                    )
+            return result
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(restore, item) for item in plan]
+            results = []
+            for item, future in zip(plan, futures):
+                try:
+                    result = future.result()
+                except (AssertionError, OSError) as error:
+                    result = Result(subject=item['path_in_library'], success=False, message=repr(error))
+                results.append((item, result))
+        return {
+            'results': results,
+            'bytes_copied': sum(result.metrics.get('bytes', 0) for _, result in results),
+            'seconds': time.monotonic() - start_time
+        }
+
+    def on_restore_progress(self, total_files_to_restore, file_number, file_name, library_name, bytes_per_second):
+        print('Restored {0}/{1} at {2}/s: [{3}: {4}]'.format(
+            file_number,
+            total_files_to_restore,
+            format_size(bytes_per_second),
+            library_name,
+            file_name
+        ), file=self.output)
+
+    def print_restore_plan(self, plan):
+        summary = dict()
+        for item in plan:
+            count, size = summary.get(item['library_name'], (0, 0))
+            summary[item['library_name']] = (count + 1, size + item['size'])
+        for library_name, (count, size) in sorted(summary.items()):
+            print(' > {0}: {1} files, {2}'.format(library_name, count, format_size(size)), file=self.output)
+        print('Total: {0} files, {1}'.format(len(plan), format_size(sum(item['size'] for item in plan))), file=self.output)
+
+    def print_restore_report(self, report):
+        failed = [(item, result) for item, result in report['results'] if not result.success]
+        for item, result in failed:
+            print('Failed to restore: [{0}: {1}]'.format(item['library_name'], item['path_in_library']), file=self.output)
+            print(result.message, file=self.output)
+        print('Restored {0} files, {1} failed'.format(len(report['results']) - len(failed), len(failed)), file=self.output)
+        print('Copied {0} in {1:.1f} seconds, {2}/s'.format(
+            format_size(report['bytes_copied']),
+            report['seconds'],
+            format_size(report['bytes_copied'] / report['seconds'] if report['seconds'] > 0 else 0)
+        ), file=self.output)
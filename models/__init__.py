@@ -1,3 +1,20 @@
+from .background_hasher import BackgroundHasher
+from .backup_queue import BackupQueue
 from .media_file import MediaFile
+from .media_file import format_size
+from .object_storage import ObjectStorage
 from .mirror import SourceMirror
-from .mirror import BackupMirror
\ No newline at end of file
+from .mirror import BackupMirror
+from .orphan_policy import OrphanDeletionPolicy
+from .orphan_policy import RenameIndex
+from .pack_storage import PackStorage
+from .parity import ParityStore
+from .restore_journal import RestoreJournal
+from .retry_queue import RetryQueue
+from .throttle import Throttle
+from .throttle import lower_process_priority
+from .versions import VersionPruner
+from .versions import VersionStore
+from .watcher import ChangeDebouncer
+from .watcher import LibraryWatcher
+from .watcher import PollingWatcher
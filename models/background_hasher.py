@@ -0,0 +1,48 @@
+import sys
+import threading
+
+from .throttle import lower_process_priority
+
+class BackgroundHasher(threading.Thread):
+    def __init__(self, candidates, niceness: int=19, io_idle: bool=True, callback_on_progress=None):
+        #  'candidates' is an iterable of MediaFile objects; it may be a generator
+        threading.Thread.__init__(self, name='BackgroundHasher', daemon=True)
+        self.candidates = candidates
+        self.niceness = niceness
+        self.io_idle = io_idle
+        self.callback_on_progress = callback_on_progress
+        self.hashed_count = 0
+        self.stop_event = threading.Event()
+
+    def run(self):
+        #  Description
+        #    Pre-compute the checksum of each candidate and save it next to the cache file
+        #  Guarantees
+        #    Candidates with a valid pre-computed checksum are skipped
+        #    The thread stops between reads once 'stop' is called; a partial checksum is not saved
+        #  Implementation Notes
+        #    On Linux, priority is set per thread, so only this thread's priority is lowered
+        #    Elsewhere, priority is set per process, so it is left alone
+
+        if sys.platform.startswith('linux'):
+            lower_process_priority(niceness=self.niceness, io_idle=self.io_idle)
+        for media in self.candidates:
+            if self.stop_event.is_set():
+                break
+            try:
+                if media.load_prehash_file():
+                    continue
+                if media.generate_checksum(stop_event=self.stop_event):
+                    media.save_prehash_file()
+                    self.hashed_count += 1
+                    if self.callback_on_progress:
+                        self.callback_on_progress(hashed_count=self.hashed_count, file_name=media.path)
+            except (OSError, ValueError):
+                #  The file changed or disappeared while the user was idle; it is picked up by the next scan
+                continue
+
+    def stop(self):
+        #  Ask the thread to stop, and wait until it has
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
@@ -0,0 +1,85 @@
+import time
+
+from . import disk_layout
+
+#  Orders for the new media in each library
+QUEUE_LAYOUT = 'layout'  # By physical position on the source disc, to reduce seeking
+QUEUE_SMALLEST_FIRST = 'smallest'  # Protect the most files per minute
+QUEUE_NEWEST_FIRST = 'newest'  # Protect freshly added media first
+
+class BackupQueue(object):
+    def __init__(self, strategy: str=QUEUE_LAYOUT, library_weights: dict=None, time_budget_seconds: float=None):
+        #  'library_weights' is a dict of {'library_name': weight}; a library without a weight has a weight of 1
+        #  With weights, libraries are interleaved: a library with weight 3 gets three files for each file of a library with weight 1
+        #  With a 'time_budget_seconds', no copy is started that is projected to end after the budget
+        assert strategy in [QUEUE_LAYOUT, QUEUE_SMALLEST_FIRST, QUEUE_NEWEST_FIRST], 'Unknown queue strategy: {}'.format(strategy)
+        self.strategy = strategy
+        self.library_weights = library_weights
+        self.time_budget_seconds = time_budget_seconds
+        self.start_time = None
+
+    def order_library(self, media):
+        #  Order a dict of {'path_in_library': MediaFile} by 'self.strategy'
+        if self.strategy == QUEUE_SMALLEST_FIRST:
+            return sorted(media, key=lambda path_in_library: (media[path_in_library].real_size, path_in_library))
+        if self.strategy == QUEUE_NEWEST_FIRST:
+            return sorted(media, key=lambda path_in_library: (-media[path_in_library].real_mtime, path_in_library))
+        #  The media of one library shares its storage
+        storage = next(iter(media.values())).storage if media else None
+        return disk_layout.sort_by_layout({path_in_library: media[path_in_library].path for path_in_library in media}, storage)
+
+    def order(self, media_by_library):
+        #  Description
+        #    Order the new media of several libraries into one queue
+        #  Requires
+        #    'media_by_library' is a list of ('library_name', {'path_in_library': MediaFile}) tuples
+        #  Guarantees
+        #    A list of ('library_name', 'path_in_library') tuples is returned
+        #    Each library's media is in 'self.strategy' order
+        #    Without weights, libraries follow each other in the order given
+        #    With weights, the library with the fewest queued files for its weight goes next; ties go to the earlier library
+
+        library_queues = [(library_name, self.order_library(media)) for library_name, media in media_by_library]
+        if not self.library_weights:
+            return [(library_name, path_in_library) for library_name, queue in library_queues for path_in_library in queue]
+
+        queue = []
+        positions = [0] * len(library_queues)
+        while True:
+            candidates = [index for index, (library_name, library_queue) in enumerate(library_queues) if positions[index] < len(library_queue)]
+            if len(candidates) == 0:
+                return queue
+            index = min(candidates, key=lambda index: (
+                (positions[index] + 1) / self.library_weights.get(library_queues[index][0], 1),
+                index
+            ))
+            library_name, library_queue = library_queues[index]
+            queue.append((library_name, library_queue[positions[index]]))
+            positions[index] += 1
+
+    def start(self):
+        #  Start the clock for 'self.time_budget_seconds'
+        self.start_time = time.time()
+
+    def get_remaining_seconds(self):
+        #  What is left of the time budget, or 'None' if there is no time budget
+        if self.time_budget_seconds is None:
+            return None
+        return max(self.time_budget_seconds - (time.time() - self.start_time), 0)
+
+    def has_time_for(self, size, bytes_per_second=None):
+        #  Description
+        #    Determine whether a copy of 'size' bytes fits in what is left of the time budget
+        #  Guarantees
+        #    True is returned if there is no time budget
+        #    Once the budget is spent, False is returned
+        #    Otherwise, a copy projected to end after the budget is refused, if 'bytes_per_second' is known
+
+        if self.time_budget_seconds is None:
+            return True
+        elapsed = time.time() - self.start_time
+        if elapsed >= self.time_budget_seconds:
+            return False
+        if bytes_per_second:
+            return elapsed + size / bytes_per_second <= self.time_budget_seconds
+        return True
@@ -0,0 +1,82 @@
+import json
+import os
+
+from .storage import LOCAL_STORAGE
+
+#  Each backed up media file also gets a cache file, which takes at least one filesystem block
+CACHE_FILE_OVERHEAD = 4096
+
+#  What to do when a backup mirror cannot hold every new media file
+WHEN_FULL_ABORT = 'abort'  # Copy nothing to the mirror
+WHEN_FULL_SUBSET = 'subset'  # Copy as many files as fit, in queue order
+
+def get_available_bytes(path, reserve_bytes=0, storage=None):
+    #  Free space on the filesystem holding 'path', less 'reserve_bytes'
+    #  A backend without a limit, like an object store, has infinite space
+    free_bytes = (storage or LOCAL_STORAGE).get_free_bytes(path)
+    if free_bytes is None:
+        return float('inf')
+    return max(free_bytes - reserve_bytes, 0)
+
+def get_required_bytes(size):
+    #  Space needed to back up a media file of 'size' bytes
+    return size + CACHE_FILE_OVERHEAD
+
+def select_to_fit(items, available_bytes):
+    #  Description
+    #    Select work items that fit in the available space
+    #  Requires
+    #    'items' is a list of (item, size) tuples, in queue order
+    #  Guarantees
+    #    A tuple is returned: (list of selected items, list of skipped items)
+    #    Items are taken in queue order; an item that does not fit is skipped, and smaller items after it may still fit
+
+    selected = []
+    skipped = []
+    for item, size in items:
+        required_bytes = get_required_bytes(size)
+        if required_bytes <= available_bytes:
+            selected.append(item)
+            available_bytes -= required_bytes
+        else:
+            skipped.append(item)
+    return selected, skipped
+
+def get_throughput_file(mirror_path):
+    return os.path.join(mirror_path, '.cache', 'throughput.json')
+
+def load_throughput(mirror_path, storage=None):
+    #  The write throughput measured by the last backup to the mirror, in bytes per second, or 'None'
+    storage = storage or LOCAL_STORAGE
+    throughput_file = get_throughput_file(mirror_path)
+    if not storage.isfile(throughput_file):
+        return None
+    try:
+        with storage.open(throughput_file, 'r') as file:
+            return json.load(file)['bytes_per_second']
+    except (ValueError, KeyError):
+        return None
+
+def save_throughput(mirror_path, bytes_copied, seconds, storage=None):
+    #  Description
+    #    Save the throughput of a backup run, so the next run can project its duration
+    #  Guarantees
+    #    Nothing is saved for a run too small to measure
+
+    if bytes_copied == 0 or seconds <= 0:
+        return
+    storage = storage or LOCAL_STORAGE
+    throughput_file = get_throughput_file(mirror_path)
+    storage.makedirs(os.path.dirname(throughput_file))
+    with storage.open(throughput_file, 'w') as file:
+        json.dump({'bytes_per_second': bytes_copied / seconds}, file)
+
+def format_duration(seconds):
+    #  Format a number of seconds for display, e.g. '1h 02m 03s'
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+        return '{0}h {1:02d}m {2:02d}s'.format(hours, minutes, seconds)
+    if minutes > 0:
+        return '{0}m {1:02d}s'.format(minutes, seconds)
+    return '{0}s'.format(seconds)
@@ -0,0 +1,250 @@
+import ctypes
+import errno
+import os
+import shutil
+import sys
+
+from . import page_cache
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#  Copy methods, from most to least preferred
+COPY_METHOD_REFLINK = 'reflink'
+COPY_METHOD_COPY_FILE_RANGE = 'copy_file_range'
+COPY_METHOD_SENDFILE = 'sendfile'
+COPY_METHOD_USERSPACE = 'userspace'
+
+#  One user-space read written to several libraries (see 'Library.copy_media_to_libraries')
+COPY_METHOD_FAN_OUT = 'fan-out'
+
+#  Only the changed blocks of an existing file are written (see 'Library.update_media')
+COPY_METHOD_DELTA = 'delta'
+
+#  ioctl(2) request to share the source file's extents with the destination (Linux)
+FICLONE = 0x40049409
+
+#  Errors that mean a method is not supported for a source/destination pair
+UNSUPPORTED_ERRNOS = {
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSUP,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EPERM,
+    errno.EXDEV
+}
+
+#  Methods found to be unsupported, as {(source_device, destination_device): set(methods)}
+_unsupported_methods = dict()
+
+#  fallocate(2) from the C library, found on first use (see 'fallocate')
+_fallocate_function = None
+
+#  User-space buffers are rounded up to a multiple of this many bytes, so every write but the last is block aligned
+WRITE_ALIGNMENT = 65536
+
+def copy_file(source_filepath, destination_filepath, throttle=None, buffer_size=1048576):
+    #  Description
+    #    Copy a file with the fastest mechanism available for the source/destination pair
+    #  Requires
+    #    'source_filepath' must exist on the filesystem
+    #    The directory of 'destination_filepath' must exist on the filesystem
+    #  Guarantees
+    #    The file is copied to 'destination_filepath', replacing any existing file
+    #    Unless the copy is a reflink, the destination is preallocated to the size of the source
+    #    The copy is flushed to the disc with os.fsync() before returning
+    #    The source file's pages are dropped from the page cache once it is copied
+    #    The metadata that 'shutil.copy2' preserves is preserved (see 'shutil.copystat')
+    #    The name of the copy method that was used is returned
+    #  Implementation Notes
+    #    Same-device copies try a reflink first, then 'copy_file_range' and 'sendfile'
+    #    A 'throttle' limits each write, so a throttled copy always uses user-space buffers
+    #    A method that fails, or ends before the end of the source (see 'check_copied_size'), is remembered
+    #    as unsupported for the device pair
+    #    Preallocation lets the filesystem reserve contiguous extents, which matters on nearly full discs
+
+    buffer_size = align_buffer_size(buffer_size)
+    with open(source_filepath, 'rb') as source_file, open(destination_filepath, 'wb') as destination_file:
+        source_fd = source_file.fileno()
+        destination_fd = destination_file.fileno()
+        device_pair = (os.fstat(source_fd).st_dev, os.fstat(destination_fd).st_dev)
+        unsupported_methods = _unsupported_methods.setdefault(device_pair, set())
+        source_size = os.fstat(source_fd).st_size
+
+        method = None
+        preallocated = False
+        if throttle is None:
+            for candidate_method, copy_function in get_kernel_copy_functions(device_pair):
+                if candidate_method in unsupported_methods:
+                    continue
+                #  A reflink shares the source's extents, so there is nothing to preallocate
+                if candidate_method != COPY_METHOD_REFLINK and not preallocated:
+                    preallocated = preallocate(destination_fd, source_size)
+                try:
+                    copy_function(source_fd, destination_fd, buffer_size)
+                    method = candidate_method
+                    break
+                except OSError as error:
+                    if error.errno not in UNSUPPORTED_ERRNOS:
+                        raise
+                    unsupported_methods.add(candidate_method)
+                    #  Start over from an empty destination
+                    source_file.seek(0)
+                    destination_file.seek(0)
+                    if not preallocated:
+                        destination_file.truncate()
+
+        if method is None:
+            if not preallocated:
+                preallocated = preallocate(destination_fd, source_size)
+            page_cache.advise_sequential(source_fd)
+            copy_userspace(source_file, destination_file, throttle, buffer_size)
+            method = COPY_METHOD_USERSPACE
+
+        destination_file.flush()
+        if preallocated:
+            #  Trim the preallocation, in case the source shrank while it was copied
+            os.ftruncate(destination_fd, os.lseek(destination_fd, 0, os.SEEK_CUR))
+        os.fsync(destination_fd)
+        page_cache.drop_cache(source_fd)
+
+    shutil.copystat(source_filepath, destination_filepath)
+    return method
+
+def clone_file(source_filepath, destination_filepath):
+    #  Description
+    #    Make 'destination_filepath' a reflink of 'source_filepath', sharing its extents
+    #  Guarantees
+    #    True is returned if the file was cloned; nothing is copied
+    #    False is returned, and no destination is left behind, where the filesystem can not share extents
+
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    with open(source_filepath, 'rb') as source_file, open(destination_filepath, 'wb') as destination_file:
+        device_pair = (os.fstat(source_file.fileno()).st_dev, os.fstat(destination_file.fileno()).st_dev)
+        unsupported_methods = _unsupported_methods.setdefault(device_pair, set())
+        cloned = False
+        if device_pair[0] == device_pair[1] and COPY_METHOD_REFLINK not in unsupported_methods:
+            try:
+                copy_reflink(source_file.fileno(), destination_file.fileno(), None)
+                cloned = True
+            except OSError as error:
+                if error.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                unsupported_methods.add(COPY_METHOD_REFLINK)
+    if not cloned:
+        os.remove(destination_filepath)
+        return False
+    shutil.copystat(source_filepath, destination_filepath)
+    return True
+
+def align_buffer_size(buffer_size):
+    #  Round a buffer size up to a multiple of 'WRITE_ALIGNMENT'
+    return -(-buffer_size // WRITE_ALIGNMENT) * WRITE_ALIGNMENT
+
+def preallocate(fd, size):
+    #  Description
+    #    Reserve 'size' bytes of disc space for a file that is about to be written
+    #  Guarantees
+    #    True is returned if the space was reserved; the file's size is then at least 'size'
+    #    False is returned if the platform or filesystem cannot preallocate
+    #    Running out of space raises OSError, before any data is copied
+    #  Implementation Notes
+    #    On Linux, the fallocate(2) system call is made directly: glibc's posix_fallocate() falls back to writing
+    #    every block where the filesystem can not preallocate (exFAT, NTFS-3g, NFS), which doubles the writes,
+    #    while the system call fails with EOPNOTSUPP
+
+    if size == 0:
+        return False
+    try:
+        if sys.platform.startswith('linux'):
+            fallocate(fd, 0, size)
+        elif hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            return False
+    except OSError as error:
+        if error.errno not in UNSUPPORTED_ERRNOS:
+            raise
+        return False
+    return True
+
+def fallocate(fd, offset, length):
+    #  Description
+    #    Reserve 'length' bytes of 'fd' from 'offset' with the fallocate(2) system call (Linux)
+    #  Guarantees
+    #    OSError is raised if the call fails, or the C library has no fallocate()
+
+    global _fallocate_function
+    if _fallocate_function is None:
+        libc = ctypes.CDLL(None, use_errno=True)
+        function = getattr(libc, 'fallocate64', None) or getattr(libc, 'fallocate', None)
+        if function is None:
+            raise OSError(errno.ENOSYS, 'fallocate() is not available')
+        function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        _fallocate_function = function
+    while _fallocate_function(fd, 0, offset, length) != 0:
+        error = ctypes.get_errno()
+        if error != errno.EINTR:
+            raise OSError(error, os.strerror(error))
+
+def get_kernel_copy_functions(device_pair):
+    #  Kernel copy methods that may work for the device pair, most preferred first
+    copy_functions = []
+    if fcntl is not None and sys.platform.startswith('linux') and device_pair[0] == device_pair[1]:
+        copy_functions.append((COPY_METHOD_REFLINK, copy_reflink))
+    if hasattr(os, 'copy_file_range'):
+        copy_functions.append((COPY_METHOD_COPY_FILE_RANGE, copy_with_copy_file_range))
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        copy_functions.append((COPY_METHOD_SENDFILE, copy_with_sendfile))
+    return copy_functions
+
+def copy_reflink(source_fd, destination_fd, buffer_size):
+    fcntl.ioctl(destination_fd, FICLONE, source_fd)
+
+def copy_with_copy_file_range(source_fd, destination_fd, buffer_size):
+    copied = 0
+    while True:
+        count = os.copy_file_range(source_fd, destination_fd, buffer_size)
+        if count == 0:
+            break
+        copied += count
+    check_copied_size(source_fd, copied)
+
+def copy_with_sendfile(source_fd, destination_fd, buffer_size):
+    offset = 0
+    while True:
+        sent = os.sendfile(destination_fd, source_fd, offset, buffer_size)
+        if sent == 0:
+            break
+        offset += sent
+    check_copied_size(source_fd, offset)
+
+def check_copied_size(source_fd, copied):
+    #  Description
+    #    Check that a kernel copy reached the end of the source
+    #  Guarantees
+    #    OSError (EOPNOTSUPP) is raised if fewer bytes were copied than the source holds, so the method is treated
+    #    as unsupported for the device pair
+    #  Implementation Notes
+    #    Some kernels and filesystems return 0 before the end of the file: cross-filesystem copy_file_range on
+    #    Linux 5.3 to 5.18, FUSE, CIFS and overlayfs
+    #    The size is read again, so a source that shrank while it was copied is not taken for a short copy
+
+    source_size = os.fstat(source_fd).st_size
+    if copied < source_size:
+        raise OSError(errno.EOPNOTSUPP, 'The copy ended at {0} of {1} bytes'.format(copied, source_size))
+
+def copy_userspace(source_file, destination_file, throttle, buffer_size):
+    while True:
+        data = source_file.read(buffer_size)
+        if not data:
+            break
+        if throttle:
+            throttle.write(destination_file, data)
+        else:
+            destination_file.write(data)
@@ -0,0 +1,176 @@
+import hashlib
+import math
+import zlib
+
+#  Blocks are at least a page, and at most the largest block rsync uses
+MIN_BLOCK_SIZE = 4096
+MAX_BLOCK_SIZE = 131072
+
+#  The weak checksum is Adler-32 (see 'zlib.adler32'), which can be rolled forward one byte at a time
+ADLER_MODULUS = 65521
+
+#  The source is read in pieces of this many bytes
+READ_SIZE = 1048576
+
+#  Smaller files are copied in full; there is little to save
+MIN_FILE_SIZE = 1048576
+
+#  Searching unmatched data is slow (see 'plan_delta'), so a file that differs by more than this is copied in full
+MAX_LITERAL_BYTES = 16777216
+
+def get_block_size(file_size):
+    #  About the square root of the file's size, as rsync does, rounded down to whole pages
+    block_size = int(math.sqrt(file_size)) // MIN_BLOCK_SIZE * MIN_BLOCK_SIZE
+    return min(max(block_size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+def get_signature(basis_file, block_size):
+    #  Description
+    #    Checksum each block of the file that is being updated
+    #  Guarantees
+    #    A dict is returned: {weak checksum: [(offset, length, strong checksum)]}
+    #    The last block may be shorter than 'block_size'
+    #    'basis_file' is read from its start to its end
+
+    signature = dict()
+    basis_file.seek(0)
+    offset = 0
+    while True:
+        block = basis_file.read(block_size)
+        if not block:
+            break
+        weak = zlib.adler32(block)
+        signature.setdefault(weak, []).append((offset, len(block), hashlib.sha1(block).digest()))
+        offset += len(block)
+    return signature
+
+def find_block(signature, weak, window, position):
+    #  The offset of a basis block with the same content as 'window', or 'None'
+    #  A block before 'position' may already have been overwritten, so it is never used
+    #  The block at 'position' itself is preferred, as it need not be written at all
+    strong = None
+    found = None
+    for offset, length, block_strong in signature.get(weak, ()):
+        if length != len(window) or offset < position:
+            continue
+        if strong is None:
+            strong = hashlib.sha1(window).digest()
+        if block_strong == strong:
+            if offset == position:
+                return offset
+            if found is None:
+                found = offset
+    return found
+
+def plan_delta(source_file, signature, block_size, max_literal_bytes):
+    #  Description
+    #    Find the blocks of the basis file that can be reused in the source, with a rolling checksum
+    #  Requires
+    #    'signature' is from 'get_signature', with the same 'block_size'
+    #  Guarantees
+    #    A list of instructions is returned, in order of their offset in the source:
+    #      (offset, basis_offset, length, None) reuses 'length' bytes of the basis file from 'basis_offset'
+    #      (offset, None, length, data) writes the source's own data
+    #    Applied in order to the basis file itself, the instructions turn it into the source (see 'apply_delta')
+    #    'None' is returned once more than 'max_literal_bytes' of the source would have to be written
+    #  Implementation Notes
+    #    The checksum of a block is rolled forward one byte at a time, so a block is found wherever it moved to
+    #    Rolling is done in Python, so unmatched data is slow to search; 'max_literal_bytes' also bounds that time
+
+    instructions = []
+    literal_bytes = 0
+    buffer = b''
+    buffer_offset = 0  # The offset of 'buffer' in the source
+    position = 0  # The offset of the window in the source
+    literal_start = 0  # The offset of the unmatched data before the window
+    weak = None
+    end_of_file = False
+
+    def add_instruction(offset, basis_offset, length, data):
+        if instructions and basis_offset is not None:
+            last_offset, last_basis_offset, last_length, _ = instructions[-1]
+            if last_basis_offset is not None and last_offset + last_length == offset and last_basis_offset + last_length == basis_offset:
+                instructions[-1] = (last_offset, last_basis_offset, last_length + length, None)
+                return
+        instructions.append((offset, basis_offset, length, data))
+
+    while True:
+        #  The window, and the byte after it, must be in the buffer
+        if position + block_size + 1 > buffer_offset + len(buffer) and not end_of_file:
+            data = source_file.read(READ_SIZE)
+            end_of_file = len(data) == 0
+            buffer = buffer[literal_start - buffer_offset:] + data
+            buffer_offset = literal_start
+            continue
+        start = position - buffer_offset
+        window_length = min(block_size, len(buffer) - start)
+        if window_length < block_size:
+            break
+        if weak is None:
+            weak = zlib.adler32(buffer[start:start + block_size])
+        if weak in signature:
+            basis_offset = find_block(signature, weak, buffer[start:start + block_size], position)
+            if basis_offset is not None:
+                if literal_start < position:
+                    add_instruction(literal_start, None, position - literal_start, buffer[literal_start - buffer_offset:start])
+                    literal_bytes += position - literal_start
+                add_instruction(position, basis_offset, block_size, None)
+                position += block_size
+                literal_start = position
+                weak = None
+                continue
+        if start + block_size >= len(buffer):
+            break
+
+        #  Roll the window forward by one byte
+        out_byte = buffer[start]
+        in_byte = buffer[start + block_size]
+        a = ((weak & 0xffff) - out_byte + in_byte) % ADLER_MODULUS
+        b = ((weak >> 16) - block_size * out_byte + a - 1) % ADLER_MODULUS
+        weak = (b << 16) | a
+        position += 1
+        if literal_bytes + position - literal_start > max_literal_bytes:
+            return None
+
+    #  The rest of the source is shorter than a block; it is reused only if it is the basis file's own last block
+    tail = buffer[literal_start - buffer_offset:]
+    tail_offset = find_block(signature, zlib.adler32(tail), tail, literal_start) if literal_start == position and tail else None
+    if tail_offset is not None:
+        add_instruction(literal_start, tail_offset, len(tail), None)
+    elif tail:
+        if literal_bytes + len(tail) > max_literal_bytes:
+            return None
+        add_instruction(literal_start, None, len(tail), tail)
+    return instructions
+
+def apply_delta(file, instructions, size, buffer_size=READ_SIZE):
+    #  Description
+    #    Update the basis file in place, so that it matches the source
+    #  Requires
+    #    'file' is the basis file, open for reading and writing ('r+b')
+    #    'instructions' are from 'plan_delta', and 'size' is the size of the source
+    #  Guarantees
+    #    Only the data that differs from what is already at each offset is written
+    #    The file is truncated to 'size'
+    #    The number of bytes written is returned
+    #  Implementation Notes
+    #    Reused blocks only ever move towards the start of the file, so copying each one forward is safe
+
+    written = 0
+    for offset, basis_offset, length, data in instructions:
+        if basis_offset == offset:
+            continue
+        if basis_offset is None:
+            file.seek(offset)
+            file.write(data)
+            written += length
+            continue
+        copied = 0
+        while copied < length:
+            file.seek(basis_offset + copied)
+            data = file.read(min(buffer_size, length - copied))
+            file.seek(offset + copied)
+            file.write(data)
+            copied += len(data)
+        written += length
+    file.truncate(size)
+    return written
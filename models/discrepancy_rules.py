@@ -0,0 +1,79 @@
+#  Kinds of checksum discrepancy
+DISCREPANCY_LOCAL = 'local'  # A media file no longer matches its own cache file
+DISCREPANCY_MIRROR = 'mirror'  # The source and backup cache files disagree
+
+#  Actions a rule can choose
+ACTION_UPDATE_CACHE = 'update_cache'  # Accept the new checksum of the file with the local discrepancy
+ACTION_COPY_SOURCE_TO_BACKUP = 'copy_source_to_backup'
+ACTION_COPY_BACKUP_TO_SOURCE = 'copy_backup_to_source'
+
+class Discrepancy(object):
+    def __init__(self, kind: str, library_name: str, path_in_library: str, is_source: bool,
+                 source_library, source_media, backup_library, backup_media):
+        self.kind = kind
+        self.library_name = library_name
+        self.path_in_library = path_in_library
+        self.is_source = is_source  # For local discrepancies, whether the source file is the one that changed
+        self.source_library = source_library
+        self.source_media = source_media  # 'None' if the file does not exist in the source
+        self.backup_library = backup_library
+        self.backup_media = backup_media  # 'None' if the file does not exist in the backup
+
+    @property
+    def changed_media(self):
+        #  The media file with the local discrepancy
+        return self.source_media if self.is_source else self.backup_media
+
+    @property
+    def mirror_media(self):
+        #  The other copy of the media file with the local discrepancy
+        return self.backup_media if self.is_source else self.source_media
+
+#  Rules
+#  Each rule returns an action for a discrepancy, or 'None' if the rule does not apply
+
+def source_newer_mtime_wins(discrepancy):
+    #  The source file was modified after the backup file, so the source is the new version
+    if discrepancy.kind == DISCREPANCY_MIRROR:
+        source_media, backup_media = discrepancy.source_media, discrepancy.backup_media
+        if source_media.storage.stat(source_media.path).st_mtime > backup_media.storage.stat(backup_media.path).st_mtime:
+            return ACTION_COPY_SOURCE_TO_BACKUP
+    return None
+
+def restore_from_intact_mirror(discrepancy):
+    #  The other copy still matches its own cache file, and both cache files agree
+    #  The changed file is damaged; restore it from the other copy
+    if discrepancy.kind == DISCREPANCY_LOCAL and discrepancy.mirror_media is not None:
+        changed_media = discrepancy.changed_media
+        mirror_media = discrepancy.mirror_media
+        if mirror_media.real_checksum == mirror_media.cached_checksum == changed_media.cached_checksum:
+            return ACTION_COPY_BACKUP_TO_SOURCE if discrepancy.is_source else ACTION_COPY_SOURCE_TO_BACKUP
+    return None
+
+def accept_new_checksum_when_size_changed(discrepancy):
+    #  Bit rot does not change the size of a file; a new size means the file was edited
+    if discrepancy.kind == DISCREPANCY_LOCAL:
+        changed_media = discrepancy.changed_media
+        if changed_media.cached_size is not None and changed_media.cached_size != changed_media.real_size:
+            return ACTION_UPDATE_CACHE
+    return None
+
+#  Rules by name, in the order they are offered
+RULES = [
+    ('restore_from_intact_mirror', restore_from_intact_mirror),
+    ('accept_new_checksum_when_size_changed', accept_new_checksum_when_size_changed),
+    ('source_newer_mtime_wins', source_newer_mtime_wins)
+]
+
+def choose_action(discrepancy, rules):
+    #  Description
+    #    Apply 'rules' to a discrepancy in order
+    #  Guarantees
+    #    The action of the first rule that applies is returned
+    #    'None' is returned if no rule applies
+
+    for rule in rules:
+        action = rule(discrepancy)
+        if action is not None:
+            return action
+    return None
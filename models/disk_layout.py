@@ -0,0 +1,106 @@
+import os
+import struct
+import sys
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#  ioctl(2) request for a file's extent map (Linux)
+FS_IOC_FIEMAP = 0xC020660B
+
+#  struct fiemap, followed by 'fm_extent_count' struct fiemap_extent
+FIEMAP_HEADER = struct.Struct('=QQLLLL')
+FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+
+#  Files that can no longer be read sort last
+MISSING_LAYOUT_KEY = (sys.maxsize, sys.maxsize)
+
+def get_fiemap(path, extent_count):
+    #  Description
+    #    Get the extent map of a file with the FIEMAP ioctl
+    #  Guarantees
+    #    A tuple is returned: (number of mapped extents, list of (logical, physical, length) tuples)
+    #    With an 'extent_count' of 0, only the number of extents is returned
+    #    'None' is returned if FIEMAP is not available for the file
+    #  Implementation Notes
+    #    FIEMAP_FLAG_SYNC is not passed, as it would write out the file's dirty pages first; copies are synced
+    #    before their extents are counted, and files sorted by layout are not being written
+
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return None
+    buffer = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size * extent_count)
+    FIEMAP_HEADER.pack_into(buffer, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, extent_count, 0)
+    try:
+        with open(path, 'rb') as file:
+            fcntl.ioctl(file.fileno(), FS_IOC_FIEMAP, buffer)
+    except OSError:
+        return None
+    mapped_extents = FIEMAP_HEADER.unpack_from(buffer, 0)[3]
+    extents = []
+    for index in range(min(mapped_extents, extent_count)):
+        extent = FIEMAP_EXTENT.unpack_from(buffer, FIEMAP_HEADER.size + FIEMAP_EXTENT.size * index)
+        extents.append((extent[0], extent[1], extent[2]))
+    return mapped_extents, extents
+
+def get_extent_count(path):
+    #  Description
+    #    Get the number of extents a file is stored in, as a measure of fragmentation
+    #  Guarantees
+    #    'None' is returned if FIEMAP is not available for the file
+
+    fiemap = get_fiemap(path, 0)
+    if fiemap is None:
+        return None
+    return fiemap[0]
+
+def get_layout_key(path):
+    #  Description
+    #    Get a key that sorts files by their physical position on disk
+    #  Guarantees
+    #    A tuple is returned: (device, position)
+    #    The position is the physical offset of the first extent when FIEMAP is available
+    #    Otherwise, the position is the inode number, which loosely follows allocation order
+    #    Files that can no longer be read sort last
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return MISSING_LAYOUT_KEY
+    fiemap = get_fiemap(path, 1)
+    if fiemap and fiemap[1]:
+        return (stat.st_dev, fiemap[1][0][1])
+    return (stat.st_dev, stat.st_ino)
+
+def get_layout_keys(filepaths, storage=None):
+    #  The layout key of each item's file, from the backend the files are stored on (see 'storage')
+    #  Files on the local filesystem are used if 'storage' is 'None'
+    get_key = get_layout_key if storage is None else storage.get_layout_key
+    return {item: get_key(filepath) for item, filepath in filepaths.items()}
+
+def sort_by_layout(filepaths, storage=None):
+    #  Description
+    #    Sort work items by the physical layout of their files
+    #  Requires
+    #    'filepaths' is a dict of {'item': 'absolute file path'}, of files on 'storage'
+    #  Guarantees
+    #    A list of the items is returned, grouped by device and ordered by position on the device
+
+    layout_keys = get_layout_keys(filepaths, storage)
+    return sorted(filepaths, key=lambda item: layout_keys[item])
+
+def group_by_device(filepaths, storage=None):
+    #  Description
+    #    Group work items by the device their files are stored on
+    #  Requires
+    #    'filepaths' is a dict of {'item': 'absolute file path'}, of files on 'storage'
+    #  Guarantees
+    #    A list of lists of items is returned; one list per device
+    #    Each list is ordered by position on the device
+
+    layout_keys = get_layout_keys(filepaths, storage)
+    groups = dict()
+    for item in sorted(filepaths, key=lambda item: layout_keys[item]):
+        groups.setdefault(layout_keys[item][0], []).append(item)
+    return list(groups.values())
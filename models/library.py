@@ -1,16 +1,35 @@
+import errno
+import hashlib
+import io
+import json
 import os
-import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 
+from . import copy_engine
+from . import delta_transfer
+from . import disk_layout
 from .media_file import MediaFile
 from .result import Result
+from .storage import LOCAL_STORAGE
+from .storage import copy_between
+from .tree_snapshot import TreeSnapshot
 
 class Library(object):
-    def __init__(self, name: str, path: str, source: bool):
+    def __init__(self, name: str, path: str, source: bool, throttle=None, storage=None):
         self.name = name
         self.path = path
         self.source = source
+        self.throttle = throttle  # Optional Throttle for reads from, and writes to, the library
+        self.storage = storage or LOCAL_STORAGE  # The backend the library is stored on (see 'storage')
         self.media = dict()  # {'path_in_library': MediaFileObject}
+        self.snapshot = None  # TreeSnapshot of every file and directory, captured by 'load_all_media'
+        self.copy_buffer_size = 8388608
+
+        #  Listings of unchanged directories are reused from this file (see 'load_all_media')
+        self.directory_index_file = os.path.join(self.path, '.cache', 'directory_index.json')
 
         self.allowed_media_extensions = [
             '.3gpp',
@@ -56,28 +75,222 @@ class Library(object):
         #    'self.path' must exist on the filesystem
         #  Guarantees
         #    All media files with 'allowed_media_extensions' are added to 'self.media'
+        #    Every file and directory, including '.cache' directories, is captured in 'self.snapshot'
+        #    The listing of each directory is saved to 'self.directory_index_file'
+        #  Implementation Notes
+        #    Adding, removing or renaming an entry changes the modification time of its directory
+        #    A directory whose modification time has not changed reuses its saved listing
+        #    Every directory is still checked with stat(), but only changed directories are listed
+        #    '.cache' directories are checked like the others, but their files are not media
 
         #  Reset 'self.media'
         #  Old members may no longer exist
         self.media.clear()
+        snapshot = TreeSnapshot()
+
+        saved_index = self.load_directory_index()
+        directory_index = dict()
+        unsettled_time_ns = int((time.time() - 2) * 1e9)
 
         #  Populate 'self.media'
-        for dirpath, _, filenames in os.walk(self.path):
-            if '.cache' not in dirpath:
-                for filename in filenames:
-                    if os.path.splitext(filename)[1] in self.allowed_media_extensions:
-                        filepath = os.path.join(dirpath, filename)
-                        filepath_in_library = filepath.replace(self.path + os.sep, '')
-                        self.media[filepath_in_library] = MediaFile(filepath, filepath_in_library, self.source)
-                        if callback_on_progress:
-                            callback_on_progress(
-                                mirror_is_source=self.source,
-                                library_name=self.name,
-                                current_media_count=len(self.media)
-                            )
+        directories_to_load = ['']
+        while directories_to_load:
+            directory_in_library = directories_to_load.pop()
+            dirpath = os.path.join(self.path, directory_in_library) if directory_in_library else self.path
+            try:
+                mtime_ns = self.storage.stat(dirpath).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            #  A listing saved before other files and '.cache' directories were indexed is not reused
+            saved_listing = saved_index.get(directory_in_library)
+            if saved_listing and saved_listing['mtime_ns'] == mtime_ns and 'others' in saved_listing:
+                filenames = saved_listing['files']
+                other_filenames = saved_listing['others']
+                dirnames = saved_listing['dirs']
+                cache_dirnames = saved_listing['cache_dirs']
+            else:
+                filenames, other_filenames, dirnames, cache_dirnames = self.scan_directory(dirpath)
+
+            #  A directory modified in the last two seconds may change again within the same timestamp
+            #  Its listing is saved without a modification time, so it is listed again next time
+            #  So is the directory of the index itself, which changes each time the index is saved
+            settled = mtime_ns < unsettled_time_ns and dirpath != os.path.dirname(self.directory_index_file)
+            directory_index[directory_in_library] = {
+                'mtime_ns': mtime_ns if settled else None,
+                'files': filenames,
+                'others': other_filenames,
+                'dirs': dirnames,
+                'cache_dirs': cache_dirnames
+            }
+            snapshot.set_listing(directory_in_library, filenames + other_filenames, dirnames + cache_dirnames)
+            for dirname in reversed(cache_dirnames + dirnames):
+                directories_to_load.append(os.path.join(directory_in_library, dirname))
+            if '.cache' in directory_in_library:
+                continue
+
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                filepath_in_library = os.path.join(directory_in_library, filename)
+                self.media[filepath_in_library] = MediaFile(filepath, filepath_in_library, self.source, self.throttle, self.storage)
+                if callback_on_progress:
+                    callback_on_progress(
+                        mirror_is_source=self.source,
+                        library_name=self.name,
+                        current_media_count=len(self.media)
+                    )
+
+        #  The saved index is listed in its own directory; an unchanged index is not written again
+        index_directory, index_name = os.path.split(os.path.relpath(self.directory_index_file, self.path))
+        if index_directory in directory_index and index_name not in directory_index[index_directory]['others']:
+            directory_index[index_directory]['others'] = sorted(directory_index[index_directory]['others'] + [index_name])
+        if (saved_index and directory_index == saved_index) or self.save_directory_index(directory_index):
+            snapshot.add_file(os.path.relpath(self.directory_index_file, self.path))
+        self.snapshot = snapshot
         return True
 
-    def copy_media(self, source_filepath, path_in_library, source_checksum):
+    def list_directory(self, dirpath):
+        #  Description
+        #    List the media files and sub-directories of a directory in the library
+        #  Guarantees
+        #    A tuple is returned: (sorted media file names, sorted sub-directory names)
+        #    Only files with 'allowed_media_extensions' are listed
+        #    '.cache' directories are not listed
+
+        filenames, _, dirnames, _ = self.scan_directory(dirpath)
+        return filenames, dirnames
+
+    def list_snapshot_directory(self, directory_in_library):
+        #  As 'list_directory', from 'self.snapshot' instead of the disc
+        filenames, dirnames = self.snapshot.get_listing(directory_in_library)
+        return (
+            sorted(filename for filename in filenames if os.path.splitext(filename)[1] in self.allowed_media_extensions),
+            sorted(dirname for dirname in dirnames if '.cache' not in dirname)
+        )
+
+    def scan_directory(self, dirpath):
+        #  Description
+        #    List every entry of a directory in the library, by kind
+        #  Guarantees
+        #    A tuple of sorted names is returned:
+        #      (media files, other files, sub-directories, '.cache' directories)
+        #    Media files have 'allowed_media_extensions'
+
+        filenames = []
+        other_filenames = []
+        dirnames = []
+        cache_dirnames = []
+        for entry in self.storage.scandir(dirpath):
+            if entry.is_dir(follow_symlinks=False):
+                if '.cache' in entry.name:
+                    cache_dirnames.append(entry.name)
+                else:
+                    dirnames.append(entry.name)
+            elif os.path.splitext(entry.name)[1] in self.allowed_media_extensions:
+                filenames.append(entry.name)
+            else:
+                other_filenames.append(entry.name)
+        return sorted(filenames), sorted(other_filenames), sorted(dirnames), sorted(cache_dirnames)
+
+    def reload_directory(self, directory_in_library, changed_names=()):
+        #  Description
+        #    Bring 'self.media' and 'self.snapshot' up to date with a directory that changed after the library was loaded
+        #  Requires
+        #    The library is loaded (see 'load_all_media')
+        #  Guarantees
+        #    Media files added to the directory are added to 'self.media'; deleted ones are removed
+        #    Media files named in 'changed_names' are replaced, so their size, modification time and checksum are read again
+        #    New sub-directories are loaded in full; deleted ones are removed, with their media
+        #    A directory that no longer exists is removed, with everything under it
+        #    A list of the paths_in_library of the media added or replaced is returned
+        #  Implementation Notes
+        #    Only the directory and its new sub-directories are listed; the rest of the library is not visited
+        #    New media is found by comparing the listing with 'self.snapshot', so a library that was not loaded
+        #    only reports the media added since its snapshot was captured
+
+        snapshot = self.get_snapshot()
+        dirpath = os.path.join(self.path, directory_in_library) if directory_in_library else self.path
+        try:
+            filenames, other_filenames, dirnames, cache_dirnames = self.scan_directory(dirpath)
+        except (FileNotFoundError, NotADirectoryError):
+            self.forget_directory(directory_in_library)
+            return []
+
+        old_filenames, old_dirnames = snapshot.get_listing(directory_in_library)
+        for dirname in old_dirnames - set(dirnames + cache_dirnames):
+            self.forget_directory(os.path.join(directory_in_library, dirname))
+        snapshot.set_listing(directory_in_library, filenames + other_filenames, dirnames + cache_dirnames)
+        changed_media = []
+        if '.cache' not in directory_in_library:
+            for filename in old_filenames - set(filenames):
+                self.media.pop(os.path.join(directory_in_library, filename), None)
+            for filename in filenames:
+                if filename in changed_names or filename not in old_filenames:
+                    filepath = os.path.join(dirpath, filename)
+                    filepath_in_library = os.path.join(directory_in_library, filename)
+                    self.media[filepath_in_library] = MediaFile(filepath, filepath_in_library, self.source, self.throttle, self.storage)
+                    changed_media.append(filepath_in_library)
+        for dirname in cache_dirnames + dirnames:
+            if dirname not in old_dirnames:
+                changed_media += self.reload_directory(os.path.join(directory_in_library, dirname))
+        return changed_media
+
+    def forget_directory(self, directory_in_library):
+        #  Remove a deleted directory, and everything under it, from 'self.media' and 'self.snapshot'
+        snapshot = self.get_snapshot()
+        for path_in_library in snapshot.get_files_under(directory_in_library):
+            self.media.pop(path_in_library, None)
+        snapshot.remove_directory(directory_in_library)
+
+    def load_directory_index(self):
+        #  The saved listing of each directory, as {'directory_in_library': {'mtime_ns', 'files', 'dirs'}}
+        #  A missing or unreadable index is treated as empty, so every directory is listed
+        try:
+            with self.storage.open(self.directory_index_file, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return dict()
+
+    def save_directory_index(self, directory_index):
+        #  Write to a temporary file first, so an interrupted write never leaves a partial index
+        #  True is returned if the index was saved
+        try:
+            self.storage.makedirs(os.path.dirname(self.directory_index_file))
+            temporary_file = self.directory_index_file + '.tmp'
+            with self.storage.open(temporary_file, 'w') as file:
+                json.dump(directory_index, file)
+            self.storage.replace(temporary_file, self.directory_index_file)
+            return True
+        except OSError:
+            #  A read-only library still loads; it is listed in full next time
+            return False
+
+    def iterate_media(self):
+        #  Description
+        #    Yield every media file in the library, without populating 'self.media'
+        #  Requires
+        #    'self.path' must exist on the filesystem
+        #  Guarantees
+        #    A MediaFile object is yielded for each media file with 'allowed_media_extensions'
+        #    Media is yielded in 'mirror_diff.get_sort_key' order
+        #    Only the listings of the directories being walked are held in memory
+        #    Once the library is loaded, the listings come from 'self.snapshot' and the library is not walked
+
+        def iterate_directory(dirpath, prefix):
+            if self.snapshot is None:
+                filenames, dirnames = self.list_directory(dirpath)
+            else:
+                filenames, dirnames = self.list_snapshot_directory(prefix[:-len(os.sep)])
+            for filename in filenames:
+                yield MediaFile(os.path.join(dirpath, filename), prefix + filename, self.source, self.throttle, self.storage)
+            for dirname in dirnames:
+                for media in iterate_directory(os.path.join(dirpath, dirname), prefix + dirname + os.sep):
+                    yield media
+
+        for media in iterate_directory(self.path, ''):
+            yield media
+
+    def copy_media(self, source_filepath, path_in_library, source_checksum, source_storage=None):
         #  Description
         #    Copy a media file into the library from an outside location
         #  Requires
@@ -90,46 +303,54 @@ class Library(object):
         #    The file will have cache_file generated in the library
         #    The copied file will be added to 'self.media' as 'self.media[path_in_library]'
         #    If the checksum match fails, the copied file is deleted from the library
+        #    If the copy fails with OSError, the partial copy is deleted and the error is raised
+        #    The Result's 'copy_method' metric names the mechanism used (see 'copy_engine')
+        #    'source_filepath' is read from 'source_storage', which defaults to the library's own storage
 
         #  Verify the file exists
-        if os.path.exists(source_filepath):
+        source_storage = source_storage or self.storage
+        if source_storage.exists(source_filepath):
             destination_filepath= os.path.join(self.path, path_in_library)
-            if os.path.exists(destination_filepath):
+            if self.storage.exists(destination_filepath):
                 return Result(
                     subject=source_filepath,
                     success=False,
                     message='Media already exists in library.'
                 )
             else:
-                #  Make missing directories
-                if not os.path.exists(os.path.dirname(destination_filepath)):
-                    os.makedirs(os.path.dirname(destination_filepath))
+                #  Make missing directories; another thread may be making them too
+                self.storage.makedirs(os.path.dirname(destination_filepath))
 
                 #  Copy from source to destination
-                shutil.copy2(source_filepath, destination_filepath)
-
-                #  Add the library object to 'self.media' as {'path_in_library': MediaFileObject}
-                self.media[path_in_library] = MediaFile(destination_filepath, path_in_library, self.source)
-
-                #  Verify the source and copied files' checksums match
-                if self.media[path_in_library].real_checksum == source_checksum:
-                    self.media[path_in_library].save_cache_file(overwrite=False)
-                    self.media[path_in_library].load_cache_file()
-                    return Result(subject=source_filepath, success=True)
-                else:
-                    #  Something went wrong, undo the copy
-                    copied_file_checksum = self.media[path_in_library].real_checksum
-                    self.delete_media(path_in_library)
-                    return Result(
-                        subject=source_filepath,
-                        success=False,
-                        message=(
-                            'Checksums for source file and copied file do not match.' +
-                            '\nThe copied file has been deleted.' +
-                            '\nSource file checksum: {}'.format(source_checksum) +
-                            '\nCopied file checksum: {}'.format(copied_file_checksum)
+                #  A copy interrupted by an I/O error is removed before the error is raised
+                try:
+                    if source_storage is self.storage:
+                        copy_method = self.storage.copy_file(
+                            source_filepath,
+                            destination_filepath,
+                            throttle=self.throttle,
+                            buffer_size=self.copy_buffer_size
                         )
-                    )
+                    else:
+                        copy_method = copy_between(
+                            source_storage,
+                            source_filepath,
+                            self.storage,
+                            destination_filepath,
+                            throttle=self.throttle,
+                            buffer_size=self.copy_buffer_size
+                        )
+                    result = self.verify_copied_media(source_filepath, path_in_library, source_checksum)
+                except OSError:
+                    self.media.pop(path_in_library, None)
+                    if self.storage.exists(destination_filepath):
+                        self.storage.remove(destination_filepath)
+                    raise
+                result.metrics['copy_method'] = copy_method
+                if result.success:
+                    result.metrics['bytes'] = self.storage.stat(destination_filepath).st_size
+                    result.metrics['extents'] = self.storage.get_extent_count(destination_filepath)
+                return result
         else:
             return Result(
                 subject=source_filepath,
@@ -137,6 +358,221 @@ class Library(object):
                 message='Source file does not exist.'
             )
 
+    def update_media(self, source_filepath, path_in_library, source_checksum, source_storage=None):
+        #  Description
+        #    Update a media file in the library in place, so it matches 'source_filepath', writing only the changed blocks
+        #  Requires
+        #    'path_in_library' must be a key in 'self.media'
+        #    'source_checksum' must match the checksum for the file in 'source_filepath'
+        #  Guarantees
+        #    'None' is returned, and the file is not changed, where a full copy is as cheap (see 'delta_transfer'):
+        #      The files are small, or differ by more than 'delta_transfer.MAX_LITERAL_BYTES'
+        #      The storage can not update files in place, e.g. pack files and object stores
+        #    Otherwise the updated file is verified as a copy is (see 'verify_copied_media'), and its Result is returned
+        #    If the checksum match fails, or the update fails with OSError, the file is deleted from the library
+        #    The Result's 'bytes' metric is the bytes written, and 'bytes_saved' the bytes of the file that were not
+
+        source_storage = source_storage or self.storage
+        destination_filepath = os.path.join(self.path, path_in_library)
+        size = source_storage.stat(source_filepath).st_size
+        basis_size = self.storage.stat(destination_filepath).st_size
+        if max(size, basis_size) < delta_transfer.MIN_FILE_SIZE:
+            return None
+        block_size = delta_transfer.get_block_size(basis_size)
+        max_literal_bytes = min(delta_transfer.MAX_LITERAL_BYTES, size // 2)
+        try:
+            file = self.storage.open(destination_filepath, 'r+b')
+        except io.UnsupportedOperation:
+            return None
+        updating = False
+        try:
+            with file:
+                self.storage.advise_sequential(file)
+                signature = delta_transfer.get_signature(file, block_size)
+                with source_storage.open(source_filepath, 'rb') as source_file:
+                    source_storage.advise_sequential(source_file)
+                    instructions = delta_transfer.plan_delta(source_file, signature, block_size, max_literal_bytes)
+                if instructions is None:
+                    return None
+                updating = True
+                written = delta_transfer.apply_delta(file, instructions, size)
+                self.storage.sync(file)
+        except OSError:
+            if updating:
+                self.delete_media(path_in_library)
+            raise
+
+        #  The old cache and parity files describe the old contents, so they are replaced
+        media = self.media[path_in_library]
+        for filepath in (media.cache_file, media.prehash_file, media.parity_file):
+            if self.storage.exists(filepath):
+                self.storage.remove(filepath)
+        result = self.verify_copied_media(source_filepath, path_in_library, source_checksum)
+        result.metrics['copy_method'] = copy_engine.COPY_METHOD_DELTA
+        if result.success:
+            result.metrics['bytes'] = written
+            result.metrics['bytes_saved'] = size - written
+        return result
+
+    def verify_copied_media(self, source_filepath, path_in_library, source_checksum):
+        #  Description
+        #    Verify a media file that was just copied into the library
+        #  Requires
+        #    The copied file must exist at 'path_in_library' under 'self.path'
+        #    The copied file must be flushed to the disc (see 'LocalStorage.sync')
+        #    'source_checksum' must match the checksum for the file in 'source_filepath'
+        #  Guarantees
+        #    The copied file will be added to 'self.media' as 'self.media[path_in_library]'
+        #    If the checksums match, the copied file will have cache_file generated in the library
+        #    If the checksum match fails, the copied file is deleted from the library
+
+        #  Add the library object to 'self.media' as {'path_in_library': MediaFileObject}
+        #  The copied file is read again from the disc; a pre-computed checksum is never trusted here
+        #  The copy was flushed to the disc, so dropping its cached pages forces a real read back
+        #  A backend that verified the copy as it was written (e.g. against an object store's ETag) is not read back
+        destination_filepath = os.path.join(self.path, path_in_library)
+        self.media[path_in_library] = MediaFile(destination_filepath, path_in_library, self.source, self.throttle, self.storage)
+        verified_checksum = self.storage.get_verified_checksum(destination_filepath)
+        if verified_checksum is not None:
+            self.media[path_in_library].real_checksum = verified_checksum
+        else:
+            self.media[path_in_library].generate_checksum(drop_cache=True)
+
+        #  Verify the source and copied files' checksums match
+        if self.media[path_in_library].real_checksum == source_checksum:
+            self.media[path_in_library].save_cache_file(overwrite=False)
+            self.media[path_in_library].load_cache_file()
+            if self.snapshot is not None:
+                self.snapshot.add_media(path_in_library)
+            return Result(subject=source_filepath, success=True)
+        else:
+            #  Something went wrong, undo the copy
+            copied_file_checksum = self.media[path_in_library].real_checksum
+            self.delete_media(path_in_library)
+            return Result(
+                subject=source_filepath,
+                success=False,
+                message=(
+                    'Checksums for source file and copied file do not match.' +
+                    '\nThe copied file has been deleted.' +
+                    '\nSource file checksum: {}'.format(source_checksum) +
+                    '\nCopied file checksum: {}'.format(copied_file_checksum)
+                )
+            )
+
+    @source_only
+    def copy_media_to_libraries(self, source_media, backup_libraries):
+        #  Description
+        #    Copy a media file from this library into one or more backup libraries
+        #  Requires
+        #    'source_media' must be a MediaFile in this library
+        #    Each library in 'backup_libraries' must exist on the filesystem
+        #  Guarantees
+        #    The source file is read and hashed once; each buffer is written to all targets in parallel
+        #    A Result is returned for each library in 'backup_libraries', in the same order
+        #    Each copy is verified by the target library (see 'verify_copied_media')
+        #    A target that fails does not stop the copy to the remaining targets
+        #    A partial copy is deleted from any target that fails
+
+        path_in_library = source_media.path_in_library
+        results = [None] * len(backup_libraries)
+
+        #  Open a destination file in each target library
+        #  Each writer is [index, backup_library, destination_filepath, file, mtime_is_set]
+        writers = []
+
+        def fail_writer(writer, message):
+            writer[3].close()
+            if writer[1].storage.exists(writer[2]):
+                writer[1].storage.remove(writer[2])
+            results[writer[0]] = Result(subject=source_media.path, success=False, message=message)
+            writers.remove(writer)
+
+        for index, backup_library in enumerate(backup_libraries):
+            destination_filepath = os.path.join(backup_library.path, path_in_library)
+            if backup_library.storage.exists(destination_filepath):
+                results[index] = Result(
+                    subject=source_media.path,
+                    success=False,
+                    message='Media already exists in library.'
+                )
+                continue
+            #  A library that runs out of space while preallocating gets no data, and its empty file is removed
+            writer = None
+            try:
+                source_stat = self.storage.stat(source_media.path)
+                backup_library.storage.makedirs(os.path.dirname(destination_filepath))
+                writer = [index, backup_library, destination_filepath, backup_library.storage.open(destination_filepath, 'wb'), False]
+                writers.append(writer)
+                backup_library.storage.preallocate(writer[3], source_stat.st_size)
+                writer[4] = backup_library.storage.set_mtime_on_close(writer[3], source_stat.st_mtime)
+            except OSError as error:
+                if writer is not None:
+                    fail_writer(writer, str(error))
+                else:
+                    results[index] = Result(subject=source_media.path, success=False, message=str(error))
+
+        #  Read the source once; hash each buffer and hand it to every writer
+        buffer_size = copy_engine.align_buffer_size(self.copy_buffer_size)
+        sha1 = hashlib.sha1()
+        with ThreadPoolExecutor(max_workers=max(len(writers), 1)) as executor:
+            try:
+                with self.storage.open(source_media.path, 'rb') as source_file:
+                    while writers:
+                        if self.throttle:
+                            data = self.throttle.read(source_file, buffer_size)
+                        else:
+                            data = source_file.read(buffer_size)
+                        if not data:
+                            break
+                        sha1.update(data)
+                        futures = [(writer, executor.submit(writer[1].write_media_data, writer[3], data)) for writer in writers]
+                        for writer, future in futures:
+                            try:
+                                future.result()
+                            except OSError as error:
+                                fail_writer(writer, str(error))
+            except OSError as error:
+                for writer in list(writers):
+                    fail_writer(writer, 'Source file could not be read: {}'.format(error))
+
+        #  The checksum is only complete if the whole source file was read
+        if writers:
+            source_media.real_checksum = sha1.hexdigest()
+
+        #  Flush each copy to its disc, preserve the source metadata, and verify it
+        for writer in list(writers):
+            index, backup_library, destination_filepath, file, mtime_is_set = writer
+            try:
+                file.flush()
+                file.truncate()  # Trim the preallocation, in case the source shrank while it was read
+                backup_library.storage.sync(file)
+                file.close()  # Some backends, like an object store, finish and check the upload here
+            except OSError as error:
+                fail_writer(writer, str(error))
+                continue
+            if backup_library.storage is self.storage:
+                backup_library.storage.copystat(source_media.path, destination_filepath)
+            elif not mtime_is_set:
+                backup_library.storage.utime(destination_filepath, source_stat.st_mtime)
+            results[index] = backup_library.verify_copied_media(
+                source_filepath=source_media.path,
+                path_in_library=path_in_library,
+                source_checksum=source_media.real_checksum
+            )
+            results[index].metrics['copy_method'] = copy_engine.COPY_METHOD_FAN_OUT
+            if results[index].success:
+                results[index].metrics['bytes'] = backup_library.storage.stat(destination_filepath).st_size
+                results[index].metrics['extents'] = backup_library.storage.get_extent_count(destination_filepath)
+        return results
+
+    def write_media_data(self, file, data):
+        #  Write a buffer to a media file in this library, honoring 'self.throttle'
+        if self.throttle:
+            self.throttle.write(file, data)
+        else:
+            file.write(data)
+
     def delete_media(self, path_in_library):
         #  Description
         #    Delete a media file from the library
@@ -144,7 +580,7 @@ class Library(object):
         #    'path_in_library' must be a key in 'self.media'
         #  Guarantees
         #    The media file is removed from the filesystem
-        #    The media file's cache file is removed from the filesystem, if it exists
+        #    The media file's cache file, pre-computed checksum and parity are removed from the filesystem, if they exist
         #    The reference to the media file is removed from 'self.media'
         #  Implementation Notes
         #    The method allows media to be deleted from 'source' libraries
@@ -153,11 +589,35 @@ class Library(object):
 
         #  Verify the file exists
         media_file = self.media[path_in_library]
-        assert os.path.exists(media_file.path)
-        if os.path.exists(media_file.cache_file):
-            os.remove(media_file.cache_file)
-        os.remove(media_file.path)
+        assert self.storage.exists(media_file.path)
+        if self.storage.exists(media_file.cache_file):
+            self.storage.remove(media_file.cache_file)
+        if self.storage.exists(media_file.prehash_file):
+            self.storage.remove(media_file.prehash_file)
+        if self.storage.exists(media_file.parity_file):
+            self.storage.remove(media_file.parity_file)
+        self.storage.remove(media_file.path)
         self.media.pop(path_in_library)
+        if self.snapshot is not None:
+            self.snapshot.remove_media(path_in_library)
+
+    def delete_media_batch(self, paths_in_library):
+        #  Description
+        #    Delete a batch of media files, and their cache files, from the library
+        #  Requires
+        #    Each of 'paths_in_library' must be a key in 'self.media'
+        #  Guarantees
+        #    A Result is returned for each of 'paths_in_library', in the same order
+        #    A file that can not be deleted does not stop the rest of the batch
+
+        results = []
+        for path_in_library in paths_in_library:
+            try:
+                self.delete_media(path_in_library)
+                results.append(Result(subject=path_in_library, success=True))
+            except (AssertionError, KeyError, OSError) as error:
+                results.append(Result(subject=path_in_library, success=False, message=repr(error)))
+        return results
 
     def get_empty_directories(self):
         #  Description
@@ -166,14 +626,11 @@ class Library(object):
         #    'self.path' must exist on the filesystem
         #  Guarantees
         #    The path to all empty directories in 'self.path' is returned in the form of a list
+        #    The library itself is never listed
+        #  Implementation Notes
+        #    The answer comes from 'self.snapshot'; the library is only walked if it was not loaded
 
-        list_of_empty_directories = []
-        for dirpath, dirnames, filenames in os.walk(self.path):
-            if len(dirnames) == 0 and len(filenames) == 0:
-                #  Don't delete the library itself
-                if dirpath is not self.path:
-                    list_of_empty_directories.append(dirpath)
-        return list_of_empty_directories
+        return [os.path.join(self.path, directory) for directory in self.get_snapshot().get_empty_directories()]
 
     def delete_empty_directories(self):
         #  Description
@@ -186,12 +643,24 @@ class Library(object):
         #  Implementation Notes
         #    Reason for the 'while' loop is for case where deleting a directory
         #    creates an empty directory
+        #    A directory that gained files since the snapshot was taken is listed again, and kept
         
+        snapshot = self.get_snapshot()
         while True:
-            empty_directories = self.get_empty_directories()
+            empty_directories = snapshot.get_empty_directories()
             if len(empty_directories) > 0:
                 for directory in empty_directories:
-                    os.rmdir(directory)
+                    dirpath = os.path.join(self.path, directory)
+                    try:
+                        self.storage.rmdir(dirpath)
+                        snapshot.remove_directory(directory)
+                    except FileNotFoundError:
+                        snapshot.remove_directory(directory)
+                    except OSError as error:
+                        if error.errno != errno.ENOTEMPTY:
+                            raise
+                        filenames, other_filenames, dirnames, cache_dirnames = self.scan_directory(dirpath)
+                        snapshot.set_listing(directory, filenames + other_filenames, dirnames + cache_dirnames)
             else:
                 break
 
@@ -202,18 +671,10 @@ class Library(object):
         #    'self.path' must exist on the filesystem
         #  Guarantees
         #    The path to all orphan cache files in 'self.path' is returned in the form of a list
+        #  Implementation Notes
+        #    The answer comes from 'self.snapshot'; the library is only walked if it was not loaded
 
-        list_of_orphan_cache_files = []
-        for dirpath, _, filenames in os.walk(self.path):
-            if '.cache' in dirpath:
-                for cache_file in filenames:
-                    if os.path.splitext(cache_file)[1] == '.txt':
-                        parent_directory = os.path.dirname(dirpath)
-                        media_file_name = os.path.splitext(cache_file)[0]
-                        media_file_path = os.path.join(parent_directory, media_file_name)
-                        if not os.path.exists(media_file_path):
-                            list_of_orphan_cache_files.append(os.path.join(dirpath, cache_file))
-        return list_of_orphan_cache_files
+        return [os.path.join(self.path, cache_file) for cache_file in self.get_snapshot().get_orphan_cache_files()]
 
     def delete_orphan_cache_files(self):
         #  Description
@@ -223,17 +684,38 @@ class Library(object):
         #  Guarantees
         #    All orphan cache files under 'self.path' are removed from the disc
 
-        for cache_file in self.get_orphan_cache_files():
-            os.remove(cache_file)
+        snapshot = self.get_snapshot()
+        for cache_file in snapshot.get_orphan_cache_files():
+            self.storage.remove(os.path.join(self.path, cache_file))
+            snapshot.remove_file(cache_file)
+
+    def get_snapshot(self):
+        #  The library's TreeSnapshot; a library that was not loaded is walked once to capture one
+        if self.snapshot is None:
+            snapshot = TreeSnapshot()
+            for dirpath, dirnames, filenames in self.storage.walk(self.path):
+                directory = os.path.relpath(dirpath, self.path)
+                snapshot.set_listing('' if directory == os.curdir else directory, filenames, dirnames)
+            self.snapshot = snapshot
+        return self.snapshot
 
     def get_stale_cache_media(self, stale_cache_days):
-        stale_cache_media = []
+        #  Stale media is ordered by its physical layout on disk, to reduce seeking
+        stale_cache_media = dict()
         for path_in_library in self.media:
             if self.media[path_in_library].cache_is_stale(stale_cache_days):
-                stale_cache_media.append(path_in_library)
-        return stale_cache_media
-        
+                stale_cache_media[path_in_library] = self.media[path_in_library].path
+        return disk_layout.sort_by_layout(stale_cache_media, self.storage)
+
     def refresh_stale_cache_files(self, stale_cache_days, callback_on_start, callback_on_progress):
+        #  Description
+        #    Refresh the cache file of each media file with a stale cache file
+        #  Guarantees
+        #    A cache file is only refreshed if the media file's checksum still matches it
+        #  Implementation Notes
+        #    Media is grouped by device; each device is refreshed by its own thread
+        #    Each device's media is refreshed in physical layout order
+
         stale_cache_media = self.get_stale_cache_media(stale_cache_days)
         if callback_on_start:
             callback_on_start(
@@ -241,24 +723,41 @@ class Library(object):
                 total_files_to_refresh=len(stale_cache_media),
                 library_name=self.name
             )
-        for index, path_in_library in enumerate(stale_cache_media):
-            if callback_on_progress:
-                callback_on_progress(
-                    total_files_to_refresh=len(stale_cache_media),
-                    file_number=index + 1,
-                    mirror_is_source=self.source,
-                    file_name=path_in_library,
-                    library_name=self.name
-                )
-            media = self.media[path_in_library]
-            if media.real_checksum == media.cached_checksum:
-                media.refresh_cache_file()
+        device_groups = disk_layout.group_by_device({
+            path_in_library: self.media[path_in_library].path for path_in_library in stale_cache_media
+        }, self.storage)
+        progress = {'file_number': 0}
+        progress_lock = threading.Lock()
+
+        def refresh_device_group(device_group):
+            for path_in_library in device_group:
+                with progress_lock:
+                    progress['file_number'] += 1
+                    if callback_on_progress:
+                        callback_on_progress(
+                            total_files_to_refresh=len(stale_cache_media),
+                            file_number=progress['file_number'],
+                            mirror_is_source=self.source,
+                            file_name=path_in_library,
+                            library_name=self.name
+                        )
+                media = self.media[path_in_library]
+                if media.real_checksum == media.cached_checksum:
+                    media.refresh_cache_file()
+
+        if len(device_groups) > 1:
+            with ThreadPoolExecutor(max_workers=len(device_groups)) as executor:
+                for future in [executor.submit(refresh_device_group, group) for group in device_groups]:
+                    future.result()
+        else:
+            for device_group in device_groups:
+                refresh_device_group(device_group)
 
     def get_local_checksum_discrepancies(self, cache_days):
         local_checksum_discrepancies = []
         for path_in_library in self.get_stale_cache_media(cache_days):
             media = self.media[path_in_library]
-            if media.real_checksum != media.cached_checksum:
+            if media.has_local_discrepancy():
                 local_checksum_discrepancies.append(path_in_library)
         return local_checksum_discrepancies
 
@@ -273,44 +772,70 @@ class Library(object):
                     mirror_checksum_discrepancies.append(path_in_library)
         return mirror_checksum_discrepancies
 
-    @backup_only
-    def get_media_not_backed_up(self, source_library):
-        list_of_media_not_backed_up = []
-        for path_in_library in source_library.media:
-            if path_in_library not in self.media:
-                list_of_media_not_backed_up.append(path_in_library)
-        return list_of_media_not_backed_up
-
-    @backup_only
-    def backup_new_media(self, source_library, callback_on_start, callback_on_progress, callback_on_error):
-        media_to_backup = self.get_media_not_backed_up(source_library)
-        #  Callback on start of method
-        if callback_on_start:
-            callback_on_start(
-                total_files_to_backup=len(media_to_backup),
-                library_name=self.name
-            )
-        for index, path_in_library in enumerate(media_to_backup):
-            if path_in_library not in self.media:
-                #  Callback on new file to backup
-                if callback_on_progress:
-                    callback_on_progress(
-                        total_files_to_backup=len(media_to_backup),
-                        file_number=index + 1,
-                        file_name=path_in_library,
-                        library_name=self.name
-                    )
-                source_media = source_library.media[path_in_library]
-                copy_result = self.copy_media(
+    @source_only
+    def backup_media(self, source_media, backup_libraries):
+        #  Description
+        #    Copy a source media file into each of the 'backup_libraries'
+        #  Guarantees
+        #    A Result is returned for each library in 'backup_libraries', in the same order
+        #    A single target uses 'copy_media', so the copy engine can pick a kernel copy method
+        #    Several targets use 'copy_media_to_libraries', so the source file is read once
+        #    An I/O error fails the file for every target, rather than being raised
+
+        try:
+            if len(backup_libraries) == 1:
+                return [backup_libraries[0].copy_media(
                     source_filepath=source_media.path,
-                    path_in_library=path_in_library,
-                    source_checksum=source_media.real_checksum
+                    path_in_library=source_media.path_in_library,
+                    source_checksum=source_media.real_checksum,
+                    source_storage=self.storage
+                )]
+            return self.copy_media_to_libraries(source_media, backup_libraries)
+        except OSError as error:
+            return [
+                Result(subject=source_media.path, success=False, message=str(error))
+                for backup_library in backup_libraries
+            ]
+
+    def has_media(self, path_in_library):
+        #  Whether a media file is in the library; a file missing from 'self.media' is looked for on the disc,
+        #  so a library that was not loaded can be asked
+        return path_in_library in self.media or self.storage.isfile(os.path.join(self.path, path_in_library))
+
+    def get_media(self, path_in_library):
+        #  Get a media file by its path, whether or not the library's media is loaded
+        if path_in_library in self.media:
+            return self.media[path_in_library]
+        return MediaFile(os.path.join(self.path, path_in_library), path_in_library, self.source, self.throttle, self.storage)
+
+    @source_only
+    def get_media_to_backup(self, backup_libraries, selected_media=None, paths_in_library=None):
+        #  Description
+        #    Find the media that is missing from any of the 'backup_libraries'
+        #  Requires
+        #    Each library in 'backup_libraries' must be loaded, unless 'paths_in_library' is given
+        #    'selected_media', if given, is a dict of {'backup library path': set(paths_in_library)}
+        #  Guarantees
+        #    A dict of {'path_in_library': [backup libraries missing the file]} is returned
+        #    A backup library listed in 'selected_media' is only given the media selected for it
+        #    If 'paths_in_library' is given, only those media files are checked, each on the disc if it is not loaded
+        #    (see 'has_media'); the libraries do not need to be loaded
+
+        def is_missing(backup_library, path_in_library):
+            if paths_in_library is None:
+                return path_in_library not in backup_library.media
+            return not backup_library.has_media(path_in_library)
+
+        media_to_backup = dict()
+        for path_in_library in self.media if paths_in_library is None else paths_in_library:
+            target_libraries = [
+                backup_library for backup_library in backup_libraries
+                if is_missing(backup_library, path_in_library) and (
+                    selected_media is None or
+                    backup_library.path not in selected_media or
+                    path_in_library in selected_media[backup_library.path]
                 )
-                #  Handle copy failure
-                if callback_on_error:
-                    if not copy_result.success:
-                        callback_on_error(
-                            file_name=path_in_library,
-                            library_name=self.name,
-                            error_message=copy_result.message
-                        )
+            ]
+            if target_libraries:
+                media_to_backup[path_in_library] = target_libraries
+        return media_to_backup
@@ -2,42 +2,106 @@ import datetime
 import hashlib
 import os
 
+from .storage import LOCAL_STORAGE
+
+def format_size(size_bytes):
+    #  Format a number of bytes for display, e.g. '1.234 GB'
+    if size_bytes is None:
+        return 'unknown'
+    if size_bytes == float('inf'):
+        return 'unlimited'
+    for string in ['bytes', 'KB', 'MB', 'GB', 'TB']:
+        if size_bytes < 1024.0 or string == 'TB':
+            return '%4.3f %s' % (size_bytes, string)
+        size_bytes /= 1024.0
+
+def format_mtime(mtime):
+    #  Format a modification time, in seconds since the epoch, for display
+    if mtime is None:
+        return 'unknown'
+    return str(datetime.datetime.fromtimestamp(mtime))
+
+def parse_cached_mtime(text):
+    #  Older cache files store the modification time as a formatted date, e.g. '2020-01-31 12:00:00.123456'
+    #  'str(datetime)' leaves out the microseconds when there are none
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.strptime(text, '%Y-%m-%d %H:%M:%S.%f').timestamp()
+    except ValueError:
+        return datetime.datetime.strptime(text, '%Y-%m-%d %H:%M:%S').timestamp()
+
+def parse_cached_size(text):
+    #  Older cache files store a formatted size, e.g. '1.234 GB', which is too coarse to compare; 'None' is returned
+    try:
+        return int(text)
+    except ValueError:
+        return None
+
 class MediaFile(object):
-    def __init__(self, path, path_in_library, source):
+    #  A pre-computed checksum is only reused for this many days
+    prehash_max_age_days = 1
+
+    #  Hashed pages are dropped from the page cache in blocks of this many bytes
+    drop_cache_interval = 8388608
+
+    #  A fingerprint hashes this many bytes from the start, middle and end of the file
+    fingerprint_sample_size = 1048576
+
+    def __init__(self, path, path_in_library, source, throttle=None, storage=None):
         self.name = os.path.basename(path)
         self.ext = os.path.splitext(self.name)[1]
         self.source = source
         self.path = path
         self.path_in_library = path_in_library
+        self.throttle = throttle  # Optional Throttle applied when reading the file
+        self.storage = storage or LOCAL_STORAGE  # The backend the file and its cache files are stored on
         self.cache_file = os.path.join(
             os.path.dirname(self.path),
             '.cache',
             '{}.txt'.format(self.name)
         )
+        self.prehash_file = os.path.join(
+            os.path.dirname(self.path),
+            '.cache',
+            '{}.prehash'.format(self.name)
+        )
+        self.parity_file = os.path.join(
+            os.path.dirname(self.path),
+            '.cache',
+            '{}.parity'.format(self.name)
+        )
 
         self._real_checksum = None
+        self._real_fingerprint = None
         self._real_mtime = None
         self._real_size = None
         self._cached_checksum = None
+        self._cached_fingerprint = None
         self._cached_date = None
         self._cached_mtime = None
         self._cached_size = None
 
-    def print_info(self):
+    def print_info(self, output=None):
         print(
             ' > File type: {}'.format('Source' if self.source else 'Backup') +
-            '\n > File modified: {}'.format(self.real_mtime) +
-            '\n > File size: {}'.format(self.real_size) +
+            '\n > File modified: {}'.format(format_mtime(self.real_mtime)) +
+            '\n > File size: {}'.format(format_size(self.real_size)) +
             '\n > Checksum: {}'.format(self.real_checksum) +
             '\n > Cached information:' +
             '\n >   Cache date: {}'.format(self.cached_date) +
-            '\n >   File modified: {}'.format(self.cached_mtime) +
-            '\n >   File size: {}'.format(self.cached_size) +
-            '\n >   Checksum: {}'.format(self.cached_checksum)
+            '\n >   File modified: {}'.format(format_mtime(self.cached_mtime)) +
+            '\n >   File size: {}'.format(format_size(self.cached_size)) +
+            '\n >   Checksum: {}'.format(self.cached_checksum),
+            file=output
         )
 
     @property
     def real_checksum(self):
+        if self._real_checksum is None:
+            self.load_prehash_file()
         if self._real_checksum is None:
             self.generate_checksum()
         return self._real_checksum
@@ -46,6 +110,16 @@ class MediaFile(object):
     def real_checksum(self, value):
         self._real_checksum = value
 
+    @property
+    def real_fingerprint(self):
+        if self._real_fingerprint is None:
+            self.generate_fingerprint()
+        return self._real_fingerprint
+
+    @real_fingerprint.setter
+    def real_fingerprint(self, value):
+        self._real_fingerprint = value
+
     @property
     def real_mtime(self):
         if self._real_mtime is None:
@@ -76,6 +150,17 @@ class MediaFile(object):
     def cached_checksum(self, value):
         self._cached_checksum = value
 
+    @property
+    def cached_fingerprint(self):
+        #  'None' for cache files written before fingerprints were stored
+        if self._cached_fingerprint is None:
+            self.load_cache_file()
+        return self._cached_fingerprint
+
+    @cached_fingerprint.setter
+    def cached_fingerprint(self, value):
+        self._cached_fingerprint = value
+
     @property
     def cached_date(self):
         if self._cached_date is None:
@@ -113,48 +198,132 @@ class MediaFile(object):
         return cached_date < expiration_date
 
     #  Generate a new checksum and store as self._real_checksum
-    def generate_checksum(self):
+    #  Return False, without storing a checksum, if 'stop_event' is set before the file is fully read
+    #  With 'drop_cache', the file's cached pages are dropped first, so the bytes are read from the disc
+    #  Pages are dropped as they are hashed, so a scan does not flush the rest of the page cache
+    def generate_checksum(self, stop_event=None, drop_cache=False):
         sha1 = hashlib.sha1()
-        with open(self.path, 'rb') as file:
+        with self.storage.open(self.path, 'rb') as file:
+            self.storage.advise_sequential(file)
+            if drop_cache:
+                self.storage.drop_cache(file)
+            offset = 0
             while True:
-                data = file.read(65536)
+                if stop_event is not None and stop_event.is_set():
+                    return False
+                data = self.throttle.read(file, 65536) if self.throttle else file.read(65536)
                 if not data:
                     break
                 sha1.update(data)
+                offset += len(data)
+                if offset % self.drop_cache_interval == 0:
+                    self.storage.drop_cache(file, offset - self.drop_cache_interval, self.drop_cache_interval)
+            self.storage.drop_cache(file, offset - offset % self.drop_cache_interval)
             self.real_checksum = sha1.hexdigest()
+        return True
+
+    #  Generate a quick fingerprint and store as self._real_fingerprint
+    #  The fingerprint is the file size and a hash of samples from the start, middle and end of the file
+    #  Files no larger than three samples are hashed whole
+    def generate_fingerprint(self):
+        sha1 = hashlib.sha1()
+        sample_size = self.fingerprint_sample_size
+        with self.storage.open(self.path, 'rb') as file:
+            size = self.storage.stat(self.path).st_size
+            if size <= sample_size * 3:
+                offsets = [0]
+                sample_size = size
+            else:
+                offsets = [0, (size - sample_size) // 2, size - sample_size]
+            for offset in offsets:
+                file.seek(offset)
+                data = self.throttle.read(file, sample_size) if self.throttle else file.read(sample_size)
+                sha1.update(data)
+            self.storage.drop_cache(file)
+        self.real_fingerprint = '{0}:{1}'.format(size, sha1.hexdigest())
+
+    #  Determine whether the file has a local checksum discrepancy
+    #  Unless 'deep', a file whose fingerprint matches its cache file is not read in full
+    #  A fingerprint only covers samples of the file, so bit rot between the samples needs a deep check
+    def has_local_discrepancy(self, deep=True):
+        if not deep and self.cached_fingerprint is not None:
+            if self.real_fingerprint == self.cached_fingerprint:
+                return False
+        return self.real_checksum != self.cached_checksum
+
+    #  Save a pre-computed checksum, so a later run can reuse it instead of reading the file again
+    #  The checksum is tied to the file's current modification time and size
+    def save_prehash_file(self):
+        stat = self.storage.stat(self.path)
+        if not self.storage.exists(os.path.dirname(self.prehash_file)):
+            self.storage.makedirs(os.path.dirname(self.prehash_file))
+        with self.storage.open(self.prehash_file, 'w') as file:
+            file.write('{0}|{1}|{2}|{3}'.format(
+                datetime.date.today(),
+                self.real_checksum,
+                stat.st_mtime_ns,
+                stat.st_size
+            ))
+
+    #  Load a pre-computed checksum into self._real_checksum
+    #  It is ignored if it is too old, or if the file was modified after it was computed
+    def load_prehash_file(self):
+        if not self.storage.isfile(self.prehash_file):
+            return False
+        with self.storage.open(self.prehash_file, 'r') as file:
+            split = file.readline().split('|')
+        if len(split) != 4:
+            return False
+        prehash_date = datetime.datetime.strptime(split[0].strip(), '%Y-%m-%d').date()
+        if prehash_date < datetime.date.today() - datetime.timedelta(days=self.prehash_max_age_days):
+            return False
+        stat = self.storage.stat(self.path)
+        if split[2].strip() != str(stat.st_mtime_ns) or split[3].strip() != str(stat.st_size):
+            return False
+        self.real_checksum = split[1].strip()
+        return True
 
     #  Save the cache file
+    #  The modification time is stored in seconds since the epoch, and the size in bytes
     def save_cache_file(self, overwrite):
         #  Careful not to overwrite an existing cache file without explicit permission to do so
-        if overwrite or not os.path.exists(self.cache_file):
+        if overwrite or not self.storage.exists(self.cache_file):
             today = str(datetime.date.today())
             self.cached_date = today
 
             #  Create missing directories
-            if not os.path.exists(os.path.dirname(self.cache_file)):
-                os.mkdir(os.path.dirname(self.cache_file))
+            if not self.storage.exists(os.path.dirname(self.cache_file)):
+                self.storage.makedirs(os.path.dirname(self.cache_file))
 
             #  Open the file in "write" mode
             #  An existing file with the same name will be replaced
-            with open(self.cache_file, 'w') as file:
-                line = '{0}|{1}|{2}|{3}'.format(today, self.real_checksum, self.real_mtime, self.real_size)
+            with self.storage.open(self.cache_file, 'w') as file:
+                line = '{0}|{1}|{2!r}|{3}|{4}'.format(
+                    today,
+                    self.real_checksum,
+                    self.real_mtime,
+                    self.real_size,
+                    self.real_fingerprint
+                )
                 file.write(line)
 
     #  Load the values from the cache file into the MediaFile object
     def load_cache_file(self):
-        if os.path.isfile(self.cache_file):
-            with open(self.cache_file, 'r') as file:
+        if self.storage.isfile(self.cache_file):
+            with self.storage.open(self.cache_file, 'r') as file:
                 line = file.readline()
                 assert '|' in line, 'Malformed cached file: {}'.format(self.cache_file)
                 split = line.split('|')
                 assert len(split) >= 2, 'Too few items in cache file'
-                assert len(split) <= 4, 'Too many items in cache file'
+                assert len(split) <= 5, 'Too many items in cache file'
                 if len(split) >= 2:
                     self.cached_date = line.split('|')[0].strip()
                     self.cached_checksum = line.split('|')[1].strip()
-                if len(split) == 4:
-                    self.cached_mtime = line.split('|')[2].strip()
-                    self.cached_size = line.split('|')[3].strip()
+                if len(split) >= 4:
+                    self.cached_mtime = parse_cached_mtime(line.split('|')[2].strip())
+                    self.cached_size = parse_cached_size(line.split('|')[3].strip())
+                if len(split) == 5:
+                    self.cached_fingerprint = line.split('|')[4].strip()
         else:
             self.save_cache_file(overwrite=False)
             self.load_cache_file()
@@ -164,12 +333,7 @@ class MediaFile(object):
         self.save_cache_file(overwrite=True)
 
     def get_mtime(self):
-        self.real_mtime = str(datetime.datetime.fromtimestamp(os.path.getmtime(self.path)))
+        self.real_mtime = self.storage.stat(self.path).st_mtime
 
     def get_size(self):
-        size_bytes = os.path.getsize(self.path)
-        for string in ['bytes', 'KB', 'MB', 'GB', 'TB']:
-            if size_bytes < 1024.0:
-                self.real_size = '%4.3f %s' % (size_bytes, string)
-                break
-            size_bytes /= 1024.0
+        self.real_size = self.storage.stat(self.path).st_size
@@ -1,42 +1,50 @@
 import os
 from .library import Library
+from .storage import LOCAL_STORAGE
 
 class BaseMirror(object):
-    def __init__(self, path: str, source: bool):
-        self.path = path
+    def __init__(self, path: str, source: bool, throttle=None, storage=None):
+        self.path = os.path.normpath(path)
         self.source = source
+        self.throttle = throttle  # Optional Throttle shared by all libraries in the mirror
+        self.storage = storage or LOCAL_STORAGE  # The backend the mirror is stored on (see 'storage')
         self.libraries = dict()  # {'library_name': LibraryObject}
-        self.exists = os.path.exists(self.path)
+        self.exists = self.storage.exists(self.path)
 
         #  The mirror must exist
         assert self.exists, 'Mirror does not exist: {}'.format(self.path)
 
-    def load_library(self, library):
+    def load_library(self, library, restore=False):
         #  Append a Library object to 'self.libraries'
         #  This does not load any of the library's media
+        #  With 'restore', a missing source library is made, so it can be restored from backup (e.g. after a source disc failed)
 
         library_path = os.path.join(self.path, library)
 
         #  The library must exist if this is the "source"
-        library_exists = os.path.exists(library_path)
+        library_exists = self.storage.exists(library_path)
         library_is_backup = not self.source
-        assert (library_exists or library_is_backup), 'Library does not exist on source: {}'.format(library_path)
+        assert (library_exists or library_is_backup or restore), 'Library does not exist on source: {}'.format(library_path)
 
         #  Make the library path if it does not exist
         if not library_exists:
-            os.makedirs(library_path)
+            self.storage.makedirs(library_path)
         
         #  Add the library object to 'self.libraries' as {'library_name': LibraryObject}
         self.libraries[library] = Library(
             name=library,
             path=library_path,
-            source=self.source
+            source=self.source,
+            throttle=self.throttle,
+            storage=self.storage
         )
 
 class SourceMirror(BaseMirror):
-    def __init__(self, path):
-        BaseMirror.__init__(self, path=path, source=True)
+    def __init__(self, path, throttle=None, storage=None):
+        BaseMirror.__init__(self, path=path, source=True, throttle=throttle, storage=storage)
 
 class BackupMirror(BaseMirror):
-    def __init__(self, path):
-        BaseMirror.__init__(self, path=path, source=False)
+    def __init__(self, path, throttle=None, version_store=None, storage=None, parity_store=None):
+        BaseMirror.__init__(self, path=path, source=False, throttle=throttle, storage=storage)
+        self.version_store = version_store  # Optional VersionStore that keeps overwritten media
+        self.parity_store = parity_store  # Optional ParityStore that repairs bit rot in backed up media
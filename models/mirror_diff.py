@@ -0,0 +1,76 @@
+import heapq
+import os
+
+#  Status of a media file when a source library is compared with a backup library
+DIFF_NEW = 'new'  # Only in the source library
+DIFF_ORPHAN = 'orphan'  # Only in the backup library
+DIFF_MATCH = 'match'  # In both libraries, with matching cached checksums
+DIFF_MISMATCH = 'mismatch'  # In both libraries, with different cached checksums
+
+def get_sort_key(path_in_library):
+    #  Description
+    #    Get the key that 'Library.iterate_media' yields media in
+    #  Guarantees
+    #    A directory's files sort before its sub-directories
+    #    Files and sub-directories are each sorted by name
+
+    parts = path_in_library.split(os.sep)
+    return [(1, part) for part in parts[:-1]] + [(0, parts[-1])]
+
+def merge_libraries(libraries):
+    #  Description
+    #    Walk several libraries together in sorted order, like a merge join
+    #  Requires
+    #    Each library in 'libraries' must exist on the filesystem
+    #  Guarantees
+    #    A tuple is yielded for each path found in any library: (path_in_library, list of media)
+    #    The list of media holds a MediaFile, or 'None', for each library in the same order as 'libraries'
+    #    Memory use does not grow with the size of the libraries
+
+    def keyed_media(index, library):
+        for media in library.iterate_media():
+            yield get_sort_key(media.path_in_library), index, media
+
+    current_key = None
+    current_media = None
+    streams = [keyed_media(index, library) for index, library in enumerate(libraries)]
+    for key, index, media in heapq.merge(*streams):
+        if key != current_key:
+            if current_media is not None:
+                yield current_path, current_media
+            current_key = key
+            current_path = media.path_in_library
+            current_media = [None] * len(libraries)
+        current_media[index] = media
+    if current_media is not None:
+        yield current_path, current_media
+
+def diff_libraries(source_library, backup_libraries, compare_checksums=True):
+    #  Description
+    #    Stream the differences between a source library and one or more backup libraries
+    #  Requires
+    #    Each library must exist on the filesystem
+    #  Guarantees
+    #    A tuple is yielded for each path and backup library: (status, path_in_library, source_media, backup_media, backup_library)
+    #    'status' is one of 'DIFF_NEW', 'DIFF_ORPHAN', 'DIFF_MATCH' or 'DIFF_MISMATCH'
+    #    Entries are yielded as the walk progresses; nothing is collected in 'Library.media'
+    #    If 'compare_checksums' is False, only 'DIFF_NEW' and 'DIFF_ORPHAN' entries are yielded
+    #  Implementation Notes
+    #    Only paths found in both libraries read their cache files, to compare cached checksums
+
+    for path_in_library, media in merge_libraries([source_library] + list(backup_libraries)):
+        source_media = media[0]
+        for backup_library, backup_media in zip(backup_libraries, media[1:]):
+            if source_media is None and backup_media is None:
+                continue
+            elif backup_media is None:
+                status = DIFF_NEW
+            elif source_media is None:
+                status = DIFF_ORPHAN
+            elif not compare_checksums:
+                continue
+            elif source_media.cached_checksum == backup_media.cached_checksum:
+                status = DIFF_MATCH
+            else:
+                status = DIFF_MISMATCH
+            yield status, path_in_library, source_media, backup_media, backup_library
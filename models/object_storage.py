@@ -0,0 +1,841 @@
+import base64
+import collections
+import email.utils
+import errno
+import hashlib
+import hmac
+import http.client
+import io
+import json
+import os
+import queue
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+
+from . import copy_engine
+from .storage import MemoryDirEntry
+from .storage import StorageStat
+from .storage import walk_storage
+
+#  Object stores
+#  An ObjectStorage keeps a backup mirror in a bucket of an S3-compatible object store (AWS S3, MinIO, Ceph, ...):
+#   - Each file is an object keyed by its path under the mirror; directories are key prefixes,
+#     and a directory made with 'makedirs' is kept as a zero-byte '<key>/' marker until it is removed
+#   - Requests are signed with AWS Signature Version 4, and sent over a pool of kept-alive connections
+#   - A large file is uploaded in parts, several at a time. The store returns the MD5 of each part as its ETag,
+#     and of the whole object as '<MD5 of the parts' MD5s>-<part count>'; both are checked, so a copy is
+#     verified without being downloaded again (see 'get_verified_checksum')
+#   - Cache files ('.cache/<name>.txt' and '.cache/<name>.prehash') are kept together in one index object for
+#     each directory, '.cache/cache_files.json', rather than as objects of their own
+#   - A file's modification time is kept in its object's metadata, and is sent with the upload
+#  Objects can not be changed in place: changing metadata afterwards (see 'utime') copies the object onto itself
+#  inside the store, which costs a request but no transfer. Writing a cache file rewrites its directory's index.
+#  Indexes are kept in memory once read, so one process should write to a mirror at a time.
+
+COPY_METHOD_SERVER_SIDE = 'server-side'
+
+#  Objects larger than this are copied in parts of 'COPY_PART_SIZE' bytes
+MAX_COPY_SIZE = 5368709120
+COPY_PART_SIZE = 1073741824
+
+METADATA_PREFIX = 'x-amz-meta-'
+SIDECAR_EXTENSIONS = ('.txt', '.prehash')  # Cache files kept in an index (see 'MediaFile')
+SIDECAR_INDEX = 'cache_files.json'  # The index in each '.cache' directory, as {'cache file name': 'contents'}
+
+#  The parts of a HEAD response used by the storage; 'metadata' is {'name': 'value'} without 'x-amz-meta-'
+ObjectHead = collections.namedtuple('ObjectHead', ['size', 'etag', 'mtime_ns', 'metadata'])
+
+def local_name(element):
+    #  The name of an XML element, without its namespace
+    return element.tag.rsplit('}', 1)[-1]
+
+def find_children(element, name):
+    return [child for child in element if local_name(child) == name]
+
+def find_text(element, name, default=None):
+    for child in find_children(element, name):
+        return child.text or ''
+    return default
+
+def encode_query(query):
+    #  A query string in the canonical form used for signing: sorted, with every reserved character escaped
+    return '&'.join(
+        '{0}={1}'.format(urllib.parse.quote(name, safe='-_.~'), urllib.parse.quote(value, safe='-_.~'))
+        for name, value in sorted(query.items())
+    )
+
+def get_multipart_etag(part_digests):
+    #  The ETag a store gives an object uploaded in parts, from the MD5 digest of each part
+    return '{0}-{1}'.format(hashlib.md5(b''.join(part_digests)).hexdigest(), len(part_digests))
+
+class ConnectionPool(object):
+    #  Kept-alive HTTP connections to one endpoint
+    #  A connection goes back to the pool once its response has been read; beyond 'size', connections are closed
+    def __init__(self, endpoint, size=8, timeout=60):
+        parsed = urllib.parse.urlsplit(endpoint)
+        self.host = parsed.netloc
+        self.connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+        self.timeout = timeout
+        self.connections = queue.LifoQueue(maxsize=size)
+
+    def get(self):
+        #  Return a (connection, reused) tuple
+        try:
+            return self.connections.get_nowait(), True
+        except queue.Empty:
+            return self.connection_class(self.host, timeout=self.timeout), False
+
+    def put(self, connection):
+        try:
+            self.connections.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except queue.Empty:
+                break
+
+class ObjectReader(io.RawIOBase):
+    #  An object read with ranged GETs
+    #  A read asks for only the bytes it reads, so reads after seeks (e.g. fingerprint samples) leave nothing in flight
+    #  A read that continues where the last range ended streams the rest of the object with one GET
+    def __init__(self, storage, object_key, size):
+        io.RawIOBase.__init__(self)
+        self.storage = storage
+        self.object_key = object_key
+        self.size = size
+        self.position = 0
+        self.range_end = None  # The end of the range last requested
+        self.response = None
+        self.connection = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.position >= self.size or len(buffer) == 0:
+            return 0
+        if self.response is None:
+            if self.position == self.range_end:
+                end = self.size
+            else:
+                end = min(self.position + len(buffer), self.size)
+            headers = {'range': 'bytes={0}-{1}'.format(self.position, end - 1)}
+            self.response, self.connection = self.storage.request('GET', self.object_key, headers=headers, stream=True)
+            self.range_end = end
+        count = self.response.readinto(buffer)
+        if count == 0:
+            self.release()
+            raise OSError(errno.EIO, 'The object store ended the download early', self.object_key)
+        self.position += count
+        if self.position >= self.range_end:
+            self.release()
+        return count
+
+    def release(self):
+        #  A connection is only reused once its response has been read to the end
+        if self.response is not None:
+            if self.response.isclosed() and not self.response.will_close:
+                self.storage.pool.put(self.connection)
+            else:
+                self.connection.close()
+            self.response = None
+            self.connection = None
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        offset = max(min(offset, self.size), 0)
+        if offset != self.position:
+            self.release()
+            self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.release()
+        io.RawIOBase.close(self)
+
+class ObjectWriter(io.RawIOBase):
+    #  A file being uploaded to an ObjectStorage
+    #  A file smaller than the storage's part size is sent with one PUT when it is closed
+    #  A larger one becomes a multipart upload; each full part is sent as soon as it is written,
+    #  with up to 'storage.upload_workers' parts in flight
+    #  The upload is checked against the store's ETag when the file is closed; a failed upload is aborted
+    def __init__(self, storage, key):
+        io.RawIOBase.__init__(self)
+        self.storage = storage
+        self.key = key
+        self.object_key = storage.object_key(key)
+        self.buffer = bytearray()
+        self.length = 0
+        self.sha1 = hashlib.sha1()
+        self.upload_id = None
+        self.parts = []  # Futures of each part's ETag
+        self.part_digests = []  # MD5 digest of each part
+        self.metadata = dict()  # Sent with the upload (see 'ObjectStorage.set_mtime_on_close')
+        self.failed = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.failed:
+            raise OSError(errno.EIO, 'The upload has failed', self.object_key)
+        self.buffer += data
+        self.sha1.update(data)
+        self.length += len(data)
+        try:
+            while len(self.buffer) >= self.storage.part_size:
+                self.upload_part(bytes(self.buffer[:self.storage.part_size]))
+                del self.buffer[:self.storage.part_size]
+        except BaseException:
+            self.abort()
+            raise
+        return len(data)
+
+    def upload_part(self, data):
+        if self.upload_id is None:
+            metadata = dict(self.metadata)
+            metadata['part-size'] = str(self.storage.part_size)
+            self.upload_id = self.storage.create_multipart_upload(self.object_key, metadata)
+        in_flight = [part for part in self.parts if not part.done()]
+        if len(in_flight) >= self.storage.upload_workers:
+            in_flight[0].result()
+        digest = hashlib.md5(data).digest()
+        self.part_digests.append(digest)
+        self.parts.append(self.storage.executor.submit(
+            self.storage.upload_part, self.object_key, self.upload_id, len(self.parts) + 1, data, digest
+        ))
+
+    def abort(self):
+        self.failed = True
+        for part in self.parts:
+            part.cancel()
+        for part in self.parts:
+            if not part.cancelled():
+                part.exception()  # Wait for the parts already being sent
+        if self.upload_id is not None:
+            self.storage.abort_multipart_upload(self.object_key, self.upload_id)
+
+    def tell(self):
+        return self.length
+
+    def truncate(self, size=None):
+        #  Uploaded data can not be taken back; only a no-op truncate is allowed
+        if size is not None and size != self.length:
+            raise io.UnsupportedOperation('objects can only be appended to while they are written')
+        return self.length
+
+    def close(self):
+        if not self.closed:
+            try:
+                if not self.failed:
+                    self.finish()
+            finally:
+                io.RawIOBase.close(self)
+
+    def finish(self):
+        if self.upload_id is None:
+            self.storage.put_object(self.object_key, bytes(self.buffer), self.metadata)
+        else:
+            try:
+                if self.buffer:
+                    self.upload_part(bytes(self.buffer))
+                etags = [part.result() for part in self.parts]
+                etag = self.storage.complete_multipart_upload(self.object_key, self.upload_id, etags)
+            except BaseException:
+                self.abort()
+                raise
+            if etag != get_multipart_etag(self.part_digests):
+                self.storage.delete_object(self.object_key)
+                raise OSError(errno.EIO, 'The uploaded object does not match its ETag ({})'.format(etag), self.object_key)
+        self.buffer = bytearray()
+        self.storage.set_verified_checksum(self.key, self.sha1.hexdigest())
+
+class SidecarWriter(io.BytesIO):
+    #  A cache file being written; it is stored in its directory's index when it is closed
+    def __init__(self, storage, key):
+        io.BytesIO.__init__(self)
+        self.storage = storage
+        self.key = key
+
+    def close(self):
+        if not self.closed:
+            self.storage.write_sidecar(self.key, self.getvalue())
+        io.BytesIO.close(self)
+
+class ObjectStorage(object):
+    def __init__(self, root_path, endpoint, bucket, access_key, secret_key, region='us-east-1', prefix='',
+                 part_size: int=8388608, upload_workers: int=4, pool_size: int=8, timeout: float=60):
+        #  Description
+        #    A storage backend that keeps the files under 'root_path' in an S3-compatible bucket (see 'storage')
+        #  Requires
+        #    'bucket' must exist, and the key must be allowed to list, read, write and delete its objects
+        #  Implementation Notes
+        #    'root_path' only names the mirror; nothing is stored on the local filesystem
+        #    A file under 'root_path' is the object '<prefix><path under root_path>', in path-style URLs
+        #    Files larger than 'part_size' are uploaded in parts; S3 requires parts of at least 5 MiB
+        #    The pool should hold at least 'upload_workers' connections, so parallel parts reuse them
+
+        self.root_path = os.path.normpath(root_path)
+        self.endpoint = endpoint
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.part_size = part_size
+        self.upload_workers = upload_workers
+        self.pool = ConnectionPool(endpoint, size=pool_size, timeout=timeout)
+        self.executor = ThreadPoolExecutor(max_workers=upload_workers)
+        self.verified_checksums = dict()  # {'key': 'checksum'} of uploads verified by their ETag, until claimed
+        self.sidecar_indexes = dict()  # {'index object key': {'cache file name': 'contents'}}, once read
+        self.index_locks = dict()  # {'index object key': Lock}, held while an index is read or changed
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+
+    #  Requests
+
+    def sign(self, method, path, query, headers, body):
+        #  Add the AWS Signature Version 4 headers to a request; every header sent is signed
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        scope = '{0}/{1}/s3/aws4_request'.format(amz_date[:8], self.region)
+        headers = {name.lower(): str(value).strip() for name, value in headers.items()}
+        headers['host'] = self.pool.host
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = hashlib.sha256(body).hexdigest()
+        signed_headers = ';'.join(sorted(headers))
+        canonical_request = '\n'.join([
+            method,
+            urllib.parse.quote(path, safe='/-_.~'),
+            encode_query(query),
+            ''.join('{0}:{1}\n'.format(name, headers[name]) for name in sorted(headers)),
+            signed_headers,
+            headers['x-amz-content-sha256']
+        ])
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256',
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+        ])
+        signing_key = ('AWS4' + self.secret_key).encode('utf-8')
+        for scope_part in scope.split('/'):
+            signing_key = hmac.new(signing_key, scope_part.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        headers['authorization'] = 'AWS4-HMAC-SHA256 Credential={0}/{1}, SignedHeaders={2}, Signature={3}'.format(
+            self.access_key, scope, signed_headers, signature
+        )
+        return headers
+
+    def request(self, method, object_key=None, query=None, headers=None, body=b'', stream=False):
+        #  Description
+        #    Send a signed request for an object, or for the bucket if 'object_key' is 'None'
+        #  Guarantees
+        #    A (response, body) tuple is returned, and the connection goes back to the pool
+        #    With 'stream', a successful response is returned unread, as a (response, connection) tuple;
+        #    the caller returns the connection once the body is read (see 'ObjectReader')
+        #    A missing object raises FileNotFoundError, and any other error status raises OSError
+        #    A pooled connection the store has since closed is replaced, and the request is sent again
+
+        query = query or dict()
+        path = '/' + self.bucket + ('/' + object_key if object_key is not None else '')
+        headers = self.sign(method, path, query, headers or dict(), body)
+        url = urllib.parse.quote(path, safe='/-_.~') + ('?' + encode_query(query) if query else '')
+        while True:
+            connection, reused = self.pool.get()
+            try:
+                connection.request(method, url, body=body or None, headers=headers)
+                response = connection.getresponse()
+                if stream and response.status < 300:
+                    return response, connection
+                data = response.read()
+            except (http.client.HTTPException, OSError) as error:
+                connection.close()
+                if reused:
+                    continue
+                raise OSError(errno.EIO, 'The object store request failed: {}'.format(error), object_key)
+            if response.will_close:
+                connection.close()
+            else:
+                self.pool.put(connection)
+            break
+        if response.status >= 300:
+            raise self.error(response.status, data, object_key)
+        return response, data
+
+    def error(self, status, data, object_key):
+        code = None
+        if data:
+            try:
+                code = find_text(ElementTree.fromstring(data), 'Code')
+            except ElementTree.ParseError:
+                pass
+        message = 'The object store returned {0}{1}'.format(status, ' ' + code if code else '')
+        if status == 404:
+            return FileNotFoundError(errno.ENOENT, message, object_key)
+        if status == 403:
+            return PermissionError(errno.EACCES, message, object_key)
+        return OSError(errno.EIO, message, object_key)
+
+    def parse(self, data, object_key):
+        #  Parse an XML response; S3 reports some failures, like a failed copy, in the body of a '200 OK'
+        root = ElementTree.fromstring(data)
+        if local_name(root) == 'Error':
+            raise OSError(errno.EIO, 'The object store returned {}'.format(find_text(root, 'Code')), object_key)
+        return root
+
+    def metadata_headers(self, metadata):
+        return {METADATA_PREFIX + name: urllib.parse.quote(value) for name, value in metadata.items()}
+
+    #  Objects
+
+    def head(self, object_key):
+        response, _ = self.request('HEAD', object_key)
+        metadata = {
+            name.lower()[len(METADATA_PREFIX):]: urllib.parse.unquote(value)
+            for name, value in response.getheaders() if name.lower().startswith(METADATA_PREFIX)
+        }
+        if 'mtime' in metadata:
+            mtime_ns = int(metadata['mtime'])
+        else:
+            mtime_ns = int(email.utils.parsedate_to_datetime(response.getheader('Last-Modified')).timestamp() * 1e9)
+        return ObjectHead(int(response.getheader('Content-Length', 0)), response.getheader('ETag', '').strip('"'), mtime_ns, metadata)
+
+    def list_objects(self, object_prefix, max_keys=None):
+        #  Yield a ('key', is_prefix) tuple for each object and common prefix one level under 'object_prefix'
+        #  With 'max_keys', only the first page is listed
+        query = {'list-type': '2', 'prefix': object_prefix, 'delimiter': '/'}
+        if max_keys:
+            query['max-keys'] = str(max_keys)
+        while True:
+            _, data = self.request('GET', None, query)
+            root = self.parse(data, object_prefix)
+            for element in find_children(root, 'Contents'):
+                yield find_text(element, 'Key'), False
+            for element in find_children(root, 'CommonPrefixes'):
+                yield find_text(element, 'Prefix'), True
+            if max_keys or find_text(root, 'IsTruncated') != 'true':
+                break
+            query['continuation-token'] = find_text(root, 'NextContinuationToken')
+
+    def put_object(self, object_key, data, metadata):
+        #  Upload a whole object, and check the store received it intact
+        md5 = hashlib.md5(data)
+        headers = self.metadata_headers(metadata)
+        headers['content-md5'] = base64.b64encode(md5.digest()).decode('ascii')
+        response, _ = self.request('PUT', object_key, headers=headers, body=data)
+        etag = response.getheader('ETag', '').strip('"')
+        if etag != md5.hexdigest():
+            self.delete_object(object_key)
+            raise OSError(errno.EIO, 'The uploaded object does not match its ETag ({})'.format(etag), object_key)
+
+    def delete_object(self, object_key):
+        self.request('DELETE', object_key)
+
+    def create_multipart_upload(self, object_key, metadata):
+        _, data = self.request('POST', object_key, {'uploads': ''}, self.metadata_headers(metadata))
+        return find_text(self.parse(data, object_key), 'UploadId')
+
+    def upload_part(self, object_key, upload_id, number, data, digest):
+        #  Upload one part, and return its ETag once it matches the part's MD5 digest
+        headers = {'content-md5': base64.b64encode(digest).decode('ascii')}
+        response, _ = self.request('PUT', object_key, {'partNumber': str(number), 'uploadId': upload_id}, headers, data)
+        etag = response.getheader('ETag', '').strip('"')
+        if etag != digest.hex():
+            raise OSError(errno.EIO, 'Part {0} does not match its ETag ({1})'.format(number, etag), object_key)
+        return etag
+
+    def complete_multipart_upload(self, object_key, upload_id, etags):
+        #  Join the uploaded parts into the object, and return the object's ETag
+        body = '<CompleteMultipartUpload>{}</CompleteMultipartUpload>'.format(''.join(
+            '<Part><PartNumber>{0}</PartNumber><ETag>"{1}"</ETag></Part>'.format(number, etag)
+            for number, etag in enumerate(etags, start=1)
+        ))
+        _, data = self.request('POST', object_key, {'uploadId': upload_id}, body=body.encode('utf-8'))
+        return find_text(self.parse(data, object_key), 'ETag').strip('"')
+
+    def abort_multipart_upload(self, object_key, upload_id):
+        #  Parts left by an upload that could not be aborted are removed by the store's lifecycle rules, if any
+        try:
+            self.request('DELETE', object_key, {'uploadId': upload_id})
+        except OSError:
+            pass
+
+    def copy_object(self, source_key, destination_key, metadata=None):
+        #  Description
+        #    Copy an object inside the bucket; no data goes through this client
+        #  Guarantees
+        #    The copy has the source's metadata, or 'metadata' if it is given
+        #    An object larger than 'MAX_COPY_SIZE' is copied in parts of 'COPY_PART_SIZE'
+
+        head = self.head(source_key)
+        metadata = dict(head.metadata if metadata is None else metadata)
+        copy_source = urllib.parse.quote('/{0}/{1}'.format(self.bucket, source_key), safe='/-_.~')
+        if head.size <= MAX_COPY_SIZE:
+            headers = self.metadata_headers(metadata)
+            headers.update({'x-amz-copy-source': copy_source, 'x-amz-metadata-directive': 'REPLACE'})
+            _, data = self.request('PUT', destination_key, headers=headers)
+            self.parse(data, destination_key)
+            return
+        metadata['part-size'] = str(COPY_PART_SIZE)
+        upload_id = self.create_multipart_upload(destination_key, metadata)
+        try:
+            etags = []
+            for number, offset in enumerate(range(0, head.size, COPY_PART_SIZE), start=1):
+                headers = {
+                    'x-amz-copy-source': copy_source,
+                    'x-amz-copy-source-range': 'bytes={0}-{1}'.format(offset, min(offset + COPY_PART_SIZE, head.size) - 1)
+                }
+                _, data = self.request('PUT', destination_key, {'partNumber': str(number), 'uploadId': upload_id}, headers)
+                etags.append(find_text(self.parse(data, destination_key), 'ETag').strip('"'))
+            self.complete_multipart_upload(destination_key, upload_id, etags)
+        except BaseException:
+            self.abort_multipart_upload(destination_key, upload_id)
+            raise
+
+    def update_metadata(self, object_key, changes):
+        #  Set each metadata value in 'changes', or remove it if the value is 'None'
+        metadata = self.head(object_key).metadata
+        for name, value in changes.items():
+            if value is None:
+                metadata.pop(name, None)
+            else:
+                metadata[name] = value
+        self.copy_object(object_key, object_key, metadata)
+
+    def set_verified_checksum(self, key, checksum):
+        with self._lock:
+            self.verified_checksums[key] = checksum
+
+    def verify(self, path):
+        #  Description
+        #    Determine whether an object still matches the ETag the store computed when it was written
+        #  Guarantees
+        #    The object is downloaded, and hashed like the store hashed it: whole, or in its upload's parts
+        #    'None' is returned for an object uploaded in parts by another client, whose part size is not known
+
+        head = self.head(self.object_key(self.key(path)))
+        part_size = int(head.metadata.get('part-size', 0)) if '-' in head.etag else 0
+        if '-' in head.etag and not part_size:
+            return None
+        whole_md5 = hashlib.md5()
+        part_md5 = hashlib.md5()
+        part_bytes = 0
+        part_digests = []
+        with self.open(path, 'rb') as file:
+            while True:
+                size = copy_engine.WRITE_ALIGNMENT * 16
+                if part_size:
+                    size = min(size, part_size - part_bytes)
+                data = file.read(size)
+                if not data:
+                    break
+                whole_md5.update(data)
+                part_md5.update(data)
+                part_bytes += len(data)
+                if part_bytes == part_size:
+                    part_digests.append(part_md5.digest())
+                    part_md5 = hashlib.md5()
+                    part_bytes = 0
+        if part_bytes:
+            part_digests.append(part_md5.digest())
+        if part_size:
+            return get_multipart_etag(part_digests) == head.etag
+        return whole_md5.hexdigest() == head.etag
+
+    #  Cache files
+
+    def get_sidecar(self, key):
+        #  The (index object key, cache file name) of a cache file kept in an index, or 'None' for any other file
+        directory, name = os.path.split(key)
+        media_name, extension = os.path.splitext(name)
+        if os.path.basename(directory) != '.cache' or extension not in SIDECAR_EXTENSIONS or not media_name:
+            return None
+        return self.object_key(os.path.join(directory, SIDECAR_INDEX)), name
+
+    def get_index_lock(self, index_key):
+        with self._lock:
+            return self.index_locks.setdefault(index_key, threading.Lock())
+
+    def load_index(self, index_key):
+        #  The index of a '.cache' directory, read once; the caller holds the index's lock
+        if index_key not in self.sidecar_indexes:
+            try:
+                _, data = self.request('GET', index_key)
+                self.sidecar_indexes[index_key] = json.loads(data.decode('utf-8'))
+            except FileNotFoundError:
+                self.sidecar_indexes[index_key] = dict()
+        return self.sidecar_indexes[index_key]
+
+    def save_index(self, index_key, index):
+        #  An empty index is deleted, so its '.cache' directory can be removed
+        if index:
+            self.put_object(index_key, json.dumps(index, sort_keys=True).encode('utf-8'), dict())
+        else:
+            self.delete_object(index_key)
+
+    def read_sidecar(self, key):
+        #  The contents of a cache file, or 'None'
+        index_key, name = self.get_sidecar(key)
+        with self.get_index_lock(index_key):
+            data = self.load_index(index_key).get(name)
+        return None if data is None else data.encode('utf-8')
+
+    def write_sidecar(self, key, data):
+        index_key, name = self.get_sidecar(key)
+        with self.get_index_lock(index_key):
+            index = self.load_index(index_key)
+            index[name] = data.decode('utf-8')
+            self.save_index(index_key, index)
+
+    def remove_sidecar(self, path, key):
+        index_key, name = self.get_sidecar(key)
+        with self.get_index_lock(index_key):
+            index = self.load_index(index_key)
+            if name not in index:
+                raise self.not_found(path)
+            del index[name]
+            self.save_index(index_key, index)
+
+    def list_sidecars(self, key):
+        #  The names of the cache files in the index of the '.cache' directory 'key'
+        index_key = self.object_key(os.path.join(key, SIDECAR_INDEX))
+        with self.get_index_lock(index_key):
+            return list(self.load_index(index_key))
+
+    #  Storage interface (see 'LocalStorage')
+
+    def key(self, path):
+        path = os.path.normpath(path)
+        if path == self.root_path:
+            return ''
+        if not path.startswith(self.root_path + os.sep):
+            raise FileNotFoundError(errno.ENOENT, 'Path is outside of the object storage', path)
+        return path[len(self.root_path) + 1:]
+
+    def object_key(self, key):
+        return self.prefix + key.replace(os.sep, '/')
+
+    def directory_prefix(self, key):
+        return self.object_key(key) + '/' if key else self.prefix
+
+    def not_found(self, path):
+        return FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+    def exists(self, path):
+        return self.isfile(path) or self.isdir(path)
+
+    def isfile(self, path):
+        try:
+            key = self.key(path)
+        except FileNotFoundError:
+            return False
+        if key == '':
+            return False
+        if self.get_sidecar(key):
+            return self.read_sidecar(key) is not None
+        try:
+            self.head(self.object_key(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def isdir(self, path):
+        try:
+            key = self.key(path)
+        except FileNotFoundError:
+            return False
+        return key == '' or any(True for _ in self.list_objects(self.directory_prefix(key), max_keys=1))
+
+    def stat(self, path):
+        #  Directories have no modification time in an object store; theirs is always now,
+        #  so a saved listing of a directory is never mistaken for a current one
+        key = self.key(path)
+        if self.get_sidecar(key):
+            data = self.read_sidecar(key)
+            if data is None:
+                raise self.not_found(path)
+            mtime_ns = int(time.time() * 1e9)
+            return StorageStat(len(data), mtime_ns / 1e9, mtime_ns, 0, 0)
+        if key:
+            try:
+                head = self.head(self.object_key(key))
+                return StorageStat(head.size, head.mtime_ns / 1e9, head.mtime_ns, 0, 0)
+            except FileNotFoundError:
+                pass
+        if self.isdir(path):
+            mtime_ns = int(time.time() * 1e9)
+            return StorageStat(0, mtime_ns / 1e9, mtime_ns, 0, 0)
+        raise self.not_found(path)
+
+    def scandir(self, path):
+        key = self.key(path)
+        prefix = self.directory_prefix(key)
+        found = key == ''
+        entries = dict()  # {'name': is_directory}
+        for object_key, is_prefix in self.list_objects(prefix):
+            found = True
+            name = object_key[len(prefix):].rstrip('/')
+            if name:
+                entries[name] = is_prefix
+        #  The index of a '.cache' directory is listed as the cache files it holds
+        if entries.pop(SIDECAR_INDEX, None) is not None:
+            for name in self.list_sidecars(key):
+                entries[name] = False
+        if not found:
+            raise self.not_found(path)
+        return [MemoryDirEntry(self, os.path.join(path, name), entries[name]) for name in sorted(entries)]
+
+    def walk(self, top, topdown=True):
+        return walk_storage(self, top, topdown)
+
+    def makedirs(self, path):
+        #  '.cache' directories are not kept: cache files are stored in metadata, and other files imply the prefix
+        key = self.key(path)
+        if key == '' or os.path.basename(key) == '.cache':
+            return
+        if self.isdir(path):
+            return
+        if self.isfile(path):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+        self.request('PUT', self.directory_prefix(key))
+
+    def open(self, path, mode='r'):
+        #  Modes 'r' and 'w', in text or binary ('b'); an object is replaced, never changed in place
+        key = self.key(path)
+        if key == '':
+            raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+        sidecar = self.get_sidecar(key)
+        if 'w' in mode:
+            file = SidecarWriter(self, key) if sidecar else ObjectWriter(self, key)
+        elif 'r' in mode and '+' not in mode:
+            if sidecar:
+                data = self.read_sidecar(key)
+                if data is None:
+                    raise self.not_found(path)
+                file = io.BytesIO(data)
+            else:
+                try:
+                    file = ObjectReader(self, self.object_key(key), self.head(self.object_key(key)).size)
+                except FileNotFoundError:
+                    raise self.not_found(path)
+        else:
+            raise io.UnsupportedOperation('objects do not support mode {}'.format(mode))
+        if 'b' in mode:
+            return file
+        if isinstance(file, io.RawIOBase):
+            file = io.BufferedWriter(file) if 'w' in mode else io.BufferedReader(file)
+        return io.TextIOWrapper(file, encoding='utf-8')
+
+    def replace(self, source_path, destination_path):
+        #  A rename is a copy inside the store, then a delete; as on a disc, a media file's cache files stay where they are
+        source_key = self.key(source_path)
+        destination_key = self.key(destination_path)
+        if self.get_sidecar(source_key) or self.get_sidecar(destination_key):
+            with self.open(source_path, 'rb') as source_file:
+                data = source_file.read()
+            with self.open(destination_path, 'wb') as destination_file:
+                destination_file.write(data)
+            self.remove(source_path)
+            return
+        try:
+            self.copy_object(self.object_key(source_key), self.object_key(destination_key))
+        except FileNotFoundError:
+            raise self.not_found(source_path)
+        self.delete_object(self.object_key(source_key))
+
+    def remove(self, path):
+        key = self.key(path)
+        if self.get_sidecar(key):
+            self.remove_sidecar(path, key)
+            return
+        if not self.isfile(path):
+            raise self.not_found(path)
+        self.delete_object(self.object_key(key))
+
+    def rmdir(self, path):
+        entries = self.scandir(path)
+        if entries:
+            raise OSError(errno.ENOTEMPTY, os.strerror(errno.ENOTEMPTY), path)
+        key = self.key(path)
+        if key:
+            self.delete_object(self.directory_prefix(key))
+
+    def copy_file(self, source_path, destination_path, throttle=None, buffer_size=1048576):
+        #  The store copies the object itself, so 'throttle' does not apply
+        try:
+            self.copy_object(self.object_key(self.key(source_path)), self.object_key(self.key(destination_path)))
+        except FileNotFoundError:
+            raise self.not_found(source_path)
+        return COPY_METHOD_SERVER_SIDE
+
+    def clone_file(self, source_path, destination_path):
+        #  Objects are never updated in place, so there is nothing to clone them for
+        return False
+
+    def copystat(self, source_path, destination_path):
+        self.utime(destination_path, self.stat(source_path).st_mtime)
+
+    def utime(self, path, mtime):
+        #  The modification time is kept in metadata; a cache file has no time of its own
+        key = self.key(path)
+        if self.get_sidecar(key):
+            return
+        try:
+            self.update_metadata(self.object_key(key), {'mtime': str(int(mtime * 1e9))})
+        except FileNotFoundError:
+            raise self.not_found(path)
+
+    def set_mtime_on_close(self, file, mtime):
+        #  The modification time is sent with the upload, unless its upload has already begun
+        if not isinstance(file, ObjectWriter) or file.upload_id is not None:
+            return False
+        file.metadata['mtime'] = str(int(mtime * 1e9))
+        return True
+
+    def preallocate(self, file, size):
+        return False
+
+    def sync(self, file):
+        #  Each file is uploaded, and verified, when it is closed
+        file.flush()
+
+    def advise_sequential(self, file):
+        pass
+
+    def drop_cache(self, file, offset=0, length=0):
+        pass
+
+    def get_extent_count(self, path):
+        return None
+
+    def get_layout_key(self, path):
+        #  Objects have no physical layout; every file has the same key, so files keep the order they are given in
+        return (0, 0)
+
+    def get_free_bytes(self, path):
+        return None
+
+    def get_verified_checksum(self, path):
+        #  The checksum of an upload verified by its ETag; it is only handed out once
+        with self._lock:
+            return self.verified_checksums.pop(self.key(path), None)
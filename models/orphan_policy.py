@@ -0,0 +1,72 @@
+import fnmatch
+import time
+
+class OrphanDeletionPolicy(object):
+    def __init__(self, min_age_days: float=None, min_size: int=None, max_size: int=None, globs: list=None,
+                 missing_from_rename_index: bool=False):
+        #  Every rule that is set must match for an orphan to be deleted
+        #  A rule of 'None' is not applied
+        self.min_age_days = min_age_days  # Days since the orphan was last modified
+        self.min_size = min_size  # Bytes
+        self.max_size = max_size  # Bytes
+        self.globs = globs  # Patterns matched against 'path_in_library'; any pattern may match
+        self.missing_from_rename_index = missing_from_rename_index  # Keep orphans whose content is still in the source
+
+    def matches(self, media, rename_index=None):
+        #  Description
+        #    Determine whether an orphan backup media file should be deleted
+        #  Requires
+        #    'rename_index' must be a RenameIndex of the source media if 'self.missing_from_rename_index' is True
+        #  Guarantees
+        #    True is returned if the media file matches every rule that is set
+
+        if self.min_age_days is not None:
+            age_days = (time.time() - media.storage.stat(media.path).st_mtime) / 86400
+            if age_days < self.min_age_days:
+                return False
+        if self.min_size is not None or self.max_size is not None:
+            size = media.storage.stat(media.path).st_size
+            if self.min_size is not None and size < self.min_size:
+                return False
+            if self.max_size is not None and size > self.max_size:
+                return False
+        if self.globs:
+            if not any(fnmatch.fnmatch(media.path_in_library, pattern) for pattern in self.globs):
+                return False
+        if self.missing_from_rename_index:
+            #  An orphan with the same content as a source file was renamed or moved, not deleted
+            if rename_index.contains(media):
+                return False
+        return True
+
+class RenameIndex(object):
+    def __init__(self, source_media):
+        #  Description
+        #    Find orphan backup media whose content is still in the source, under another path
+        #  Requires
+        #    'source_media' is an iterable of source MediaFile objects
+        #  Implementation Notes
+        #    Source files are indexed by size, so nothing is read until an orphan of the same size is looked up
+        #    A checksum is taken from the file's cache file if it has one; otherwise the file is hashed, once,
+        #    and no cache file is written
+
+        self.media_by_size = dict()  # {size: [MediaFile]}
+        for media in source_media:
+            try:
+                self.media_by_size.setdefault(media.real_size, []).append(media)
+            except FileNotFoundError:
+                continue
+
+    def contains(self, media):
+        #  Whether a source file has the same content as 'media'
+        candidates = self.media_by_size.get(media.real_size)
+        if not candidates:
+            return False
+        checksum = get_checksum(media)
+        return any(get_checksum(candidate) == checksum for candidate in candidates)
+
+def get_checksum(media):
+    #  The checksum of a media file, from its cache file if it has one, without writing a cache file
+    if media.storage.isfile(media.cache_file):
+        return media.cached_checksum
+    return media.real_checksum
@@ -0,0 +1,548 @@
+import errno
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import time
+
+from . import copy_engine
+from . import disk_layout
+from . import page_cache
+from .storage import MemoryDirEntry
+from .storage import StorageStat
+from .storage import walk_storage
+
+#  Pack files
+#  Small media files cost more in filesystem metadata (directory entries, allocation tables, a '.cache' sidecar)
+#  than in data, especially on exFAT discs. A PackStorage appends every file to a few large pack files instead:
+#   - '<root>/.packs/pack-000001.pack' holds the contents of many files, back to back
+#   - '<root>/.packs/index.log' records where each file is (pack, offset, length, checksum), one JSON line per change
+#  The index is replayed when the storage is opened. Deleted and replaced files leave garbage in the packs,
+#  which 'compact' reclaims.
+#  Changes are committed in groups: the packs, then the index, are flushed to the disc once for many changes,
+#  and a 'commit' record marks the end of each group. A file added after the last commit may not have reached
+#  the disc before a crash, so it is read back when the index is replayed, and dropped if it does not match.
+
+PACK_DIRECTORY = '.packs'
+INDEX_FILE = 'index.log'
+
+#  A group of changes is committed once it has this many records, this many bytes of new files, or is this old
+COMMIT_RECORDS = 256
+COMMIT_BYTES = 67108864
+COMMIT_SECONDS = 1.0
+
+class PackEntry(object):
+    def __init__(self, pack, offset, length, checksum, mtime_ns):
+        self.pack = pack  # Pack file name
+        self.offset = offset
+        self.length = length
+        self.checksum = checksum  # SHA-1 of the contents
+        self.mtime_ns = mtime_ns
+
+class PackWriter(io.RawIOBase):
+    #  A file being written to a PackStorage
+    #  Data is appended straight to the current pack; the file is added to the index when it is closed
+    #  'replaces' and 'mtime_ns' are used by compaction, to move a file without changing it
+    def __init__(self, storage, key, replaces=None, mtime_ns=None):
+        io.RawIOBase.__init__(self)
+        self.storage = storage
+        self.key = key
+        self.replaces = replaces
+        self.mtime_ns = mtime_ns
+        self.pack, self.pack_file = storage.open_pack_for_append()
+        self.offset = self.pack_file.tell()
+        self.length = 0
+        self.sha1 = hashlib.sha1()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.pack_file.write(data)
+        self.sha1.update(data)
+        self.length += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.length
+
+    def truncate(self, size=None):
+        #  Appended data can not be taken back; only a no-op truncate is allowed
+        if size is not None and size != self.length:
+            raise io.UnsupportedOperation('pack files can only be appended to')
+        return self.length
+
+    def close(self):
+        #  The pack is flushed to the disc with the rest of its group (see 'PackStorage.commit')
+        if not self.closed:
+            try:
+                self.pack_file.flush()
+                self.storage.add_entry(
+                    self.key,
+                    PackEntry(self.pack, self.offset, self.length, self.sha1.hexdigest(), self.mtime_ns or int(time.time() * 1e9)),
+                    replaces=self.replaces
+                )
+            finally:
+                self.storage.release_pack()
+        io.RawIOBase.close(self)
+
+class PackReader(io.RawIOBase):
+    #  A file read from its region of a pack file; reads and seeks never leave the region
+    def __init__(self, pack_path, entry):
+        io.RawIOBase.__init__(self)
+        self.pack_file = open(pack_path, 'rb')
+        self.entry = entry
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.entry.length - self.position)
+        if size <= 0:
+            return 0
+        data = os.pread(self.pack_file.fileno(), size, self.entry.offset + self.position)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.entry.length
+        self.position = max(min(offset, self.entry.length), 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.pack_file.close()
+        io.RawIOBase.close(self)
+
+class PackStorage(object):
+    def __init__(self, root_path, pack_size: int=1073741824):
+        #  Description
+        #    A storage backend that keeps the files under 'root_path' in pack files (see 'storage')
+        #  Requires
+        #    'root_path' must exist on the filesystem; usually it is a backup mirror
+        #  Implementation Notes
+        #    A new pack is started once the current one reaches 'pack_size' bytes; a file is never split
+        #    Files are written one at a time; a second writer waits until the first is closed
+
+        self.root_path = os.path.normpath(root_path)
+        self.pack_path = os.path.join(self.root_path, PACK_DIRECTORY)
+        self.index_path = os.path.join(self.pack_path, INDEX_FILE)
+        self.pack_size = pack_size
+        self.entries = dict()  # {'key': PackEntry}
+        self.directories = {'': int(time.time() * 1e9)}  # {'key': mtime_ns}
+        self.children = {'': set()}  # {'directory key': set('names')}
+        self.current_pack = None
+        self.unsynced_packs = set()  # Packs written to since the last commit
+        self.uncommitted_records = 0
+        self.uncommitted_bytes = 0
+        self.uncommitted_since = None  # time.monotonic() of the first change since the last commit
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        os.makedirs(self.pack_path, exist_ok=True)
+        self.load_index()
+
+    #  Index
+
+    def load_index(self):
+        #  Replay 'index.log'; a record cut short by a crash is ignored
+        #  Files added after the last commit are kept only if their data reached the disc
+        if not os.path.isfile(self.index_path):
+            return
+        uncommitted = set()  # id() of each PackEntry added after the last commit
+        with open(self.index_path, 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record['op'] == 'commit':
+                    uncommitted = set()
+                    continue
+                self.apply(record)
+                if record['op'] == 'add':
+                    uncommitted.add(id(self.entries[record['key']]))
+        for key, entry in list(self.entries.items()):
+            if id(entry) in uncommitted and not self.verify_entry(entry):
+                self.entries.pop(key)
+                self.remove_child(key, int(time.time() * 1e9))
+        packs = self.get_pack_names()
+        self.current_pack = packs[-1] if packs else None
+
+    def apply(self, record):
+        operation = record['op']
+        key = record.get('key')
+        time_ns = record.get('time_ns', int(time.time() * 1e9))
+        if operation == 'mkdir':
+            self.add_directory(key, time_ns)
+        elif operation == 'add':
+            self.add_child(key, time_ns)
+            self.entries[key] = PackEntry(record['pack'], record['offset'], record['length'], record['checksum'], record['mtime_ns'])
+        elif operation == 'remove' and key in self.entries:
+            self.entries.pop(key)
+            self.remove_child(key, time_ns)
+        elif operation == 'rmdir' and key in self.directories:
+            self.directories.pop(key)
+            self.children.pop(key)
+            self.remove_child(key, time_ns)
+        elif operation == 'rename' and key in self.entries:
+            self.entries[record['to']] = self.entries.pop(key)
+            self.remove_child(key, time_ns)
+            self.add_child(record['to'], time_ns)
+        elif operation == 'utime' and key in self.entries:
+            self.entries[key].mtime_ns = record['mtime_ns']
+
+    def record(self, record):
+        #  Apply a change and append it to the index; the group is committed once it is large or old enough
+        record['time_ns'] = int(time.time() * 1e9)
+        with self._lock:
+            self.apply(record)
+            with open(self.index_path, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+            self.uncommitted_records += 1
+            self.uncommitted_bytes += record.get('length', 0)
+            if self.uncommitted_since is None:
+                self.uncommitted_since = time.monotonic()
+            if (self.uncommitted_records >= COMMIT_RECORDS or self.uncommitted_bytes >= COMMIT_BYTES or
+                    time.monotonic() - self.uncommitted_since >= COMMIT_SECONDS):
+                self.commit()
+
+    def commit(self):
+        #  Flush the packs written to, then the index, to the disc, and mark the end of the group in the index
+        with self._lock:
+            if self.uncommitted_records == 0:
+                return
+            for pack in sorted(self.unsynced_packs):
+                with open(os.path.join(self.pack_path, pack), 'ab') as file:
+                    os.fsync(file.fileno())
+            self.unsynced_packs.clear()
+            with open(self.index_path, 'a') as file:
+                file.write(json.dumps({'op': 'commit', 'time_ns': int(time.time() * 1e9)}) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            self.uncommitted_records = 0
+            self.uncommitted_bytes = 0
+            self.uncommitted_since = None
+
+    def add_entry(self, key, entry, replaces=None):
+        #  With 'replaces', the entry is only added if the file still has that entry
+        #  A file changed or deleted while compaction moved it keeps the change
+        with self._lock:
+            if replaces is not None and self.entries.get(key) is not replaces:
+                return
+            self.record({
+                'op': 'add', 'key': key, 'pack': entry.pack, 'offset': entry.offset,
+                'length': entry.length, 'checksum': entry.checksum, 'mtime_ns': entry.mtime_ns
+            })
+
+    def add_directory(self, key, time_ns):
+        if key not in self.directories:
+            self.directories[key] = time_ns
+            self.children[key] = set()
+            self.add_child(key, time_ns)
+
+    def add_child(self, key, time_ns):
+        if key == '':
+            return
+        parent = os.path.dirname(key)
+        if parent not in self.directories:
+            self.add_directory(parent, time_ns)
+        self.children[parent].add(os.path.basename(key))
+        self.directories[parent] = max(time_ns, self.directories[parent] + 1)
+
+    def remove_child(self, key, time_ns):
+        parent = os.path.dirname(key)
+        if parent in self.children:
+            self.children[parent].discard(os.path.basename(key))
+            self.directories[parent] = max(time_ns, self.directories[parent] + 1)
+
+    #  Packs
+
+    def get_pack_names(self):
+        return sorted(name for name in os.listdir(self.pack_path) if name.endswith('.pack'))
+
+    def get_new_pack_name(self):
+        packs = self.get_pack_names()
+        number = int(packs[-1][len('pack-'):-len('.pack')]) + 1 if packs else 1
+        return 'pack-{:06d}.pack'.format(number)
+
+    def open_pack_for_append(self):
+        #  Hold the write lock until 'release_pack'; start a new pack if the current one is full
+        self._write_lock.acquire()
+        try:
+            if self.current_pack is None or os.path.getsize(os.path.join(self.pack_path, self.current_pack)) >= self.pack_size:
+                self.current_pack = self.get_new_pack_name()
+            self._pack_file = open(os.path.join(self.pack_path, self.current_pack), 'ab')
+            with self._lock:
+                self.unsynced_packs.add(self.current_pack)
+            return self.current_pack, self._pack_file
+        except OSError:
+            self._write_lock.release()
+            raise
+
+    def release_pack(self):
+        self._pack_file.close()
+        self._write_lock.release()
+
+    def get_garbage_bytes(self, pack=None):
+        #  Bytes in pack files that no longer belong to a file, in one pack or in all of them
+        packs = [pack] if pack else self.get_pack_names()
+        with self._lock:
+            live_bytes = sum(entry.length for entry in self.entries.values() if entry.pack in packs)
+        return sum(os.path.getsize(os.path.join(self.pack_path, name)) for name in packs) - live_bytes
+
+    def compact(self, min_garbage_ratio: float=0.25, stop_event=None):
+        #  Description
+        #    Reclaim the space left in pack files by deleted and replaced files
+        #  Guarantees
+        #    Each full pack with at least 'min_garbage_ratio' garbage has its live files appended to the current pack,
+        #    and is then deleted
+        #    A file's new location is in the index before its old pack is deleted, so a crash loses nothing
+        #    The index is rewritten without the history of changes
+        #    The number of bytes reclaimed is returned
+
+        reclaimed_bytes = 0
+        for pack in self.get_pack_names():
+            if stop_event is not None and stop_event.is_set():
+                break
+            if pack == self.current_pack:
+                continue
+            pack_bytes = os.path.getsize(os.path.join(self.pack_path, pack))
+            garbage_bytes = self.get_garbage_bytes(pack)
+            if pack_bytes == 0 or garbage_bytes / pack_bytes < min_garbage_ratio:
+                continue
+            with self._lock:
+                live = [(key, entry) for key, entry in self.entries.items() if entry.pack == pack]
+            for key, entry in live:
+                with self.open_entry(entry) as reader, PackWriter(self, key, replaces=entry, mtime_ns=entry.mtime_ns) as writer:
+                    while True:
+                        data = reader.read(copy_engine.WRITE_ALIGNMENT * 16)
+                        if not data:
+                            break
+                        writer.write(data)
+            self.commit()
+            with self._lock:
+                self.unsynced_packs.discard(pack)
+            os.remove(os.path.join(self.pack_path, pack))
+            reclaimed_bytes += garbage_bytes
+        self.rewrite_index()
+        return reclaimed_bytes
+
+    def rewrite_index(self):
+        #  Write the current state as a fresh index; the old one is replaced in one step
+        with self._lock:
+            self.commit()
+            temporary_path = self.index_path + '.tmp'
+            with open(temporary_path, 'w') as file:
+                for key in sorted(self.directories):
+                    if key:
+                        file.write(json.dumps({'op': 'mkdir', 'key': key, 'time_ns': self.directories[key]}) + '\n')
+                for key, entry in sorted(self.entries.items()):
+                    file.write(json.dumps({
+                        'op': 'add', 'key': key, 'pack': entry.pack, 'offset': entry.offset,
+                        'length': entry.length, 'checksum': entry.checksum, 'mtime_ns': entry.mtime_ns
+                    }) + '\n')
+                file.write(json.dumps({'op': 'commit', 'time_ns': int(time.time() * 1e9)}) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary_path, self.index_path)
+
+    def verify(self, path):
+        #  Determine whether a file still matches the checksum it was written with
+        return self.verify_entry(self.get_entry(path))
+
+    def verify_entry(self, entry):
+        sha1 = hashlib.sha1()
+        length = 0
+        try:
+            with self.open_entry(entry) as reader:
+                while True:
+                    data = reader.read(copy_engine.WRITE_ALIGNMENT * 16)
+                    if not data:
+                        break
+                    sha1.update(data)
+                    length += len(data)
+        except FileNotFoundError:
+            return False
+        return length == entry.length and sha1.hexdigest() == entry.checksum
+
+    def open_entry(self, entry):
+        return PackReader(os.path.join(self.pack_path, entry.pack), entry)
+
+    #  Storage interface (see 'LocalStorage')
+
+    def key(self, path):
+        path = os.path.normpath(path)
+        if path == self.root_path:
+            return ''
+        if not path.startswith(self.root_path + os.sep):
+            raise FileNotFoundError(errno.ENOENT, 'Path is outside of the pack storage', path)
+        return path[len(self.root_path) + 1:]
+
+    def not_found(self, path):
+        return FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+    def get_entry(self, path):
+        with self._lock:
+            entry = self.entries.get(self.key(path))
+        if entry is None:
+            raise self.not_found(path)
+        return entry
+
+    def exists(self, path):
+        return self.isfile(path) or self.isdir(path)
+
+    def isfile(self, path):
+        try:
+            return self.key(path) in self.entries
+        except FileNotFoundError:
+            return False
+
+    def isdir(self, path):
+        try:
+            return self.key(path) in self.directories
+        except FileNotFoundError:
+            return False
+
+    def stat(self, path):
+        key = self.key(path)
+        with self._lock:
+            if key in self.entries:
+                entry = self.entries[key]
+                return StorageStat(entry.length, entry.mtime_ns / 1e9, entry.mtime_ns, os.stat(self.root_path).st_dev, 0)
+            if key in self.directories:
+                mtime_ns = self.directories[key]
+                return StorageStat(0, mtime_ns / 1e9, mtime_ns, os.stat(self.root_path).st_dev, 0)
+        raise self.not_found(path)
+
+    def scandir(self, path):
+        key = self.key(path)
+        with self._lock:
+            if key not in self.directories:
+                raise self.not_found(path)
+            return [
+                MemoryDirEntry(self, os.path.join(path, name), os.path.join(key, name) in self.directories)
+                for name in sorted(self.children[key])
+            ]
+
+    def walk(self, top, topdown=True):
+        return walk_storage(self, top, topdown)
+
+    def makedirs(self, path):
+        key = self.key(path)
+        if key in self.entries:
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+        if key not in self.directories:
+            self.record({'op': 'mkdir', 'key': key})
+
+    def open(self, path, mode='r'):
+        #  Modes 'r' and 'w', in text or binary ('b'); a file is replaced, never changed in place
+        key = self.key(path)
+        if 'w' in mode:
+            if os.path.dirname(key) not in self.directories:
+                raise self.not_found(path)
+            if key in self.directories:
+                raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+            file = PackWriter(self, key)
+            return file if 'b' in mode else io.TextIOWrapper(io.BufferedWriter(file), encoding='utf-8')
+        if 'r' in mode and '+' not in mode:
+            file = self.open_entry(self.get_entry(path))
+            return file if 'b' in mode else io.TextIOWrapper(io.BufferedReader(file), encoding='utf-8')
+        raise io.UnsupportedOperation('pack files do not support mode {}'.format(mode))
+
+    def replace(self, source_path, destination_path):
+        self.get_entry(source_path)
+        if os.path.dirname(self.key(destination_path)) not in self.directories:
+            raise self.not_found(destination_path)
+        self.record({'op': 'rename', 'key': self.key(source_path), 'to': self.key(destination_path)})
+
+    def remove(self, path):
+        self.get_entry(path)
+        self.record({'op': 'remove', 'key': self.key(path)})
+
+    def rmdir(self, path):
+        key = self.key(path)
+        if key not in self.directories:
+            raise self.not_found(path)
+        if self.children[key]:
+            raise OSError(errno.ENOTEMPTY, os.strerror(errno.ENOTEMPTY), path)
+        self.record({'op': 'rmdir', 'key': key})
+
+    def copy_file(self, source_path, destination_path, throttle=None, buffer_size=1048576):
+        #  A copy inside the storage reads the source's region and appends it as a new file, with the source's mtime
+        with self.open(source_path, 'rb') as source_file, self.open(destination_path, 'wb') as destination_file:
+            self.set_mtime_on_close(destination_file, self.stat(source_path).st_mtime)
+            while True:
+                data = throttle.read(source_file, buffer_size) if throttle else source_file.read(buffer_size)
+                if not data:
+                    break
+                if throttle:
+                    throttle.write(destination_file, data)
+                else:
+                    destination_file.write(data)
+        return copy_engine.COPY_METHOD_USERSPACE
+
+    def clone_file(self, source_path, destination_path):
+        #  Files in packs are never updated in place, so there is nothing to clone them for
+        return False
+
+    def copystat(self, source_path, destination_path):
+        self.utime(destination_path, self.stat(source_path).st_mtime)
+
+    def utime(self, path, mtime):
+        self.get_entry(path)
+        self.record({'op': 'utime', 'key': self.key(path), 'mtime_ns': int(mtime * 1e9)})
+
+    def set_mtime_on_close(self, file, mtime):
+        #  The modification time is kept in the file's add record
+        if not isinstance(file, PackWriter):
+            return False
+        file.mtime_ns = int(mtime * 1e9)
+        return True
+
+    def preallocate(self, file, size):
+        return False
+
+    def sync(self, file):
+        #  Files are flushed to the disc in groups (see 'commit')
+        file.flush()
+
+    def advise_sequential(self, file):
+        if isinstance(file, PackReader):
+            page_cache.advise_sequential(file.pack_file.fileno())
+
+    def drop_cache(self, file, offset=0, length=0):
+        #  Drop the pages of the file's region of its pack
+        if isinstance(file, PackReader):
+            length = length or file.entry.length - offset
+            page_cache.drop_cache(file.pack_file.fileno(), file.entry.offset + offset, length)
+
+    def get_extent_count(self, path):
+        return None
+
+    def get_layout_key(self, path):
+        #  Files are read from their packs, so they are ordered by pack, then by offset in the pack
+        try:
+            entry = self.get_entry(path)
+        except OSError:
+            return disk_layout.MISSING_LAYOUT_KEY
+        return (0, entry.pack, entry.offset)
+
+    def get_free_bytes(self, path):
+        return shutil.disk_usage(self.root_path).free
+
+    def get_verified_checksum(self, path):
+        #  Each file is read back from its pack to be verified
+        return None
@@ -0,0 +1,21 @@
+import os
+
+#  Page cache advice for large sequential reads
+#  Every function is a no-op where posix_fadvise() is not available
+
+def advise_sequential(fd):
+    #  Read ahead aggressively, and do not keep the pages once they are used
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_NOREUSE)
+
+def drop_cache(fd, offset=0, length=0):
+    #  Description
+    #    Ask the kernel to drop a file's cached pages
+    #  Guarantees
+    #    Clean pages in the range are dropped; a 'length' of 0 means to the end of the file
+    #  Implementation Notes
+    #    Dirty pages are not dropped, so call os.fsync() first to drop freshly written data
+
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
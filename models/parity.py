@@ -0,0 +1,328 @@
+import collections
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import struct
+import zlib
+
+from .result import Result
+
+#  Reed-Solomon arithmetic is in GF(2^8), with the polynomial x^8 + x^4 + x^3 + x^2 + 1 and generator 2 (as RAID-6)
+GF_POLYNOMIAL = 0x11d
+GF_EXP = [0] * 510
+GF_LOG = [0] * 256
+_value = 1
+for _power in range(255):
+    GF_EXP[_power] = GF_EXP[_power + 255] = _value
+    GF_LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= GF_POLYNOMIAL
+
+#  Each block's CRC-32 is stored, so the damaged blocks of a stripe are known before it is repaired
+CRC = struct.Struct('>I')
+
+#  Each worker process encodes stripes in tasks of about this many bytes
+TASK_SIZE = 4194304
+
+ParityHeader = collections.namedtuple('ParityHeader', ['checksum', 'size', 'block_size', 'data_blocks', 'parity_blocks'])
+
+def gf_inverse(a):
+    return GF_EXP[255 - GF_LOG[a]]
+
+class BlockArithmetic(object):
+    def __init__(self, block_size):
+        #  Description
+        #    GF(2^8) arithmetic on every byte of a block at once
+        #  Implementation Notes
+        #    A block is held as one Python integer, so each operation runs over the whole block in C
+        #    Multiplying by 2 shifts each byte left and reduces the bytes that overflowed; no carry crosses a byte
+
+        self.block_size = block_size
+        self.low_bits = int.from_bytes(b'\x7f' * block_size, 'little')
+        self.high_bits = int.from_bytes(b'\x80' * block_size, 'little')
+
+    def to_int(self, block):
+        return int.from_bytes(block, 'little')
+
+    def to_bytes(self, value):
+        return value.to_bytes(self.block_size, 'little')
+
+    def multiply_by_two(self, value):
+        return ((value & self.low_bits) << 1) ^ (((value & self.high_bits) >> 7) * (GF_POLYNOMIAL & 0xff))
+
+    def multiply(self, value, constant):
+        product = 0
+        while constant:
+            if constant & 1:
+                product ^= value
+            value = self.multiply_by_two(value)
+            constant >>= 1
+        return product
+
+    def get_syndromes(self, values, count=2):
+        #  P, the sum of the blocks, and Q, the sum of each block 'i' times 2^i; Q is only computed if 'count' is 2
+        p = 0
+        q = 0
+        for value in reversed(values):
+            p ^= value
+            if count == 2:
+                q = self.multiply_by_two(q) ^ value
+        return (p, q)[:count]
+
+def encode_stripes(data, block_size, data_blocks, parity_blocks):
+    #  Description
+    #    Encode consecutive stripes of a file, in a worker process
+    #  Guarantees
+    #    The record of each stripe is returned, concatenated (see 'ParityStore.get_record_size')
+    #    A short last stripe is encoded as if it were padded with zeros
+
+    arithmetic = BlockArithmetic(block_size)
+    records = []
+    stripe_size = block_size * data_blocks
+    for stripe_offset in range(0, len(data), stripe_size):
+        stripe = data[stripe_offset:stripe_offset + stripe_size]
+        blocks = [stripe[offset:offset + block_size] for offset in range(0, len(stripe), block_size)]
+        crcs = [zlib.crc32(block) for block in blocks] + [0] * (data_blocks - len(blocks))
+        values = [arithmetic.to_int(block) for block in blocks]
+        parity = [arithmetic.to_bytes(syndrome) for syndrome in arithmetic.get_syndromes(values, parity_blocks)]
+        crcs += [zlib.crc32(block) for block in parity]
+        records.append(b''.join(CRC.pack(crc) for crc in crcs) + b''.join(parity))
+    return b''.join(records)
+
+class ParityStore(object):
+    def __init__(self, block_size: int=65536, data_blocks: int=64, parity_blocks: int=2, workers: int=None):
+        #  Description
+        #    Reed-Solomon parity for backup media, kept next to each file's cache file, to repair small bit rot
+        #  Requires
+        #    'parity_blocks' is 1 (P, which repairs one damaged block per stripe) or 2 (P and Q, which repair two)
+        #    'data_blocks' is at most 255
+        #  Implementation Notes
+        #    A file is split into stripes of 'data_blocks' blocks of 'block_size' bytes
+        #    Each stripe gets 'parity_blocks' parity blocks, so the parity file is about parity_blocks/data_blocks of the file
+        #    Stripes are encoded by up to 'workers' processes, one per core by default; a file of one task is encoded here
+
+        assert parity_blocks in (1, 2), 'Only one or two parity blocks are supported'
+        assert 0 < data_blocks <= 255, 'At most 255 data blocks are supported'
+        self.block_size = block_size
+        self.data_blocks = data_blocks
+        self.parity_blocks = parity_blocks
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+
+    def get_pool(self):
+        #  Worker processes are spawned rather than forked, as the controller runs other threads
+        #  A spawning Pool, rather than a ProcessPoolExecutor, as 'mp_context' needs Python 3.7
+        if self.pool is None:
+            self.pool = multiprocessing.get_context('spawn').Pool(self.workers)
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def get_record_size(self, header):
+        #  Each stripe's record: a CRC-32 for each data and parity block, then the parity blocks
+        return CRC.size * (header.data_blocks + header.parity_blocks) + header.block_size * header.parity_blocks
+
+    def save_parity(self, library, path_in_library):
+        #  Description
+        #    Compute and save the parity of a media file, e.g. once it is backed up
+        #  Requires
+        #    'path_in_library' must be a key in 'library.media', with a cache file
+        #  Guarantees
+        #    The parity file replaces any earlier one (see 'MediaFile.parity_file'), and is added to 'library.snapshot'
+        #    If the file does not match its cached checksum, no parity is saved and False is returned
+        #    The file is read once; stripes are encoded while the next are read
+
+        media = library.media[path_in_library]
+        storage = library.storage
+        header = ParityHeader(media.cached_checksum, storage.stat(media.path).st_size, self.block_size,
+                              self.data_blocks, self.parity_blocks)
+        stripe_size = self.block_size * self.data_blocks
+        task_size = max(TASK_SIZE // stripe_size, 1) * stripe_size
+        sha1 = hashlib.sha1()
+        temporary_file = media.parity_file + '.tmp'
+        storage.makedirs(os.path.dirname(media.parity_file))
+        with storage.open(media.path, 'rb') as file, storage.open(temporary_file, 'wb') as parity_file:
+            storage.advise_sequential(file)
+            parity_file.write((json.dumps(header._asdict()) + '\n').encode('utf-8'))
+            if header.size <= task_size:
+                data = file.read()
+                sha1.update(data)
+                parity_file.write(encode_stripes(data, self.block_size, self.data_blocks, self.parity_blocks))
+            else:
+                pool = self.get_pool()
+                pending = collections.deque()
+                while True:
+                    data = file.read(task_size)
+                    if data:
+                        sha1.update(data)
+                        pending.append(pool.apply_async(encode_stripes, (data, self.block_size, self.data_blocks, self.parity_blocks)))
+                    while pending and (not data or len(pending) > self.workers):
+                        parity_file.write(pending.popleft().get())
+                    if not data:
+                        break
+            storage.drop_cache(file)
+        if sha1.hexdigest() != header.checksum:
+            storage.remove(temporary_file)
+            return False
+        storage.replace(temporary_file, media.parity_file)
+        if library.snapshot is not None:
+            library.snapshot.add_file(os.path.relpath(media.parity_file, library.path))
+        return True
+
+    def load_header(self, storage, parity_file):
+        #  The ParityHeader of a parity file, and the offset of its first record, or (None, None)
+        try:
+            with storage.open(parity_file, 'rb') as file:
+                line = file.readline()
+            return ParityHeader(**json.loads(line.decode('utf-8'))), len(line)
+        except (OSError, ValueError, TypeError):
+            return None, None
+
+    def has_parity(self, library, path_in_library):
+        #  Whether a media file has parity for the checksum in its cache file
+        media = library.media[path_in_library]
+        header, _ = self.load_header(library.storage, media.parity_file)
+        return header is not None and header.checksum == media.cached_checksum
+
+    def repair(self, library, path_in_library):
+        #  Description
+        #    Repair a media file that no longer matches its cache file, from its parity
+        #  Requires
+        #    'path_in_library' must be a key in 'library.media'
+        #  Guarantees
+        #    Only the blocks whose CRC-32 does not match are rewritten, and only once every damaged stripe is repairable
+        #    A failed Result is returned, and the file is not changed, if there is too much damage
+        #    The repaired file is read back and verified against its cached checksum
+        #    The file's modification time is kept; the Result's 'repaired_blocks' metric counts the rewritten blocks
+        #    A repaired file's cache file is refreshed, as it was just verified
+
+        media = library.media[path_in_library]
+        storage = library.storage
+        header, offset = self.load_header(storage, media.parity_file)
+        if header is None or header.checksum != media.cached_checksum:
+            return Result(subject=media.path, success=False, message='The file has no parity for its cached checksum.')
+        stat = storage.stat(media.path)
+        if stat.st_size != header.size:
+            return Result(subject=media.path, success=False, message='The file has changed size; parity can not repair it.')
+
+        #  Find the repairs of every stripe before any is written
+        repairs = dict()  # {offset: repaired block}
+        record_size = self.get_record_size(header)
+        stripe_size = header.block_size * header.data_blocks
+        with storage.open(media.path, 'rb') as file, storage.open(media.parity_file, 'rb') as parity_file:
+            storage.advise_sequential(file)
+            parity_file.seek(offset)
+            stripe_offset = 0
+            while stripe_offset < header.size:
+                stripe = file.read(stripe_size)
+                record = parity_file.read(record_size)
+                stripe_repairs = self.repair_stripe(header, stripe, record)
+                if stripe_repairs is None:
+                    return Result(subject=media.path, success=False, message=(
+                        'Too many blocks are damaged to repair, from offset {}.'.format(stripe_offset)
+                    ))
+                for block_offset, block in stripe_repairs.items():
+                    repairs[stripe_offset + block_offset] = block
+                stripe_offset += stripe_size
+            storage.drop_cache(file)
+
+        if repairs:
+            self.write_blocks(storage, media.path, repairs)
+            storage.utime(media.path, stat.st_mtime)
+        media.generate_checksum(drop_cache=True)
+        if media.real_checksum != media.cached_checksum:
+            return Result(subject=media.path, success=False, message=(
+                'The repaired file does not match its cached checksum.' +
+                '\nCached checksum: {}'.format(media.cached_checksum) +
+                '\nRepaired file checksum: {}'.format(media.real_checksum)
+            ))
+        if storage.exists(media.prehash_file):
+            storage.remove(media.prehash_file)
+        media.refresh_cache_file()
+        result = Result(subject=media.path, success=True)
+        result.metrics['repaired_blocks'] = len(repairs)
+        return result
+
+    def repair_stripe(self, header, stripe, record):
+        #  Description
+        #    Rebuild the damaged blocks of a stripe
+        #  Guarantees
+        #    A dict is returned: {offset in the stripe: repaired block}, empty if no block is damaged
+        #    'None' is returned if more blocks are damaged than there are intact parity blocks
+        #    A rebuilt block is only returned if it matches its CRC-32
+
+        block_size = header.block_size
+        crc_count = header.data_blocks + header.parity_blocks
+        if len(record) != self.get_record_size(header):
+            return None
+        crcs = [CRC.unpack_from(record, index * CRC.size)[0] for index in range(crc_count)]
+        blocks = [stripe[offset:offset + block_size] for offset in range(0, len(stripe), block_size)]
+        damaged = [index for index, block in enumerate(blocks) if zlib.crc32(block) != crcs[index]]
+        if not damaged:
+            return dict()
+        parity_offset = CRC.size * crc_count
+        parity = [record[parity_offset + index * block_size:parity_offset + (index + 1) * block_size] for index in range(header.parity_blocks)]
+        intact = [zlib.crc32(block) == crcs[header.data_blocks + index] for index, block in enumerate(parity)]
+        if len(damaged) > sum(intact):
+            return None
+
+        arithmetic = BlockArithmetic(block_size)
+        values = [0 if index in damaged else arithmetic.to_int(block) for index, block in enumerate(blocks)]
+        syndromes = arithmetic.get_syndromes(values, header.parity_blocks)
+        p, q = syndromes[0], syndromes[-1]
+        if len(damaged) == 1 and intact[0]:
+            rebuilt = {damaged[0]: p ^ arithmetic.to_int(parity[0])}
+        elif len(damaged) == 1:
+            #  Q alone: Q' = 2^x * D_x
+            x = damaged[0]
+            rebuilt = {x: arithmetic.multiply(q ^ arithmetic.to_int(parity[1]), gf_inverse(GF_EXP[x]))}
+        else:
+            #  P and Q: D_x + D_y = P', and 2^x * D_x + 2^y * D_y = Q'
+            x, y = damaged
+            p ^= arithmetic.to_int(parity[0])
+            q ^= arithmetic.to_int(parity[1])
+            d_x = arithmetic.multiply(q ^ arithmetic.multiply(p, GF_EXP[y]), gf_inverse(GF_EXP[x] ^ GF_EXP[y]))
+            rebuilt = {x: d_x, y: p ^ d_x}
+
+        repairs = dict()
+        for index, value in rebuilt.items():
+            block = arithmetic.to_bytes(value)[:len(blocks[index])]
+            if zlib.crc32(block) != crcs[index]:
+                return None
+            repairs[index * block_size] = block
+        return repairs
+
+    def write_blocks(self, storage, path, repairs):
+        #  Write the repaired blocks in place, or rewrite the file where the storage can not (e.g. pack files)
+        try:
+            file = storage.open(path, 'r+b')
+        except io.UnsupportedOperation:
+            file = None
+        if file is not None:
+            with file:
+                for offset, block in sorted(repairs.items()):
+                    file.seek(offset)
+                    file.write(block)
+                storage.sync(file)
+            return
+        temporary_file = path + '.repair'
+        with storage.open(path, 'rb') as source_file, storage.open(temporary_file, 'wb') as destination_file:
+            offset = 0
+            for block_offset, block in sorted(repairs.items()) + [(None, b'')]:
+                while block_offset is None or offset < block_offset:
+                    data = source_file.read(TASK_SIZE if block_offset is None else min(TASK_SIZE, block_offset - offset))
+                    if not data:
+                        break
+                    destination_file.write(data)
+                    offset += len(data)
+                destination_file.write(block)
+                source_file.seek(offset + len(block))
+                offset += len(block)
+        storage.replace(temporary_file, path)
@@ -0,0 +1,60 @@
+import json
+import os
+import threading
+
+class RestoreJournal(object):
+    def __init__(self, library):
+        #  Records the media being restored into 'library', so an interrupted restore can be resumed
+        #  Restored media is not recorded; it is found in the library, with a verified cache file
+        self.library = library
+        self.storage = library.storage
+        self.journal_file = os.path.join(library.path, '.cache', 'restore_journal.json')
+        self.in_progress = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self.storage.isfile(self.journal_file):
+            with self.storage.open(self.journal_file, 'r') as file:
+                self.in_progress = set(json.load(file))
+
+    def save(self):
+        if len(self.in_progress) == 0:
+            if self.storage.exists(self.journal_file):
+                self.storage.remove(self.journal_file)
+            return
+        self.storage.makedirs(os.path.dirname(self.journal_file))
+        with self.storage.open(self.journal_file, 'w') as file:
+            json.dump(sorted(self.in_progress), file)
+
+    def start(self, path_in_library):
+        #  Record a copy before it starts
+        with self._lock:
+            self.in_progress.add(path_in_library)
+            self.save()
+
+    def finish(self, path_in_library):
+        #  Forget a copy once it has been verified, or undone
+        with self._lock:
+            self.in_progress.discard(path_in_library)
+            self.save()
+
+    def recover(self):
+        #  Description
+        #    Undo the copies of an interrupted restore
+        #  Guarantees
+        #    Each media file that was being copied is deleted from the library, with its cache file
+        #    The paths of the deleted media are returned, so they can be restored again
+
+        self.load()
+        recovered = sorted(self.in_progress)
+        for path_in_library in recovered:
+            media = self.library.get_media(path_in_library)
+            for filepath in [media.cache_file, media.prehash_file, media.parity_file, media.path]:
+                if self.storage.exists(filepath):
+                    self.storage.remove(filepath)
+            self.library.media.pop(path_in_library, None)
+            if self.library.snapshot is not None:
+                self.library.snapshot.remove_media(path_in_library)
+            self.in_progress.discard(path_in_library)
+        self.save()
+        return recovered
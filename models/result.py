@@ -1,5 +1,6 @@
 class Result(object):
-    def __init__(self, subject: str, success: bool=False, message: str=None):
+    def __init__(self, subject: str, success: bool=False, message: str=None, metrics: dict=None):
         self.subject = subject
         self.success = success
-        self.message = message
\ No newline at end of file
+        self.message = message
+        self.metrics = metrics if metrics is not None else dict()  # e.g. {'copy_method': 'reflink'}
\ No newline at end of file
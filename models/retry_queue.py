@@ -0,0 +1,118 @@
+import json
+import os
+import time
+
+class RetryQueue(object):
+    def __init__(self, max_attempts: int=3, backoff_seconds: float=5.0, backoff_factor: float=2.0):
+        #  A failed backup is retried until it has been attempted 'max_attempts' times
+        #  The wait before each retry grows by 'backoff_factor', starting at 'backoff_seconds'
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.backoff_factor = backoff_factor
+
+        #  Failed backups, as {(library_name, path_in_library, mirror_path): entry}
+        #  Each entry is a dict of 'library_name', 'path_in_library', 'mirror_path', 'attempts',
+        #  'error_message' and 'next_attempt_time'
+        self.entries = dict()
+
+    def add_failure(self, library_name, path_in_library, mirror_path, error_message, now=None):
+        #  Description
+        #    Record a failed attempt to back up a media file to a mirror
+        #  Guarantees
+        #    The entry's attempt count is increased, and its next retry is scheduled with exponential backoff
+        #    The entry is returned
+
+        now = time.time() if now is None else now
+        key = (library_name, path_in_library, mirror_path)
+        entry = self.entries.setdefault(key, {
+            'library_name': library_name,
+            'path_in_library': path_in_library,
+            'mirror_path': mirror_path,
+            'attempts': 0,
+            'error_message': None,
+            'next_attempt_time': now
+        })
+        entry['attempts'] += 1
+        entry['error_message'] = error_message
+        entry['next_attempt_time'] = now + self.backoff_seconds * self.backoff_factor ** (entry['attempts'] - 1)
+        return entry
+
+    def remove(self, library_name, path_in_library, mirror_path):
+        #  Forget a failure once the media file has been backed up
+        self.entries.pop((library_name, path_in_library, mirror_path), None)
+
+    def get_pending(self):
+        #  Entries that may still be retried
+        return [entry for entry in self.entries.values() if entry['attempts'] < self.max_attempts]
+
+    def get_due(self, now=None):
+        #  Entries that may still be retried and whose backoff has passed, in the order they failed
+        now = time.time() if now is None else now
+        return [entry for entry in self.get_pending() if entry['next_attempt_time'] <= now]
+
+    def get_next_attempt_time(self):
+        #  The time of the next scheduled retry, or 'None' if nothing is pending
+        pending = self.get_pending()
+        if len(pending) == 0:
+            return None
+        return min(entry['next_attempt_time'] for entry in pending)
+
+    def get_failure_report(self):
+        #  Description
+        #    Get the failures that are left
+        #  Guarantees
+        #    A list of dicts is returned, sorted by mirror, library and path
+        #    Each dict holds 'library_name', 'path_in_library', 'mirror_path', 'attempts' and 'error_message'
+
+        return [
+            {
+                'library_name': entry['library_name'],
+                'path_in_library': entry['path_in_library'],
+                'mirror_path': entry['mirror_path'],
+                'attempts': entry['attempts'],
+                'error_message': entry['error_message']
+            }
+            for entry in sorted(
+                self.entries.values(),
+                key=lambda entry: (entry['mirror_path'], entry['library_name'], entry['path_in_library'])
+            )
+        ]
+
+    def save(self, report_file):
+        #  Description
+        #    Save the failure report, so a later run can retry only these failures
+        #  Guarantees
+        #    The report file is removed if there are no failures
+
+        report = self.get_failure_report()
+        if len(report) == 0:
+            if os.path.exists(report_file):
+                os.remove(report_file)
+            return
+        os.makedirs(os.path.dirname(report_file), exist_ok=True)
+        with open(report_file, 'w') as file:
+            json.dump(report, file, indent=4)
+
+    def load(self, report_file, now=None):
+        #  Description
+        #    Queue the failures in a saved failure report
+        #  Guarantees
+        #    Each failure starts over with no attempts, and is due immediately
+        #    The number of failures queued is returned
+
+        if not os.path.isfile(report_file):
+            return 0
+        with open(report_file, 'r') as file:
+            report = json.load(file)
+        now = time.time() if now is None else now
+        for item in report:
+            key = (item['library_name'], item['path_in_library'], item['mirror_path'])
+            self.entries[key] = {
+                'library_name': item['library_name'],
+                'path_in_library': item['path_in_library'],
+                'mirror_path': item['mirror_path'],
+                'attempts': 0,
+                'error_message': item['error_message'],
+                'next_attempt_time': now
+            }
+        return len(report)
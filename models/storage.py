@@ -0,0 +1,461 @@
+import collections
+import errno
+import io
+import os
+import shutil
+import threading
+import time
+
+from . import copy_engine
+from . import disk_layout
+from . import page_cache
+
+#  Storage backends
+#  Libraries and media files reach their files through a backend, so the same code can run against
+#  a local disc or a simulated one:
+#   - 'LocalStorage' calls the operating system
+#   - 'MemoryStorage' keeps every file in memory, and models the latency and throughput of a device
+#  Other backends: 'pack_storage.PackStorage' and 'object_storage.ObjectStorage'
+
+#  The subset of 'os.stat_result' used by the models
+StorageStat = collections.namedtuple('StorageStat', ['st_size', 'st_mtime', 'st_mtime_ns', 'st_dev', 'st_ino'])
+
+class LocalStorage(object):
+    #  Files on a local, or mounted, filesystem
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def isfile(self, path):
+        return os.path.isfile(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def scandir(self, path):
+        return os.scandir(path)
+
+    def walk(self, top, topdown=True):
+        return os.walk(top, topdown=topdown)
+
+    def makedirs(self, path):
+        os.makedirs(path, exist_ok=True)
+
+    def open(self, path, mode='r'):
+        return open(path, mode)
+
+    def replace(self, source_path, destination_path):
+        os.replace(source_path, destination_path)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def rmdir(self, path):
+        os.rmdir(path)
+
+    def copy_file(self, source_path, destination_path, throttle=None, buffer_size=1048576):
+        #  Copy with the best method the kernel offers, and return its name (see 'copy_engine.copy_file')
+        return copy_engine.copy_file(source_path, destination_path, throttle=throttle, buffer_size=buffer_size)
+
+    def clone_file(self, source_path, destination_path):
+        #  Share the file's data without copying it, where the filesystem supports reflinks (see 'copy_engine.clone_file')
+        return copy_engine.clone_file(source_path, destination_path)
+
+    def copystat(self, source_path, destination_path):
+        shutil.copystat(source_path, destination_path)
+
+    def utime(self, path, mtime):
+        os.utime(path, (time.time(), mtime))
+
+    def set_mtime_on_close(self, file, mtime):
+        #  Give a file being written 'mtime' when it is closed, where the backend stores it with the file's data
+        #  'False' is returned otherwise, and the caller sets it with 'utime' once the file is closed
+        return False
+
+    def preallocate(self, file, size):
+        return copy_engine.preallocate(file.fileno(), size)
+
+    def sync(self, file):
+        #  Flush a file written with 'open' to the disc
+        file.flush()
+        os.fsync(file.fileno())
+
+    def advise_sequential(self, file):
+        page_cache.advise_sequential(file.fileno())
+
+    def drop_cache(self, file, offset=0, length=0):
+        page_cache.drop_cache(file.fileno(), offset, length)
+
+    def get_extent_count(self, path):
+        return disk_layout.get_extent_count(path)
+
+    def get_layout_key(self, path):
+        #  A key that sorts files by their physical position (see 'disk_layout.sort_by_layout')
+        return disk_layout.get_layout_key(path)
+
+    def get_free_bytes(self, path):
+        #  Free space for new files under 'path', or 'None' if the backend has no limit
+        return shutil.disk_usage(path).free
+
+    def get_verified_checksum(self, path):
+        #  The SHA-1 checksum of a file the backend verified as it was written, or 'None'
+        #  A file without one is verified by reading it back (see 'Library.verify_copied_media')
+        return None
+
+#  Most libraries use the local filesystem; they share one backend
+LOCAL_STORAGE = LocalStorage()
+
+def copy_between(source_storage, source_path, destination_storage, destination_path, throttle=None, buffer_size=1048576):
+    #  Description
+    #    Copy a file from one backend to another
+    #  Guarantees
+    #    The file is streamed through user-space buffers, honoring 'throttle' for reads and writes
+    #    The copy is flushed, and keeps the source's modification time
+    #    The name of the copy method is returned, as for 'LocalStorage.copy_file'
+
+    source_stat = source_storage.stat(source_path)
+    with source_storage.open(source_path, 'rb') as source_file, destination_storage.open(destination_path, 'wb') as destination_file:
+        destination_storage.preallocate(destination_file, source_stat.st_size)
+        mtime_is_set = destination_storage.set_mtime_on_close(destination_file, source_stat.st_mtime)
+        while True:
+            data = throttle.read(source_file, buffer_size) if throttle else source_file.read(buffer_size)
+            if not data:
+                break
+            if throttle:
+                throttle.write(destination_file, data)
+            else:
+                destination_file.write(data)
+        destination_file.truncate()
+        destination_storage.sync(destination_file)
+    if not mtime_is_set:
+        destination_storage.utime(destination_path, source_stat.st_mtime)
+    return copy_engine.COPY_METHOD_USERSPACE
+
+def walk_storage(storage, top, topdown=True):
+    #  Like 'os.walk', for a backend that only lists directories with 'scandir'; 'top' is yielded as given
+    try:
+        entries = storage.scandir(top)
+    except FileNotFoundError:
+        return
+    dirnames = [entry.name for entry in entries if entry.is_dir()]
+    filenames = [entry.name for entry in entries if entry.is_file()]
+    if topdown:
+        yield top, dirnames, filenames
+    for dirname in dirnames:
+        for walked in walk_storage(storage, os.path.join(top, dirname), topdown):
+            yield walked
+    if not topdown:
+        yield top, dirnames, filenames
+
+class MemoryNode(object):
+    def __init__(self, data, mtime_ns, inode):
+        self.data = data  # bytes
+        self.mtime_ns = mtime_ns
+        self.inode = inode
+
+class MemoryDirEntry(object):
+    #  A directory entry, as returned by 'os.scandir'
+    def __init__(self, storage, path, is_directory):
+        self.storage = storage
+        self.path = path
+        self.name = os.path.basename(path)
+        self._is_directory = is_directory
+
+    def is_dir(self, follow_symlinks=True):
+        return self._is_directory
+
+    def is_file(self, follow_symlinks=True):
+        return not self._is_directory
+
+    def stat(self, follow_symlinks=True):
+        return self.storage.stat(self.path)
+
+class MemoryFile(io.BytesIO):
+    #  A file opened on a MemoryStorage
+    #  Reads and writes are charged to the storage's throughput; the contents are stored when the file is closed
+    def __init__(self, storage, path, data, writable):
+        io.BytesIO.__init__(self, data)
+        self.storage = storage
+        self.path = path
+        self.writable_file = writable
+
+    def read(self, size=-1):
+        data = io.BytesIO.read(self, size)
+        self.storage.charge_read(len(data))
+        return data
+
+    def read1(self, size=-1):
+        data = io.BytesIO.read1(self, size)
+        self.storage.charge_read(len(data))
+        return data
+
+    def readinto(self, buffer):
+        count = io.BytesIO.readinto(self, buffer)
+        self.storage.charge_read(count)
+        return count
+
+    def write(self, data):
+        if not self.writable_file:
+            raise io.UnsupportedOperation('not writable')
+        self.storage.charge_write(len(data))
+        return io.BytesIO.write(self, data)
+
+    def close(self):
+        if not self.closed and self.writable_file:
+            self.storage.store(self.path, self.getvalue())
+        io.BytesIO.close(self)
+
+class MemoryStorage(object):
+    def __init__(self, latency_seconds: float=0.0, read_bytes_per_second: int=None, write_bytes_per_second: int=None,
+                 sleep: bool=True):
+        #  Description
+        #    A filesystem held in memory, for tests and benchmarks at a scale that real files would not allow
+        #  Implementation Notes
+        #    Every metadata operation (stat, listing, open, rename, delete) costs 'latency_seconds'
+        #    Reads and writes cost their size divided by the read or write throughput; 'None' is unlimited
+        #    The modeled time is added up in 'self.simulated_seconds'
+        #    With 'sleep', each operation also takes its modeled time; without it, a benchmark of
+        #    millions of files runs at memory speed and reports the time the device would have taken
+
+        self.latency_seconds = latency_seconds
+        self.read_bytes_per_second = read_bytes_per_second
+        self.write_bytes_per_second = write_bytes_per_second
+        self.sleep = sleep
+        self.simulated_seconds = 0.0
+        self.files = dict()  # {'path': MemoryNode}
+        self.directories = {os.sep: MemoryNode(None, int(time.time() * 1e9), 1)}  # {'path': MemoryNode}
+        self.children = {os.sep: set()}  # {'directory path': set('names')}
+        self._next_inode = 2
+        self._lock = threading.RLock()
+
+    def charge(self, seconds):
+        with self._lock:
+            self.simulated_seconds += seconds
+        if self.sleep and seconds > 0:
+            time.sleep(seconds)
+
+    def charge_operation(self):
+        self.charge(self.latency_seconds)
+
+    def charge_read(self, size):
+        if self.read_bytes_per_second and size:
+            self.charge(size / self.read_bytes_per_second)
+
+    def charge_write(self, size):
+        if self.write_bytes_per_second and size:
+            self.charge(size / self.write_bytes_per_second)
+
+    def normalize(self, path):
+        return os.path.normpath(os.path.join(os.sep, path))
+
+    def new_node(self, data):
+        node = MemoryNode(data, int(time.time() * 1e9), self._next_inode)
+        self._next_inode += 1
+        return node
+
+    def touch_directory(self, path):
+        #  Adding or removing an entry changes the modification time of its directory, as on a real filesystem
+        self.directories[path].mtime_ns = max(int(time.time() * 1e9), self.directories[path].mtime_ns + 1)
+
+    def not_found(self, path):
+        return FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+    def exists(self, path):
+        self.charge_operation()
+        path = self.normalize(path)
+        return path in self.files or path in self.directories
+
+    def isfile(self, path):
+        self.charge_operation()
+        return self.normalize(path) in self.files
+
+    def isdir(self, path):
+        self.charge_operation()
+        return self.normalize(path) in self.directories
+
+    def stat(self, path):
+        self.charge_operation()
+        path = self.normalize(path)
+        with self._lock:
+            if path in self.files:
+                node = self.files[path]
+                size = len(node.data)
+            elif path in self.directories:
+                node = self.directories[path]
+                size = 0
+            else:
+                raise self.not_found(path)
+            return StorageStat(size, node.mtime_ns / 1e9, node.mtime_ns, 0, node.inode)
+
+    def scandir(self, path):
+        self.charge_operation()
+        path = self.normalize(path)
+        with self._lock:
+            if path not in self.directories:
+                raise self.not_found(path)
+            return [
+                MemoryDirEntry(self, os.path.join(path, name), os.path.join(path, name) in self.directories)
+                for name in sorted(self.children[path])
+            ]
+
+    def walk(self, top, topdown=True):
+        return walk_storage(self, top, topdown)
+
+    def makedirs(self, path):
+        self.charge_operation()
+        path = self.normalize(path)
+        with self._lock:
+            if path in self.files:
+                raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+            missing = []
+            while path not in self.directories:
+                missing.append(path)
+                path = os.path.dirname(path)
+            for directory in reversed(missing):
+                parent = os.path.dirname(directory)
+                self.directories[directory] = self.new_node(None)
+                self.children[directory] = set()
+                self.children[parent].add(os.path.basename(directory))
+                self.touch_directory(parent)
+
+    def open(self, path, mode='r'):
+        #  Modes 'r', 'w', 'a' and 'r+', in text or binary ('b')
+        self.charge_operation()
+        path = self.normalize(path)
+        with self._lock:
+            if path in self.directories:
+                raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+            if os.path.dirname(path) not in self.directories:
+                raise self.not_found(path)
+            if 'w' in mode:
+                data = b''
+                self.store(path, data)
+            elif path in self.files:
+                data = self.files[path].data
+            elif 'a' in mode:
+                data = b''
+            else:
+                raise self.not_found(path)
+        file = MemoryFile(self, path, data, writable=any(flag in mode for flag in 'wa+'))
+        if 'a' in mode:
+            file.seek(0, io.SEEK_END)
+        if 'b' in mode:
+            return file
+        return io.TextIOWrapper(file, encoding='utf-8')
+
+    def store(self, path, data):
+        #  Set the contents of a file, as when it is closed after writing
+        with self._lock:
+            if path in self.files:
+                self.files[path].data = bytes(data)
+                self.files[path].mtime_ns = int(time.time() * 1e9)
+            else:
+                self.files[path] = self.new_node(bytes(data))
+                self.children[os.path.dirname(path)].add(os.path.basename(path))
+                self.touch_directory(os.path.dirname(path))
+
+    def replace(self, source_path, destination_path):
+        self.charge_operation()
+        source_path = self.normalize(source_path)
+        destination_path = self.normalize(destination_path)
+        with self._lock:
+            if source_path not in self.files:
+                raise self.not_found(source_path)
+            if os.path.dirname(destination_path) not in self.directories:
+                raise self.not_found(destination_path)
+            node = self.files.pop(source_path)
+            self.children[os.path.dirname(source_path)].discard(os.path.basename(source_path))
+            self.touch_directory(os.path.dirname(source_path))
+            self.files[destination_path] = node
+            self.children[os.path.dirname(destination_path)].add(os.path.basename(destination_path))
+            self.touch_directory(os.path.dirname(destination_path))
+
+    def remove(self, path):
+        self.charge_operation()
+        path = self.normalize(path)
+        with self._lock:
+            if path not in self.files:
+                raise self.not_found(path)
+            self.files.pop(path)
+            self.children[os.path.dirname(path)].discard(os.path.basename(path))
+            self.touch_directory(os.path.dirname(path))
+
+    def rmdir(self, path):
+        self.charge_operation()
+        path = self.normalize(path)
+        with self._lock:
+            if path not in self.directories:
+                raise self.not_found(path)
+            if self.children[path]:
+                raise OSError(errno.ENOTEMPTY, os.strerror(errno.ENOTEMPTY), path)
+            self.directories.pop(path)
+            self.children.pop(path)
+            self.children[os.path.dirname(path)].discard(os.path.basename(path))
+            self.touch_directory(os.path.dirname(path))
+
+    def copy_file(self, source_path, destination_path, throttle=None, buffer_size=1048576):
+        #  A buffered copy, charged for reading the source and writing the destination
+        with self.open(source_path, 'rb') as source_file, self.open(destination_path, 'wb') as destination_file:
+            while True:
+                data = throttle.read(source_file, buffer_size) if throttle else source_file.read(buffer_size)
+                if not data:
+                    break
+                if throttle:
+                    throttle.write(destination_file, data)
+                else:
+                    destination_file.write(data)
+        self.copystat(source_path, destination_path)
+        return copy_engine.COPY_METHOD_USERSPACE
+
+    def clone_file(self, source_path, destination_path):
+        #  Contents are immutable bytes, so a clone shares them, as a reflink would
+        self.charge_operation()
+        with self._lock:
+            if self.normalize(source_path) not in self.files:
+                raise self.not_found(source_path)
+            self.store(self.normalize(destination_path), self.files[self.normalize(source_path)].data)
+        self.copystat(source_path, destination_path)
+        return True
+
+    def copystat(self, source_path, destination_path):
+        with self._lock:
+            self.files[self.normalize(destination_path)].mtime_ns = self.files[self.normalize(source_path)].mtime_ns
+
+    def utime(self, path, mtime):
+        with self._lock:
+            self.files[self.normalize(path)].mtime_ns = int(mtime * 1e9)
+
+    def set_mtime_on_close(self, file, mtime):
+        return False
+
+    def preallocate(self, file, size):
+        return False
+
+    def sync(self, file):
+        file.flush()
+
+    def advise_sequential(self, file):
+        pass
+
+    def drop_cache(self, file, offset=0, length=0):
+        pass
+
+    def get_extent_count(self, path):
+        return None
+
+    def get_layout_key(self, path):
+        #  Files in memory are ordered by inode, as they were created
+        try:
+            stat = self.stat(path)
+        except OSError:
+            return disk_layout.MISSING_LAYOUT_KEY
+        return (stat.st_dev, stat.st_ino)
+
+    def get_free_bytes(self, path):
+        return None
+
+    def get_verified_checksum(self, path):
+        return None
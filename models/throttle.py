@@ -0,0 +1,130 @@
+import ctypes
+import os
+import platform
+import sys
+import threading
+import time
+
+class Throttle(object):
+    def __init__(self, read_bytes_per_second: int=None, write_bytes_per_second: int=None, iops: int=None,
+                 adaptive: bool=False, adaptive_latency_factor: float=2.0, adaptive_max_delay: float=1.0):
+        #  A 'None' limit means the operation is not limited
+        self.read_bytes_per_second = read_bytes_per_second
+        self.write_bytes_per_second = write_bytes_per_second
+        self.iops = iops
+
+        #  Adaptive mode backs off when the measured read latency rises above the baseline
+        self.adaptive = adaptive
+        self.adaptive_latency_factor = adaptive_latency_factor
+        self.adaptive_max_delay = adaptive_max_delay
+        self.baseline_latency = None
+        self.average_latency = None
+        self.backoff_delay = 0.0
+
+        #  The earliest time the next read, write, or I/O operation may start
+        self._next_read_time = 0.0
+        self._next_write_time = 0.0
+        self._next_operation_time = 0.0
+        self._lock = threading.Lock()
+
+    def read(self, file, size):
+        #  Description
+        #    Read up to 'size' bytes from 'file', honoring the read and IOPS limits
+        #  Guarantees
+        #    The data read from 'file' is returned
+        #    In adaptive mode, the read latency is measured and the back-off delay is updated
+
+        self._wait(size, is_read=True)
+        start_time = time.monotonic()
+        data = file.read(size)
+        if self.adaptive and data:
+            self.record_read_latency(time.monotonic() - start_time)
+            if self.backoff_delay > 0:
+                time.sleep(self.backoff_delay)
+        return data
+
+    def write(self, file, data):
+        #  Description
+        #    Write 'data' to 'file', honoring the write and IOPS limits
+        #  Guarantees
+        #    All of 'data' is written to 'file'
+
+        self._wait(len(data), is_read=False)
+        file.write(data)
+
+    def record_read_latency(self, latency):
+        #  Description
+        #    Update the back-off delay from a measured read latency
+        #  Implementation Notes
+        #    The baseline is the lowest moving average seen so far
+        #    The delay doubles while latency is above the baseline and halves once it recovers
+
+        with self._lock:
+            if self.average_latency is None:
+                self.average_latency = latency
+            else:
+                self.average_latency = 0.8 * self.average_latency + 0.2 * latency
+            if self.baseline_latency is None or self.average_latency < self.baseline_latency:
+                self.baseline_latency = self.average_latency
+
+            if self.average_latency > self.baseline_latency * self.adaptive_latency_factor:
+                self.backoff_delay = min(max(self.backoff_delay * 2, 0.01), self.adaptive_max_delay)
+            elif self.backoff_delay > 0:
+                self.backoff_delay = self.backoff_delay / 2 if self.backoff_delay > 0.01 else 0.0
+
+    def _wait(self, size, is_read):
+        #  Reserve a time slot for the operation, then sleep until the slot starts
+        with self._lock:
+            now = time.monotonic()
+            bytes_per_second = self.read_bytes_per_second if is_read else self.write_bytes_per_second
+            next_time = self._next_read_time if is_read else self._next_write_time
+            start_time = max(now, next_time)
+            if bytes_per_second:
+                next_time = start_time + size / bytes_per_second
+            if self.iops:
+                start_time = max(start_time, self._next_operation_time)
+                self._next_operation_time = start_time + 1.0 / self.iops
+            if is_read:
+                self._next_read_time = next_time
+            else:
+                self._next_write_time = next_time
+        if start_time > now:
+            time.sleep(start_time - now)
+
+#  ioprio_set() syscall numbers; Python does not expose ioprio_set()
+IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+def lower_process_priority(niceness: int=None, io_idle: bool=False):
+    #  Description
+    #    Lower the CPU and I/O priority of the current process
+    #  Guarantees
+    #    The CPU priority is set to 'niceness', unless the process is already nicer
+    #    On Linux, 'io_idle' puts the process in the idle I/O scheduling class
+    #    A tuple is returned: (niceness was applied, I/O class was applied)
+    #  Implementation Notes
+    #    The niceness is absolute, so calling this more than once has no extra effect
+
+    niceness_applied = False
+    if niceness is not None and hasattr(os, 'setpriority'):
+        if os.getpriority(os.PRIO_PROCESS, 0) < niceness:
+            os.setpriority(os.PRIO_PROCESS, 0, niceness)
+        niceness_applied = True
+
+    io_idle_applied = False
+    syscall_number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if io_idle and sys.platform.startswith('linux') and syscall_number:
+        libc = ctypes.CDLL(None, use_errno=True)
+        io_priority = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+        io_idle_applied = libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, 0, io_priority) == 0
+
+    return niceness_applied, io_idle_applied
@@ -0,0 +1,119 @@
+import os
+import threading
+
+#  Extensions of the files kept in '.cache' directories for each media file (see 'MediaFile')
+CACHE_FILE_EXTENSIONS = ['.txt', '.prehash', '.parity']
+
+class TreeSnapshot(object):
+    def __init__(self):
+        #  Description
+        #    The directories and files of a library, captured while it is loaded (see 'Library.load_all_media')
+        #  Implementation Notes
+        #    Paths are relative to the library; '' is the library itself
+        #    Every file and directory is held, including '.cache' directories and files that are not media,
+        #    so the maintenance queries of a scan answer without walking the library again
+        #    The library updates the snapshot as it copies and deletes files; changes made by other programs
+        #    are only seen by the next load
+        #    Copies may run in parallel, so every change and query holds 'self._lock'
+
+        self.files = dict()  # {'directory_in_library': set('file names')}
+        self.directories = dict()  # {'directory_in_library': set('sub-directory names')}
+        self._lock = threading.RLock()
+
+    def set_listing(self, directory, filenames, dirnames):
+        with self._lock:
+            self.add_directory(directory)
+            self.files[directory] = set(filenames)
+            self.directories[directory] = set(dirnames)
+
+    def add_directory(self, directory):
+        #  Add a directory, and any missing parents
+        with self._lock:
+            if directory in self.files:
+                return
+            self.files[directory] = set()
+            self.directories[directory] = set()
+            if directory:
+                parent = os.path.dirname(directory)
+                self.add_directory(parent)
+                self.directories[parent].add(os.path.basename(directory))
+
+    def remove_directory(self, directory):
+        #  Remove a directory and everything under it
+        with self._lock:
+            for key in [key for key in self.files if key == directory or key.startswith(directory + os.sep)]:
+                self.files.pop(key)
+                self.directories.pop(key)
+            parent = os.path.dirname(directory)
+            if directory and parent in self.directories:
+                self.directories[parent].discard(os.path.basename(directory))
+
+    def add_file(self, path):
+        with self._lock:
+            parent = os.path.dirname(path)
+            self.add_directory(parent)
+            self.files[parent].add(os.path.basename(path))
+
+    def remove_file(self, path):
+        with self._lock:
+            self.files.get(os.path.dirname(path), set()).discard(os.path.basename(path))
+
+    def add_media(self, path_in_library):
+        #  A media file copied into the library, and its cache file
+        with self._lock:
+            self.add_file(path_in_library)
+            self.add_file(get_cache_file(path_in_library, '.txt'))
+
+    def remove_media(self, path_in_library):
+        #  A media file deleted or moved out of the library, and its cache files
+        with self._lock:
+            self.remove_file(path_in_library)
+            for extension in CACHE_FILE_EXTENSIONS:
+                self.remove_file(get_cache_file(path_in_library, extension))
+
+    def get_listing(self, directory):
+        #  A copy of a directory's listing, as a tuple: (set('file names'), set('sub-directory names'))
+        with self._lock:
+            return set(self.files.get(directory, set())), set(self.directories.get(directory, set()))
+
+    def get_files_under(self, directory):
+        #  Every file in a directory and its sub-directories, relative to the library
+        with self._lock:
+            return [
+                os.path.join(key, filename) for key in self.files
+                if not directory or key == directory or key.startswith(directory + os.sep)
+                for filename in self.files[key]
+            ]
+
+    def exists(self, path):
+        with self._lock:
+            parent = os.path.dirname(path)
+            name = os.path.basename(path)
+            return name in self.files.get(parent, set()) or name in self.directories.get(parent, set())
+
+    def get_empty_directories(self):
+        #  Directories without files or sub-directories, except the library itself, in sorted order
+        with self._lock:
+            return [
+                directory for directory in sorted(self.files)
+                if directory and not self.files[directory] and not self.directories[directory]
+            ]
+
+    def get_orphan_cache_files(self):
+        #  Cache files whose media file is not in the parent of their '.cache' directory, in sorted order
+        with self._lock:
+            orphan_cache_files = []
+            for directory in sorted(self.files):
+                if '.cache' not in directory:
+                    continue
+                parent = os.path.dirname(directory)
+                for filename in sorted(self.files[directory]):
+                    media_name, extension = os.path.splitext(filename)
+                    if extension in CACHE_FILE_EXTENSIONS and not self.exists(os.path.join(parent, media_name)):
+                        orphan_cache_files.append(os.path.join(directory, filename))
+            return orphan_cache_files
+
+def get_cache_file(path_in_library, extension):
+    #  The path of a media file's cache file, as in 'MediaFile.cache_file' and 'MediaFile.prehash_file'
+    return os.path.join(os.path.dirname(path_in_library), '.cache', os.path.basename(path_in_library) + extension)
+
@@ -0,0 +1,203 @@
+import datetime
+import os
+import sys
+import threading
+
+from .storage import LOCAL_STORAGE
+from .throttle import lower_process_priority
+from .tree_snapshot import get_cache_file
+
+#  Versions are named by the time they were kept, e.g. '20200131T120000.mkv'
+VERSION_TIME_FORMAT = '%Y%m%dT%H%M%S'
+
+class VersionStore(object):
+    def __init__(self, mirror_path, max_versions: int=3, max_age_days: float=90, storage=None):
+        #  Prior versions of overwritten backup media, under '.versions' in the backup mirror
+        #  Each media file's versions are kept in their own directory: '.versions/<library>/<path_in_library>/'
+        #  A retention rule of 'None' is not applied
+        self.path = os.path.join(mirror_path, '.versions')
+        self.max_versions = max_versions  # Newest versions to keep for each media file
+        self.max_age_days = max_age_days  # Versions older than this are pruned
+        self.storage = storage or LOCAL_STORAGE  # The backend of the backup mirror (see 'storage')
+
+    def get_version_directory(self, library_name, path_in_library):
+        return os.path.join(self.path, library_name, path_in_library)
+
+    def get_new_version_path(self, library_name, path_in_library, ext, now):
+        #  A free path for a version kept at 'now'; its directory is made
+        version_directory = self.get_version_directory(library_name, path_in_library)
+        self.storage.makedirs(version_directory)
+        stamp = now.strftime(VERSION_TIME_FORMAT)
+        suffix = 0
+        while self.storage.exists(os.path.join(version_directory, stamp + ext)):
+            suffix += 1
+            stamp = '{0}-{1}'.format(now.strftime(VERSION_TIME_FORMAT), suffix)
+        return os.path.join(version_directory, stamp + ext)
+
+    def keep_version(self, library, path_in_library, now=None):
+        #  Description
+        #    Move a backup media file, and its cache and parity files, into the versions area
+        #  Requires
+        #    'path_in_library' must be a key in 'library.media'
+        #  Guarantees
+        #    The media file is renamed, so no data is copied
+        #    The media file is removed from 'library.media', as if it had been deleted
+        #    The path of the kept version is returned
+
+        media = library.media[path_in_library]
+        version_path = self.get_new_version_path(library.name, path_in_library, media.ext, now or datetime.datetime.now())
+        cache_path = os.path.splitext(version_path)[0] + '.txt'
+        self.storage.replace(media.path, version_path)
+        if self.storage.exists(media.cache_file):
+            self.storage.replace(media.cache_file, cache_path)
+        if self.storage.exists(media.parity_file):
+            self.storage.replace(media.parity_file, os.path.splitext(version_path)[0] + '.parity')
+        if self.storage.exists(media.prehash_file):
+            self.storage.remove(media.prehash_file)
+        library.media.pop(path_in_library)
+        if library.snapshot is not None:
+            library.snapshot.remove_media(path_in_library)
+        return version_path
+
+    def clone_version(self, library, path_in_library, now=None):
+        #  Description
+        #    Keep a backup media file as a version, but leave it in the library to be updated in place
+        #  Requires
+        #    'path_in_library' must be a key in 'library.media'
+        #  Guarantees
+        #    The media file is cloned, so no data is copied, and its cache file is copied
+        #    Its parity file is moved, as it will not match the updated file
+        #    The path of the kept version is returned, or 'None' if the storage can not clone files (see 'clone_file')
+        #    A version kept this way is restored, and pruned, as one kept by 'keep_version'
+
+        media = library.media[path_in_library]
+        version_path = self.get_new_version_path(library.name, path_in_library, media.ext, now or datetime.datetime.now())
+        cache_path = os.path.splitext(version_path)[0] + '.txt'
+        if not self.storage.clone_file(media.path, version_path):
+            self.remove_empty_directories(os.path.dirname(version_path))
+            return None
+        if self.storage.exists(media.cache_file):
+            self.storage.copy_file(media.cache_file, cache_path)
+        if self.storage.exists(media.parity_file):
+            self.storage.replace(media.parity_file, os.path.splitext(version_path)[0] + '.parity')
+            if library.snapshot is not None:
+                library.snapshot.remove_file(get_cache_file(path_in_library, '.parity'))
+        return version_path
+
+    def restore_version(self, library, path_in_library, version_path):
+        #  Description
+        #    Move a kept version back into the library, e.g. when the copy that replaced it failed
+        #  Guarantees
+        #    The media file and its cache and parity files are renamed back, and the media is added to 'library.media'
+
+        media = library.get_media(path_in_library)
+        cache_path = os.path.splitext(version_path)[0] + '.txt'
+        parity_path = os.path.splitext(version_path)[0] + '.parity'
+        self.storage.replace(version_path, media.path)
+        if self.storage.exists(cache_path):
+            self.storage.makedirs(os.path.dirname(media.cache_file))
+            self.storage.replace(cache_path, media.cache_file)
+        restored_parity = self.storage.exists(parity_path)
+        if restored_parity:
+            self.storage.makedirs(os.path.dirname(media.parity_file))
+            self.storage.replace(parity_path, media.parity_file)
+        library.media[path_in_library] = media
+        if library.snapshot is not None:
+            library.snapshot.add_media(path_in_library)
+            if restored_parity:
+                library.snapshot.add_file(get_cache_file(path_in_library, '.parity'))
+        self.remove_empty_directories(os.path.dirname(version_path))
+
+    def get_versions(self, library_name, path_in_library):
+        #  The versions kept for a media file, oldest first, as a list of paths
+        return self.list_versions(self.get_version_directory(library_name, path_in_library))
+
+    def list_versions(self, version_directory):
+        try:
+            return sorted(
+                entry.path for entry in self.storage.scandir(version_directory)
+                if os.path.splitext(entry.name)[1] not in ('.txt', '.parity') and entry.is_file()
+            )
+        except FileNotFoundError:
+            return []
+
+    def get_version_time(self, version_path):
+        stamp = os.path.splitext(os.path.basename(version_path))[0].split('-')[0]
+        return datetime.datetime.strptime(stamp, VERSION_TIME_FORMAT)
+
+    def prune(self, now=None, stop_event=None):
+        #  Description
+        #    Delete the versions that are beyond the retention rules
+        #  Guarantees
+        #    For each media file, versions beyond the newest 'self.max_versions' are deleted
+        #    Versions older than 'self.max_age_days' are deleted
+        #    Version directories left empty are removed
+        #    The paths of the deleted versions are returned
+        #    Pruning stops between media files once 'stop_event' is set
+        #    Versions pruned meanwhile by another process, e.g. a daemon, are skipped
+
+        now = now or datetime.datetime.now()
+        pruned = []
+        if not self.storage.isdir(self.path):
+            return pruned
+        for dirpath, dirnames, filenames in self.storage.walk(self.path, topdown=False):
+            if stop_event is not None and stop_event.is_set():
+                break
+            versions = self.list_versions(dirpath)
+            expired = []
+            if self.max_versions is not None and len(versions) > self.max_versions:
+                expired += versions[:len(versions) - self.max_versions]
+            if self.max_age_days is not None:
+                expiration_time = now - datetime.timedelta(days=self.max_age_days)
+                expired += [version for version in versions if self.get_version_time(version) < expiration_time]
+            for version_path in sorted(set(expired)):
+                try:
+                    for extension in ('.txt', '.parity'):
+                        if self.storage.exists(os.path.splitext(version_path)[0] + extension):
+                            self.storage.remove(os.path.splitext(version_path)[0] + extension)
+                    self.storage.remove(version_path)
+                except FileNotFoundError:
+                    continue
+                pruned.append(version_path)
+            self.remove_empty_directories(dirpath)
+        return pruned
+
+    def remove_empty_directories(self, directory):
+        #  Remove 'directory' and its parents while they are empty, up to the versions area
+        while directory != self.path and directory.startswith(self.path) and self.storage.isdir(directory):
+            try:
+                if len(list(self.storage.scandir(directory))) > 0:
+                    break
+                self.storage.rmdir(directory)
+            except FileNotFoundError:
+                pass
+            directory = os.path.dirname(directory)
+
+class VersionPruner(threading.Thread):
+    def __init__(self, version_stores, niceness: int=19, io_idle: bool=True):
+        #  Prune each VersionStore in 'version_stores' in the background, at low priority
+        threading.Thread.__init__(self, name='VersionPruner', daemon=True)
+        self.version_stores = version_stores
+        self.niceness = niceness
+        self.io_idle = io_idle
+        self.pruned = []
+        self.stop_event = threading.Event()
+
+    def run(self):
+        #  On Linux, priority is set per thread, so only this thread's priority is lowered (see 'BackgroundHasher')
+        if sys.platform.startswith('linux'):
+            lower_process_priority(niceness=self.niceness, io_idle=self.io_idle)
+        for version_store in self.version_stores:
+            if self.stop_event.is_set():
+                break
+            try:
+                self.pruned += version_store.prune(stop_event=self.stop_event)
+            except OSError:
+                #  The backup disc went away; the next run prunes again
+                continue
+
+    def stop(self):
+        #  Ask the thread to stop, and wait until it has
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
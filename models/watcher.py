@@ -0,0 +1,352 @@
+import ctypes
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+from .storage import LOCAL_STORAGE
+
+#  Linux inotify (see 'man 7 inotify')
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+#  Every change to the entries of a directory, and to the files in it
+DIRECTORY_EVENTS = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+    IN_ONLYDIR
+)
+
+#  struct inotify_event: wd, mask, cookie and the length of the name that follows
+EVENT_HEADER = struct.Struct('iIII')
+
+class Inotify(object):
+    def __init__(self):
+        #  Description
+        #    An inotify instance, read without blocking
+        #  Guarantees
+        #    OSError is raised where inotify is not available, e.g. on other platforms or past the instance limit
+
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        watch_descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if watch_descriptor < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return watch_descriptor
+
+    def read_events(self, timeout=0):
+        #  Description
+        #    Read the queued events, waiting up to 'timeout' seconds for the first
+        #  Guarantees
+        #    A list of tuples is returned: (watch descriptor, mask, cookie, name)
+        #    'name' is '' for events on the watched directory itself
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                watch_descriptor, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                events.append((watch_descriptor, mask, cookie, name))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class LibraryWatcher(object):
+    def __init__(self, libraries):
+        #  Description
+        #    Watch every directory of 'libraries' for changes
+        #  Requires
+        #    Each library's snapshot is loaded (see 'Library.load_all_media')
+        #  Guarantees
+        #    OSError is raised if inotify is not available
+        #  Implementation Notes
+        #    Only libraries on local storage can be watched; the others are listed in 'self.unwatched'
+        #    A library that can not be watched is only changed by this program (see readme), which keeps it current
+        #    New directories are watched as soon as their creation is read, before their parent is reloaded,
+        #    so nothing written to them in the meantime is missed
+        #    A directory that inotify refuses to watch, e.g. past the watch limit (ENOSPC) or without permission (EACCES),
+        #    is polled instead, as by 'PollingWatcher', each time changes are read
+
+        self.inotify = Inotify()
+        self.watches = dict()  # {watch descriptor: (LibraryObject, 'directory_in_library')}
+        self.polled = dict()  # {(LibraryObject, 'directory_in_library'): mtime_ns}, for directories not watched
+        self.libraries = []
+        self.unwatched = []
+        self.changes = dict()  # {(LibraryObject, 'directory_in_library'): set('changed names')}
+        self.open_files = set()  # {(LibraryObject, 'path_in_library')} created, but not yet closed
+        self.overflowed = False
+        try:
+            for library in libraries:
+                if library.storage is LOCAL_STORAGE:
+                    self.libraries.append(library)
+                    for directory_in_library in sorted(library.get_snapshot().files):
+                        self.watch_directory(library, directory_in_library)
+                else:
+                    self.unwatched.append(library)
+        except BaseException:
+            self.inotify.close()
+            raise
+
+    def fileno(self):
+        return self.inotify.fileno()
+
+    def watch_directory(self, library, directory_in_library):
+        dirpath = os.path.join(library.path, directory_in_library) if directory_in_library else library.path
+        try:
+            watch_descriptor = self.inotify.add_watch(dirpath, DIRECTORY_EVENTS)
+        except (FileNotFoundError, NotADirectoryError):
+            #  Removed before it was watched; its parent's change covers it
+            return
+        except OSError as error:
+            key = (library, directory_in_library)
+            if key not in self.polled:
+                if not self.polled:
+                    print('Some directories can not be watched ({}); they are polled instead'.format(error))
+                self.polled[key] = self.get_mtime(library, directory_in_library)
+            return
+        self.watches[watch_descriptor] = (library, directory_in_library)
+
+    def get_mtime(self, library, directory_in_library):
+        dirpath = os.path.join(library.path, directory_in_library) if directory_in_library else library.path
+        try:
+            return os.stat(dirpath).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def watch_tree(self, library, directory_in_library):
+        #  A directory created or moved into a library may already have sub-directories
+        self.watch_directory(library, directory_in_library)
+        dirpath = os.path.join(library.path, directory_in_library)
+        for parent, dirnames, _ in os.walk(dirpath):
+            for dirname in dirnames:
+                self.watch_directory(library, os.path.relpath(os.path.join(parent, dirname), library.path))
+
+    def poll_directories(self):
+        #  Description
+        #    Check the modification time of each polled directory, and add those that changed to 'self.changes'
+        #  Guarantees
+        #    True is returned if any polled directory changed
+        #    New sub-directories of a changed directory are watched, or polled; a removed directory is no longer polled
+
+        changed = False
+        for key, mtime_ns in list(self.polled.items()):
+            library, directory_in_library = key
+            new_mtime_ns = self.get_mtime(library, directory_in_library)
+            if new_mtime_ns == mtime_ns:
+                continue
+            self.changes.setdefault(key, set())
+            changed = True
+            if new_mtime_ns is None:
+                self.polled.pop(key)
+                continue
+            self.polled[key] = new_mtime_ns
+            known = set(self.watches.values()) | set(self.polled)
+            dirpath = os.path.join(library.path, directory_in_library) if directory_in_library else library.path
+            try:
+                entries = list(os.scandir(dirpath))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                path_in_library = os.path.join(directory_in_library, entry.name)
+                if entry.is_dir(follow_symlinks=False) and (library, path_in_library) not in known:
+                    self.watch_tree(library, path_in_library)
+        return changed
+    def read_changes(self, timeout=0):
+        #  Description
+        #    Read the queued events into 'self.changes', waiting up to 'timeout' seconds for the first
+        #  Guarantees
+        #    True is returned if there were any events, or a polled directory changed
+        #    If the kernel's queue overflowed, 'self.overflowed' is set; events were lost
+
+        polled_changed = self.poll_directories()
+        events = self.inotify.read_events(0 if polled_changed else timeout)
+        for watch_descriptor, mask, _, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            if watch_descriptor not in self.watches:
+                continue
+            library, directory_in_library = self.watches[watch_descriptor]
+            if mask & IN_IGNORED:
+                #  The directory was removed, or moved out of the library
+                self.watches.pop(watch_descriptor)
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                #  Reported by the parent, too
+                continue
+            path_in_library = os.path.join(directory_in_library, name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(library, path_in_library)
+            elif mask & IN_CREATE:
+                self.open_files.add((library, path_in_library))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE):
+                self.open_files.discard((library, path_in_library))
+            self.changes.setdefault((library, directory_in_library), set()).add(name)
+        return len(events) > 0 or polled_changed
+
+    def is_open(self, library, path_in_library):
+        #  Whether a file was created, and has not been closed since; a file opened before it was watched is not known
+        return (library, path_in_library) in self.open_files
+
+    def pop_changes(self):
+        #  Description
+        #    Take the changes read so far
+        #  Guarantees
+        #    A dict is returned: {(LibraryObject, 'directory_in_library'): set('changed names')}
+        #    After an overflow, every directory is watched again and returned, with no names; each must be listed again
+
+        if self.overflowed:
+            #  Closes may have been lost, too; from here on, only their size and modification time tell
+            self.overflowed = False
+            self.open_files.clear()
+            for library in self.libraries:
+                self.watch_tree(library, '')
+            self.changes = {key: set() for key in list(self.watches.values()) + list(self.polled)}
+        changes = self.changes
+        self.changes = dict()
+        return changes
+
+    def close(self):
+        self.inotify.close()
+
+class PollingWatcher(object):
+    def __init__(self, libraries, interval_seconds=10.0):
+        #  Description
+        #    Find the changed directories of 'libraries' by checking their modification times, where inotify is not available
+        #  Requires
+        #    Each library's snapshot is loaded (see 'Library.load_all_media')
+        #  Implementation Notes
+        #    Every 'interval_seconds', each directory is checked with stat(), but none is listed
+        #    Adding, removing or renaming an entry changes a directory's modification time; rewriting a file does not,
+        #    so changed names are never reported
+        #    A directory new to a snapshot is reported by the next poll, as it may have changed since it was listed
+
+        self.libraries = list(libraries)
+        self.interval_seconds = interval_seconds
+        self.mtimes = dict()  # {(LibraryObject, 'directory_in_library'): mtime_ns}
+        self.changes = dict()
+        self.last_poll_time = time.time()
+        for library in self.libraries:
+            for directory_in_library in library.get_snapshot().files:
+                self.mtimes[(library, directory_in_library)] = self.get_mtime(library, directory_in_library)
+
+    def get_mtime(self, library, directory_in_library):
+        dirpath = os.path.join(library.path, directory_in_library) if directory_in_library else library.path
+        try:
+            return library.storage.stat(dirpath).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def read_changes(self, timeout=0):
+        #  Description
+        #    Poll the directories into 'self.changes', if 'interval_seconds' have passed, waiting up to 'timeout' seconds
+        #  Guarantees
+        #    True is returned if any directory changed
+
+        remaining = self.last_poll_time + self.interval_seconds - time.time()
+        if remaining > timeout:
+            time.sleep(timeout)
+            return False
+        time.sleep(max(remaining, 0))
+        self.last_poll_time = time.time()
+
+        changed = False
+        for library in self.libraries:
+            for directory_in_library in library.get_snapshot().files:
+                self.mtimes.setdefault((library, directory_in_library), None)
+        for key, mtime_ns in list(self.mtimes.items()):
+            library, directory_in_library = key
+            new_mtime_ns = self.get_mtime(library, directory_in_library)
+            if new_mtime_ns == mtime_ns:
+                continue
+            self.changes.setdefault(key, set())
+            changed = True
+            if new_mtime_ns is None:
+                self.mtimes.pop(key)
+            else:
+                self.mtimes[key] = new_mtime_ns
+        return changed
+
+    def is_open(self, library, path_in_library):
+        #  Open files can not be seen by polling; only the file's size and modification time tell
+        return False
+
+    def pop_changes(self):
+        #  As 'LibraryWatcher.pop_changes'
+        changes = self.changes
+        self.changes = dict()
+        return changes
+
+    def close(self):
+        pass
+
+class ChangeDebouncer(object):
+    def __init__(self, settle_seconds=5.0):
+        #  Description
+        #    Hold changed media files until they have settled
+        #  Implementation Notes
+        #    A file has settled once it is closed, and its size and modification time have not changed for 'settle_seconds'
+        #    A file that is deleted while it is held is dropped
+
+        self.settle_seconds = settle_seconds
+        self.pending = dict()  # {(LibraryObject, 'path_in_library'): (size, mtime_ns, time of the last change)}
+
+    def add(self, library, path_in_library, now=None):
+        self.pending[(library, path_in_library)] = (None, None, now if now is not None else time.time())
+
+    def pop_settled(self, is_open, now=None):
+        #  Description
+        #    Take the files that have settled
+        #  Requires
+        #    'is_open' is called as is_open(library, path_in_library) (see 'LibraryWatcher.is_open')
+        #  Guarantees
+        #    A list of tuples is returned: (LibraryObject, 'path_in_library'), in the order the files were added
+
+        now = now if now is not None else time.time()
+        settled = []
+        for key, (size, mtime_ns, change_time) in list(self.pending.items()):
+            library, path_in_library = key
+            try:
+                stat = library.storage.stat(os.path.join(library.path, path_in_library))
+            except (FileNotFoundError, NotADirectoryError):
+                self.pending.pop(key)
+                continue
+            if is_open(library, path_in_library) or (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                self.pending[key] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - change_time >= self.settle_seconds:
+                self.pending.pop(key)
+                settled.append(key)
+        return settled
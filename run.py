@@ -13,5 +13,12 @@ if __name__ == '__main__':
     assert os.path.exists(config_path), 'Missing config file: {}'.format(config_path)
 
     #  Load UI
+    #  With '--daemon', keep the mirrors loaded for other main menus instead (see readme)
+    #  With '--watch', back up new media as it arrives instead
     ui = UI(config_path)
-    ui.main_menu()
+    if '--daemon' in sys.argv[1:]:
+        ui.run_daemon()
+    elif '--watch' in sys.argv[1:]:
+        ui.run_watch()
+    else:
+        ui.main_menu()
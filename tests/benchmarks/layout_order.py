@@ -0,0 +1,59 @@
+import argparse
+import os
+import time
+
+from ..tools import sandbox
+from ...models import disk_layout
+from ...models import library
+
+#  Compare hashing a library in walk order with hashing it in physical layout order
+#  Run: python3 -m media-backup.tests.benchmarks.layout_order [--files N] [--size BYTES]
+#  Set TMPDIR to put the sandbox on the disc being measured
+
+def drop_page_cache(filepath):
+    #  Ask the kernel to forget the file's pages, so it is read from the disc again
+    if hasattr(os, 'posix_fadvise'):
+        with open(filepath, 'rb') as file:
+            os.fsync(file.fileno())
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def time_hashing(library_object, order):
+    for path_in_library in order:
+        drop_page_cache(library_object.media[path_in_library].path)
+    start_time = time.monotonic()
+    for path_in_library in order:
+        library_object.media[path_in_library].generate_checksum()
+    return time.monotonic() - start_time
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark walk order against physical layout order')
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', type=int, default=1048576)
+    arguments = parser.parse_args()
+
+    test_sandbox = sandbox.Sandbox()
+    test_sandbox.create()
+    try:
+        mock_library = test_sandbox.source_videos_library
+        test_sandbox.populate_library_with_generated_media(mock_library, arguments.files, arguments.size)
+        library_object = library.Library(mock_library.name, mock_library.path, mock_library.source)
+        library_object.load_all_media(callback_on_progress=None)
+
+        walk_order = list(library_object.media)
+        start_time = time.monotonic()
+        layout_order = disk_layout.sort_by_layout({
+            path_in_library: media.path for path_in_library, media in library_object.media.items()
+        })
+        sort_seconds = time.monotonic() - start_time
+
+        walk_seconds = time_hashing(library_object, walk_order)
+        layout_seconds = time_hashing(library_object, layout_order)
+
+        print('Files: {0} x {1} bytes'.format(arguments.files, arguments.size))
+        print('Walk order:   {0:.3f} seconds'.format(walk_seconds))
+        print('Layout order: {0:.3f} seconds (+{1:.3f} seconds to sort)'.format(layout_seconds, sort_seconds))
+    finally:
+        test_sandbox.destroy()
+
+if __name__ == '__main__':
+    main()
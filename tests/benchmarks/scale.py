@@ -0,0 +1,55 @@
+import argparse
+import time
+
+from ..tools import sandbox
+from ...models import library
+from ...models import storage
+
+#  Simulate loading and backing up a large library on a slow device, without creating real files
+#  Run: python3 -m media-backup.tests.benchmarks.scale [--files N] [--size BYTES] [--device usb|nas]
+#  The reported times are the device's modeled times (see 'MemoryStorage'), not the time the benchmark took
+
+#  Device profiles, as MemoryStorage arguments
+DEVICES = {
+    'usb': {'latency_seconds': 0.0005, 'read_bytes_per_second': 40000000, 'write_bytes_per_second': 25000000},
+    'nas': {'latency_seconds': 0.002, 'read_bytes_per_second': 110000000, 'write_bytes_per_second': 90000000}
+}
+
+def measure(device, function):
+    #  Run 'function' and return (its result, the device time it took)
+    start_seconds = device.simulated_seconds
+    result = function()
+    return result, device.simulated_seconds - start_seconds
+
+def backup_library_media(source_library, backup_libraries):
+    #  Back up each media file missing from 'backup_libraries', one file at a time, as the main controller does
+    for path_in_library, target_libraries in source_library.get_media_to_backup(backup_libraries).items():
+        source_library.backup_media(source_library.media[path_in_library], target_libraries)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark a large library on a simulated device')
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--device', choices=sorted(DEVICES), default='usb')
+    arguments = parser.parse_args()
+
+    device = storage.MemoryStorage(sleep=False, **DEVICES[arguments.device])
+    test_sandbox = sandbox.Sandbox(storage=device)
+    test_sandbox.create()
+    start_time = time.monotonic()
+    test_sandbox.populate_library_with_generated_media(
+        test_sandbox.source_music_library, arguments.files, arguments.size, directory_count=max(arguments.files // 100, 1)
+    )
+    source_library = library.Library('Music', test_sandbox.source_music_library.path, True, storage=device)
+    backup_library = library.Library('Music', test_sandbox.backup_music_library.path, False, storage=device)
+
+    _, load_seconds = measure(device, lambda: source_library.load_all_media(None))
+    _, backup_seconds = measure(device, lambda: backup_library_media(source_library, [backup_library]))
+
+    print('Files: {0} x {1} bytes on a simulated {2} device'.format(arguments.files, arguments.size, arguments.device))
+    print('Load:   {0:.3f} seconds'.format(load_seconds))
+    print('Backup: {0:.3f} seconds'.format(backup_seconds))
+    print('Benchmark ran in {0:.3f} seconds'.format(time.monotonic() - start_time))
+
+if __name__ == '__main__':
+    main()
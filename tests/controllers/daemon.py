@@ -0,0 +1,118 @@
+import contextlib
+import io
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from ..tools import sandbox
+from ...controllers import Daemon
+from ...controllers import DaemonClient
+from ...controllers import MainController
+
+class DaemonTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        #  A daemon serves its mirrors on a socket in its own temporary directory, which keeps the path short
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        self.source_files = self.sandbox.populate_library_with_unique_media(self.sandbox.source_videos_library)
+        self.socket_directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.socket_directory, 'daemon.sock')
+        self.daemon = Daemon(self.load_controller, self.socket_path, background_hashing=False)
+        self.daemon.start()
+        self.thread = threading.Thread(target=self.daemon.serve_forever, daemon=True)
+        self.thread.start()
+        self.client = DaemonClient(self.socket_path)
+
+    def tearDown(self):
+        if self.thread.is_alive():
+            self.client.request('stop')
+            self.thread.join(timeout=10)
+        shutil.rmtree(self.socket_directory)
+        self.sandbox.destroy()
+
+    def load_controller(self):
+        controller = MainController(self.sandbox.source_mirror, [self.sandbox.backup_mirror], ['Videos'], 30)
+        with contextlib.redirect_stdout(io.StringIO()):
+            controller.load_mirrors()
+        return controller
+
+    def send_raw(self, data):
+        #  Send raw bytes as a request, and read the one line answered
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(self.socket_path)
+            with connection.makefile('rwb') as stream:
+                stream.write(data)
+                stream.flush()
+                return stream.readline()
+
+    def test_status(self):
+        response = self.client.request('status')
+        self.assertTrue(response['ok'], response.get('error'))
+        media_counts = {(item['mirror_path'], item['library_name']): item['media_count'] for item in response['result']['libraries']}
+        self.assertEqual(media_counts[(self.sandbox.source_mirror, 'Videos')], len(self.source_files))
+        self.assertEqual(media_counts[(self.sandbox.backup_mirror, 'Videos')], 0)
+        self.assertIsNone(response['result']['counts']['backup_failures'])
+
+    def test_scan(self):
+        #  What the scan prints is returned with its answer, and the new media is backed up
+        #  sys.stdout is left alone while the request runs, as other threads print to it
+        backup_new_source_media = self.daemon.controller.backup_new_source_media
+        stdout_during_request = []
+
+        def backup_and_record_stdout():
+            stdout_during_request.append(sys.stdout)
+            backup_new_source_media()
+
+        with contextlib.redirect_stdout(io.StringIO()) as daemon_output:
+            with mock.patch.object(self.daemon.controller, 'backup_new_source_media', side_effect=backup_and_record_stdout):
+                response = self.client.request('scan', kind='quick')
+        self.assertTrue(response['ok'], response.get('error'))
+        self.assertIn('new media files', response['output'])
+        self.assertEqual(stdout_during_request, [daemon_output])
+        self.assertEqual(daemon_output.getvalue(), '')
+        self.assertEqual(response['result']['backup_failures'], 0)
+        for source_file in self.source_files:
+            self.assertTrue(os.path.isfile(os.path.join(self.sandbox.backup_videos_library.path, source_file.name)))
+        status = self.client.request('status')
+        self.assertEqual(status['result']['counts']['backup_failures'], 0)
+
+    def test_streamed_scan(self):
+        #  A streamed scan's output is sent a line at a time, before its answer
+        output = []
+        response = self.client.request('scan', on_output=output.append, kind='quick')
+        self.assertTrue(response['ok'], response.get('error'))
+        self.assertEqual(response['output'], '')
+        self.assertGreater(len(output), 1)
+        self.assertTrue(all(text.endswith(('\n', '\r')) for text in output))
+        self.assertIn('new media files', ''.join(output))
+
+    def test_unknown_scan(self):
+        response = self.client.request('scan', kind='sideways')
+        self.assertFalse(response['ok'])
+        self.assertIn('Unknown scan', response['error'])
+
+    def test_malformed_request(self):
+        #  The connection stays open after a malformed request
+        self.assertIn(b'Malformed request', self.send_raw(b'not json\n'))
+        self.assertIn(b'Malformed request', self.send_raw(b'["status"]\n'))
+        self.assertTrue(self.client.request('status')['ok'])
+
+    def test_unknown_command(self):
+        response = self.client.request('rescan')
+        self.assertFalse(response['ok'])
+        self.assertIn('Unknown command', response['error'])
+
+    def test_stop(self):
+        #  The daemon stops serving, and removes its socket
+        self.assertTrue(self.client.request('stop')['ok'])
+        self.thread.join(timeout=10)
+        self.assertFalse(self.thread.is_alive())
+        self.assertFalse(os.path.exists(self.socket_path))
+        with self.assertRaises(ConnectionError):
+            self.client.request('status')
@@ -0,0 +1,75 @@
+import contextlib
+import io
+import os
+import unittest
+from unittest import mock
+
+from ..tools import sandbox
+from ...controllers import MainController
+from ...controllers import main_controller
+from ...models import BackupQueue
+from ...models import capacity
+from ...models import RetryQueue
+
+class MainControllerTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        self.source_files = self.sandbox.populate_library_with_unique_media(self.sandbox.source_videos_library)
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def load_controller(self, time_budget_seconds, backoff_seconds):
+        controller = MainController(
+            self.sandbox.source_mirror,
+            [self.sandbox.backup_mirror],
+            ['Videos'],
+            30,
+            retry_queue=RetryQueue(backoff_seconds=backoff_seconds),
+            backup_queue=BackupQueue(time_budget_seconds=time_budget_seconds)
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            controller.load_mirrors()
+        controller.reset_backup_report()
+        controller.backup_queue.start()
+        path_in_library = os.path.relpath(self.source_files[0].path, self.sandbox.source_videos_library.path)
+        controller.retry_queue.add_failure('Videos', path_in_library, self.sandbox.backup_mirror, 'mock error')
+        return controller
+
+    def retry(self, controller):
+        with contextlib.redirect_stdout(io.StringIO()), mock.patch.object(main_controller.time, 'sleep') as sleep:
+            controller.retry_failed_backups()
+        return sleep
+
+    def test_retry_within_time_budget(self):
+        controller = self.load_controller(time_budget_seconds=60, backoff_seconds=0)
+        self.retry(controller)
+        self.assertEqual(controller.retry_queue.get_pending(), [])
+        self.assertEqual(controller.backup_report[self.sandbox.backup_mirror]['retried'], 1)
+
+    def test_retry_backoff_past_time_budget(self):
+        #  A backoff that ends after the budget is not waited for; the failure is left for the next run
+        controller = self.load_controller(time_budget_seconds=60, backoff_seconds=120)
+        sleep = self.retry(controller)
+        sleep.assert_not_called()
+        self.assertEqual([entry['attempts'] for entry in controller.retry_queue.get_pending()], [1])
+
+    def test_retry_after_time_budget(self):
+        #  Once the budget is spent, a due retry is not started
+        controller = self.load_controller(time_budget_seconds=0, backoff_seconds=0)
+        self.retry(controller)
+        self.assertEqual([entry['attempts'] for entry in controller.retry_queue.get_pending()], [1])
+        self.assertEqual(controller.backup_report[self.sandbox.backup_mirror]['retried'], 0)
+
+    def test_throughput_is_measured_from_copies(self):
+        #  Time spent before and between copies, here an hour of planning, is not counted
+        controller = self.load_controller(time_budget_seconds=None, backoff_seconds=0)
+        controller.backup_start_time -= 3600
+        with contextlib.redirect_stdout(io.StringIO()):
+            controller.finish_backup()
+        counts = controller.backup_report[self.sandbox.backup_mirror]
+        self.assertGreater(counts['bytes'], 0)
+        self.assertLess(counts['seconds'], 60)
+        self.assertAlmostEqual(capacity.load_throughput(self.sandbox.backup_mirror), counts['bytes'] / counts['seconds'])
@@ -0,0 +1,66 @@
+import os
+import unittest
+
+from ..tools import sandbox
+from ...models import background_hasher
+from ...models import media_file
+
+class BackgroundHasherTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        self.mock_files = self.sandbox.populate_library_with_unique_media(self.sandbox.source_videos_library)
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def make_media(self, mock_file):
+        return media_file.MediaFile(mock_file.path, mock_file.name, mock_file.source)
+
+    def run_hasher(self):
+        hasher = background_hasher.BackgroundHasher(
+            [self.make_media(mock_file) for mock_file in self.mock_files],
+            niceness=None,
+            io_idle=False
+        )
+        hasher.start()
+        hasher.join()
+        return hasher
+
+    def test_prehash_is_saved_and_reused(self):
+        hasher = self.run_hasher()
+        self.assertEqual(hasher.hashed_count, 12)
+        for mock_file in self.mock_files:
+            media = self.make_media(mock_file)
+            self.assertTrue(os.path.exists(media.prehash_file))
+            self.assertTrue(media.load_prehash_file())
+            expected_media = self.make_media(mock_file)
+            expected_media.generate_checksum()
+            self.assertEqual(media.real_checksum, expected_media.real_checksum)
+
+        #  A second run has nothing left to do
+        self.assertEqual(self.run_hasher().hashed_count, 0)
+
+    def test_modified_file_ignores_prehash(self):
+        self.run_hasher()
+        mock_file = self.mock_files[0]
+        with open(mock_file.path, 'a') as file:
+            file.write(' and more bits')
+        media = self.make_media(mock_file)
+        self.assertFalse(media.load_prehash_file())
+        expected_media = self.make_media(mock_file)
+        expected_media.generate_checksum()
+        self.assertEqual(media.real_checksum, expected_media.real_checksum)
+
+    def test_stop(self):
+        hasher = background_hasher.BackgroundHasher(
+            [self.make_media(mock_file) for mock_file in self.mock_files],
+            niceness=None,
+            io_idle=False
+        )
+        hasher.stop_event.set()
+        hasher.start()
+        hasher.stop()
+        self.assertEqual(hasher.hashed_count, 0)
+        self.assertFalse(hasher.is_alive())
@@ -0,0 +1,66 @@
+import os
+import unittest
+
+from ..tools import sandbox
+from ...models import backup_queue
+from ...models import media_file
+
+class BackupQueueTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        self.videos = self.make_media(self.sandbox.source_videos_library, [('a.mkv', 300, 100), ('b.mkv', 100, 300), ('c.mkv', 200, 200)])
+        self.music = self.make_media(self.sandbox.source_music_library, [('d.flac', 50, 400), ('e.flac', 60, 500)])
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def make_media(self, mock_library, files):
+        #  'files' is a list of (name, size, mtime)
+        media = dict()
+        for name, size, mtime in files:
+            mock_file = self.sandbox.make_media(name, 'x' * size, mock_library)
+            os.utime(mock_file.path, (mtime, mtime))
+            media[name] = media_file.MediaFile(mock_file.path, name, True)
+        return media
+
+    def test_smallest_first(self):
+        queue = backup_queue.BackupQueue(strategy=backup_queue.QUEUE_SMALLEST_FIRST)
+        self.assertEqual(queue.order([('Videos', self.videos)]), [('Videos', 'b.mkv'), ('Videos', 'c.mkv'), ('Videos', 'a.mkv')])
+
+    def test_newest_first(self):
+        queue = backup_queue.BackupQueue(strategy=backup_queue.QUEUE_NEWEST_FIRST)
+        self.assertEqual(queue.order([('Videos', self.videos)]), [('Videos', 'b.mkv'), ('Videos', 'c.mkv'), ('Videos', 'a.mkv')])
+        self.assertEqual(queue.order([('Music', self.music)]), [('Music', 'e.flac'), ('Music', 'd.flac')])
+
+    def test_libraries_follow_each_other_without_weights(self):
+        queue = backup_queue.BackupQueue(strategy=backup_queue.QUEUE_SMALLEST_FIRST)
+        self.assertEqual(
+            [library_name for library_name, path_in_library in queue.order([('Videos', self.videos), ('Music', self.music)])],
+            ['Videos', 'Videos', 'Videos', 'Music', 'Music']
+        )
+
+    def test_library_weights(self):
+        queue = backup_queue.BackupQueue(strategy=backup_queue.QUEUE_SMALLEST_FIRST, library_weights={'Videos': 2})
+        self.assertEqual(
+            queue.order([('Videos', self.videos), ('Music', self.music)]),
+            [('Videos', 'b.mkv'), ('Videos', 'c.mkv'), ('Music', 'd.flac'), ('Videos', 'a.mkv'), ('Music', 'e.flac')]
+        )
+
+    def test_time_budget(self):
+        queue = backup_queue.BackupQueue()
+        queue.start()
+        self.assertTrue(queue.has_time_for(10 ** 12, 1))
+
+        queue = backup_queue.BackupQueue(time_budget_seconds=60)
+        queue.start()
+        self.assertTrue(queue.has_time_for(1000))
+        self.assertTrue(queue.has_time_for(1000, bytes_per_second=100))
+        self.assertFalse(queue.has_time_for(10000, bytes_per_second=100))
+
+        queue = backup_queue.BackupQueue(time_budget_seconds=0)
+        queue.start()
+        self.assertFalse(queue.has_time_for(1))
+        self.assertEqual(queue.get_remaining_seconds(), 0)
+        self.assertIsNone(backup_queue.BackupQueue().get_remaining_seconds())
@@ -0,0 +1,43 @@
+import os
+import unittest
+
+from ..tools import sandbox
+from ...models import capacity
+
+class CapacityTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def test_select_to_fit(self):
+        overhead = capacity.CACHE_FILE_OVERHEAD
+        items = [('a', 100), ('b', 300), ('c', 50)]
+        selected, skipped = capacity.select_to_fit(items, 200 + overhead * 2)
+        self.assertEqual(selected, ['a', 'c'])
+        self.assertEqual(skipped, ['b'])
+
+    def test_select_nothing_when_full(self):
+        selected, skipped = capacity.select_to_fit([('a', 1)], 0)
+        self.assertEqual(selected, [])
+        self.assertEqual(skipped, ['a'])
+
+    def test_available_bytes(self):
+        free = capacity.get_available_bytes(self.sandbox.backup_mirror)
+        self.assertGreater(free, 0)
+        self.assertEqual(capacity.get_available_bytes(self.sandbox.backup_mirror, reserve_bytes=free * 2), 0)
+
+    def test_save_and_load_throughput(self):
+        self.assertIsNone(capacity.load_throughput(self.sandbox.backup_mirror))
+        capacity.save_throughput(self.sandbox.backup_mirror, 0, 10)
+        self.assertIsNone(capacity.load_throughput(self.sandbox.backup_mirror))
+        capacity.save_throughput(self.sandbox.backup_mirror, 1000, 10)
+        self.assertEqual(capacity.load_throughput(self.sandbox.backup_mirror), 100)
+
+    def test_format_duration(self):
+        self.assertEqual(capacity.format_duration(5), '5s')
+        self.assertEqual(capacity.format_duration(65), '1m 05s')
+        self.assertEqual(capacity.format_duration(3723), '1h 02m 03s')
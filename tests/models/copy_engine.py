@@ -0,0 +1,106 @@
+import errno
+import os
+import sys
+import unittest
+from unittest import mock
+
+from ..tools import sandbox
+from ...models import copy_engine
+
+class CopyEngineTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        self.source_mock_file = self.sandbox.make_media('mock.mkv', 'source bits' * 100000, self.sandbox.source_videos_library)
+        os.utime(self.source_mock_file.path, (1500000000, 1500000000))
+        self.destination_path = os.path.join(self.sandbox.backup_videos_library.path, 'mock.mkv')
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def test_copy_file(self):
+        method = copy_engine.copy_file(self.source_mock_file.path, self.destination_path)
+        CopyEngineTestMethods().assert_copied(self.source_mock_file.path, self.destination_path)
+        self.assertIn(method, [
+            copy_engine.COPY_METHOD_REFLINK,
+            copy_engine.COPY_METHOD_COPY_FILE_RANGE,
+            copy_engine.COPY_METHOD_SENDFILE,
+            copy_engine.COPY_METHOD_USERSPACE
+        ])
+
+    def test_copy_file_with_small_buffer(self):
+        copy_engine.copy_file(self.source_mock_file.path, self.destination_path, buffer_size=4096)
+        CopyEngineTestMethods().assert_copied(self.source_mock_file.path, self.destination_path)
+
+    def test_copy_file_userspace_fallback(self):
+        #  A device pair with no supported kernel methods falls back to user-space buffers
+        device_pair = (
+            os.stat(self.source_mock_file.path).st_dev,
+            os.stat(os.path.dirname(self.destination_path)).st_dev
+        )
+        copy_engine._unsupported_methods[device_pair] = {
+            copy_engine.COPY_METHOD_REFLINK,
+            copy_engine.COPY_METHOD_COPY_FILE_RANGE,
+            copy_engine.COPY_METHOD_SENDFILE
+        }
+        try:
+            method = copy_engine.copy_file(self.source_mock_file.path, self.destination_path)
+        finally:
+            copy_engine._unsupported_methods.pop(device_pair)
+        self.assertEqual(method, copy_engine.COPY_METHOD_USERSPACE)
+        CopyEngineTestMethods().assert_copied(self.source_mock_file.path, self.destination_path)
+
+    def test_short_kernel_copy_falls_back(self):
+        #  A kernel copy that returns 0 before the end of the source is unsupported for the device pair
+        device_pair = (
+            os.stat(self.source_mock_file.path).st_dev,
+            os.stat(os.path.dirname(self.destination_path)).st_dev
+        )
+        copy_engine._unsupported_methods[device_pair] = {copy_engine.COPY_METHOD_REFLINK}
+        counts = iter([4096, 0])
+        try:
+            with mock.patch.object(copy_engine.os, 'copy_file_range', create=True, side_effect=lambda *args: next(counts)), \
+                    mock.patch.object(copy_engine.os, 'sendfile', create=True, return_value=0):
+                method = copy_engine.copy_file(self.source_mock_file.path, self.destination_path)
+            unsupported_methods = copy_engine._unsupported_methods[device_pair]
+        finally:
+            copy_engine._unsupported_methods.pop(device_pair)
+        self.assertEqual(method, copy_engine.COPY_METHOD_USERSPACE)
+        self.assertIn(copy_engine.COPY_METHOD_COPY_FILE_RANGE, unsupported_methods)
+        if sys.platform.startswith('linux'):
+            self.assertIn(copy_engine.COPY_METHOD_SENDFILE, unsupported_methods)
+        CopyEngineTestMethods().assert_copied(self.source_mock_file.path, self.destination_path)
+
+    def test_copy_file_trims_preallocation(self):
+        #  A destination preallocated beyond the size of the source is trimmed to the copied size
+        with open(self.destination_path, 'wb') as destination_file:
+            copy_engine.preallocate(destination_file.fileno(), 4194304)
+        copy_engine.copy_file(self.source_mock_file.path, self.destination_path, buffer_size=1000)
+        CopyEngineTestMethods().assert_copied(self.source_mock_file.path, self.destination_path)
+        self.assertEqual(os.path.getsize(self.source_mock_file.path), os.path.getsize(self.destination_path))
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'fallocate(2) is only called on Linux')
+    def test_preallocate_never_writes_blocks(self):
+        #  posix_fallocate() writes every block where the filesystem can not preallocate; it is never called
+        with mock.patch.object(copy_engine.os, 'posix_fallocate', create=True, side_effect=AssertionError('posix_fallocate')):
+            with open(self.destination_path, 'wb') as destination_file:
+                preallocated = copy_engine.preallocate(destination_file.fileno(), 65536)
+                with mock.patch.object(copy_engine, 'fallocate', side_effect=OSError(errno.EOPNOTSUPP, 'not supported')):
+                    self.assertFalse(copy_engine.preallocate(destination_file.fileno(), 131072))
+        if preallocated:
+            self.assertEqual(os.path.getsize(self.destination_path), 65536)
+
+    def test_align_buffer_size(self):
+        self.assertEqual(copy_engine.align_buffer_size(1), copy_engine.WRITE_ALIGNMENT)
+        self.assertEqual(copy_engine.align_buffer_size(copy_engine.WRITE_ALIGNMENT), copy_engine.WRITE_ALIGNMENT)
+        self.assertEqual(copy_engine.align_buffer_size(copy_engine.WRITE_ALIGNMENT + 1), copy_engine.WRITE_ALIGNMENT * 2)
+
+class CopyEngineTestMethods(unittest.TestCase):
+    #  Re-usable methods
+
+    def assert_copied(self, source_path, destination_path):
+        with open(source_path, 'rb') as source_file, open(destination_path, 'rb') as destination_file:
+            self.assertEqual(source_file.read(), destination_file.read())
+        self.assertEqual(os.stat(source_path).st_mtime, os.stat(destination_path).st_mtime)
+        self.assertEqual(os.stat(source_path).st_mode, os.stat(destination_path).st_mode)
@@ -0,0 +1,97 @@
+import io
+import os
+import random
+import unittest
+
+from ..tools import sandbox
+from ...models import delta_transfer
+from ...models import library
+
+class DeltaTransferTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        self.random = random.Random(49)
+        self.basis = bytes(self.random.getrandbits(8) for _ in range(262144))
+        self.block_size = 4096
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def update(self, basis, source, max_literal_bytes):
+        #  Update a copy of 'basis' in memory; (updated data, bytes written, instructions) is returned
+        file = io.BytesIO(basis)
+        signature = delta_transfer.get_signature(file, self.block_size)
+        instructions = delta_transfer.plan_delta(io.BytesIO(source), signature, self.block_size, max_literal_bytes)
+        if instructions is None:
+            return None, None, None
+        written = delta_transfer.apply_delta(file, instructions, len(source))
+        return file.getvalue(), written, instructions
+
+    def write_media(self, mock_library, path_in_library, data):
+        filepath = os.path.join(mock_library.path, path_in_library)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'wb') as file:
+            file.write(data)
+
+    def test_changed_block_is_written_alone(self):
+        #  Re-tagging in place, e.g. into padding, changes a few bytes and leaves the rest where it was
+        source = self.basis[:100000] + b'new tags' + self.basis[100008:]
+        updated, written, _ = self.update(self.basis, source, len(source))
+        self.assertEqual(updated, source)
+        self.assertEqual(written, self.block_size)
+
+    def test_moved_blocks_are_found(self):
+        #  Removing tags from the start moves everything after them; the rolling checksum finds each block again
+        source = self.basis[:1000] + self.basis[5000:]
+        updated, _, instructions = self.update(self.basis, source, len(source))
+        self.assertEqual(updated, source)
+        literal_bytes = sum(length for _, basis_offset, length, _ in instructions if basis_offset is None)
+        self.assertLess(literal_bytes, 2 * self.block_size)
+
+    def test_blocks_are_never_read_after_they_are_overwritten(self):
+        #  Growing the start of the file overwrites the blocks that moved, so they can not be reused
+        source = b'longer tags' + self.basis + b'appended'
+        self.assertEqual(self.update(self.basis, source, self.block_size), (None, None, None))
+        updated, written, _ = self.update(self.basis, source, len(source))
+        self.assertEqual(updated, source)
+        self.assertEqual(written, len(source))
+
+    def test_truncated_file(self):
+        source = self.basis[:200000]
+        updated, written, _ = self.update(self.basis, source, len(source))
+        self.assertEqual(updated, source)
+        self.assertLess(written, self.block_size)
+
+    def test_update_media(self):
+        #  A re-tagged source file updates its backup in place, and the backup gets a new cache file
+        data = bytes(self.random.getrandbits(8) for _ in range(2 * delta_transfer.MIN_FILE_SIZE))
+        self.write_media(self.sandbox.backup_videos_library, 'dir/mock.mkv', data)
+        self.write_media(self.sandbox.source_videos_library, 'dir/mock.mkv', b'tags' + data[4:])
+        source_library = library.Library('Videos', self.sandbox.source_videos_library.path, True)
+        backup_library = library.Library('Videos', self.sandbox.backup_videos_library.path, False)
+        source_library.load_all_media(None)
+        backup_library.load_all_media(None)
+        backup_library.media['dir/mock.mkv'].save_cache_file(overwrite=True)
+        source_media = source_library.media['dir/mock.mkv']
+
+        result = backup_library.update_media(source_media.path, 'dir/mock.mkv', source_media.real_checksum)
+        self.assertTrue(result.success, result.message)
+        self.assertEqual(result.metrics['copy_method'], 'delta')
+        self.assertEqual(result.metrics['bytes_saved'], len(data) - result.metrics['bytes'])
+        self.assertLessEqual(result.metrics['bytes'], delta_transfer.get_block_size(len(data)))
+        with open(os.path.join(backup_library.path, 'dir', 'mock.mkv'), 'rb') as file:
+            self.assertEqual(file.read(), b'tags' + data[4:])
+        backup_library.load_all_media(None)
+        self.assertEqual(backup_library.media['dir/mock.mkv'].cached_checksum, source_media.real_checksum)
+
+    def test_small_media_is_copied(self):
+        self.sandbox.make_media('mock.mkv', 'old', self.sandbox.backup_videos_library)
+        self.sandbox.make_media('mock.mkv', 'new', self.sandbox.source_videos_library)
+        source_library = library.Library('Videos', self.sandbox.source_videos_library.path, True)
+        backup_library = library.Library('Videos', self.sandbox.backup_videos_library.path, False)
+        source_library.load_all_media(None)
+        backup_library.load_all_media(None)
+        source_media = source_library.media['mock.mkv']
+        self.assertIsNone(backup_library.update_media(source_media.path, 'mock.mkv', source_media.real_checksum))
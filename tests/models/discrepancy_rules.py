@@ -0,0 +1,102 @@
+import os
+import unittest
+
+from ..tools import sandbox
+from ...models import discrepancy_rules
+from ...models import library
+
+class DiscrepancyRulesTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        self.sandbox.populate_libraries_with_identical_media(
+            self.sandbox.source_videos_library,
+            self.sandbox.backup_videos_library
+        )
+        self.source_library = self.load_library(self.sandbox.source_videos_library)
+        self.backup_library = self.load_library(self.sandbox.backup_videos_library)
+        self.path_in_library = 'mock-1.mkv'
+
+        #  Generate the cache files before anything changes
+        self.source_library.media[self.path_in_library].cached_checksum
+        self.backup_library.media[self.path_in_library].cached_checksum
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def load_library(self, mock_library):
+        library_object = library.Library(mock_library.name, mock_library.path, mock_library.source)
+        library_object.load_all_media(callback_on_progress=None)
+        return library_object
+
+    def make_discrepancy(self, kind):
+        #  Reload the libraries so no values are remembered from before the change
+        self.source_library = self.load_library(self.sandbox.source_videos_library)
+        self.backup_library = self.load_library(self.sandbox.backup_videos_library)
+        return discrepancy_rules.Discrepancy(
+            kind=kind,
+            library_name='Videos',
+            path_in_library=self.path_in_library,
+            is_source=True,
+            source_library=self.source_library,
+            source_media=self.source_library.media[self.path_in_library],
+            backup_library=self.backup_library,
+            backup_media=self.backup_library.media[self.path_in_library]
+        )
+
+    def write_source(self, text):
+        with open(self.source_library.media[self.path_in_library].path, 'w') as file:
+            file.write(text)
+
+    def test_restore_from_intact_mirror(self):
+        #  Same size, different content: bit rot in the source
+        self.write_source('mock-X')
+        discrepancy = self.make_discrepancy(discrepancy_rules.DISCREPANCY_LOCAL)
+        self.assertEqual(
+            discrepancy_rules.restore_from_intact_mirror(discrepancy),
+            discrepancy_rules.ACTION_COPY_BACKUP_TO_SOURCE
+        )
+        self.assertIsNone(discrepancy_rules.accept_new_checksum_when_size_changed(discrepancy))
+
+    def test_accept_new_checksum_when_size_changed(self):
+        self.write_source('mock-1 with new tags')
+        discrepancy = self.make_discrepancy(discrepancy_rules.DISCREPANCY_LOCAL)
+        self.assertEqual(
+            discrepancy_rules.accept_new_checksum_when_size_changed(discrepancy),
+            discrepancy_rules.ACTION_UPDATE_CACHE
+        )
+
+    def test_source_newer_mtime_wins(self):
+        backup_path = self.backup_library.media[self.path_in_library].path
+        os.utime(backup_path, (1500000000, 1500000000))
+        discrepancy = self.make_discrepancy(discrepancy_rules.DISCREPANCY_MIRROR)
+        self.assertEqual(
+            discrepancy_rules.source_newer_mtime_wins(discrepancy),
+            discrepancy_rules.ACTION_COPY_SOURCE_TO_BACKUP
+        )
+
+        #  A newer backup file is left for manual review
+        os.utime(backup_path, None)
+        os.utime(self.source_library.media[self.path_in_library].path, (1500000000, 1500000000))
+        self.assertIsNone(discrepancy_rules.source_newer_mtime_wins(discrepancy))
+
+    def test_choose_action(self):
+        self.write_source('mock-1 with new tags')
+        discrepancy = self.make_discrepancy(discrepancy_rules.DISCREPANCY_LOCAL)
+        #  The first rule that applies wins
+        self.assertEqual(
+            discrepancy_rules.choose_action(discrepancy, [
+                discrepancy_rules.accept_new_checksum_when_size_changed,
+                discrepancy_rules.restore_from_intact_mirror
+            ]),
+            discrepancy_rules.ACTION_UPDATE_CACHE
+        )
+        self.assertEqual(
+            discrepancy_rules.choose_action(discrepancy, [
+                discrepancy_rules.restore_from_intact_mirror,
+                discrepancy_rules.accept_new_checksum_when_size_changed
+            ]),
+            discrepancy_rules.ACTION_COPY_BACKUP_TO_SOURCE
+        )
+        self.assertIsNone(discrepancy_rules.choose_action(discrepancy, [discrepancy_rules.source_newer_mtime_wins]))
@@ -0,0 +1,67 @@
+import os
+import unittest
+from unittest import mock
+
+from ..tools import sandbox
+from ...models import disk_layout
+from ...models import pack_storage
+
+class DiskLayoutTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        self.generated_media = self.sandbox.populate_library_with_generated_media(
+            self.sandbox.source_videos_library,
+            file_count=20,
+            file_size=8192
+        )
+        self.filepaths = {item.name: item.path for item in self.generated_media}
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def test_sort_by_layout(self):
+        sorted_items = disk_layout.sort_by_layout(self.filepaths)
+        self.assertEqual(sorted(sorted_items), sorted(self.filepaths))
+        layout_keys = [disk_layout.get_layout_key(self.filepaths[item]) for item in sorted_items]
+        self.assertEqual(layout_keys, sorted(layout_keys))
+
+    def test_group_by_device(self):
+        #  The sandbox is on a single device
+        device_groups = disk_layout.group_by_device(self.filepaths)
+        self.assertEqual(len(device_groups), 1)
+        self.assertEqual(device_groups[0], disk_layout.sort_by_layout(self.filepaths))
+
+    @unittest.skipUnless(disk_layout.fcntl is not None, 'FIEMAP needs fcntl')
+    def test_fiemap_does_not_sync(self):
+        #  No flags are passed, so mapping a file does not write out its dirty pages
+        requests = []
+
+        def ioctl(fd, request, buffer):
+            requests.append(disk_layout.FIEMAP_HEADER.unpack_from(buffer, 0))
+
+        with mock.patch.object(disk_layout.sys, 'platform', 'linux'), mock.patch.object(disk_layout.fcntl, 'ioctl', side_effect=ioctl):
+            disk_layout.get_fiemap(self.generated_media[0].path, 1)
+        self.assertEqual([request[2] for request in requests], [0])
+
+    def test_missing_files_sort_last(self):
+        os.remove(self.generated_media[0].path)
+        sorted_items = disk_layout.sort_by_layout(self.filepaths)
+        self.assertEqual(sorted_items[-1], self.generated_media[0].name)
+
+    def test_sort_by_pack_layout(self):
+        #  Files in pack files are ordered by their position in the packs, and missing files sort last
+        storage = pack_storage.PackStorage(self.sandbox.backup_mirror, pack_size=64)
+        library_path = os.path.join(self.sandbox.backup_mirror, 'Music')
+        storage.makedirs(library_path)
+        filepaths = dict()
+        for name in ['c.flac', 'a.flac', 'b.flac']:
+            filepaths[name] = os.path.join(library_path, name)
+            with storage.open(filepaths[name], 'wb') as file:
+                file.write(name.encode('utf-8') * 16)
+        filepaths['missing.flac'] = os.path.join(library_path, 'missing.flac')
+        self.assertEqual(
+            disk_layout.sort_by_layout(filepaths, storage),
+            ['c.flac', 'a.flac', 'b.flac', 'missing.flac']
+        )
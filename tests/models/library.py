@@ -1,9 +1,13 @@
 import unittest
 import datetime
+import errno
+import json
 import os
+from unittest import mock
 
 from ..tools import sandbox
 from ...models import library
+from ...models import storage
 
 class LibraryTests(unittest.TestCase):
     def setUp(self):
@@ -74,6 +78,21 @@ class LibraryTests(unittest.TestCase):
     def test_delete_media_from_backup_video_library(self):
         LibraryTestMethods().delete_media(self.sandbox.backup_videos_library)
 
+    def test_delete_media_batch_from_backup_video_library(self):
+        library_object = library.Library(
+            self.sandbox.backup_videos_library.name,
+            self.sandbox.backup_videos_library.path,
+            self.sandbox.backup_videos_library.source
+        )
+        library_object.load_all_media(False)
+        paths_in_library = list(library_object.media)[:5] + ['missing.mkv']
+        results = library_object.delete_media_batch(paths_in_library)
+        self.assertEqual([item.success for item in results], [True] * 5 + [False])
+        self.assertEqual(len(library_object.media), 13)
+
+    def test_incremental_load_from_source_video_library(self):
+        LibraryTestMethods().incremental_load_all_media(self.sandbox.source_videos_library)
+
     def test_ignore_txt_in_source_video_library(self):
         file_path = self.sandbox.make_media(
             'ignore_me.txt',
@@ -96,6 +115,44 @@ class LibraryTests(unittest.TestCase):
             file_path
         )
 
+    def test_copy_media_to_multiple_backup_libraries(self):
+        #  Add a second backup mirror to the sandbox
+        second_backup_path = os.path.join(self.sandbox.path, 'backup-2', 'Videos')
+        os.makedirs(second_backup_path)
+        second_backup_library = sandbox.MockLibrary('Videos', second_backup_path, False)
+
+        LibraryTestMethods().copy_media_to_libraries(
+            self.sandbox.source_videos_library,
+            [self.sandbox.backup_videos_library, second_backup_library]
+        )
+
+    def test_backup_unreadable_media(self):
+        #  An I/O error fails the file for each target instead of being raised
+        source_library = library.Library('Videos', self.sandbox.source_videos_library.path, True)
+        backup_library = library.Library('Videos', self.sandbox.backup_videos_library.path, False)
+        source_media = source_library.get_media('missing.mkv')
+        results = source_library.backup_media(source_media, [backup_library])
+        self.assertEqual(len(results), 1)
+        self.assertFalse(results[0].success)
+        self.assertFalse(os.path.exists(os.path.join(backup_library.path, 'missing.mkv')))
+
+    def test_backup_to_full_library(self):
+        #  A library that runs out of space while preallocating gets no data, and the other library still gets a copy
+        second_backup_path = os.path.join(self.sandbox.path, 'backup-2', 'Videos')
+        os.makedirs(second_backup_path)
+        full_storage = storage.LocalStorage()
+        source_library = library.Library('Videos', self.sandbox.source_videos_library.path, True)
+        backup_library = library.Library('Videos', self.sandbox.backup_videos_library.path, False)
+        full_library = library.Library('Videos', second_backup_path, False, storage=full_storage)
+        source_library.load_all_media(None)
+        path_in_library = self.unique_source_files[0].name
+        no_space = OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        with mock.patch.object(full_storage, 'preallocate', side_effect=no_space):
+            results = source_library.backup_media(source_library.media[path_in_library], [backup_library, full_library])
+        self.assertTrue(results[0].success, results[0].message)
+        self.assertFalse(results[1].success)
+        self.assertFalse(os.path.exists(os.path.join(second_backup_path, path_in_library)))
+
 class LibraryTestMethods(unittest.TestCase):
     #  Re-usable methods
 
@@ -270,3 +327,79 @@ class LibraryTestMethods(unittest.TestCase):
             file_to_ignore.name,
             library_object.media
         )
+
+    def copy_media_to_libraries(self, source_mock_library: sandbox.MockLibrary, backup_mock_libraries: list):
+        #  Make and load the Library objects
+        source_library_object = library.Library(source_mock_library.name, source_mock_library.path, source_mock_library.source)
+        source_library_object.load_all_media(False)
+        backup_library_objects = []
+        for backup_mock_library in backup_mock_libraries:
+            backup_library_object = library.Library(backup_mock_library.name, backup_mock_library.path, backup_mock_library.source)
+            backup_library_object.load_all_media(False)
+            backup_library_objects.append(backup_library_object)
+
+        #  Copy every source media to every backup library that is missing it
+        copy_count = 0
+        for media_name in source_library_object.media:
+            target_library_objects = [item for item in backup_library_objects if media_name not in item.media]
+            results = source_library_object.copy_media_to_libraries(
+                source_library_object.media[media_name],
+                target_library_objects
+            )
+            self.assertEqual(len(results), len(target_library_objects))
+            for result, target_library_object in zip(results, target_library_objects):
+                copy_count += 1
+                self.assertTrue(result.success)
+                self.assertTrue(os.path.exists(target_library_object.media[media_name].path))
+                self.assertEqual(
+                    target_library_object.media[media_name].cached_checksum,
+                    source_library_object.media[media_name].real_checksum
+                )
+
+        #  The first backup library was missing 12 files; the second was empty
+        self.assertEqual(copy_count, 12 + 18)
+        for backup_library_object in backup_library_objects:
+            for media_name in source_library_object.media:
+                self.assertIn(media_name, backup_library_object.media)
+
+        #  Copying media that already exists fails for that target only
+        media_name = list(source_library_object.media)[0]
+        results = source_library_object.copy_media_to_libraries(
+            source_library_object.media[media_name],
+            backup_library_objects
+        )
+        self.assertFalse(any(result.success for result in results))
+
+    def incremental_load_all_media(self, mock_library):
+        #  Make a Library object and load it; every directory is listed
+        library_object = library.Library(mock_library.name, mock_library.path, mock_library.source)
+        library_object.load_all_media(False)
+        self.assertEqual(len(library_object.media), 18)
+        self.assertTrue(os.path.exists(library_object.directory_index_file))
+
+        #  Make the saved listings look settled, as they would be on a later run
+        with open(library_object.directory_index_file, 'r') as file:
+            directory_index = json.load(file)
+        for directory_in_library, listing in directory_index.items():
+            dirpath = os.path.join(library_object.path, directory_in_library)
+            listing['mtime_ns'] = os.stat(dirpath).st_mtime_ns
+
+        #  An unchanged directory reuses its saved listing, without listing the directory again
+        directory_index['dir-1']['files'].append('only-in-index.mkv')
+        with open(library_object.directory_index_file, 'w') as file:
+            json.dump(directory_index, file)
+        library_object.load_all_media(False)
+        self.assertIn(os.path.join('dir-1', 'only-in-index.mkv'), library_object.media)
+
+        #  A changed directory is listed again
+        new_file = self.make_media_file(os.path.join(library_object.path, 'dir-1', 'new.mkv'))
+        os.utime(os.path.dirname(new_file), ns=(0, 1))
+        library_object.load_all_media(False)
+        self.assertIn(os.path.join('dir-1', 'new.mkv'), library_object.media)
+        self.assertNotIn(os.path.join('dir-1', 'only-in-index.mkv'), library_object.media)
+        self.assertEqual(len(library_object.media), 19)
+
+    def make_media_file(self, path):
+        with open(path, 'w') as new_file:
+            new_file.write('new bits')
+        return path
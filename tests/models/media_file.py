@@ -92,6 +92,77 @@ class MediaFileTests(unittest.TestCase):
     def test_backup_cached_checksum_date(self):
         MediaFileTestMethods().cached_checksum_date(self.backup_mock_file)
 
+    def test_checksum_with_dropped_cache(self):
+        #  Dropping pages while hashing, in blocks smaller than the file, does not change the checksum
+        mock_file = self.sandbox.make_media('large.mkv', 'source bits' * 20000, self.sandbox.source_videos_library)
+        expected_media = media_file.MediaFile(mock_file.path, mock_file.name, mock_file.source)
+        expected_media.generate_checksum()
+        media = media_file.MediaFile(mock_file.path, mock_file.name, mock_file.source)
+        media.drop_cache_interval = 65536
+        self.assertTrue(media.generate_checksum(drop_cache=True))
+        self.assertEqual(media.real_checksum, expected_media.real_checksum)
+
+    def test_fingerprint_samples_start_middle_and_end(self):
+        media_file.MediaFile.fingerprint_sample_size = 4096
+        try:
+            mock_file = self.sandbox.make_media('large.mkv', 'a' * 40000, self.sandbox.source_videos_library)
+            media = media_file.MediaFile(mock_file.path, mock_file.name, mock_file.source)
+            fingerprint = media.real_fingerprint
+            self.assertTrue(fingerprint.startswith('40000:'))
+
+            #  A change between the samples does not change the fingerprint
+            with open(mock_file.path, 'r+b') as file:
+                file.seek(10000)
+                file.write(b'b')
+            self.assertEqual(media_file.MediaFile(mock_file.path, mock_file.name, mock_file.source).real_fingerprint, fingerprint)
+
+            #  A change in the middle sample does
+            with open(mock_file.path, 'r+b') as file:
+                file.seek(20000)
+                file.write(b'b')
+            self.assertNotEqual(media_file.MediaFile(mock_file.path, mock_file.name, mock_file.source).real_fingerprint, fingerprint)
+        finally:
+            media_file.MediaFile.fingerprint_sample_size = 1048576
+
+    def test_quick_local_discrepancy_check(self):
+        media = media_file.MediaFile(self.source_mock_file.path, self.source_mock_file.name, self.source_mock_file.source)
+        media.save_cache_file(overwrite=True)
+        media = media_file.MediaFile(self.source_mock_file.path, self.source_mock_file.name, self.source_mock_file.source)
+        self.assertIsNotNone(media.cached_fingerprint)
+        self.assertFalse(media.has_local_discrepancy(deep=False))
+        self.assertIsNone(media._real_checksum)  # The file was not read in full
+
+        with open(self.source_mock_file.path, 'w') as file:
+            file.write('changed bits')
+        media = media_file.MediaFile(self.source_mock_file.path, self.source_mock_file.name, self.source_mock_file.source)
+        self.assertTrue(media.has_local_discrepancy(deep=False))
+        self.assertTrue(media.has_local_discrepancy(deep=True))
+
+    def test_numeric_size_and_mtime(self):
+        media = media_file.MediaFile(self.source_mock_file.path, self.source_mock_file.name, self.source_mock_file.source)
+        media.save_cache_file(overwrite=True)
+        media = media_file.MediaFile(self.source_mock_file.path, self.source_mock_file.name, self.source_mock_file.source)
+        self.assertEqual(media.real_size, len('source bits'))
+        self.assertEqual(media.cached_size, media.real_size)
+        self.assertEqual(media.cached_mtime, os.path.getmtime(self.source_mock_file.path))
+
+    def test_load_legacy_cache_file(self):
+        #  Cache files written before sizes were numeric store formatted values
+        media = media_file.MediaFile(self.source_mock_file.path, self.source_mock_file.name, self.source_mock_file.source)
+        os.makedirs(os.path.dirname(media.cache_file), exist_ok=True)
+        with open(media.cache_file, 'w') as file:
+            file.write('2020-01-31|1a571c4ef14eb5de03dcc5dfb6faa716c74759eb|2020-01-30 12:00:00.500000|11.000 bytes')
+        self.assertEqual(media.cached_mtime, datetime.datetime(2020, 1, 30, 12, 0, 0, 500000).timestamp())
+        self.assertIsNone(media.cached_size)
+        self.assertIsNone(media.cached_fingerprint)
+
+    def test_load_legacy_cache_file_without_microseconds(self):
+        #  A modification time on a whole second was formatted without microseconds
+        self.assertEqual(
+            media_file.parse_cached_mtime('2020-01-30 12:00:00'),
+            datetime.datetime(2020, 1, 30, 12, 0, 0).timestamp()
+        )
+
 class MediaFileTestMethods(unittest.TestCase):
     #  Re-usable methods
     
@@ -0,0 +1,27 @@
+import os
+import shutil
+import unittest
+
+from ..tools import sandbox
+from ...models import mirror
+
+class MirrorTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def test_missing_source_library(self):
+        #  A missing source library is only made when restoring, e.g. after a source disc was replaced
+        shutil.rmtree(self.sandbox.source_videos_library.path)
+        source_mirror = mirror.SourceMirror(self.sandbox.source_mirror)
+        with self.assertRaises(AssertionError):
+            source_mirror.load_library('Videos')
+        self.assertFalse(os.path.exists(self.sandbox.source_videos_library.path))
+
+        source_mirror.load_library('Videos', restore=True)
+        self.assertTrue(os.path.isdir(self.sandbox.source_videos_library.path))
+        self.assertIn('Videos', source_mirror.libraries)
@@ -0,0 +1,73 @@
+import unittest
+
+from ..tools import sandbox
+from ...models import library
+from ...models import mirror_diff
+
+class MirrorDiffTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+
+        #  12 unique files in each 'Videos' library, 6 matching files, and 1 mismatched file
+        self.sandbox.populate_library_with_unique_media(self.sandbox.source_videos_library)
+        self.sandbox.populate_library_with_unique_media(self.sandbox.backup_videos_library)
+        self.sandbox.populate_libraries_with_identical_media(
+            self.sandbox.source_videos_library,
+            self.sandbox.backup_videos_library
+        )
+        self.sandbox.make_media('dir-2/changed.mkv', 'source bits', self.sandbox.source_videos_library)
+        self.sandbox.make_media('dir-2/changed.mkv', 'backup bits', self.sandbox.backup_videos_library)
+
+        self.source_library = self.make_library(self.sandbox.source_videos_library)
+        self.backup_library = self.make_library(self.sandbox.backup_videos_library)
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def make_library(self, mock_library):
+        return library.Library(mock_library.name, mock_library.path, mock_library.source)
+
+    def test_iterate_media_is_sorted(self):
+        media_names = [media.path_in_library for media in self.source_library.iterate_media()]
+        self.assertEqual(media_names, sorted(media_names, key=mirror_diff.get_sort_key))
+
+        #  The same media is found as 'Library.load_all_media', without populating 'Library.media'
+        self.assertEqual(len(self.source_library.media), 0)
+        self.source_library.load_all_media(callback_on_progress=None)
+        self.assertEqual(sorted(media_names), sorted(self.source_library.media))
+
+    def test_diff_libraries(self):
+        statuses = dict()
+        for status, path_in_library, source_media, backup_media, backup_library in mirror_diff.diff_libraries(
+            self.source_library,
+            [self.backup_library]
+        ):
+            self.assertIs(backup_library, self.backup_library)
+            self.assertNotIn(path_in_library, statuses)
+            statuses[path_in_library] = status
+            if status == mirror_diff.DIFF_NEW:
+                self.assertIsNone(backup_media)
+            elif status == mirror_diff.DIFF_ORPHAN:
+                self.assertIsNone(source_media)
+            else:
+                self.assertEqual(source_media.path_in_library, backup_media.path_in_library)
+
+        counts = {status: list(statuses.values()).count(status) for status in set(statuses.values())}
+        self.assertEqual(counts[mirror_diff.DIFF_NEW], 12)
+        self.assertEqual(counts[mirror_diff.DIFF_ORPHAN], 12)
+        self.assertEqual(counts[mirror_diff.DIFF_MATCH], 6)
+        self.assertEqual(counts[mirror_diff.DIFF_MISMATCH], 1)
+        self.assertEqual(statuses['dir-2/changed.mkv'], mirror_diff.DIFF_MISMATCH)
+
+    def test_diff_libraries_without_checksums(self):
+        statuses = [
+            item[0] for item in mirror_diff.diff_libraries(
+                self.source_library,
+                [self.backup_library],
+                compare_checksums=False
+            )
+        ]
+        self.assertEqual(len(statuses), 24)
+        self.assertEqual(set(statuses), {mirror_diff.DIFF_NEW, mirror_diff.DIFF_ORPHAN})
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import unittest
+
+from ..tools import object_store
+from ..tools import sandbox
+from ...models import library
+from ...models import object_storage
+
+class ObjectStorageTests(unittest.TestCase):
+    def setUp(self):
+        #  Start a stand-in object store; the backup mirror is kept in its bucket
+        #  Parts are 64 bytes, so small files are uploaded in parts
+        self.server = object_store.ObjectStoreServer(page_size=2)
+        self.server.start()
+        self.mirror_path = '/object-store'
+        self.storage = self.new_storage(part_size=64)
+        self.library_path = os.path.join(self.mirror_path, 'Music')
+
+    def tearDown(self):
+        self.storage.close()
+        self.server.stop()
+
+    def new_storage(self, **settings):
+        return object_storage.ObjectStorage(
+            self.mirror_path, self.server.endpoint, self.server.bucket, 'access', 'secret', prefix='mirror', **settings
+        )
+
+    def write(self, path_in_library, data):
+        path = os.path.join(self.library_path, path_in_library)
+        self.storage.makedirs(os.path.dirname(path))
+        with self.storage.open(path, 'wb') as file:
+            for offset in range(0, len(data), 10):
+                file.write(data[offset:offset + 10])
+        return path
+
+    def test_multipart_upload(self):
+        data = bytes(range(256)) + b'end'
+        path = self.write('dir/mock.flac', data)
+        stored = self.server.objects['mirror/Music/dir/mock.flac']
+        self.assertEqual(stored.data, data)
+        self.assertTrue(stored.etag.endswith('-5'))
+        self.assertEqual(self.storage.get_verified_checksum(path), hashlib.sha1(data).hexdigest())
+        self.assertIsNone(self.storage.get_verified_checksum(path))
+        self.assertTrue(self.storage.verify(path))
+
+        #  Reads stream the object, and a seek starts a ranged read
+        with self.storage.open(path, 'rb') as file:
+            file.seek(250)
+            self.assertEqual(file.read(), data[250:])
+        self.assertEqual(self.storage.stat(path).st_size, len(data))
+
+        #  A read after a seek only asks for the bytes it reads; reading on streams the rest
+        del self.server.ranges[:]
+        with self.storage.open(path, 'rb') as file:
+            file.seek(100)
+            self.assertEqual(file.read(5), data[100:105])
+            file.seek(10)
+            self.assertEqual(file.read(5), data[10:15])
+            self.assertEqual(file.read(5), data[15:20])
+            self.assertEqual(file.read(), data[20:])
+        self.assertEqual(self.server.ranges, ['bytes=100-104', 'bytes=10-14', 'bytes=15-258'])
+
+        #  Every request went over the pool's few connections
+        self.assertGreater(self.server.request_count, 10)
+        self.assertLessEqual(self.server.connection_count, 8)
+
+    def test_corrupted_upload_is_rejected(self):
+        self.server.corrupt_uploads = True
+        path = os.path.join(self.library_path, 'mock.flac')
+        self.storage.makedirs(self.library_path)
+        with self.assertRaises(OSError):
+            with self.storage.open(path, 'wb') as file:
+                file.write(b'mock bits')
+        self.assertFalse(self.storage.exists(path))
+        self.assertIsNone(self.storage.get_verified_checksum(path))
+
+    def test_directories_and_cache_files(self):
+        #  Listings are read page by page; the stand-in returns two entries per page
+        for name in ['a.flac', 'b.flac', 'c.flac', 'sub/d.flac']:
+            self.write(name, b'mock bits')
+        self.storage.makedirs(os.path.join(self.library_path, 'empty'))
+        self.assertEqual(
+            [(entry.name, entry.is_dir()) for entry in self.storage.scandir(self.library_path)],
+            [('a.flac', False), ('b.flac', False), ('c.flac', False), ('empty', True), ('sub', True)]
+        )
+        self.storage.rmdir(os.path.join(self.library_path, 'empty'))
+        self.assertFalse(self.storage.isdir(os.path.join(self.library_path, 'empty')))
+
+        #  Cache files are kept in their directory's index, and listed as files of their own
+        cache_directory = os.path.join(self.library_path, '.cache')
+        for name in ['a.flac.txt', 'b.flac.txt']:
+            with self.storage.open(os.path.join(cache_directory, name), 'w') as file:
+                file.write('2020-01-31|' + name)
+        self.assertNotIn('mirror/Music/.cache/a.flac.txt', self.server.objects)
+        self.assertIn('mirror/Music/.cache/cache_files.json', self.server.objects)
+        self.assertEqual([entry.name for entry in self.storage.scandir(cache_directory)], ['a.flac.txt', 'b.flac.txt'])
+        self.storage.replace(os.path.join(cache_directory, 'a.flac.txt'), os.path.join(cache_directory, 'moved.flac.txt'))
+        self.assertFalse(self.storage.exists(os.path.join(cache_directory, 'a.flac.txt')))
+        reloaded_storage = self.new_storage()
+        self.addCleanup(reloaded_storage.close)
+        with reloaded_storage.open(os.path.join(cache_directory, 'moved.flac.txt'), 'r') as file:
+            self.assertEqual(file.read(), '2020-01-31|a.flac.txt')
+
+        #  The index is deleted with its last cache file
+        for name in ['moved.flac.txt', 'b.flac.txt']:
+            self.storage.remove(os.path.join(cache_directory, name))
+        self.assertFalse(self.storage.exists(os.path.join(cache_directory, 'b.flac.txt')))
+        self.assertNotIn('mirror/Music/.cache/cache_files.json', self.server.objects)
+
+    def test_library_backup_to_object_store(self):
+        #  A library in an object store is backed up to and verified like a library on a disc
+        test_sandbox = sandbox.Sandbox()
+        test_sandbox.create()
+        self.addCleanup(test_sandbox.destroy)
+        source_media = test_sandbox.populate_library_with_unique_media(test_sandbox.source_music_library)
+        source_library = library.Library('Music', test_sandbox.source_music_library.path, True)
+        backup_library = library.Library('Music', self.library_path, False, storage=self.storage)
+        self.storage.makedirs(self.library_path)
+        source_library.load_all_media(None)
+        for media in source_library.media.values():
+            result = source_library.backup_media(media, [backup_library])[0]
+            self.assertTrue(result.success, result.message)
+
+        #  No cache file is an object of its own, and no object was copied to change its metadata
+        self.assertEqual([key for key in self.server.objects if key.endswith('.txt')], [])
+        self.assertEqual(self.server.copy_count, 0)
+        reloaded_library = library.Library('Music', self.library_path, False, storage=self.new_storage())
+        reloaded_library.load_all_media(None)
+        self.assertEqual(len(reloaded_library.media), len(source_media))
+        for path_in_library, media in reloaded_library.media.items():
+            self.assertEqual(media.real_checksum, source_library.media[path_in_library].real_checksum)
+            self.assertEqual(media.cached_checksum, media.real_checksum)
+            self.assertAlmostEqual(media.real_mtime, source_library.media[path_in_library].real_mtime, places=5)
+        self.assertEqual(reloaded_library.get_orphan_cache_files(), [])
+        reloaded_library.storage.close()
@@ -0,0 +1,73 @@
+import os
+import time
+import unittest
+from unittest import mock
+
+from ..tools import sandbox
+from ...models import media_file
+from ...models import orphan_policy
+
+class OrphanDeletionPolicyTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        mock_file = self.sandbox.make_media('dir/orphan.avi', 'x' * 2048, self.sandbox.backup_videos_library)
+        self.media = media_file.MediaFile(mock_file.path, mock_file.name, mock_file.source)
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def test_no_rules(self):
+        self.assertTrue(orphan_policy.OrphanDeletionPolicy().matches(self.media))
+
+    def test_age(self):
+        self.assertFalse(orphan_policy.OrphanDeletionPolicy(min_age_days=1).matches(self.media))
+        two_days_ago = time.time() - 2 * 86400
+        os.utime(self.media.path, (two_days_ago, two_days_ago))
+        self.assertTrue(orphan_policy.OrphanDeletionPolicy(min_age_days=1).matches(self.media))
+
+    def test_size(self):
+        self.assertTrue(orphan_policy.OrphanDeletionPolicy(min_size=1024, max_size=4096).matches(self.media))
+        self.assertFalse(orphan_policy.OrphanDeletionPolicy(min_size=4096).matches(self.media))
+        self.assertFalse(orphan_policy.OrphanDeletionPolicy(max_size=1024).matches(self.media))
+
+    def test_globs(self):
+        self.assertTrue(orphan_policy.OrphanDeletionPolicy(globs=['*.mkv', 'dir/*.avi']).matches(self.media))
+        self.assertFalse(orphan_policy.OrphanDeletionPolicy(globs=['*.mkv']).matches(self.media))
+
+    def make_source_media(self, name, text):
+        mock_file = self.sandbox.make_media(name, text, self.sandbox.source_videos_library)
+        return media_file.MediaFile(mock_file.path, mock_file.name, mock_file.source)
+
+    def test_rename_index(self):
+        #  An orphan with the content of a source file is kept; no cache file is written to find it
+        policy = orphan_policy.OrphanDeletionPolicy(missing_from_rename_index=True)
+        renamed_media = self.make_source_media('renamed.avi', 'x' * 2048)
+        self.assertTrue(policy.matches(self.media, rename_index=orphan_policy.RenameIndex([])))
+        self.assertFalse(policy.matches(self.media, rename_index=orphan_policy.RenameIndex([renamed_media])))
+        self.assertFalse(os.path.exists(renamed_media.cache_file))
+        self.assertFalse(os.path.exists(self.media.cache_file))
+
+    def test_rename_index_matches_sizes_first(self):
+        #  Nothing is hashed unless an orphan and a source file are the same size
+        policy = orphan_policy.OrphanDeletionPolicy(missing_from_rename_index=True)
+        rename_index = orphan_policy.RenameIndex([self.make_source_media('other.avi', 'y' * 1024)])
+        with mock.patch.object(media_file.MediaFile, 'generate_checksum', side_effect=AssertionError('hashed')):
+            self.assertTrue(policy.matches(self.media, rename_index=rename_index))
+
+    def test_rename_index_uses_cache_files(self):
+        #  A source file with a cache file is not hashed again
+        policy = orphan_policy.OrphanDeletionPolicy(missing_from_rename_index=True)
+        cached_media = self.make_source_media('cached.avi', 'x' * 2048)
+        cached_media.save_cache_file(overwrite=False)
+        rename_index = orphan_policy.RenameIndex([
+            media_file.MediaFile(cached_media.path, cached_media.path_in_library, cached_media.source)
+        ])
+        self.media.save_cache_file(overwrite=False)
+        with mock.patch.object(media_file.MediaFile, 'generate_checksum', side_effect=AssertionError('hashed')):
+            self.assertFalse(policy.matches(self.media, rename_index=rename_index))
+
+    def test_all_rules_must_match(self):
+        policy = orphan_policy.OrphanDeletionPolicy(min_size=1024, globs=['*.mkv'])
+        self.assertFalse(policy.matches(self.media))
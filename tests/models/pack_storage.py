@@ -0,0 +1,134 @@
+import os
+import unittest
+from unittest import mock
+
+from ..tools import sandbox
+from ...models import library
+from ...models import pack_storage
+
+class PackStorageTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        #  The backup mirror is stored in pack files
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        self.storage = pack_storage.PackStorage(self.sandbox.backup_mirror, pack_size=64)
+        self.library_path = os.path.join(self.sandbox.backup_mirror, 'Music')
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def write(self, path_in_library, data):
+        path = os.path.join(self.library_path, path_in_library)
+        self.storage.makedirs(os.path.dirname(path))
+        with self.storage.open(path, 'wb') as file:
+            file.write(data)
+        return path
+
+    def test_random_access_read(self):
+        path = self.write('dir/mock.flac', b'0123456789')
+        self.write('dir/other.flac', b'abcdef')
+        with self.storage.open(path, 'rb') as file:
+            file.seek(4)
+            self.assertEqual(file.read(3), b'456')
+            self.assertEqual(file.read(), b'789')
+        self.assertEqual(self.storage.stat(path).st_size, 10)
+        self.assertTrue(self.storage.verify(path))
+        self.assertEqual([entry.name for entry in self.storage.scandir(os.path.dirname(path))], ['mock.flac', 'other.flac'])
+
+    def test_index_is_replayed(self):
+        #  A new PackStorage on the same mirror finds every file, and not the deleted ones
+        path = self.write('dir/mock.flac', b'mock bits')
+        deleted_path = self.write('dir/deleted.flac', b'deleted bits')
+        self.storage.remove(deleted_path)
+        self.storage.replace(path, path + '.renamed')
+
+        reopened = pack_storage.PackStorage(self.sandbox.backup_mirror)
+        self.assertFalse(reopened.exists(deleted_path))
+        self.assertFalse(reopened.exists(path))
+        with reopened.open(path + '.renamed', 'rb') as file:
+            self.assertEqual(file.read(), b'mock bits')
+
+    def test_compact(self):
+        #  Packs are 64 bytes, so the first pack is full after two 40 byte files
+        kept_path = self.write('kept.flac', b'k' * 40)
+        deleted_path = self.write('deleted.flac', b'd' * 40)
+        self.write('current.flac', b'c' * 40)
+        self.storage.remove(deleted_path)
+        self.assertEqual(self.storage.get_garbage_bytes(), 40)
+
+        reclaimed_bytes = self.storage.compact(min_garbage_ratio=0.5)
+        self.assertEqual(reclaimed_bytes, 40)
+        self.assertEqual(self.storage.get_garbage_bytes(), 0)
+        self.assertEqual(len(self.storage.get_pack_names()), 1)
+
+        #  The kept file was moved to the current pack, and the rewritten index finds it
+        reopened = pack_storage.PackStorage(self.sandbox.backup_mirror)
+        with reopened.open(kept_path, 'rb') as file:
+            self.assertEqual(file.read(), b'k' * 40)
+        self.assertTrue(reopened.verify(kept_path))
+
+    def test_library_backup_to_packs(self):
+        #  A library stored in packs is backed up to and verified like a library on a disc
+        source_media = self.sandbox.populate_library_with_unique_media(self.sandbox.source_music_library)
+        source_library = library.Library('Music', self.sandbox.source_music_library.path, True)
+        backup_library = library.Library('Music', self.library_path, False, storage=self.storage)
+        self.storage.makedirs(self.library_path)
+        source_library.load_all_media(None)
+        for media in source_library.media.values():
+            result = source_library.backup_media(media, [backup_library])[0]
+            self.assertTrue(result.success, result.message)
+
+        #  Nothing is written to the library directory on the disc
+        self.assertEqual(os.listdir(self.library_path), [])
+        reloaded_library = library.Library('Music', self.library_path, False, storage=pack_storage.PackStorage(self.sandbox.backup_mirror))
+        reloaded_library.load_all_media(None)
+        self.assertEqual(len(reloaded_library.media), len(source_media))
+        for path_in_library, media in reloaded_library.media.items():
+            self.assertEqual(media.real_checksum, source_library.media[path_in_library].real_checksum)
+            self.assertEqual(media.cached_checksum, media.real_checksum)
+
+        #  Loading an unchanged library writes nothing to the packs
+        pack_bytes = sum(os.path.getsize(os.path.join(self.storage.pack_path, pack)) for pack in self.storage.get_pack_names())
+        reloaded_library.load_all_media(None)
+        self.assertEqual(
+            sum(os.path.getsize(os.path.join(self.storage.pack_path, pack)) for pack in self.storage.get_pack_names()),
+            pack_bytes
+        )
+
+    def test_changes_are_committed_in_groups(self):
+        #  Files, their modification times and cache files are flushed to the disc once for the whole group
+        #  One pack, so the group is one fsync of the pack and one of the index
+        storage = pack_storage.PackStorage(self.sandbox.backup_mirror)
+        source_media = self.sandbox.populate_library_with_unique_media(self.sandbox.source_music_library)
+        source_library = library.Library('Music', self.sandbox.source_music_library.path, True)
+        backup_library = library.Library('Music', self.library_path, False, storage=storage)
+        storage.makedirs(self.library_path)
+        source_library.load_all_media(None)
+        with mock.patch.object(pack_storage, 'COMMIT_SECONDS', 60), \
+                mock.patch.object(pack_storage.os, 'fsync', wraps=os.fsync) as fsync:
+            for media in source_library.media.values():
+                result = source_library.backup_media(media, [backup_library])[0]
+                self.assertTrue(result.success, result.message)
+            storage.commit()
+        self.assertEqual(fsync.call_count, 2)
+        with open(storage.index_path, 'r') as file:
+            operations = [line.split('"op": "')[1].split('"')[0] for line in file]
+        self.assertNotIn('utime', operations)
+        self.assertEqual(operations[-1], 'commit')
+        self.assertGreater(len(source_media), 1)
+
+    def test_uncommitted_files_are_checked_on_replay(self):
+        #  A file added after the last commit whose data did not reach the disc is dropped; committed files are kept
+        committed_path = self.write('committed.flac', b'committed bits')
+        self.storage.commit()
+        lost_path = self.write('lost.flac', b'lost bits')
+        entry = self.storage.get_entry(lost_path)
+        with open(os.path.join(self.storage.pack_path, entry.pack), 'r+b') as file:
+            file.seek(entry.offset)
+            file.write(b'\0' * entry.length)
+
+        reopened = pack_storage.PackStorage(self.sandbox.backup_mirror)
+        self.assertTrue(reopened.exists(committed_path))
+        self.assertFalse(reopened.exists(lost_path))
+        self.assertEqual([entry.name for entry in reopened.scandir(self.library_path)], ['committed.flac'])
@@ -0,0 +1,125 @@
+import os
+import random
+import unittest
+from unittest import mock
+
+from ..tools import sandbox
+from ...models import library
+from ...models import pack_storage
+from ...models import parity
+
+class ParityStoreTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        #  Small blocks and stripes, so a small file has several stripes
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        self.random = random.Random(50)
+        self.block_size = 1024
+        self.data = bytes(self.random.getrandbits(8) for _ in range(40000))
+        self.parity_store = parity.ParityStore(block_size=self.block_size, data_blocks=8, parity_blocks=2, workers=2)
+
+    def tearDown(self):
+        self.parity_store.close()
+        self.sandbox.destroy()
+
+    def load_backup_library(self, data, storage=None):
+        #  A backup library with one media file, 'dir/mock.mkv', that has a cache file and parity
+        backup_library = library.Library('Videos', self.sandbox.backup_videos_library.path, False, storage=storage)
+        storage = backup_library.storage
+        filepath = os.path.join(backup_library.path, 'dir', 'mock.mkv')
+        storage.makedirs(os.path.dirname(filepath))
+        with storage.open(filepath, 'wb') as file:
+            file.write(data)
+        backup_library.load_all_media(None)
+        backup_library.media['dir/mock.mkv'].save_cache_file(overwrite=True)
+        self.assertTrue(self.parity_store.save_parity(backup_library, 'dir/mock.mkv'))
+        return backup_library, filepath
+
+    def damage(self, storage, filepath, offsets):
+        #  Flip a byte at each offset, as bit rot would
+        with storage.open(filepath, 'rb') as file:
+            data = bytearray(file.read())
+        for offset in offsets:
+            data[offset] ^= 0xff
+        with storage.open(filepath, 'wb') as file:
+            file.write(bytes(data))
+
+    def read(self, storage, filepath):
+        with storage.open(filepath, 'rb') as file:
+            return file.read()
+
+    def test_multiply(self):
+        #  Multiplying each byte of a block is the same as multiplying the bytes one at a time
+        arithmetic = parity.BlockArithmetic(4)
+        block = bytes([0x01, 0x80, 0x53, 0xff])
+        for constant in (2, 3, 0x8e):
+            expected = bytes(
+                0 if byte == 0 else parity.GF_EXP[parity.GF_LOG[byte] + parity.GF_LOG[constant]] for byte in block
+            )
+            self.assertEqual(arithmetic.to_bytes(arithmetic.multiply(arithmetic.to_int(block), constant)), expected)
+            inverse = arithmetic.multiply(arithmetic.to_int(expected), parity.gf_inverse(constant))
+            self.assertEqual(arithmetic.to_bytes(inverse), block)
+
+    def test_one_damaged_block_is_repaired(self):
+        backup_library, filepath = self.load_backup_library(self.data)
+        mtime = os.stat(filepath).st_mtime
+        self.damage(backup_library.storage, filepath, [5000])
+        os.utime(filepath, (mtime, mtime))
+
+        self.assertTrue(self.parity_store.has_parity(backup_library, 'dir/mock.mkv'))
+        result = self.parity_store.repair(backup_library, 'dir/mock.mkv')
+        self.assertTrue(result.success, result.message)
+        self.assertEqual(result.metrics['repaired_blocks'], 1)
+        self.assertEqual(self.read(backup_library.storage, filepath), self.data)
+        self.assertEqual(os.stat(filepath).st_mtime, mtime)
+
+    def test_two_damaged_blocks_in_a_stripe_are_repaired(self):
+        #  The first and fifth blocks of the first stripe, and the short last block of the file
+        backup_library, filepath = self.load_backup_library(self.data)
+        self.damage(backup_library.storage, filepath, [10, 4 * self.block_size + 7, len(self.data) - 3])
+
+        result = self.parity_store.repair(backup_library, 'dir/mock.mkv')
+        self.assertTrue(result.success, result.message)
+        self.assertEqual(result.metrics['repaired_blocks'], 3)
+        self.assertEqual(self.read(backup_library.storage, filepath), self.data)
+
+    def test_too_much_damage_is_not_repaired(self):
+        #  Three damaged blocks in one stripe are more than P and Q can repair; the file is left as it was
+        backup_library, filepath = self.load_backup_library(self.data)
+        self.damage(backup_library.storage, filepath, [10, self.block_size + 10, 2 * self.block_size + 10, 30000])
+        damaged = self.read(backup_library.storage, filepath)
+
+        result = self.parity_store.repair(backup_library, 'dir/mock.mkv')
+        self.assertFalse(result.success)
+        self.assertEqual(self.read(backup_library.storage, filepath), damaged)
+
+    def test_parity_is_encoded_by_worker_processes(self):
+        #  A file of several tasks is encoded in the pool, and matches parity encoded in this process
+        with mock.patch.object(parity, 'TASK_SIZE', 2 * self.block_size * 8):
+            backup_library, filepath = self.load_backup_library(self.data)
+        self.assertIsNotNone(self.parity_store.pool)
+        header, offset = self.parity_store.load_header(backup_library.storage, backup_library.media['dir/mock.mkv'].parity_file)
+        with open(backup_library.media['dir/mock.mkv'].parity_file, 'rb') as file:
+            file.seek(offset)
+            self.assertEqual(file.read(), parity.encode_stripes(self.data, self.block_size, 8, 2))
+
+    def test_parity_is_not_saved_for_a_changed_file(self):
+        #  Parity is only saved for the data the cache file describes
+        backup_library, filepath = self.load_backup_library(self.data)
+        media = backup_library.media['dir/mock.mkv']
+        os.remove(media.parity_file)
+        self.damage(backup_library.storage, filepath, [100])
+        self.assertFalse(self.parity_store.save_parity(backup_library, 'dir/mock.mkv'))
+        self.assertFalse(os.path.exists(media.parity_file))
+        self.assertFalse(self.parity_store.has_parity(backup_library, 'dir/mock.mkv'))
+
+    def test_pack_file_is_rewritten(self):
+        #  Pack files can not be changed in place, so the repaired file is written again
+        storage = pack_storage.PackStorage(self.sandbox.backup_mirror)
+        backup_library, filepath = self.load_backup_library(self.data, storage=storage)
+        self.damage(storage, filepath, [20000])
+
+        result = self.parity_store.repair(backup_library, 'dir/mock.mkv')
+        self.assertTrue(result.success, result.message)
+        self.assertEqual(self.read(storage, filepath), self.data)
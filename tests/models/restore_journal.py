@@ -0,0 +1,59 @@
+import os
+import unittest
+
+from ..tools import sandbox
+from ...models import library
+from ...models import restore_journal
+from ...models import storage
+
+class RestoreJournalTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        self.library = library.Library('Videos', self.sandbox.source_videos_library.path, True)
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def test_finished_copies_are_forgotten(self):
+        journal = restore_journal.RestoreJournal(self.library)
+        journal.start('mock.mkv')
+        self.assertTrue(os.path.exists(journal.journal_file))
+        journal.finish('mock.mkv')
+        self.assertFalse(os.path.exists(journal.journal_file))
+
+    def test_recover_interrupted_copy(self):
+        #  A copy that was started but never finished is deleted, with its cache file
+        partial_file = self.sandbox.make_media('dir/partial.mkv', 'partial bits', self.sandbox.source_videos_library)
+        complete_file = self.sandbox.make_media('complete.mkv', 'complete bits', self.sandbox.source_videos_library)
+        journal = restore_journal.RestoreJournal(self.library)
+        journal.start('dir/partial.mkv')
+        self.library.load_all_media(False)
+        self.library.media['dir/partial.mkv'].save_cache_file(overwrite=True)
+
+        recovered = restore_journal.RestoreJournal(self.library).recover()
+        self.assertEqual(recovered, ['dir/partial.mkv'])
+        self.assertFalse(os.path.exists(partial_file.path))
+        self.assertFalse(os.path.exists(os.path.join(os.path.dirname(partial_file.path), '.cache', 'partial.mkv.txt')))
+        self.assertNotIn('dir/partial.mkv', self.library.media)
+        self.assertTrue(os.path.exists(complete_file.path))
+        self.assertFalse(os.path.exists(journal.journal_file))
+
+    def test_journal_in_memory(self):
+        #  The journal is kept on the library's storage backend
+        memory = storage.MemoryStorage(sleep=False)
+        memory_sandbox = sandbox.Sandbox(storage=memory)
+        memory_sandbox.create()
+        memory_library = library.Library('Videos', memory_sandbox.source_videos_library.path, True, storage=memory)
+        journal = restore_journal.RestoreJournal(memory_library)
+        journal.start('mock.mkv')
+        self.assertTrue(memory.isfile(journal.journal_file))
+        self.assertFalse(os.path.exists(journal.journal_file))
+
+        reloaded = restore_journal.RestoreJournal(memory_library)
+        reloaded.load()
+        self.assertEqual(reloaded.in_progress, {'mock.mkv'})
+        reloaded.finish('mock.mkv')
+        self.assertFalse(memory.exists(journal.journal_file))
+        memory_sandbox.destroy()
@@ -0,0 +1,59 @@
+import os
+import unittest
+
+from ..tools import sandbox
+from ...models import retry_queue
+
+class RetryQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.queue = retry_queue.RetryQueue(max_attempts=3, backoff_seconds=10, backoff_factor=2)
+
+    def test_backoff_grows_with_each_attempt(self):
+        entry = self.queue.add_failure('Videos', 'mock.mkv', '/backup', 'error', now=100)
+        self.assertEqual(entry['next_attempt_time'], 110)
+        entry = self.queue.add_failure('Videos', 'mock.mkv', '/backup', 'error', now=110)
+        self.assertEqual(entry['attempts'], 2)
+        self.assertEqual(entry['next_attempt_time'], 130)
+        self.assertEqual(self.queue.get_next_attempt_time(), 130)
+
+    def test_due_entries(self):
+        self.queue.add_failure('Videos', 'a.mkv', '/backup', 'error', now=100)
+        self.queue.add_failure('Videos', 'b.mkv', '/backup', 'error', now=105)
+        self.assertEqual(self.queue.get_due(now=100), [])
+        self.assertEqual([entry['path_in_library'] for entry in self.queue.get_due(now=112)], ['a.mkv'])
+        self.assertEqual(len(self.queue.get_due(now=115)), 2)
+
+    def test_exhausted_entries_are_not_pending(self):
+        for now in [100, 110, 130]:
+            self.queue.add_failure('Videos', 'mock.mkv', '/backup', 'error', now=now)
+        self.assertEqual(self.queue.get_pending(), [])
+        self.assertIsNone(self.queue.get_next_attempt_time())
+        self.assertEqual(len(self.queue.get_failure_report()), 1)
+        self.assertEqual(self.queue.get_failure_report()[0]['attempts'], 3)
+
+    def test_remove(self):
+        self.queue.add_failure('Videos', 'mock.mkv', '/backup', 'error', now=100)
+        self.queue.remove('Videos', 'mock.mkv', '/backup')
+        self.assertEqual(self.queue.get_failure_report(), [])
+
+    def test_save_and_load(self):
+        mock_sandbox = sandbox.Sandbox()
+        mock_sandbox.create()
+        try:
+            report_file = os.path.join(mock_sandbox.source_mirror, '.cache', 'backup_failures.json')
+            for now in [100, 110, 130]:
+                self.queue.add_failure('Videos', 'mock.mkv', '/backup', 'unreadable', now=now)
+            self.queue.save(report_file)
+
+            #  A re-run starts each failure over, due immediately
+            queue = retry_queue.RetryQueue()
+            self.assertEqual(queue.load(report_file, now=1000), 1)
+            self.assertEqual(queue.get_due(now=1000)[0]['attempts'], 0)
+            self.assertEqual(queue.get_due(now=1000)[0]['error_message'], 'unreadable')
+
+            #  Saving an empty queue removes the report
+            queue.remove('Videos', 'mock.mkv', '/backup')
+            queue.save(report_file)
+            self.assertFalse(os.path.exists(report_file))
+        finally:
+            mock_sandbox.destroy()
@@ -0,0 +1,63 @@
+import os
+import unittest
+
+from ..tools import sandbox
+from ...models import library
+from ...models import storage
+
+class StorageTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in memory
+        self.storage = storage.MemoryStorage(sleep=False)
+        self.sandbox = sandbox.Sandbox(storage=self.storage)
+        self.sandbox.create()
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def test_memory_files(self):
+        path = os.path.join(self.sandbox.source_videos_library.path, 'dir', 'mock.mkv')
+        self.storage.makedirs(os.path.dirname(path))
+        with self.storage.open(path, 'w') as file:
+            file.write('mock bits')
+        self.assertTrue(self.storage.isfile(path))
+        self.assertEqual(self.storage.stat(path).st_size, 9)
+        with self.storage.open(path, 'rb') as file:
+            self.assertEqual(file.read(), b'mock bits')
+        self.assertEqual([entry.name for entry in self.storage.scandir(os.path.dirname(path))], ['mock.mkv'])
+
+        #  Renaming a file changes the modification time of its directory
+        directory_mtime_ns = self.storage.stat(os.path.dirname(path)).st_mtime_ns
+        self.storage.replace(path, path + '.old')
+        self.assertFalse(self.storage.exists(path))
+        self.assertGreater(self.storage.stat(os.path.dirname(path)).st_mtime_ns, directory_mtime_ns)
+        self.storage.remove(path + '.old')
+        with self.assertRaises(FileNotFoundError):
+            self.storage.open(path, 'r')
+
+    def test_memory_latency_and_throughput(self):
+        #  Each operation costs the latency; reads and writes cost their size over the throughput
+        device = storage.MemoryStorage(latency_seconds=0.01, read_bytes_per_second=1000, write_bytes_per_second=500, sleep=False)
+        device.makedirs('/mirror')
+        with device.open('/mirror/mock.mkv', 'wb') as file:
+            file.write(b'x' * 1000)
+        with device.open('/mirror/mock.mkv', 'rb') as file:
+            file.read()
+        self.assertAlmostEqual(device.simulated_seconds, 0.01 * 3 + 2.0 + 1.0)
+
+    def test_library_in_memory(self):
+        #  A library on a MemoryStorage loads, backs up and verifies like a library on a disc
+        source_media = self.sandbox.populate_library_with_unique_media(self.sandbox.source_videos_library)
+        source_library = library.Library('Videos', self.sandbox.source_videos_library.path, True, storage=self.storage)
+        backup_library = library.Library('Videos', self.sandbox.backup_videos_library.path, False, storage=self.storage)
+        source_library.load_all_media(None)
+        self.assertEqual(len(source_library.media), len(source_media))
+
+        for media in source_library.media.values():
+            result = backup_library.copy_media(media.path, media.path_in_library, media.real_checksum)
+            self.assertTrue(result.success, result.message)
+        backup_library.load_all_media(None)
+        self.assertEqual(sorted(backup_library.media), sorted(source_library.media))
+        for path_in_library, media in backup_library.media.items():
+            self.assertEqual(media.cached_checksum, source_library.media[path_in_library].real_checksum)
+        self.assertEqual(backup_library.get_orphan_cache_files(), [])
@@ -0,0 +1,55 @@
+import io
+import time
+import unittest
+
+from ...models import throttle
+
+class ThrottleTests(unittest.TestCase):
+    def test_unlimited_read(self):
+        throttle_object = throttle.Throttle()
+        file = io.BytesIO(b'x' * 1000)
+        self.assertEqual(throttle_object.read(file, 600), b'x' * 600)
+        self.assertEqual(throttle_object.read(file, 600), b'x' * 400)
+        self.assertEqual(throttle_object.read(file, 600), b'')
+
+    def test_read_bytes_per_second(self):
+        #  10 reads of 10 KB at 200 KB/s take at least ~0.45 seconds
+        throttle_object = throttle.Throttle(read_bytes_per_second=200000)
+        file = io.BytesIO(b'x' * 100000)
+        start_time = time.monotonic()
+        while throttle_object.read(file, 10000):
+            pass
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.4)
+
+    def test_write_bytes_per_second(self):
+        throttle_object = throttle.Throttle(write_bytes_per_second=200000)
+        file = io.BytesIO()
+        start_time = time.monotonic()
+        for _ in range(10):
+            throttle_object.write(file, b'x' * 10000)
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.4)
+        self.assertEqual(len(file.getvalue()), 100000)
+
+    def test_iops(self):
+        throttle_object = throttle.Throttle(iops=50)
+        file = io.BytesIO()
+        start_time = time.monotonic()
+        for _ in range(11):
+            throttle_object.write(file, b'x')
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.18)
+
+    def test_adaptive_back_off(self):
+        throttle_object = throttle.Throttle(adaptive=True)
+
+        #  Establish a baseline, then report rising latency
+        for _ in range(5):
+            throttle_object.record_read_latency(0.001)
+        self.assertEqual(throttle_object.backoff_delay, 0.0)
+        for _ in range(5):
+            throttle_object.record_read_latency(0.01)
+        self.assertGreater(throttle_object.backoff_delay, 0.0)
+
+        #  The delay recovers once latency falls back to the baseline
+        for _ in range(50):
+            throttle_object.record_read_latency(0.001)
+        self.assertEqual(throttle_object.backoff_delay, 0.0)
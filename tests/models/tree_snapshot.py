@@ -0,0 +1,66 @@
+import os
+import unittest
+from unittest import mock
+
+from ..tools import sandbox
+from ...models import library
+
+class TreeSnapshotTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        #  The backup 'Videos' library has an orphan cache file and a chain of empty directories
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        self.sandbox.populate_library_with_unique_media(self.sandbox.backup_videos_library)
+        self.library_path = self.sandbox.backup_videos_library.path
+        self.orphan_cache_file = os.path.join(self.library_path, '.cache', 'deleted.mkv.txt')
+        os.makedirs(os.path.dirname(self.orphan_cache_file), exist_ok=True)
+        with open(self.orphan_cache_file, 'w') as file:
+            file.write('2020-01-31|checksum')
+        self.empty_directory = os.path.join(self.library_path, 'empty', 'nested')
+        os.makedirs(self.empty_directory)
+        self.library = library.Library('Videos', self.library_path, False)
+        self.library.load_all_media(None)
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def test_queries_answer_from_snapshot(self):
+        #  Once the library is loaded, it is not walked again
+        with mock.patch.object(self.library.storage, 'walk', side_effect=AssertionError('library was walked')):
+            self.assertEqual(self.library.get_orphan_cache_files(), [self.orphan_cache_file])
+            self.assertEqual(self.library.get_empty_directories(), [self.empty_directory])
+            self.library.delete_orphan_cache_files()
+            self.library.delete_empty_directories()
+            self.assertEqual(self.library.get_orphan_cache_files(), [])
+            self.assertEqual(self.library.get_empty_directories(), [])
+        self.assertFalse(os.path.exists(self.orphan_cache_file))
+        self.assertFalse(os.path.exists(os.path.dirname(self.empty_directory)))
+
+    def test_snapshot_follows_deletes(self):
+        #  Deleting the only media file of a directory empties it, and leaves no orphan cache file
+        path_in_library = next(path for path in self.library.media if os.path.dirname(path))
+        directory = os.path.dirname(self.library.media[path_in_library].path)
+        for other_path in [path for path in self.library.media if os.path.dirname(path) == os.path.dirname(path_in_library)]:
+            self.library.delete_media(other_path)
+        self.assertEqual(self.library.get_orphan_cache_files(), [self.orphan_cache_file])
+        self.assertIn(directory, self.library.get_empty_directories())
+        self.library.delete_empty_directories()
+        self.assertFalse(os.path.exists(directory))
+        self.assertEqual(self.library.get_empty_directories(), [])
+
+    def test_snapshot_from_saved_listings(self):
+        #  Directories unchanged since the last load reuse their saved listings, and give the same snapshot
+        #  Saving the index changes the modification time of its own '.cache' directory, which is listed every time
+        for dirpath, _, _ in os.walk(self.library_path):
+            os.utime(dirpath, (1000000000, 1000000000))
+        self.library.load_all_media(None)
+        listed_snapshot = self.library.snapshot
+        with mock.patch.object(self.library.storage, 'scandir', wraps=self.library.storage.scandir) as scandir:
+            self.library.load_all_media(None)
+        self.assertEqual(
+            [args[0] for args, _ in scandir.call_args_list],
+            [os.path.dirname(self.library.directory_index_file)]
+        )
+        self.assertEqual(self.library.snapshot.files, listed_snapshot.files)
+        self.assertEqual(self.library.snapshot.directories, listed_snapshot.directories)
@@ -0,0 +1,97 @@
+import datetime
+import os
+import shutil
+import unittest
+from unittest import mock
+
+from ..tools import sandbox
+from ...models import library
+from ...models import versions
+
+class VersionStoreTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        self.library = library.Library('Videos', self.sandbox.backup_videos_library.path, False)
+        self.version_store = versions.VersionStore(self.sandbox.backup_mirror, max_versions=2, max_age_days=30)
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def keep_version(self, file_text, now):
+        self.sandbox.make_media('dir/mock.mkv', file_text, self.sandbox.backup_videos_library)
+        self.library.load_all_media(False)
+        self.library.media['dir/mock.mkv'].save_cache_file(overwrite=True)
+        return self.version_store.keep_version(self.library, 'dir/mock.mkv', now=now)
+
+    def test_keep_version(self):
+        #  The media file and its cache file are moved out of the library
+        media_path = os.path.join(self.library.path, 'dir', 'mock.mkv')
+        version_path = self.keep_version('old bits', datetime.datetime(2020, 1, 31, 12, 0, 0))
+        self.assertFalse(os.path.exists(media_path))
+        self.assertFalse(os.path.exists(os.path.join(self.library.path, 'dir', '.cache', 'mock.mkv.txt')))
+        self.assertNotIn('dir/mock.mkv', self.library.media)
+        self.assertEqual(os.path.basename(version_path), '20200131T120000.mkv')
+        self.assertTrue(os.path.exists(os.path.join(os.path.dirname(version_path), '20200131T120000.txt')))
+        with open(version_path, 'r') as version_file:
+            self.assertEqual(version_file.read(), 'old bits')
+        self.assertEqual(self.version_store.get_versions('Videos', 'dir/mock.mkv'), [version_path])
+
+    def test_restore_version(self):
+        version_path = self.keep_version('old bits', datetime.datetime(2020, 1, 31, 12, 0, 0))
+        self.version_store.restore_version(self.library, 'dir/mock.mkv', version_path)
+        self.assertIn('dir/mock.mkv', self.library.media)
+        self.assertTrue(os.path.exists(os.path.join(self.library.path, 'dir', '.cache', 'mock.mkv.txt')))
+        self.assertFalse(os.path.exists(os.path.join(self.version_store.path, 'Videos')))
+
+    def test_clone_version(self):
+        #  A reflink is simulated with a copy; the media file stays in the library, to be updated in place
+        self.sandbox.make_media('dir/mock.mkv', 'old bits', self.sandbox.backup_videos_library)
+        self.library.load_all_media(False)
+        self.library.media['dir/mock.mkv'].save_cache_file(overwrite=True)
+        def clone_file(source_path, destination_path):
+            shutil.copy2(source_path, destination_path)
+            return True
+        with mock.patch.object(self.version_store.storage, 'clone_file', side_effect=clone_file):
+            version_path = self.version_store.clone_version(self.library, 'dir/mock.mkv', now=datetime.datetime(2020, 1, 31))
+        self.assertIn('dir/mock.mkv', self.library.media)
+        self.assertTrue(os.path.exists(os.path.join(self.library.path, 'dir', '.cache', 'mock.mkv.txt')))
+        self.assertTrue(os.path.exists(os.path.splitext(version_path)[0] + '.txt'))
+        self.assertEqual(self.version_store.get_versions('Videos', 'dir/mock.mkv'), [version_path])
+
+        #  Where files can not be cloned, nothing is kept
+        with mock.patch.object(self.version_store.storage, 'clone_file', return_value=False):
+            self.assertIsNone(self.version_store.clone_version(self.library, 'dir/mock.mkv'))
+        self.assertEqual(self.version_store.get_versions('Videos', 'dir/mock.mkv'), [version_path])
+
+    def test_prune_by_count_and_age(self):
+        #  Only the newest two versions are kept, and only while they are at most 30 days old
+        for day, file_text in [(1, 'one'), (20, 'two'), (21, 'three'), (22, 'four')]:
+            self.keep_version(file_text, datetime.datetime(2020, 1, day))
+        pruned = self.version_store.prune(now=datetime.datetime(2020, 2, 20))
+        self.assertEqual([os.path.basename(path) for path in pruned], ['20200101T000000.mkv', '20200120T000000.mkv'])
+        remaining = self.version_store.get_versions('Videos', 'dir/mock.mkv')
+        self.assertEqual([os.path.basename(path) for path in remaining], ['20200121T000000.mkv', '20200122T000000.mkv'])
+        self.assertFalse(os.path.exists(os.path.splitext(pruned[0])[0] + '.txt'))
+
+        #  Once every version is pruned, the empty directories are removed
+        self.version_store.prune(now=datetime.datetime(2020, 3, 1))
+        self.assertFalse(os.path.exists(os.path.join(self.version_store.path, 'Videos')))
+
+    def test_prune_versions_pruned_elsewhere(self):
+        #  A version removed by another pruner, e.g. a daemon's, while this one runs is skipped
+        for day, file_text in [(1, 'one'), (2, 'two'), (3, 'three')]:
+            self.keep_version(file_text, datetime.datetime(2020, 1, day))
+        remove = self.version_store.storage.remove
+
+        def remove_twice(path):
+            remove(path)
+            if path.endswith('20200101T000000.txt'):
+                remove(os.path.splitext(path)[0] + '.mkv')
+
+        with mock.patch.object(self.version_store.storage, 'remove', side_effect=remove_twice):
+            pruned = self.version_store.prune(now=datetime.datetime(2020, 1, 10))
+        self.assertEqual(pruned, [])
+        remaining = self.version_store.get_versions('Videos', 'dir/mock.mkv')
+        self.assertEqual([os.path.basename(path) for path in remaining], ['20200102T000000.mkv', '20200103T000000.mkv'])
@@ -0,0 +1,176 @@
+import contextlib
+import errno
+import io
+import os
+import shutil
+import sys
+import unittest
+from unittest import mock
+
+from ..tools import sandbox
+from ...models import library
+from ...models import watcher
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is only available on Linux')
+class LibraryWatcherTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        #  The source 'Videos' library is loaded and watched
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        self.sandbox.populate_library_with_unique_media(self.sandbox.source_videos_library)
+        self.library = library.Library('Videos', self.sandbox.source_videos_library.path, True)
+        self.library.load_all_media(None)
+        self.watcher = watcher.LibraryWatcher([self.library])
+
+    def tearDown(self):
+        self.watcher.close()
+        self.sandbox.destroy()
+
+    def apply_changes(self):
+        #  As the daemon does before each request
+        self.watcher.read_changes(timeout=1)
+        changes = self.watcher.pop_changes()
+        for (changed_library, directory_in_library), changed_names in sorted(changes.items(), key=lambda item: item[0][1]):
+            changed_library.reload_directory(directory_in_library, changed_names)
+        return changes
+
+    def apply_changes_to(self, debouncer, now):
+        self.watcher.read_changes(timeout=1)
+        for (changed_library, directory_in_library), changed_names in self.watcher.pop_changes().items():
+            for path_in_library in changed_library.reload_directory(directory_in_library, changed_names):
+                debouncer.add(changed_library, path_in_library, now=now)
+
+    def assert_matches_fresh_load(self):
+        fresh_library = library.Library('Videos', self.library.path, True)
+        fresh_library.load_all_media(None)
+        self.assertEqual(sorted(self.library.media), sorted(fresh_library.media))
+        self.assertEqual(self.library.snapshot.files, fresh_library.snapshot.files)
+        self.assertEqual(self.library.snapshot.directories, fresh_library.snapshot.directories)
+
+    def test_changed_directories_are_reloaded(self):
+        self.sandbox.make_media('source-dir-1/new.mkv', 'new', self.sandbox.source_videos_library)
+        os.remove(os.path.join(self.library.path, 'source-2.mkv'))
+        changes = self.apply_changes()
+        self.assertEqual(
+            sorted((directory_in_library, sorted(names)) for (_, directory_in_library), names in changes.items()),
+            [('', ['source-2.mkv']), ('source-dir-1', ['new.mkv'])]
+        )
+        self.assertIn(os.path.join('source-dir-1', 'new.mkv'), self.library.media)
+        self.assertNotIn('source-2.mkv', self.library.media)
+        self.assert_matches_fresh_load()
+
+    def test_new_and_removed_directories(self):
+        #  A directory tree moved into the library is loaded in full, and watched
+        outside_path = os.path.join(self.sandbox.path, 'outside')
+        os.makedirs(os.path.join(outside_path, 'season-1'))
+        with open(os.path.join(outside_path, 'season-1', 'episode-1.mkv'), 'w') as file:
+            file.write('episode-1')
+        os.rename(outside_path, os.path.join(self.library.path, 'show'))
+        shutil.rmtree(os.path.join(self.library.path, 'source-3'))
+        self.apply_changes()
+        self.assertIn(os.path.join('show', 'season-1', 'episode-1.mkv'), self.library.media)
+        self.assertEqual([path for path in self.library.media if path.startswith('source-3')], [])
+        self.assert_matches_fresh_load()
+
+        self.sandbox.make_media('show/season-1/episode-2.mkv', 'episode-2', self.sandbox.source_videos_library)
+        self.apply_changes()
+        self.assertIn(os.path.join('show', 'season-1', 'episode-2.mkv'), self.library.media)
+        self.assert_matches_fresh_load()
+
+    def test_overflow_lists_every_directory(self):
+        self.sandbox.make_media('source-dir-2/new.mkv', 'new', self.sandbox.source_videos_library)
+        self.watcher.overflowed = True
+        changes = self.apply_changes()
+        self.assertEqual(len(changes), len(self.library.snapshot.files))
+        self.assert_matches_fresh_load()
+
+    def test_open_files_are_not_settled(self):
+        #  A file being written is held until it is closed, then until it has not changed for the settle time
+        debouncer = watcher.ChangeDebouncer(settle_seconds=5)
+        path = os.path.join(self.library.path, 'source-dir-1', 'rip.mkv')
+        with open(path, 'w') as file:
+            file.write('part')
+            file.flush()
+            self.apply_changes_to(debouncer, now=0)
+            self.assertTrue(self.watcher.is_open(self.library, os.path.join('source-dir-1', 'rip.mkv')))
+            self.assertEqual(debouncer.pop_settled(self.watcher.is_open, now=100), [])
+        self.apply_changes_to(debouncer, now=100)
+        self.assertFalse(self.watcher.is_open(self.library, os.path.join('source-dir-1', 'rip.mkv')))
+        self.assertEqual(debouncer.pop_settled(self.watcher.is_open, now=101), [])
+        self.assertEqual(debouncer.pop_settled(self.watcher.is_open, now=106), [(self.library, os.path.join('source-dir-1', 'rip.mkv'))])
+
+    def test_unwatchable_directories_are_polled(self):
+        #  Past the watch limit, a tree is polled; new media in it, and in new directories under it, is still found
+        def add_watch(inotify, path, mask):
+            if 'source-dir-2' in path:
+                raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), path)
+            return add_watch_original(inotify, path, mask)
+
+        add_watch_original = watcher.Inotify.add_watch
+        self.watcher.close()
+        with mock.patch.object(watcher.Inotify, 'add_watch', autospec=True, side_effect=add_watch):
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                self.watcher = watcher.LibraryWatcher([self.library])
+            self.assertIn('polled', output.getvalue())
+            self.assertIn((self.library, 'source-dir-2'), self.watcher.polled)
+
+            #  Modification times only change in whole ticks of the clock, so they are set explicitly
+            self.sandbox.make_media('source-dir-2/dir-2.1/new.mkv', 'new', self.sandbox.source_videos_library)
+            self.sandbox.make_media('source-dir-2/season/episode-1.mkv', 'episode-1', self.sandbox.source_videos_library)
+            os.utime(os.path.join(self.library.path, 'source-dir-2', 'dir-2.1'), ns=(1, 1))
+            os.utime(os.path.join(self.library.path, 'source-dir-2'), ns=(1, 1))
+            self.apply_changes()
+            self.assertIn(os.path.join('source-dir-2', 'dir-2.1', 'new.mkv'), self.library.media)
+            self.assertIn(os.path.join('source-dir-2', 'season', 'episode-1.mkv'), self.library.media)
+            self.assertIn((self.library, os.path.join('source-dir-2', 'season')), self.watcher.polled)
+            self.assert_matches_fresh_load()
+
+    def test_inotify_is_closed_if_setup_fails(self):
+        close_original = watcher.Inotify.close
+        with mock.patch.object(watcher.Inotify, 'add_watch', side_effect=RuntimeError('setup failed')), \
+                mock.patch.object(watcher.Inotify, 'close', autospec=True, side_effect=close_original) as close:
+            with self.assertRaises(RuntimeError):
+                watcher.LibraryWatcher([self.library])
+        self.assertEqual(close.call_count, 1)
+        self.assertEqual(close.call_args[0][0].fd, -1)
+
+class PollingWatcherTests(unittest.TestCase):
+    def setUp(self):
+        #  Create a sandbox in a temporary (safe) directory
+        #  The source 'Videos' library is not loaded; its snapshot is captured by the watcher
+        self.sandbox = sandbox.Sandbox()
+        self.sandbox.create()
+        self.sandbox.populate_library_with_unique_media(self.sandbox.source_videos_library)
+        self.library = library.Library('Videos', self.sandbox.source_videos_library.path, True)
+        self.watcher = watcher.PollingWatcher([self.library], interval_seconds=0)
+
+    def tearDown(self):
+        self.sandbox.destroy()
+
+    def poll(self):
+        self.watcher.read_changes()
+        changed_media = []
+        for (changed_library, directory_in_library), changed_names in sorted(self.watcher.pop_changes().items(), key=lambda item: item[0][1]):
+            changed_media += changed_library.reload_directory(directory_in_library, changed_names)
+        return sorted(changed_media)
+
+    def test_new_media_is_found_without_a_walk(self):
+        #  Modification times only change in whole ticks of the clock, so they are set explicitly
+        self.assertEqual(self.poll(), [])
+        self.sandbox.make_media('source-dir-2/dir-2.1/new.mkv', 'new', self.sandbox.source_videos_library)
+        self.sandbox.make_media('season/episode.mkv', 'episode', self.sandbox.source_videos_library)
+        os.utime(os.path.join(self.library.path, 'source-dir-2', 'dir-2.1'), ns=(1, 1))
+        os.utime(self.library.path, ns=(1, 1))
+        with mock.patch.object(self.library.storage, 'walk', side_effect=AssertionError('library was walked')):
+            self.assertEqual(self.poll(), [os.path.join('season', 'episode.mkv'), os.path.join('source-dir-2', 'dir-2.1', 'new.mkv')])
+            #  The new directory is listed once more, as it may have changed since it was listed
+            self.assertEqual(self.poll(), [])
+            self.assertIn((self.library, 'season'), self.watcher.mtimes)
+
+    def test_changed_media_is_backed_up_alone(self):
+        #  The backup library is not loaded; each changed file is looked for on the disc
+        self.sandbox.make_media('source-1.mkv', 'source-1', self.sandbox.backup_videos_library)
+        backup_library = library.Library('Videos', self.sandbox.backup_videos_library.path, False)
+        targets = self.library.get_media_to_backup([backup_library], paths_in_library=['source-1.mkv', 'source-2.mkv'])
+        self.assertEqual(targets, {'source-2.mkv': [backup_library]})
@@ -2,6 +2,29 @@ import unittest
 
 from .models.media_file import MediaFileTests
 from .models.library import LibraryTests
+from .models.background_hasher import BackgroundHasherTests
+from .models.backup_queue import BackupQueueTests
+from .models.capacity import CapacityTests
+from .models.copy_engine import CopyEngineTests
+from .models.delta_transfer import DeltaTransferTests
+from .models.discrepancy_rules import DiscrepancyRulesTests
+from .models.disk_layout import DiskLayoutTests
+from .models.mirror import MirrorTests
+from .models.mirror_diff import MirrorDiffTests
+from .models.object_storage import ObjectStorageTests
+from .models.orphan_policy import OrphanDeletionPolicyTests
+from .models.pack_storage import PackStorageTests
+from .models.parity import ParityStoreTests
+from .models.restore_journal import RestoreJournalTests
+from .models.retry_queue import RetryQueueTests
+from .models.storage import StorageTests
+from .models.throttle import ThrottleTests
+from .models.tree_snapshot import TreeSnapshotTests
+from .models.versions import VersionStoreTests
+from .models.watcher import LibraryWatcherTests
+from .models.watcher import PollingWatcherTests
+from .controllers.daemon import DaemonTests
+from .controllers.main_controller import MainControllerTests
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,270 @@
+import email.utils
+import hashlib
+import http.server
+import socketserver
+import threading
+import time
+import urllib.parse
+import uuid
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import escape
+
+#  A local stand-in for an S3-compatible object store, for tests of 'ObjectStorage'
+#  It keeps objects in memory and supports the subset of the S3 API the storage uses:
+#  PUT/GET/HEAD/DELETE of objects, server-side copies, ListObjectsV2 and multipart uploads (including part copies)
+#  Signatures are not checked, but every request must be signed
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    #  A thread per connection, as 'http.server.ThreadingHTTPServer' (Python 3.7+) does
+    daemon_threads = True
+
+class StoredObject(object):
+    def __init__(self, data, metadata, etag):
+        self.data = data
+        self.metadata = metadata  # {'x-amz-meta-name': 'value'}
+        self.etag = etag
+        self.last_modified = time.time()
+
+class ObjectStoreHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # Headers and body are written separately
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        with self.server.store.lock:
+            self.server.store.connection_count += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse_request_path(self):
+        parsed = urllib.parse.urlsplit(self.path)
+        bucket, _, key = urllib.parse.unquote(parsed.path).lstrip('/').partition('/')
+        query = dict(urllib.parse.parse_qsl(parsed.query, keep_blank_values=True))
+        return bucket, key, query
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_error_code(self, status, code):
+        self.send(status, '<Error><Code>{}</Code></Error>'.format(code).encode('utf-8'))
+
+    def handle_request(self, method):
+        store = self.server.store
+        body = self.read_body()
+        with store.lock:
+            store.request_count += 1
+        if not self.headers.get('Authorization', '').startswith('AWS4-HMAC-SHA256 '):
+            return self.send_error_code(403, 'AccessDenied')
+        bucket, key, query = self.parse_request_path()
+        if bucket != store.bucket:
+            return self.send_error_code(404, 'NoSuchBucket')
+        if method == 'GET' and not key:
+            return self.list_objects(query)
+        if method == 'POST' and 'uploads' in query:
+            return self.create_multipart_upload(key)
+        if method == 'POST' and 'uploadId' in query:
+            return self.complete_multipart_upload(key, query['uploadId'], body)
+        if method == 'PUT' and 'uploadId' in query:
+            return self.upload_part(query['uploadId'], int(query['partNumber']), body)
+        if method == 'DELETE' and 'uploadId' in query:
+            with store.lock:
+                store.uploads.pop(query['uploadId'], None)
+            return self.send(204)
+        if method == 'PUT':
+            return self.put_object(key, body)
+        if method in ('GET', 'HEAD'):
+            return self.get_object(key)
+        if method == 'DELETE':
+            with store.lock:
+                store.objects.pop(key, None)
+            return self.send(204)
+        self.send_error_code(405, 'MethodNotAllowed')
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_HEAD(self):
+        self.handle_request('HEAD')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def get_metadata(self):
+        return {name.lower(): value for name, value in self.headers.items() if name.lower().startswith('x-amz-meta-')}
+
+    def get_copy_source(self):
+        #  The data of the object named in 'x-amz-copy-source', or 'None'
+        bucket, _, key = urllib.parse.unquote(self.headers['x-amz-copy-source']).lstrip('/').partition('/')
+        with self.server.store.lock:
+            stored = self.server.store.objects.get(key) if bucket == self.server.store.bucket else None
+        return stored
+
+    def put_object(self, key, body):
+        store = self.server.store
+        if 'x-amz-copy-source' in self.headers:
+            source = self.get_copy_source()
+            if source is None:
+                return self.send_error_code(404, 'NoSuchKey')
+            metadata = self.get_metadata() if self.headers.get('x-amz-metadata-directive') == 'REPLACE' else dict(source.metadata)
+            stored = StoredObject(source.data, metadata, hashlib.md5(source.data).hexdigest())
+            with store.lock:
+                store.objects[key] = stored
+                store.copy_count += 1
+            return self.send(200, '<CopyObjectResult><ETag>"{}"</ETag></CopyObjectResult>'.format(stored.etag).encode('utf-8'))
+        if store.corrupt_uploads:
+            body = body[:-1] + bytes([body[-1] ^ 1]) if body else body
+        stored = StoredObject(body, self.get_metadata(), hashlib.md5(body).hexdigest())
+        with store.lock:
+            store.objects[key] = stored
+        self.send(200, headers={'ETag': '"{}"'.format(stored.etag)})
+
+    def get_object(self, key):
+        with self.server.store.lock:
+            stored = self.server.store.objects.get(key)
+        if stored is None:
+            return self.send_error_code(404, 'NoSuchKey')
+        headers = dict(stored.metadata)
+        headers['ETag'] = '"{}"'.format(stored.etag)
+        headers['Last-Modified'] = email.utils.formatdate(stored.last_modified, usegmt=True)
+        data = stored.data
+        status = 200
+        if 'Range' in self.headers:
+            with self.server.store.lock:
+                self.server.store.ranges.append(self.headers['Range'])
+            start, end = self.headers['Range'][len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1] if end else data[int(start):]
+            status = 206
+        if self.command == 'HEAD':
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            return
+        self.send(status, data, headers)
+
+    def list_objects(self, query):
+        store = self.server.store
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter')
+        max_keys = min(int(query.get('max-keys', store.page_size)), store.page_size)
+        with store.lock:
+            sizes = {key: len(stored.data) for key, stored in store.objects.items() if key.startswith(prefix)}
+        entries = []  # [('key', is_prefix)]
+        for key in sorted(sizes):
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                common_prefix = prefix + rest[:rest.index(delimiter) + 1]
+                if not entries or entries[-1] != (common_prefix, True):
+                    entries.append((common_prefix, True))
+            else:
+                entries.append((key, False))
+        start = int(query.get('continuation-token', 0))
+        page = entries[start:start + max_keys]
+        truncated = start + max_keys < len(entries)
+        body = ['<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">']
+        for key, is_prefix in page:
+            if is_prefix:
+                body.append('<CommonPrefixes><Prefix>{}</Prefix></CommonPrefixes>'.format(escape(key)))
+            else:
+                body.append('<Contents><Key>{0}</Key><Size>{1}</Size></Contents>'.format(escape(key), sizes[key]))
+        body.append('<IsTruncated>{}</IsTruncated>'.format('true' if truncated else 'false'))
+        if truncated:
+            body.append('<NextContinuationToken>{}</NextContinuationToken>'.format(start + max_keys))
+        body.append('</ListBucketResult>')
+        self.send(200, ''.join(body).encode('utf-8'))
+
+    def create_multipart_upload(self, key):
+        upload_id = uuid.uuid4().hex
+        with self.server.store.lock:
+            self.server.store.uploads[upload_id] = {'key': key, 'metadata': self.get_metadata(), 'parts': dict()}
+        self.send(200, '<InitiateMultipartUploadResult><UploadId>{}</UploadId></InitiateMultipartUploadResult>'.format(upload_id).encode('utf-8'))
+
+    def upload_part(self, upload_id, number, body):
+        store = self.server.store
+        with store.lock:
+            upload = store.uploads.get(upload_id)
+        if upload is None:
+            return self.send_error_code(404, 'NoSuchUpload')
+        if 'x-amz-copy-source' in self.headers:
+            source = self.get_copy_source()
+            if source is None:
+                return self.send_error_code(404, 'NoSuchKey')
+            start, end = self.headers['x-amz-copy-source-range'][len('bytes='):].split('-')
+            data = source.data[int(start):int(end) + 1]
+            with store.lock:
+                upload['parts'][number] = data
+            etag = hashlib.md5(data).hexdigest()
+            return self.send(200, '<CopyPartResult><ETag>"{}"</ETag></CopyPartResult>'.format(etag).encode('utf-8'))
+        with store.lock:
+            upload['parts'][number] = body
+        self.send(200, headers={'ETag': '"{}"'.format(hashlib.md5(body).hexdigest())})
+
+    def complete_multipart_upload(self, key, upload_id, body):
+        store = self.server.store
+        with store.lock:
+            upload = store.uploads.pop(upload_id, None)
+        if upload is None:
+            return self.send_error_code(404, 'NoSuchUpload')
+        numbers = [
+            int(element.text) for element in ElementTree.fromstring(body).iter()
+            if element.tag.endswith('PartNumber')
+        ]
+        parts = [upload['parts'][number] for number in numbers]
+        etag = '{0}-{1}'.format(hashlib.md5(b''.join(hashlib.md5(part).digest() for part in parts)).hexdigest(), len(parts))
+        with store.lock:
+            store.objects[key] = StoredObject(b''.join(parts), upload['metadata'], etag)
+        self.send(200, '<CompleteMultipartUploadResult><ETag>"{}"</ETag></CompleteMultipartUploadResult>'.format(etag).encode('utf-8'))
+
+class ObjectStoreServer(object):
+    def __init__(self, bucket='media-backup', page_size=1000):
+        #  Description
+        #    An in-memory object store served on a free local port
+        #  Implementation Notes
+        #    'objects' is {'key': StoredObject}; 'uploads' holds the multipart uploads in progress
+        #    Listings return at most 'page_size' entries per page
+        #    With 'corrupt_uploads', one bit of each uploaded object is flipped, as by a faulty network
+        #    'copy_count' counts server-side copies of whole objects, and 'ranges' lists the ranges read
+
+        self.bucket = bucket
+        self.page_size = page_size
+        self.objects = dict()
+        self.uploads = dict()
+        self.corrupt_uploads = False
+        self.connection_count = 0
+        self.request_count = 0
+        self.copy_count = 0
+        self.ranges = []
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ObjectStoreHandler)
+        self.server.store = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name='ObjectStoreServer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
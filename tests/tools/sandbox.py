@@ -1,8 +1,11 @@
 import hashlib
 import os
+import random
 import shutil
 import tempfile
 
+from ...models.storage import LOCAL_STORAGE
+
 class MockMediaFile(object):
     def __init__(self, name: str, path: str, library_name: str, source: bool):
         self.name = name
@@ -17,8 +20,10 @@ class MockLibrary(object):
         self.source = source
 
 class Sandbox(object):
-    def __init__(self):
+    def __init__(self, storage=None):
+        #  With a MemoryStorage, the sandbox is made in memory instead of a temporary directory
         self.path = None
+        self.storage = storage or LOCAL_STORAGE
 
     def create(self):
         #  Description
@@ -33,7 +38,11 @@ class Sandbox(object):
         if self.path:
             raise FileExistsError('Sandbox already exists')
 
-        self.path = tempfile.mkdtemp()
+        if self.storage is LOCAL_STORAGE:
+            self.path = tempfile.mkdtemp()
+        else:
+            self.path = os.path.join(os.sep, 'sandbox')
+            self.storage.makedirs(self.path)
 
         #  Add mirrors to the sandbox
         self.source_mirror = self.make_mirror(True)
@@ -57,8 +66,10 @@ class Sandbox(object):
         #  Implementation Notes
         #    All object properties are left intact
         #    Do not continue testing with the sandbox after this method is called
+        #    A sandbox in memory is released with its storage
 
-        shutil.rmtree(self.path)
+        if self.storage is LOCAL_STORAGE:
+            shutil.rmtree(self.path)
 
     def make_mirror(self, source: bool):
         #  Description
@@ -72,10 +83,10 @@ class Sandbox(object):
         source_string = 'source' if source else 'backup'
         mirror_path = os.path.join(self.path, source_string)
 
-        if os.path.exists(mirror_path):
+        if self.storage.exists(mirror_path):
             raise FileExistsError('Mirror already exists in sandbox')
 
-        os.mkdir(mirror_path)
+        self.storage.makedirs(mirror_path)
         return mirror_path
 
     def get_mirror_path(self, source: bool):
@@ -89,7 +100,7 @@ class Sandbox(object):
         source_string = 'source' if source else 'backup'
         mirror_path = os.path.join(self.path, source_string)
 
-        if not os.path.exists(mirror_path):
+        if not self.storage.exists(mirror_path):
             raise FileNotFoundError('Mirror does not exist in sandbox')
 
         return mirror_path           
@@ -106,10 +117,10 @@ class Sandbox(object):
         mirror_path = self.get_mirror_path(source)
         library_path = os.path.join(mirror_path, library_name)
 
-        if os.path.exists(library_path):
+        if self.storage.exists(library_path):
             raise FileExistsError('Library already exists in mirror')
 
-        os.mkdir(library_path)
+        self.storage.makedirs(library_path)
         return MockLibrary(
             name = library_name,
             path = library_path,
@@ -130,11 +141,11 @@ class Sandbox(object):
 
         media_path = os.path.join(mock_library.path, media_name)
 
-        if os.path.exists(media_path):
+        if self.storage.exists(media_path):
             raise FileExistsError('Media already exists in library')
 
-        os.makedirs(os.path.dirname(media_path), exist_ok=True)
-        with open(media_path, 'w') as new_file:
+        self.storage.makedirs(os.path.dirname(media_path))
+        with self.storage.open(media_path, 'w') as new_file:
             new_file.write(file_text)
 
         return MockMediaFile(
@@ -205,3 +216,33 @@ class Sandbox(object):
         ]
 
         return source_media, backup_media
+
+    def populate_library_with_generated_media(self, mock_library: MockLibrary, file_count: int, file_size: int, directory_count: int=10):
+        #  Description
+        #    Add 'file_count' files of 'file_size' random bytes to the target library
+        #    Return a list of MockMediaFile objects
+        #  Requires
+        #    The 'library' directory must already exist
+        #  Guarantees
+        #    The files are spread over 'directory_count' directories
+        #    The files are written in a shuffled order, so their layout on disk does not follow walk order
+
+        names = [
+            'generated-dir-{0}/generated-{1}.mkv'.format(index % directory_count, index)
+            for index in range(file_count)
+        ]
+        random.shuffle(names)
+
+        generated_media = []
+        for media_name in names:
+            media_path = os.path.join(mock_library.path, media_name)
+            self.storage.makedirs(os.path.dirname(media_path))
+            with self.storage.open(media_path, 'wb') as new_file:
+                new_file.write(os.urandom(file_size))
+            generated_media.append(MockMediaFile(
+                name = media_name,
+                path = media_path,
+                library_name = mock_library.name,
+                source = mock_library.source
+            ))
+        return generated_media
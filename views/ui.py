@@ -1,7 +1,18 @@
 import json
 import os
 import time
+from ..controllers import Daemon
+from ..controllers import DaemonClient
 from ..controllers import MainController
+from ..models import mirror_diff
+from ..models import BackupQueue
+from ..models import OrphanDeletionPolicy
+from ..models import ObjectStorage
+from ..models import PackStorage
+from ..models import RetryQueue
+from ..models import discrepancy_rules
+from ..models import Throttle
+from ..models import lower_process_priority
 
 class UI(object):
     def __init__(self, config_file_path):
@@ -12,24 +23,158 @@ class UI(object):
         self.mirror_checksum_discrepancy_count = None
         self.orphan_backup_media_count = None
         self.empty_directory_count = None
+        self.backup_failure_count = None
 
         #  Main controller
         self.controller = None
+        self.background_hashing = True
 
-    def load_controller(self):
+        #  Scans run in a daemon, if one is configured and listening (see 'run_daemon')
+        self.daemon_client = None
+
+    def load_controller(self, load_media=True, restore=False):
         #  Load settings from file
         config = json.load(open(self.config_file_path))
 
+        #  'backup_paths' lists every backup mirror
+        #  A single 'backup_path' is still accepted
+        if 'backup_paths' in config:
+            backup_paths = config['backup_paths']
+        else:
+            backup_paths = [config['backup_path']]
+
+        #  Pre-compute checksums while the main menu is idle, unless disabled
+        self.background_hashing = config.get('background_hashing', True)
+
+        #  Optional I/O limits for each mirror, as {'mirror_path': {limits}}
+        throttles = dict()
+        for mirror_path, limits in config.get('throttle', dict()).items():
+            throttles[mirror_path] = Throttle(**limits)
+
+        #  Failed backups are retried with backoff, as {'max_attempts': int, 'backoff_seconds': float}
+        retry_queue = RetryQueue(**config.get('retry', dict()))
+
+        #  The order new media is backed up in, as {'strategy': str, 'library_weights': {}, 'time_budget_seconds': float}
+        backup_queue = BackupQueue(**config.get('queue', dict()))
+
+        #  What to do when a backup mirror is too small for the new media, as {'when_full': str, 'reserve_bytes': int}
+        capacity_settings = config.get('capacity', dict())
+
+        #  Backup mirrors stored in pack files, as {'mirror_path': {'pack_size': int}}
+        storages = dict()
+        for mirror_path, pack_settings in config.get('pack', dict()).items():
+            storages[mirror_path] = PackStorage(mirror_path, **pack_settings)
+
+        #  Backup mirrors stored in an S3-compatible object store, as {'mirror_path': {'endpoint': str, 'bucket': str, ...}}
+        for mirror_path, object_store_settings in config.get('object_store', dict()).items():
+            storages[mirror_path] = ObjectStorage(mirror_path, **object_store_settings)
+
+        #  Overwritten backup media is kept as prior versions, as {'keep': bool, 'max_versions': int, 'max_age_days': float}
+        version_settings = dict(config.get('versions', dict()))
+        keep_versions = version_settings.pop('keep', True)
+
+        #  Backed up media gets parity to repair bit rot, as {'block_size': int, 'data_blocks': int, 'parity_blocks': int, 'workers': int}
+        parity_settings = config.get('parity')
+
+        #  Optionally lower the CPU and I/O priority of the whole process
+        if 'process_priority' in config:
+            lower_process_priority(**config['process_priority'])
+
         #  Load the controller
         self.controller = MainController(
             source_path=config['source_path'],
-            backup_path=config['backup_path'],
+            backup_paths=backup_paths,
             libraries=config['libraries'],
-            stale_cache_days=config['days_before_cache_is_stale']
+            stale_cache_days=config['days_before_cache_is_stale'],
+            throttles=throttles,
+            retry_queue=retry_queue,
+            backup_queue=backup_queue,
+            keep_versions=keep_versions,
+            version_retention=version_settings,
+            storages=storages,
+            parity=parity_settings,
+            **capacity_settings
         )
-        self.controller.load_mirrors()
+        self.controller.load_mirrors(load_media=load_media, restore=restore)
+        return self.controller
+
+    def run_daemon(self):
+        #  Keep the mirrors loaded, and run the scans of other main menus (see 'Daemon')
+        config = json.load(open(self.config_file_path))
+        daemon = Daemon(
+            load_controller=self.load_controller,
+            socket_path=config['daemon']['socket_path'],
+            background_hashing=config.get('background_hashing', True)
+        )
+        daemon.start()
+        print('Listening on {}'.format(daemon.socket_path))
+        daemon.serve_forever()
+
+    def run_watch(self):
+        #  Back up new media as it arrives, without the main menu (see 'watch_for_new_media')
+        self.load_controller(load_media=False)
+        self.watch_for_new_media()
+
+    def watch_for_new_media(self):
+        #  Watch settings are optional, as {'settle_seconds': float, 'poll_interval_seconds': float, 'polling': bool}
+        config = json.load(open(self.config_file_path))
+        print('Press Ctrl+C to stop watching')
+        try:
+            self.controller.watch_new_source_media(**config.get('watch', dict()))
+        except KeyboardInterrupt:
+            print('\nStopped watching')
+
+    def connect_to_daemon(self):
+        #  Use the daemon, if one is configured and listening; its counts are shown at once
+        config = json.load(open(self.config_file_path))
+        if 'daemon' not in config:
+            return
+        daemon_client = DaemonClient(config['daemon']['socket_path'])
+        try:
+            response = daemon_client.request('status')
+        except ConnectionError:
+            print('The daemon is not running; scans load the mirrors themselves\n')
+            return
+        self.daemon_client = daemon_client
+        if response['ok']:
+            self.update_counts_from_daemon(response['result']['counts'])
+
+    def scan_in_daemon(self, kind):
+        #  Description
+        #    Run a scan in the daemon, and print what it prints as it prints it
+        #  Guarantees
+        #    False is returned if no daemon is configured and listening; the scan must be run here instead
+        #    Once the daemon is gone, the main menu no longer uses it
+
+        if self.daemon_client is None:
+            return False
+        try:
+            response = self.daemon_client.request('scan', on_output=lambda text: print(text, end='', flush=True), kind=kind)
+        except ConnectionError:
+            print('The daemon is not running; scanning here\n')
+            self.daemon_client = None
+            return False
+        if response['ok']:
+            self.update_counts_from_daemon(response['result'])
+        else:
+            print('The scan failed: {}'.format(response['error']))
+        return True
+
+    def update_counts_from_daemon(self, counts):
+        #  Counts the daemon has not counted yet are left as they are
+        if counts['local_checksum_discrepancies'] is not None:
+            self.local_checksum_discrepancy_count = counts['local_checksum_discrepancies']
+        if counts['mirror_checksum_discrepancies'] is not None:
+            self.mirror_checksum_discrepancy_count = counts['mirror_checksum_discrepancies']
+        if counts['orphan_backup_media'] is not None:
+            self.orphan_backup_media_count = counts['orphan_backup_media']
+        if counts['empty_directories'] is not None:
+            self.empty_directory_count = counts['empty_directories']
+        if counts['backup_failures'] is not None:
+            self.backup_failure_count = counts['backup_failures']
 
     def main_menu(self):
+        self.connect_to_daemon()
         while True:
             input_string = (
                 '=== Main Menu ===' +
@@ -41,6 +186,10 @@ class UI(object):
                 '\n5. Resolve mirror checksum discrepancies [{1}]' +
                 '\n6. Delete orphaned media files from backup [{2}]' +
                 '\n7. Delete empty directories [{3}]' +
+                '\n8. Resolve checksum discrepancies in batch, using rules' +
+                '\n9. Retry failed backups [{4}]' +
+                '\n10. Restore libraries from backup' +
+                '\n11. Watch for new media, and back it up as it arrives' +
                 '\n...' +
                 '\n0. Exit' +
                 '\nChoose option: '
@@ -48,40 +197,64 @@ class UI(object):
                 'Run Regular/Full Scan to get count' if self.local_checksum_discrepancy_count is None else self.local_checksum_discrepancy_count,
                 'Run Regular/Full Scan to get count' if self.mirror_checksum_discrepancy_count is None else self.mirror_checksum_discrepancy_count,
                 'Run Regular/Full Scan to get count' if self.orphan_backup_media_count is None else self.orphan_backup_media_count,
-                'Run any scan to get count' if self.empty_directory_count is None else self.empty_directory_count
+                'Run any scan to get count' if self.empty_directory_count is None else self.empty_directory_count,
+                'Run any scan to get count' if self.backup_failure_count is None else self.backup_failure_count
             )
+            #  Pre-compute checksums while waiting for input
+            #  Prune prior versions of backup media while waiting, too
+            #  A daemon does both on the same mirrors, so they are left to it
+            if self.controller and self.daemon_client is None and self.background_hashing:
+                self.controller.start_background_hasher()
+            if self.controller and self.daemon_client is None:
+                self.controller.start_version_pruner()
             result = input(input_string)
+            if self.controller:
+                self.controller.stop_background_hasher()
+                self.controller.stop_version_pruner()
             if result is '1':
                 print('\n=== Quick Scan ===')
+                if self.scan_in_daemon('quick'):
+                    print('\nScan finished')
+                    print('')
+                    continue
                 time.sleep(1)
                 print('Reloading config: {}\n'.format(self.config_file_path))
-                self.load_controller()
+                self.load_controller(load_media=False)
                 self.controller.quick_scan()
+                self.backup_failure_count = self.controller.get_backup_failure_count()
                 self.orphan_backup_media_count = len(self.controller.get_orphan_backup_media())
                 self.empty_directory_count = self.controller.get_empty_directory_count()
                 print('\nScan finished')
                 print('')
             elif result is '2':
                 print('\n=== Regular Scan ===')
+                if self.scan_in_daemon('regular'):
+                    print('\nScan finished')
+                    print('')
+                    continue
                 time.sleep(1)
                 print('Reloading config: {}\n'.format(self.config_file_path))
                 self.load_controller()
                 self.controller.regular_scan()
+                self.backup_failure_count = self.controller.get_backup_failure_count()
                 self.local_checksum_discrepancy_count = len(self.controller.get_media_with_local_checksum_discrepancy())
-                self.mirror_checksum_discrepancy_count = len(self.controller.get_media_with_mirror_checksum_discrepancy())
-                self.orphan_backup_media_count = len(self.controller.get_orphan_backup_media())
+                self.update_mirror_difference_counts()
                 self.empty_directory_count = self.controller.get_empty_directory_count()
                 print('\nScan finished')
                 print('')
             elif result is '3':
                 print('\n=== Full Scan ===')
+                if self.scan_in_daemon('full'):
+                    print('\nScan finished')
+                    print('')
+                    continue
                 time.sleep(1)
                 print('Reloading config: {}\n'.format(self.config_file_path))
                 self.load_controller()
                 self.controller.full_scan()
+                self.backup_failure_count = self.controller.get_backup_failure_count()
                 self.local_checksum_discrepancy_count = len(self.controller.get_media_with_local_checksum_discrepancy())
-                self.mirror_checksum_discrepancy_count = len(self.controller.get_media_with_mirror_checksum_discrepancy())
-                self.orphan_backup_media_count = len(self.controller.get_orphan_backup_media())
+                self.update_mirror_difference_counts()
                 self.empty_directory_count = self.controller.get_empty_directory_count()
                 print('\nScan finished')
                 print('')
@@ -92,8 +265,7 @@ class UI(object):
                 self.load_controller()
                 self.resolve_local_checksum_discrepancy_menu()
                 self.local_checksum_discrepancy_count = len(self.controller.get_media_with_local_checksum_discrepancy())
-                self.mirror_checksum_discrepancy_count = len(self.controller.get_media_with_mirror_checksum_discrepancy())
-                self.orphan_backup_media_count = len(self.controller.get_orphan_backup_media())
+                self.update_mirror_difference_counts()
                 self.empty_directory_count = self.controller.get_empty_directory_count()
                 print('')
             elif result is '5':
@@ -103,8 +275,7 @@ class UI(object):
                 self.load_controller()
                 self.resolve_mirror_checksum_discrepancy_menu()
                 self.local_checksum_discrepancy_count = len(self.controller.get_media_with_local_checksum_discrepancy())
-                self.mirror_checksum_discrepancy_count = len(self.controller.get_media_with_mirror_checksum_discrepancy())
-                self.orphan_backup_media_count = len(self.controller.get_orphan_backup_media())
+                self.update_mirror_difference_counts()
                 self.empty_directory_count = self.controller.get_empty_directory_count()
                 print('')
             elif result is '6':
@@ -112,11 +283,9 @@ class UI(object):
                 time.sleep(1)
                 print('Reloading config: {}\n'.format(self.config_file_path))
                 self.load_controller()
-                print('Deleting orphan backup media...')
-                self.controller.delete_orphan_backup_media()
+                self.delete_orphan_backup_media_menu()
                 self.local_checksum_discrepancy_count = len(self.controller.get_media_with_local_checksum_discrepancy())
-                self.mirror_checksum_discrepancy_count = len(self.controller.get_media_with_mirror_checksum_discrepancy())
-                self.orphan_backup_media_count = len(self.controller.get_orphan_backup_media())
+                self.update_mirror_difference_counts()
                 self.empty_directory_count = self.controller.get_empty_directory_count()
                 print('')
             elif result is '7':
@@ -128,11 +297,52 @@ class UI(object):
                 self.controller.delete_empty_directories()
                 self.empty_directory_count = self.controller.get_empty_directory_count()
                 print('')
+            elif result == '8':
+                print('\n=== Resolve Checksum Discrepancies In Batch ===')
+                time.sleep(1)
+                print('Reloading config: {}\n'.format(self.config_file_path))
+                self.load_controller()
+                self.resolve_checksum_discrepancies_in_batch_menu()
+                self.local_checksum_discrepancy_count = len(self.controller.get_media_with_local_checksum_discrepancy())
+                self.update_mirror_difference_counts()
+                print('')
+            elif result == '9':
+                print('\n=== Retry Failed Backups ===')
+                time.sleep(1)
+                print('Reloading config: {}\n'.format(self.config_file_path))
+                self.load_controller(load_media=False)
+                self.controller.retry_backup_failures()
+                self.backup_failure_count = self.controller.get_backup_failure_count()
+                print('')
+            elif result == '10':
+                print('\n=== Restore Libraries From Backup ===')
+                time.sleep(1)
+                print('Reloading config: {}\n'.format(self.config_file_path))
+                self.load_controller(restore=True)
+                self.restore_libraries_menu()
+                self.local_checksum_discrepancy_count = None
+                self.update_mirror_difference_counts()
+                self.empty_directory_count = self.controller.get_empty_directory_count()
+                print('')
+            elif result == '11':
+                print('\n=== Watch For New Media ===')
+                time.sleep(1)
+                print('Reloading config: {}\n'.format(self.config_file_path))
+                self.load_controller(load_media=False)
+                self.watch_for_new_media()
+                self.backup_failure_count = self.controller.get_backup_failure_count()
+                print('')
             elif result is '0':
                 exit()
             else:
                 print('')
 
+    def update_mirror_difference_counts(self):
+        #  Count mirror checksum discrepancies and orphan backup media in one pass over the mirrors
+        differences = self.controller.get_mirror_differences([mirror_diff.DIFF_MISMATCH, mirror_diff.DIFF_ORPHAN])
+        self.mirror_checksum_discrepancy_count = len([item for item in differences if item['status'] == mirror_diff.DIFF_MISMATCH])
+        self.orphan_backup_media_count = len([item for item in differences if item['status'] == mirror_diff.DIFF_ORPHAN])
+
     def resolve_local_checksum_discrepancy_menu(self):
         local_checksum_discrepancies = self.controller.get_media_with_local_checksum_discrepancy()
         if len(local_checksum_discrepancies) is 0:
@@ -142,7 +352,8 @@ class UI(object):
                 self.controller.resolve_local_checksum_discrepancy(
                     is_source=item['source'],
                     library_name=item['library_name'],
-                    path_in_library=item['path_in_library']
+                    path_in_library=item['path_in_library'],
+                    mirror_path=item['mirror_path']
                 )
 
     def resolve_mirror_checksum_discrepancy_menu(self):
@@ -153,5 +364,103 @@ class UI(object):
             for item in self.controller.get_media_with_mirror_checksum_discrepancy():
                 self.controller.resolve_mirror_checksum_discrepancy(
                     library_name=item['library_name'],
-                    path_in_library=item['path_in_library']
+                    path_in_library=item['path_in_library'],
+                    mirror_path=item['mirror_path']
                 )
+
+    def delete_orphan_backup_media_menu(self):
+        input_string = (
+            '1. Review each orphan file' +
+            '\n2. Delete orphan files in bulk, using rules' +
+            '\n3. Cancel' +
+            '\nChoose an option: '
+        )
+        result = input(input_string)
+        if result == '1':
+            print('Deleting orphan backup media...')
+            self.controller.delete_orphan_backup_media()
+        elif result == '2':
+            policy = self.read_orphan_deletion_policy()
+            plan = self.controller.plan_orphan_deletion(policy)
+            if len(plan) == 0:
+                print('No orphan files match the rules')
+                return
+            print('Orphan files to delete:')
+            self.controller.print_orphan_deletion_plan(plan)
+            if input('Type "delete" to delete these files: ') == 'delete':
+                results = self.controller.execute_orphan_deletion(plan)
+                failed_results = [item for item in results if not item.success]
+                for item in failed_results:
+                    print('Could not delete: {0}\n{1}'.format(item.subject, item.message))
+                print('{0} deleted, {1} failed'.format(len(results) - len(failed_results), len(failed_results)))
+
+    def read_orphan_deletion_policy(self):
+        #  Each rule is optional; leave the answer blank to skip the rule
+        print('Rules for bulk deletion. Leave blank to skip a rule.')
+        min_age_days = self.read_number('Only delete files last modified at least this many days ago: ')
+        min_size_mb = self.read_number('Only delete files of at least this many MB: ')
+        max_size_mb = self.read_number('Only delete files of at most this many MB: ')
+        globs = input('Only delete files matching one of these patterns (comma separated, e.g. *.avi): ').strip()
+        missing_from_rename_index = input('Keep orphan files that were renamed or moved in the source? [y/N]: ').strip().lower() == 'y'
+        return OrphanDeletionPolicy(
+            min_age_days=min_age_days,
+            min_size=int(min_size_mb * 1048576) if min_size_mb is not None else None,
+            max_size=int(max_size_mb * 1048576) if max_size_mb is not None else None,
+            globs=[pattern.strip() for pattern in globs.split(',')] if globs else None,
+            missing_from_rename_index=missing_from_rename_index
+        )
+
+    def read_number(self, prompt):
+        while True:
+            result = input(prompt).strip()
+            if result == '':
+                return None
+            try:
+                return float(result)
+            except ValueError:
+                print('Enter a number, or leave blank to skip')
+
+    def resolve_checksum_discrepancies_in_batch_menu(self):
+        #  Choose the rules, in the order they should be applied
+        for index, (rule_name, _) in enumerate(discrepancy_rules.RULES):
+            print('{0}. {1}'.format(index + 1, rule_name))
+        result = input('Choose rules, in order (comma separated, e.g. 1,2): ')
+        rules = []
+        for item in result.split(','):
+            if item.strip().isdigit() and 0 < int(item) <= len(discrepancy_rules.RULES):
+                rules.append(discrepancy_rules.RULES[int(item) - 1][1])
+        if len(rules) == 0:
+            print('No rules chosen')
+            return
+
+        plan, unresolved = self.controller.plan_discrepancy_resolution(rules)
+        print('Planned actions:')
+        self.controller.print_discrepancy_plan(plan, unresolved)
+        if len(plan) > 0 and input('Type "resolve" to carry out these actions: ') == 'resolve':
+            report = self.controller.execute_discrepancy_plan(plan)
+            self.controller.print_discrepancy_report(report)
+
+    def restore_libraries_menu(self):
+        #  Choose the libraries to restore from the primary backup mirror
+        for index, library_name in enumerate(self.controller.libraries):
+            print('{0}. {1}'.format(index + 1, library_name))
+        result = input('Choose libraries (comma separated, e.g. 1,2), or leave blank for all: ')
+        library_names = []
+        for item in result.split(','):
+            if item.strip().isdigit() and 0 < int(item) <= len(self.controller.libraries):
+                library_names.append(self.controller.libraries[int(item) - 1])
+        if result.strip() != '' and len(library_names) == 0:
+            print('No libraries chosen')
+            return
+
+        plan = self.controller.plan_restore(library_names or None)
+        print('Media missing from the source:')
+        self.controller.print_restore_plan(plan)
+        if len(plan) > 0 and input('Type "restore" to copy these files from backup: ') == 'restore':
+            workers = self.read_number('Number of parallel copies (leave blank for 4): ')
+            report = self.controller.execute_restore(
+                plan,
+                workers=int(workers) if workers else 4,
+                callback_on_progress=self.controller.on_restore_progress
+            )
+            self.controller.print_restore_report(report)